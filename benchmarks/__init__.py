@@ -0,0 +1 @@
+"""Benchmarks of the scraper and the API. See benchmarks/harness.py."""
@@ -0,0 +1,198 @@
+"""Benchmarks of one scrape tick and of its steps: splitting and parsing a
+recorded output3.txt body, preparing its rows, storing them through the ORM
+and as one bulk insert, and a full tick (fetch from a local stub of the DMV
+site, parse and ingest) for both a cron-style scraper (a new Ingestor every
+tick) and a long-lived one. For example,
+
+$ python -m benchmarks.bench_ingest
+$ python -m benchmarks.bench_ingest --db postgresql://localhost/cadmv_bench
+
+The database steps run on a fresh SQLite file by default. Every --db is a
+scratch database: its tables are dropped and created again.
+"""
+import argparse
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks import harness
+from cadmv import dmv
+import cadmv.helper.data as data
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+import cadmv.queries as queries
+
+
+RESPONSE_PATH = os.path.join(
+    os.path.dirname(__file__), os.pardir, 'cadmv', 'test', 'data',
+    'response.txt')
+
+description = 'Benchmarks the steps of a scrape tick.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--db', action='append', dest='urls',
+                    help='database URL to run the database benchmarks on '
+                         '(repeatable). Its tables are dropped! Defaults to '
+                         'a temporary SQLite file')
+parser.add_argument('--body', action='store', dest='body',
+                    default=RESPONSE_PATH,
+                    help='recorded output3.txt body to serve and parse')
+parser.add_argument('--rounds', action='store', dest='rounds', type=int,
+                    default=10, help='timed rounds per benchmark')
+parser.add_argument('--compare', action='store', dest='compare',
+                    help='results file of an earlier run to compare with')
+parser.add_argument('--threshold', action='store', dest='threshold',
+                    type=float, default=harness.THRESHOLD,
+                    help='ratio of the medians reported as a regression')
+parser.add_argument('--output', action='store', dest='output',
+                    help='file to write the results to, by default one per '
+                         'database under benchmarks/results')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the recorded body"""
+
+    body = b''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub(body):
+    """Serves body on a local port in a background thread
+
+    :return:    (tuple) of the server and the URL of output3.txt on it
+    """
+    handler = type('Handler', (StubHandler,), {'body': body})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f'http://{host}:{port}/output3.txt'
+
+
+def prepare_database(url):
+    """Creates the tables of a scratch database and fills the branches
+
+    :return:    SQLAlchemy sessionmaker
+    """
+    engine = create_engine(url)
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+    session.add_all([models.Branch(**b) for b in data.prep_branches_data()])
+    session.commit()
+    session.close()
+    return Session
+
+
+def bulk_insert(session, wait_times):
+    """Stores wait times as one executemany insert, the alternative to the
+    ORM units of work of queries.create_wait_times()
+    """
+    session.execute(models.WaitTime.__table__.insert(), wait_times)
+    session.commit()
+    session.close()
+
+
+def parse_benchmarks(suite, text, rounds):
+    """Benchmarks the steps that don't touch the database"""
+    _, rows = data.split_response(text)
+    lines = text[re.search(r'\d+,\d+,\d+', text).start():].split('\r\n')
+    now = datetime.datetime.now()
+
+    suite.run('split_response', lambda: data.split_response(text), rounds)
+    suite.run('parse_wait_time_list',
+              lambda: data.parse_wait_time_list(lines), rounds, number=10)
+    suite.run('prep_wait_times_data',
+              lambda: data.prep_wait_times_data(rows, now), rounds,
+              number=100)
+    return rows
+
+
+def database_benchmarks(suite, Session, rows, url, rounds):
+    """Benchmarks storing wait times and full ticks against a stub of the DMV
+    site serving the recorded body
+    """
+    ticks = itertools.count()
+
+    def scrape():
+        timestamp = datetime.datetime(2019, 1, 7, 9) \
+            + datetime.timedelta(minutes=2 * next(ticks))
+        return data.prep_wait_times_data(rows, timestamp)
+
+    suite.run('create_wait_times[orm]',
+              lambda wait_times: queries.create_wait_times(
+                  Session(), wait_times), rounds, setup=scrape)
+    suite.run('create_wait_times[bulk]',
+              lambda wait_times: bulk_insert(Session(), wait_times), rounds,
+              setup=scrape)
+
+    ingestor = Ingestor(Session)
+    suite.run('tick[cron]',
+              lambda: Ingestor(Session).ingest(dmv.get_wait_times(
+                  url, timeout=10)), rounds)
+    suite.run('tick[loop]',
+              lambda: ingestor.ingest(dmv.get_wait_times(url, timeout=10)),
+              rounds)
+
+
+def main():
+    args = parser.parse_args()
+    # The stub serves the same body every tick, which the anomaly detection
+    # would otherwise keep warning about
+    logging.getLogger('cadmv').setLevel(logging.ERROR)
+    with open(args.body, 'rb') as f:
+        body = f.read()
+    text = body.decode('utf-8')
+
+    urls = args.urls
+    tmp_db = None
+    if not urls:
+        tmp_db = os.path.join(tempfile.gettempdir(), 'cadmv_bench.db')
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        urls = ['sqlite:///' + tmp_db]
+
+    server, stub_url = start_stub(body)
+    regressed = False
+    try:
+        for url in urls:
+            dialect = url.split(':', 1)[0].split('+', 1)[0]
+            print(f'\n{dialect}:')
+            suite = harness.Suite(
+                'ingest', {'label': dialect, 'database': dialect,
+                           'body_bytes': len(body)})
+            rows = parse_benchmarks(suite, text, args.rounds)
+            database_benchmarks(
+                suite, prepare_database(url), rows, stub_url, args.rounds)
+            print(f'Results written to {suite.save(args.output)}')
+            if args.compare:
+                regressed = harness.print_comparison(
+                    harness.load(args.compare), suite.to_dict(),
+                    args.threshold) or regressed
+    finally:
+        server.shutdown()
+        if tmp_db is not None and os.path.exists(tmp_db):
+            os.remove(tmp_db)
+
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+"""Benchmarks every read query of cadmv.queries against the synthetic data
+of benchmarks/synthetic.py, reporting latency percentiles and the plan of
+every statement a query runs. On PostgreSQL the plans come from EXPLAIN
+ANALYZE and include the rows scanned; SQLite's EXPLAIN QUERY PLAN only
+tells full scans from index searches. For example,
+
+$ python -m benchmarks.synthetic --years 1 --derived
+$ python -m benchmarks.bench_queries
+$ python -m benchmarks.bench_queries --query get_wait_time_by_date --explain
+
+Queries of cadmv.queries without a case in CASES are listed, so that new
+ones get a benchmark.
+"""
+import argparse
+import datetime
+from collections import namedtuple
+import inspect
+import logging
+import sys
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks import harness
+from benchmarks.synthetic import DEFAULT_DB
+from cadmv.catalog import Catalog
+from cadmv.hours import OpeningHours
+from cadmv import profiling
+import cadmv.queries as queries
+
+
+# The arguments the cases are built from, derived from the loaded data
+Context = namedtuple('Context', [
+    'number', 'region', 'first', 'last', 'day', 'week', 'version', 'hours'])
+
+DAY = datetime.timedelta(days=1)
+
+# Benchmark name: function of a sessionmaker and a Context running one query
+CASES = {
+    'get_branch_by_number': lambda S, c: queries.get_branch_by_number(
+        S(), c.number),
+    'get_branches_by_region': lambda S, c: queries.get_branches_by_region(
+        S(), c.region),
+    'is_branch_in_database': lambda S, c: queries.is_branch_in_database(
+        S(), c.number),
+    'get_all_branches': lambda S, c: queries.get_all_branches(S()),
+    'get_wait_time_by_number': lambda S, c: queries.get_wait_time_by_number(
+        S(), c.number),
+    'get_wait_time_by_date': lambda S, c: queries.get_wait_time_by_date(
+        S(), c.day),
+    'get_wait_times_by_region': lambda S, c:
+        queries.get_wait_times_by_region(S(), c.region),
+    'get_latest_timestamp': lambda S, c: queries.get_latest_timestamp(S()),
+    'get_first_timestamp': lambda S, c: queries.get_first_timestamp(S()),
+    'get_current_wait_times': lambda S, c: queries.get_current_wait_times(
+        S()),
+    'get_current_wait_times[region]': lambda S, c:
+        queries.get_current_wait_times(S(), region=c.region),
+    'get_recent_scrapes': lambda S, c: queries.get_recent_scrapes(S(), 30),
+    'get_wait_times_by_range[week]': lambda S, c:
+        queries.get_wait_times_by_range(S(), c.number, c.week, c.last),
+    'get_open_wait_time_samples[day]': lambda S, c:
+        queries.get_open_wait_time_samples(S(), c.day, c.day + DAY),
+    'get_scrape_times[day]': lambda S, c: queries.get_scrape_times(
+        S(), c.day, c.day + DAY),
+    'get_latest_snapshot_version': lambda S, c:
+        queries.get_latest_snapshot_version(S()),
+    'get_changes_since[30]': lambda S, c: queries.get_changes_since(
+        S(), c.version - 30),
+    'get_changes_since[full]': lambda S, c: queries.get_changes_since(S()),
+    'get_sketches[week]': lambda S, c: queries.get_sketches(
+        S(), c.week, c.last, c.number),
+    'get_wait_time_percentiles[30 days]': lambda S, c:
+        queries.get_wait_time_percentiles(
+            S(), c.number, c.last - 30 * DAY, c.last),
+    'get_region_trends[30 days]': lambda S, c: queries.get_region_trends(
+        S(), c.last - 30 * DAY, c.last, c.region),
+    'get_heatmap_cells': lambda S, c: queries.get_heatmap_cells(
+        S(), branch_num=c.number),
+    'get_heatmap_cells[region]': lambda S, c: queries.get_heatmap_cells(
+        S(), region=c.region),
+    'get_coverage[week]': lambda S, c: queries.get_coverage(
+        S(), c.week.date(), c.last.date()),
+    'get_gaps[week]': lambda S, c: queries.get_gaps(
+        S(), c.week, c.last, c.number, c.hours),
+}
+
+
+def read_functions():
+    """Returns the names of the read queries of cadmv.queries"""
+    return sorted(
+        name for name, func in inspect.getmembers(queries, inspect.isfunction)
+        if func.__module__ == queries.__name__
+        and name.startswith(('get_', 'is_')))
+
+
+def build_context(Session):
+    """Picks the arguments of the cases from the loaded data"""
+    catalog = Catalog.from_session(Session())
+    branch = queries.get_branch_by_number(
+        Session(), int(catalog.numbers[len(catalog) // 2]))
+    last = queries.get_latest_timestamp(Session())
+    first = queries.get_first_timestamp(Session())
+    day = datetime.datetime.combine(
+        (first + (last - first) / 2).date(), datetime.time())
+    version = queries.get_latest_snapshot_version(Session())
+    return Context(branch.number, branch.region, first, last, day,
+                   last - 7 * DAY, version, OpeningHours(catalog))
+
+
+class StatementLog:
+    """Records the statements run on an engine while it is active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._record)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if not executemany and (statement, parameters) not in self.statements:
+            self.statements.append((statement, parameters))
+
+
+def explain(engine, statement, parameters):
+    """Explains one statement with its parameters, with EXPLAIN ANALYZE on
+    PostgreSQL, see cadmv.profiling.explain()
+    """
+    raw = engine.raw_connection()
+    try:
+        return profiling.explain(raw.cursor(), engine.dialect.name, statement,
+                                 parameters, analyze=True)
+    finally:
+        raw.rollback()
+        raw.close()
+
+
+description = 'Benchmarks the read queries against the synthetic data.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--db', action='store', dest='url',
+                    default='sqlite:///' + DEFAULT_DB,
+                    help='database loaded by benchmarks.synthetic')
+parser.add_argument('--query', action='append', dest='queries',
+                    help='benchmark to run (repeatable), default all')
+parser.add_argument('--calls', action='store', dest='calls', type=int,
+                    default=20, help='largest number of calls per query')
+parser.add_argument('--budget', action='store', dest='budget', type=float,
+                    default=10, help='seconds after which a query stops '
+                                     'being called')
+parser.add_argument('--explain', action='store_true', dest='explain',
+                    help='print the plans of the statements')
+parser.add_argument('--compare', action='store', dest='compare',
+                    help='results file of an earlier run to compare with')
+parser.add_argument('--threshold', action='store', dest='threshold',
+                    type=float, default=harness.THRESHOLD,
+                    help='ratio of the medians reported as a regression')
+parser.add_argument('--output', action='store', dest='output',
+                    help='file to write the results to, by default under '
+                         'benchmarks/results')
+
+
+def main():
+    args = parser.parse_args()
+    logging.getLogger('cadmv').setLevel(logging.ERROR)
+    engine = create_engine(args.url)
+    Session = sessionmaker(bind=engine)
+    if queries.get_latest_timestamp(Session()) is None:
+        sys.exit(f'No wait times in {args.url}, load them with '
+                 'python -m benchmarks.synthetic')
+
+    covered = {name.split('[')[0] for name in CASES}
+    for name in read_functions():
+        if name not in covered:
+            print(f'No benchmark for queries.{name}')
+
+    context = build_context(Session)
+    dialect = engine.dialect.name
+    with engine.connect() as conn:
+        rows = conn.execute(text('SELECT COUNT(*) FROM wait_times')).scalar()
+    suite = harness.Suite('queries', {'label': dialect, 'database': dialect,
+                                      'wait_times': rows})
+    print(f'{rows} wait times on {dialect}\n')
+    print(f"{'query':<36} {'p50':>10} {'p90':>10} {'p99':>10}  plan")
+
+    for name in args.queries or CASES:
+        run = CASES[name]
+        result = harness.sample(lambda: run(Session, context), args.calls,
+                                args.budget)
+        with StatementLog(engine) as log:
+            run(Session, context)
+        plans = [explain(engine, statement, parameters)
+                 for statement, parameters in log.statements]
+        result['statements'] = len(plans)
+        result['full_scans'] = sum(plan['full_scan'] for plan in plans)
+        scanned = [plan['rows_scanned'] for plan in plans
+                   if plan['rows_scanned'] is not None]
+        result['rows_scanned'] = sum(scanned) if scanned else None
+        result['plans'] = [plan['plan'] for plan in plans]
+        suite.add(name, result)
+
+        notes = f"{result['full_scans']} full scan(s)" \
+            if result['full_scans'] else 'indexed'
+        if result['rows_scanned'] is not None:
+            notes += f", {result['rows_scanned']} rows scanned"
+        print(f"{name:<36} "
+              + ' '.join(f'{harness.format_seconds(result[p]):>10}'
+                         for p in ('p50', 'p90', 'p99'))
+              + f'  {notes}')
+        if args.explain:
+            for (statement, _), plan in zip(log.statements, plans):
+                print('    ' + ' '.join(statement.split())[:200])
+                for line in plan['plan']:
+                    print('      ' + line)
+
+    print(f'\nResults written to {suite.save(args.output)}')
+    if args.compare and harness.print_comparison(
+            harness.load(args.compare), suite.to_dict(), args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
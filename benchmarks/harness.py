@@ -0,0 +1,223 @@
+"""A small stdlib benchmark harness.
+
+Every benchmark is a function timed over a number of rounds of a few calls
+each, after a warm-up call. The per-call timings of a run are written to a
+JSON file named after the commit they were measured on, so a run can be
+compared against the results of an earlier commit:
+
+$ python -m benchmarks.bench_ingest
+$ python -m benchmarks.bench_ingest --compare benchmarks/results/<old>.json
+"""
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+# A benchmark is reported as a regression when its median is this many times
+# the median of the compared run
+THRESHOLD = 1.1
+
+
+def git_commit():
+    """Returns the current commit, with a '-dirty' suffix when the tree has
+    changes, or 'unknown' outside of a git checkout
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + '-dirty' if dirty else commit
+
+
+def measure(func, rounds=10, number=1, setup=None):
+    """Times func
+
+    :param func:    (callable) taking no arguments, or the value returned by
+                    setup
+    :param rounds:  (int) number of timed rounds
+    :param number:  (int) calls per round
+    :param setup:   (callable) called untimed before every round, its return
+                    value is passed to func, or None
+    :return:        (dict) of statistics of the seconds per call
+    """
+    args = () if setup is None else (setup(),)
+    func(*args)
+
+    timings = []
+    for _ in range(rounds):
+        args = () if setup is None else (setup(),)
+        started = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        timings.append((time.perf_counter() - started) / number)
+
+    timings.sort()
+    return {
+        'rounds': rounds,
+        'number': number,
+        'min': timings[0],
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'stdev': statistics.stdev(timings) if rounds > 1 else 0.0,
+        'p95': percentile(timings, 95),
+        'max': timings[-1],
+    }
+
+
+def percentile(values, pct):
+    """Returns the pct-th percentile of sorted values"""
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def sample(func, calls=20, budget=None):
+    """Times single calls of func, e.g. of a query whose latency
+    distribution matters
+
+    :param func:    (callable) taking no arguments
+    :param calls:   (int) largest number of timed calls
+    :param budget:  (float) seconds after which no more calls are made (at
+                    least 3 are), or None
+    :return:        (dict) of statistics of the seconds per call, including
+                    its p50, p90 and p99
+    """
+    func()
+
+    timings = []
+    spent = 0.0
+    while len(timings) < calls:
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+        spent += timings[-1]
+        if budget is not None and spent >= budget and len(timings) >= 3:
+            break
+
+    timings.sort()
+    return {
+        'calls': len(timings),
+        'min': timings[0],
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'p50': percentile(timings, 50),
+        'p90': percentile(timings, 90),
+        'p99': percentile(timings, 99),
+        'max': timings[-1],
+    }
+
+
+class Suite:
+    """Collects the results of the benchmarks of one run
+
+    :param name:    (str) name of the suite, part of the results file name
+    :param context: (dict) extra details of the run to store, e.g. the
+                    database
+    """
+
+    def __init__(self, name, context=None):
+        self.name = name
+        self.context = context or {}
+        self.results = {}
+
+    def run(self, name, func, rounds=10, number=1, setup=None):
+        """Times func (see measure()) and prints its median"""
+        result = measure(func, rounds, number, setup)
+        self.results[name] = result
+        print(f"{name:<40} {format_seconds(result['median']):>10} "
+              f"(min {format_seconds(result['min'])}, "
+              f"{rounds} x {number})")
+        return result
+
+    def add(self, name, result):
+        """Stores a result measured elsewhere, e.g. by sample()"""
+        self.results[name] = result
+        return result
+
+    def to_dict(self):
+        return {
+            'suite': self.name,
+            'commit': git_commit(),
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'context': self.context,
+            'benchmarks': self.results,
+        }
+
+    def save(self, path=None):
+        """Writes the results to path, by default
+        RESULTS_DIR/<suite>-<label>-<commit>.json where label is the context's
+        label if it has one
+
+        :return:    (str) the path written to
+        """
+        data = self.to_dict()
+        if path is None:
+            label = self.context.get('label')
+            parts = [self.name] + ([label] if label else []) + [data['commit']]
+            os.makedirs(RESULTS_DIR, exist_ok=True)
+            path = os.path.join(RESULTS_DIR, '-'.join(parts) + '.json')
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        return path
+
+
+def format_seconds(seconds):
+    """Formats a duration with a unit suited to its size"""
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f'{seconds / scale:.2f} {unit}'
+    return f'{seconds / 1e-9:.0f} ns'
+
+
+def compare(old, new, threshold=THRESHOLD):
+    """Compares the medians of two runs
+
+    :param old:         (dict) results of the earlier run, see Suite.to_dict()
+    :param new:         (dict) results of the later run
+    :param threshold:   (float) ratio of the medians from which a benchmark
+                        is a regression
+    :return:            (list) of (name, old median, new median, ratio,
+                        regressed) tuples of the benchmarks in both runs
+    """
+    rows = []
+    for name, result in new['benchmarks'].items():
+        if name not in old['benchmarks']:
+            continue
+        before = old['benchmarks'][name]['median']
+        after = result['median']
+        ratio = after / before if before else float('inf')
+        rows.append((name, before, after, ratio, ratio >= threshold))
+    return rows
+
+
+def print_comparison(old, new, threshold=THRESHOLD):
+    """Prints compare() as a table
+
+    :return:    (bool) True if any benchmark regressed
+    """
+    print(f"\nCompared with {old['commit']} ({old['created']}):")
+    regressed = False
+    for name, before, after, ratio, slower in compare(old, new, threshold):
+        regressed = regressed or slower
+        print(f"{name:<40} {format_seconds(before):>10} -> "
+              f"{format_seconds(after):>10} {ratio:6.2f}x"
+              f"{'  REGRESSION' if slower else ''}")
+    return regressed
+
+
+def load(path):
+    """Reads results written by Suite.save()"""
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,266 @@
+"""Deterministic synthetic wait times at production sizes.
+
+Every branch of offices.py (or the first --branches of them) gets a wait
+time every 2 minutes of every day, shaped like the real feed: zero while
+the branch is closed, a late morning and an early afternoon peak, busier
+Mondays and Fridays, a yearly swing, a per-branch level and day-to-day and
+tick-to-tick noise. Waits change in steps, as the DMV's do, and about
+SKIPPED of the scrapes are dropped to leave gaps. A day is generated from
+the seed and its date alone, so the same arguments always give the same
+rows, in any order and in any chunking.
+
+The rows are bulk loaded (see cadmv.bulk) along with one snapshot per
+scrape, and with --derived also the sketches, heatmaps and coverage bitmaps
+the scraper would have kept. For example,
+
+$ python -m benchmarks.synthetic --years 1
+$ python -m benchmarks.synthetic --db postgresql://localhost/cadmv_bench \
+      --years 3 --derived
+"""
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import bulk
+from cadmv.catalog import Catalog
+from cadmv import coverage
+from cadmv import heatmap
+from cadmv.hours import OpeningHours
+import cadmv.helper.data as data
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv import sketch
+
+
+DEFAULT_DB = os.path.join(tempfile.gettempdir(), 'cadmv_synthetic.db')
+START = datetime.date(2019, 1, 1)
+SEED = 0
+
+TICKS = 24 * 60 // 2
+# Share of the scrapes that fail
+SKIPPED = 0.005
+# Busyness of Monday through Sunday
+WEEKDAY_FACTORS = np.array([1.3, 1.0, 0.95, 1.0, 1.15, 0.8, 0.8])
+
+
+def daily_shape():
+    """Returns the busyness of every tick of a day, peaking late in the
+    morning and after lunch
+    """
+    hours = np.arange(TICKS) * 2 / 60
+    return 0.4 + np.exp(-(hours - 11) ** 2 / 3) \
+        + 0.7 * np.exp(-(hours - 14.5) ** 2 / 2)
+
+
+class Generator:
+    """Generates the wait times of the branches of a catalog
+
+    :param catalog: (Catalog) of the branches
+    :param seed:    (int) seed of the branch levels and of every day
+    """
+
+    def __init__(self, catalog, seed=SEED):
+        self.catalog = catalog
+        self.seed = seed
+        self.hours = OpeningHours(catalog)
+        self.shape = daily_shape()
+        rng = np.random.default_rng([seed, 0])
+        n = len(catalog)
+        self.appt_levels = rng.uniform(1, 12, n)
+        self.non_appt_levels = rng.uniform(8, 60, n)
+
+    def day(self, date):
+        """Generates the scrapes of one day
+
+        :param date:    (datetime.date) the day
+        :return:        (dict) of column arrays of the wait times, in
+                        scrape order: branch_id, appt, non_appt, timestamp
+                        (numpy.datetime64) and is_open
+        """
+        rng = np.random.default_rng([self.seed, date.toordinal()])
+        n = len(self.catalog)
+        ticks = np.flatnonzero(rng.random(TICKS) >= SKIPPED)
+
+        # Scrapes land a few seconds after their slot starts
+        offsets = ticks * 120 + rng.integers(0, 8, len(ticks))
+        timestamps = np.datetime64(date, 's') + offsets.astype('m8[s]')
+        minutes = ticks * 2
+        is_open = self.hours.bitmap[:, date.weekday(), minutes].T
+
+        season = 1 + 0.15 * np.sin(2 * np.pi * date.timetuple().tm_yday / 365)
+        busyness = self.shape[ticks, None] * WEEKDAY_FACTORS[date.weekday()] \
+            * season * rng.lognormal(0, 0.25, n)[None, :]
+        # The feed only changes every few scrapes
+        noise = np.repeat(rng.lognormal(0, 0.2, (len(ticks) // 5 + 1, n)),
+                          5, axis=0)[:len(ticks)]
+        waits = [
+            np.where(is_open, np.round(levels * busyness * noise), 0)
+            .astype(np.int32)
+            for levels in (self.appt_levels, self.non_appt_levels)
+        ]
+
+        return {
+            'branch_id': np.tile(self.catalog.numbers, len(ticks)),
+            'appt': waits[0].ravel(),
+            'non_appt': waits[1].ravel(),
+            'timestamp': np.repeat(timestamps, n),
+            'is_open': is_open.ravel(),
+        }
+
+
+def snapshot_columns(columns, n, previous=None):
+    """Builds the snapshots of a day of scrapes
+
+    :param columns:     (dict) of column arrays, see Generator.day()
+    :param n:           (int) branches per scrape
+    :param previous:    (numpy.ndarray) of the (n, 2) waits of the scrape
+                        before the day, or None
+    :return:            (tuple) of the snapshot column arrays and the waits
+                        of the day's last scrape
+    """
+    branch_ids = columns['branch_id'].reshape(-1, n)
+    waits = np.stack([columns['appt'], columns['non_appt']],
+                     axis=1).reshape(-1, n, 2)
+    changes = []
+    for scrape in range(len(waits)):
+        current = waits[scrape]
+        if previous is None:
+            diff = {'added': np.column_stack(
+                [branch_ids[scrape], current]).tolist(),
+                'changed': [], 'removed': []}
+        else:
+            changed = np.flatnonzero(np.any(current != previous, axis=1))
+            diff = {'added': [], 'changed': np.column_stack(
+                [branch_ids[scrape, changed], current[changed]]).tolist(),
+                'removed': []}
+        changes.append(json.dumps(diff, separators=(',', ':')))
+        previous = current
+
+    fetched_at = columns['timestamp'][::n]
+    return {'fetched_at': fetched_at, 'changes': changes}, previous
+
+
+def derived(columns, day_coverage, cells, Session):
+    """Adds a day of wait times to the sketches, the heatmap cells and the
+    coverage bitmaps, like the scraper would have
+    """
+    timestamps = columns['timestamp']
+    day_coverage.update(coverage.build(columns['branch_id'], timestamps))
+
+    usable = columns['is_open']
+    args = (columns['branch_id'][usable], timestamps[usable],
+            columns['appt'][usable], columns['non_appt'][usable])
+    for key, (count, appt_sum, non_appt_sum) in heatmap.build(*args).items():
+        cell = cells.setdefault(key, [0, 0.0, 0.0])
+        cell[0] += count
+        cell[1] += appt_sum
+        cell[2] += non_appt_sum
+
+    queries.save_sketches(Session(), {
+        (branch_id, hour.astype(datetime.datetime)): (
+            int(appt.sum()), sketch.encode(appt), sketch.encode(non_appt))
+        for (branch_id, hour), (appt, non_appt)
+        in sketch.build(*args).items()
+    })
+
+
+def load(engine, days, branches=None, start=START, seed=SEED,
+         with_derived=False, progress=print):
+    """Creates the tables and loads the synthetic data
+
+    :param engine:          SQLAlchemy engine of a scratch database
+    :param days:            (int) number of days to generate
+    :param branches:        (int) number of branches, or None for all of them
+    :param start:           (datetime.date) first day
+    :param seed:            (int) seed of the data
+    :param with_derived:    (bool) also build the sketches, heatmaps and
+                            coverage bitmaps
+    :param progress:        (callable) taking a progress message
+    :return:                (int) number of wait times loaded
+    """
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    offices = sorted(data.prep_branches_data(), key=lambda b: b['number'])
+    if branches is not None:
+        offices = offices[:branches]
+    session = Session()
+    session.add_all([models.Branch(**b) for b in offices])
+    session.commit()
+    session.close()
+
+    catalog = Catalog(offices)
+    generator = Generator(catalog, seed)
+    wait_time_table = models.WaitTime.__table__
+    snapshot_table = models.Snapshot.__table__
+    total, previous, cells, day_coverage = 0, None, {}, {}
+    started = time.monotonic()
+    for i in range(days):
+        date = start + datetime.timedelta(days=i)
+        columns = generator.day(date)
+        total += bulk.insert_columns(engine, wait_time_table, columns)
+        snapshots, previous = snapshot_columns(
+            columns, len(catalog), previous)
+        bulk.insert_columns(engine, snapshot_table, snapshots)
+        if with_derived:
+            derived(columns, day_coverage, cells, Session)
+        if (i + 1) % 30 == 0 or i + 1 == days:
+            rate = total / (time.monotonic() - started)
+            progress(f'{date}: {total} wait times ({rate:,.0f} rows/s)')
+
+    if with_derived:
+        queries.replace_heatmaps(Session(), cells)
+        queries.replace_coverage(Session(), day_coverage)
+
+    return total
+
+
+description = 'Loads deterministic synthetic wait times into a scratch ' \
+    'database.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--db', action='store', dest='url',
+                    default='sqlite:///' + DEFAULT_DB,
+                    help='database URL. Its tables are dropped!')
+parser.add_argument('--years', action='store', dest='years', type=float,
+                    default=1, help='years of wait times')
+parser.add_argument('--days', action='store', dest='days', type=int,
+                    help='days of wait times, instead of --years')
+parser.add_argument('--branches', action='store', dest='branches', type=int,
+                    help='number of branches, default all of them')
+parser.add_argument('--start', action='store', dest='start',
+                    type=datetime.date.fromisoformat, default=START,
+                    help='first day')
+parser.add_argument('--seed', action='store', dest='seed', type=int,
+                    default=SEED)
+parser.add_argument('--derived', action='store_true', dest='derived',
+                    help='also build the sketches, heatmaps and coverage')
+
+
+def main():
+    args = parser.parse_args()
+    days = args.days if args.days is not None else round(args.years * 365)
+    engine = create_engine(args.url)
+    if engine.dialect.name == 'sqlite':
+        # A scratch database: trade durability for load speed
+        @event.listens_for(engine, 'connect')
+        def fast_pragmas(dbapi_connection, _):
+            dbapi_connection.execute('PRAGMA journal_mode=OFF')
+            dbapi_connection.execute('PRAGMA synchronous=OFF')
+
+    started = time.monotonic()
+    total = load(engine, days, args.branches, args.start, args.seed,
+                 args.derived)
+    elapsed = time.monotonic() - started
+    print(f'Loaded {total} wait times over {days} days in {elapsed:.1f} s '
+          f'({total / elapsed:,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Serves the read API for the branches and wait times over HTTP"""
+import argparse
+import atexit
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv.async_api import AsyncApi
+import cadmv.async_server
+import cadmv.server
+from cadmv.profiling import Profiler
+from cadmv.snapshot import SnapshotStore
+import config
+
+
+description = 'Serves the CA DMV branches and wait times over HTTP.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--host', action='store', dest='host', default='127.0.0.1')
+parser.add_argument('--port', action='store', dest='port', type=int,
+                    default=8000)
+parser.add_argument('--ttl', action='store', dest='ttl', type=int, default=300,
+                    help='seconds a rendered response is kept in memory')
+parser.add_argument('--version-ttl', action='store', dest='version_ttl',
+                    type=int, default=5,
+                    help='seconds between checks for a new scrape')
+parser.add_argument('--async', action='store_true', dest='use_async',
+                    help='serve from an asyncio event loop with async '
+                         'database access (config.async_db_url)')
+parser.add_argument('--window-days', action='store', dest='window_days',
+                    type=int, default=config.window_days,
+                    help='days of recent wait times kept in memory for '
+                         '/api/recent, 0 for none, default '
+                         'config.window_days')
+parser.add_argument('--profile-sql', action='store', dest='profile_sql',
+                    type=float, metavar='SECONDS',
+                    help='profile the SQL statements, logging those slower '
+                         'than SECONDS with their plan and a summary on exit')
+parser.add_argument('--profile-output', action='store', dest='profile_output',
+                    help='JSON file the statement statistics are written to '
+                         'on exit, with --profile-sql')
+
+
+def profile(engine, args):
+    """Attaches a Profiler to engine reporting when the process exits"""
+    profiler = Profiler(engine, threshold=args.profile_sql).attach()
+
+    def report():
+        logging.getLogger('cadmv.profiling').info(
+            'SQL profile\n%s', profiler.report())
+        if args.profile_output:
+            profiler.dump(args.profile_output)
+
+    atexit.register(report)
+    return profiler
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    snapshots = SnapshotStore(config.snapshot_path)
+    if args.use_async:
+        engine = create_async_engine(config.async_db_url)
+        if args.profile_sql is not None:
+            profile(engine, args)
+        Session = sessionmaker(
+            engine, class_=AsyncSession, expire_on_commit=False)
+        api = AsyncApi(Session, ttl=args.ttl, version_ttl=args.version_ttl,
+                       snapshots=snapshots,
+                       forecast_path=config.forecast_path,
+                       window_days=args.window_days or None)
+        cadmv.async_server.serve(api, args.host, args.port)
+    else:
+        if args.profile_sql is not None:
+            profile(config.engine, args)
+        Session = sessionmaker(bind=config.engine)
+        api = Api(Session, ttl=args.ttl, version_ttl=args.version_ttl,
+                  snapshots=snapshots, forecast_path=config.forecast_path,
+                  window_days=args.window_days or None)
+        cadmv.server.serve(api, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
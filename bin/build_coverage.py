@@ -0,0 +1,51 @@
+"""Rebuilds the coverage bitmaps (see cadmv.coverage) of every branch from
+the stored wait times. The scraper keeps them up to date from then on. For
+example,
+
+$ python bin/build_coverage.py
+"""
+import argparse
+import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import coverage
+import cadmv.queries as queries
+import config
+
+
+description = 'Rebuilds the coverage bitmaps from the wait times.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--days', action='store', dest='days', type=int,
+                    default=30, help='days of wait times read at a time')
+
+
+def main():
+    args = parser.parse_args()
+    Session = sessionmaker(bind=config.engine)
+
+    start = queries.get_first_timestamp(Session())
+    end = queries.get_latest_timestamp(Session())
+    if start is None:
+        print('No wait times to build the coverage from')
+        return
+
+    # Read whole days, so that no day is split across chunks
+    start = datetime.datetime.combine(start.date(), datetime.time())
+    days = {}
+    total = 0
+    while start <= end:
+        chunk_end = start + datetime.timedelta(days=args.days)
+        times = queries.get_scrape_times(Session(), start, chunk_end)
+        if times:
+            branch_ids, timestamps = zip(*times)
+            days.update(coverage.build(branch_ids, timestamps))
+            total += len(times)
+        start = chunk_end
+
+    queries.replace_coverage(Session(), days)
+    print(f'Built {len(days)} coverage days from {total} wait times')
+
+
+if __name__ == '__main__':
+    main()
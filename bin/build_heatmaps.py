@@ -0,0 +1,64 @@
+"""Rebuilds the weekday by hour heatmaps (see cadmv.heatmap) of every branch
+from the stored wait times. The scraper keeps them up to date from then on.
+The cells are aggregated by DuckDB in one pass when cadmv.analytics is
+available, and from chunks of the wait times otherwise. For example,
+
+$ python bin/build_heatmaps.py
+"""
+import argparse
+import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import analytics
+from cadmv import heatmap
+import cadmv.queries as queries
+import config
+
+
+description = 'Rebuilds the wait time heatmaps from the wait times.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--days', action='store', dest='days', type=int,
+                    default=30, help='days of wait times read at a time')
+
+
+def main():
+    args = parser.parse_args()
+    Session = sessionmaker(bind=config.engine)
+
+    start = queries.get_first_timestamp(Session())
+    end = queries.get_latest_timestamp(Session())
+    if start is None:
+        print('No wait times to build heatmaps from')
+        return
+
+    cells = {}
+    total = 0
+    duckdb = analytics.for_engine(config.engine)
+    if duckdb is not None:
+        for branch_id, weekday, hour, *sums in analytics.get_heatmap_cells(
+                duckdb):
+            cells[branch_id, weekday, hour] = sums
+            total += sums[0]
+
+    while duckdb is None and start <= end:
+        chunk_end = start + datetime.timedelta(days=args.days)
+        samples = queries.get_open_wait_time_samples(
+            Session(), start, chunk_end)
+        if samples:
+            branch_ids, appts, non_appts, timestamps = zip(*samples)
+            built = heatmap.build(branch_ids, timestamps, appts, non_appts)
+            for key, (count, appt_sum, non_appt_sum) in built.items():
+                cell = cells.setdefault(key, [0, 0.0, 0.0])
+                cell[0] += count
+                cell[1] += appt_sum
+                cell[2] += non_appt_sum
+            total += len(samples)
+        start = chunk_end
+
+    queries.replace_heatmaps(Session(), cells)
+    print(f'Built {len(cells)} heatmap cells from {total} wait times')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Builds the hourly wait time sketches (see cadmv.sketch) from the stored
+wait times, replacing the sketches of the hours covered. The scraper keeps
+the sketches up to date from then on. For example,
+
+$ python bin/build_sketches.py --start 2018-12-01 --end 2019-01-01
+"""
+import argparse
+import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+import cadmv.queries as queries
+from cadmv import sketch
+import config
+
+
+description = 'Builds the hourly wait time sketches from the wait times.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--start', action='store', dest='start',
+                    type=datetime.datetime.fromisoformat,
+                    help='first hour to build, default the first wait time')
+parser.add_argument('--end', action='store', dest='end',
+                    type=datetime.datetime.fromisoformat,
+                    help='end of the last hour to build (exclusive)')
+parser.add_argument('--days', action='store', dest='days', type=int,
+                    default=7, help='days of wait times read at a time')
+
+
+def main():
+    args = parser.parse_args()
+    Session = sessionmaker(bind=config.engine)
+
+    start = args.start
+    if start is None:
+        start = queries.get_first_timestamp(Session())
+        if start is None:
+            print('No wait times to build sketches from')
+            return
+    start = start.replace(minute=0, second=0, microsecond=0)
+    end = args.end or datetime.datetime.now()
+
+    total = 0
+    while start < end:
+        chunk_end = min(end, start + datetime.timedelta(days=args.days))
+        samples = queries.get_open_wait_time_samples(
+            Session(), start, chunk_end)
+        if samples:
+            branch_ids, appts, non_appts, timestamps = zip(*samples)
+            sketches = sketch.build(branch_ids, timestamps, appts, non_appts)
+            queries.save_sketches(Session(), {
+                (branch_id, hour.astype(datetime.datetime)): (
+                    int(appt.sum()), sketch.encode(appt),
+                    sketch.encode(non_appt))
+                for (branch_id, hour), (appt, non_appt) in sketches.items()
+            })
+            total += len(samples)
+            print(f'{start:%Y-%m-%d}: {len(sketches)} sketches of '
+                  f'{len(samples)} wait times')
+        start = chunk_end
+
+    print(f'Built the sketches of {total} wait times')
+
+
+if __name__ == '__main__':
+    main()
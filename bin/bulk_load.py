@@ -0,0 +1,119 @@
+"""Loads large CSV or JSON lines dumps of wait times into the database.
+
+The dumps are split into chunks of whole lines that a process pool parses
+into column arrays (see cadmv.bulk), while the main process inserts them in
+order: with COPY on PostgreSQL and one executemany per chunk, in its own
+transaction, on SQLite. The indexes of wait_times are dropped during the
+load and built again at the end. Rows without is_open, or with an empty
+one, get it from the opening hours of their branch.
+
+A CSV dump has a header line naming its columns, a JSON lines dump one
+object per line. Both have branch_id, appt, non_appt and timestamp (local
+time, ISO formatted) and optionally is_open. For example,
+
+$ python bin/bulk_load.py exports/2017.csv exports/2018.jsonl --workers 8
+
+Run the bin/build_*.py scripts afterwards to rebuild the derived tables.
+"""
+import argparse
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import bulk
+from cadmv.catalog import Catalog
+from cadmv.hours import OpeningHours
+from cadmv.models import WaitTime
+from cadmv import normalized
+import config
+
+
+description = 'Loads CSV or JSON lines dumps of wait times into the database.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('paths', nargs='+', help='dumps to load')
+parser.add_argument('--db', action='store', dest='url',
+                    help='database URL, default config.engine')
+parser.add_argument('--format', action='store', dest='format',
+                    choices=bulk.FORMATS,
+                    help='format of the dumps, default from their extension')
+parser.add_argument('--workers', action='store', dest='workers', type=int,
+                    help='parsing processes, default one per CPU')
+parser.add_argument('--chunk-mb', action='store', dest='chunk_mb', type=float,
+                    default=16, help='megabytes of a dump parsed per task')
+parser.add_argument('--keep-indexes', action='store_true',
+                    dest='keep_indexes',
+                    help='keep the indexes during the load, e.g. when the '
+                         'table is much larger than the dumps')
+
+
+def _read_chunk(task):
+    return bulk.read_chunk(*task)
+
+
+def tasks(paths, fmt, chunk_bytes):
+    """Lists the chunks of the dumps as arguments of bulk.read_chunk()"""
+    for path in paths:
+        path_format = fmt or bulk.file_format(path)
+        header = bulk.read_header(path) if path_format == 'csv' else None
+        for start, end in bulk.split_file(path, chunk_bytes,
+                                          skip_header=header is not None):
+            yield path, start, end, path_format, header
+
+
+def load(engine, chunks, hours, progress=print):
+    """Inserts the parsed chunks
+
+    :param engine:      SQLAlchemy engine
+    :param chunks:      (iterable) of column array dicts, see
+                        bulk.read_chunk()
+    :param hours:       (hours.OpeningHours) filling in is_open
+    :param progress:    (callable) taking a progress message
+    :return:            (int) number of wait times inserted
+    """
+    total = 0
+    started = time.monotonic()
+    for columns in chunks:
+        count = len(columns['branch_id'])
+        if not count:
+            continue
+        bulk.fill_is_open(columns, hours)
+        columns['flags'] = np.zeros(count, dtype=np.int64)
+        total += bulk.insert_columns(engine, WaitTime.__table__, columns)
+        progress(f'{total} wait times '
+                 f'({total / (time.monotonic() - started):,.0f} rows/s)')
+    return total
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(args.url) if args.url else config.engine
+    if normalized.is_normalized(sessionmaker(bind=engine)()):
+        parser.error('the database has the normalized layout, load it '
+                     'before running bin/normalize.py')
+    hours = OpeningHours(Catalog.from_session(sessionmaker(bind=engine)()))
+    try:
+        chunk_tasks = list(tasks(args.paths, args.format,
+                                 int(args.chunk_mb * 2 ** 20)))
+    except ValueError as e:
+        parser.error(str(e))
+
+    started = time.monotonic()
+    with multiprocessing.Pool(args.workers) as pool:
+        chunks = pool.imap(_read_chunk, chunk_tasks)
+        if args.keep_indexes:
+            total = load(engine, chunks, hours)
+        else:
+            with bulk.indexes_dropped(engine, WaitTime.__table__):
+                total = load(engine, chunks, hours)
+    elapsed = time.monotonic() - started
+    print(f'Loaded {total} wait times from {len(args.paths)} dump(s) in '
+          f'{elapsed:.1f} s ({total / max(elapsed, 1e-9):,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Fits the wait time forecasts of every branch to the stored wait times and
+saves them to config.forecast_path, where the scraper keeps them up to date
+and the API reads them. Optionally prints the forecast of one branch. For
+example,
+
+$ python bin/forecast.py --days 90 --branch 542 --at 2018-12-04T10:30
+"""
+import argparse
+import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.catalog import Catalog
+from cadmv.forecast import Forecaster
+import config
+
+
+description = ('Fits the wait time forecasts to the stored wait times and '
+               'saves them.')
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--days', action='store', dest='days', type=int,
+                    help='only fit to the wait times of the last days')
+parser.add_argument('--branch', action='store', dest='branch', type=int,
+                    help='branch number to print the forecast of')
+parser.add_argument('--at', action='store', dest='at',
+                    type=datetime.datetime.fromisoformat,
+                    help='arrival time of the printed forecast, default now')
+
+
+def main():
+    args = parser.parse_args()
+    Session = sessionmaker(bind=config.engine)
+
+    start = None
+    if args.days is not None:
+        start = datetime.datetime.now() - datetime.timedelta(days=args.days)
+    catalog = Catalog.from_session(Session())
+    forecaster = Forecaster.from_session(Session(), catalog, start)
+    forecaster.save(config.forecast_path)
+    print(f'Fit {int(forecaster.counts.sum())} wait times of {len(catalog)} '
+          f'branches, saved to {config.forecast_path}')
+
+    if args.branch is not None:
+        at = args.at or datetime.datetime.now()
+        for kind in ('appt', 'non_appt'):
+            wait = forecaster.forecast(args.branch, at, kind)
+            wait = 'no data' if wait is None else f'{wait:.0f} min'
+            print(f'{args.branch} at {at:%A %H:%M}, {kind}: {wait}')
+
+
+if __name__ == '__main__':
+    main()
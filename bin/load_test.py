@@ -0,0 +1,147 @@
+"""Load tests the asyncio API server against a local SQLite file.
+
+The database is created and filled with the branches and a day of made-up
+wait times if it's empty. The server then runs in this process while many
+concurrent keep-alive clients request the given paths for a while, after
+which the throughput and latency percentiles are printed. For example,
+
+$ python bin/load_test.py --clients 2000 --duration 20
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.async_api import AsyncApi
+from cadmv.async_server import start_server
+import cadmv.helper.data
+import cadmv.models as models
+import cadmv.queries as queries
+
+
+description = 'Load tests the asyncio API server against a local SQLite file.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--db', action='store', dest='db',
+                    default=os.path.join(tempfile.gettempdir(),
+                                         'cadmv_load_test.db'))
+parser.add_argument('--clients', action='store', dest='clients', type=int,
+                    default=1000)
+parser.add_argument('--duration', action='store', dest='duration', type=float,
+                    default=10)
+parser.add_argument('--path', action='append', dest='paths',
+                    help='path to request (repeatable)')
+
+DEFAULT_PATHS = [
+    '/api/wait_times',
+    '/api/wait_times/region/7',
+    '/api/branches',
+    '/api/branches/542',
+    '/api/wait_times/542',
+]
+
+
+def prepare_database(db_path):
+    """Creates the database file and fills it if it's empty"""
+    engine = create_engine('sqlite:///' + db_path)
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    if queries.get_all_branches(Session()):
+        return
+
+    branches = cadmv.helper.data.prep_branches_data()
+    session = Session()
+    session.add_all([models.Branch(**b) for b in branches])
+    session.commit()
+
+    start = datetime.datetime.now().replace(second=0, microsecond=0) \
+        - datetime.timedelta(days=1)
+    rng = random.Random(0)
+    wait_times = []
+    for tick in range(24 * 30):
+        timestamp = start + datetime.timedelta(minutes=2 * tick)
+        wait_times.extend(
+            {
+                'branch_id': b['number'],
+                'appt': rng.randint(0, 30),
+                'non_appt': rng.randint(0, 120),
+                'timestamp': timestamp,
+            }
+            for b in branches
+        )
+    queries.create_wait_times(Session(), wait_times)
+
+
+async def client(host, port, paths, deadline, latencies, errors):
+    """Requests paths round-robin over one keep-alive connection until the
+    deadline
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    index = random.randrange(len(paths))
+    try:
+        while time.monotonic() < deadline:
+            path = paths[index % len(paths)]
+            index += 1
+            started = time.perf_counter()
+            writer.write(f'GET {path} HTTP/1.1\r\nHost: {host}\r\n'
+                         'Accept-Encoding: gzip\r\n\r\n'.encode('latin-1'))
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if not head.startswith(b'HTTP/1.1 200'):
+                errors.append(head.split(b'\r\n', 1)[0])
+    finally:
+        writer.close()
+
+
+def percentile(values, pct):
+    """Returns the pct-th percentile of values"""
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def run(args):
+    engine = create_async_engine('sqlite+aiosqlite:///' + args.db)
+    Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    api = AsyncApi(Session)
+    server = await start_server(api, '127.0.0.1', 0)
+    host, port = server.sockets[0].getsockname()[:2]
+
+    paths = args.paths or DEFAULT_PATHS
+    latencies, errors = [], []
+    deadline = time.monotonic() + args.duration
+    started = time.monotonic()
+    async with server:
+        await asyncio.gather(*(
+            client(host, port, paths, deadline, latencies, errors)
+            for _ in range(args.clients)
+        ))
+    elapsed = time.monotonic() - started
+    await engine.dispose()
+
+    print(f'{len(latencies)} requests from {args.clients} clients '
+          f'in {elapsed:.1f} s: {len(latencies) / elapsed:.0f} req/s, '
+          f'{len(errors)} non-200 responses')
+    for pct in (50, 90, 99):
+        print(f'p{pct}: {percentile(latencies, pct) * 1000:.2f} ms')
+
+
+def main():
+    args = parser.parse_args()
+    prepare_database(args.db)
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Computes the nearest-neighbour graph of the branches from their locations.
+
+The graph is cached in config.cache_dir per catalog version. By default the
+neighbours are printed next to the stored nearby1..nearby5 values; pass
+--write to replace the stored values in one bulk update. Branches without a
+location get no neighbours and are no branch's neighbour. For example,
+
+$ python bin/nearby_graph.py --write
+"""
+import argparse
+
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.catalog import Catalog
+import cadmv.geo as geo
+import cadmv.queries as queries
+import config
+
+
+description = ('Computes the nearest-neighbour graph of the branches and '
+               'optionally stores it in the nearby1..nearby5 columns.')
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('-k', action='store', dest='k', type=int, default=5,
+                    help='neighbours per branch')
+parser.add_argument('--write', action='store_true', dest='write',
+                    help='store the first five neighbours of every branch')
+
+
+def main():
+    args = parser.parse_args()
+    Session = sessionmaker(bind=config.engine)
+
+    branches = queries.get_all_branches(Session())
+    catalog = Catalog(branches)
+    graph = geo.load_neighbour_graph(catalog, args.k, config.cache_dir)
+    stored = {b.number: [b.nearby1, b.nearby2, b.nearby3, b.nearby4,
+                         b.nearby5] for b in branches}
+
+    nearby = geo.nearby_lists(graph)
+    changed = 0
+    for number, neighbours, distances in zip(*graph):
+        # update_nearby() stores missing neighbours as 0
+        padded = nearby[number] + [0] * (5 - len(nearby[number]))
+        if padded != stored[number]:
+            changed += 1
+        pairs = ', '.join(f'{n} ({d:.1f} km)'
+                          for n, d in zip(neighbours, distances)
+                          if np.isfinite(d))
+        print(f'{number}: {pairs}  [stored: {stored[number]}]')
+    print(f'{changed} of {len(catalog)} branches differ from the stored '
+          'nearby values')
+
+    if args.write:
+        queries.update_nearby(Session(), nearby)
+        print('Stored the new nearby values')
+
+
+if __name__ == '__main__':
+    main()
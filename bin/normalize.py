@@ -0,0 +1,50 @@
+"""Moves the database to the normalized layout of the wait times (see
+cadmv.normalized): one snapshots row per scrape, the wait times as readings
+referencing it and a wait_times view in place of the table. Stop the
+scraper while it runs. For example,
+
+$ python bin/normalize.py
+$ python bin/normalize.py --columns-only
+
+--columns-only only adds the columns the tables of an older database lack,
+like cadmv/helper/build_database.py.
+"""
+import argparse
+import logging
+import time
+
+from sqlalchemy import create_engine, inspect
+
+from cadmv import normalized
+import config
+
+
+description = 'Moves the database to the normalized layout of the wait times.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('--db', action='store', dest='url',
+                    help='database URL, default config.engine')
+parser.add_argument('--columns-only', action='store_true',
+                    dest='columns_only',
+                    help='only add the columns the tables lack')
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    engine = create_engine(args.url) if args.url else config.engine
+
+    if args.columns_only:
+        added = normalized.add_missing_columns(engine)
+        print(f"Added {', '.join(added) or 'no columns'}")
+        return
+    if 'wait_times' in inspect(engine).get_view_names():
+        parser.error('the database already has the normalized layout')
+
+    started = time.monotonic()
+    created, moved = normalized.normalize(engine)
+    print(f'Moved {moved} wait times into readings, created {created} '
+          f'snapshots, in {time.monotonic() - started:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Replays the raw responses archived by the scraper (see cadmv.archive and
+cadmv.replay) into the database, parsing them in parallel. Run the
+bin/build_*.py scripts afterwards to rebuild the derived tables. For
+example,
+
+$ python bin/replay.py archive/ --start 2019-01-01 --workers 8
+$ python bin/build_sketches.py && python bin/build_heatmaps.py
+"""
+import argparse
+import datetime
+import logging
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import normalized
+from cadmv.replay import CHUNK_SIZE, replay
+import config
+
+
+description = 'Replays archived raw responses into the database.'
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument('archive', nargs='?', default=config.archive_dir,
+                    help='directory of the archive, default '
+                         'config.archive_dir')
+parser.add_argument('--db', action='store', dest='url',
+                    help='database URL, default config.engine')
+parser.add_argument('--start', action='store', dest='start',
+                    type=datetime.datetime.fromisoformat,
+                    help='first fetch time to replay')
+parser.add_argument('--end', action='store', dest='end',
+                    type=datetime.datetime.fromisoformat,
+                    help='fetch time to stop before')
+parser.add_argument('--workers', action='store', dest='workers', type=int,
+                    help='parsing processes, default one per CPU')
+parser.add_argument('--chunk', action='store', dest='chunk', type=int,
+                    default=CHUNK_SIZE, help='fetches parsed per task')
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.archive is None:
+        parser.error('no archive given and config.archive_dir is not set')
+
+    engine = create_engine(args.url) if args.url else config.engine
+    if normalized.is_normalized(sessionmaker(bind=engine)()):
+        parser.error('the database has the normalized layout, replay '
+                     'before running bin/normalize.py')
+    started = time.monotonic()
+    fetches, total = replay(engine, args.archive, args.start, args.end,
+                            args.workers, args.chunk)
+    elapsed = time.monotonic() - started
+    print(f'Replayed {fetches} fetches, {total} wait times in {elapsed:.1f} s '
+          f'({total / max(elapsed, 1e-9):,.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,168 @@
 """Scrapes the wait times from the CA DMV's website and saves them to the
 database.
+
+Run it with a cron job every 2 minutes or so, or as a long-lived process with
+--loop. Either way it follows the opening hours of the branches: while every
+branch is closed it only scrapes on a slow heartbeat and stores nothing
+unless a branch reports a wait. Pass --always to scrape and store regardless
+of the hours. For example,
+
+$ python bin/wait_time_scraper.py --loop
+
+--metrics-file and --metrics-port export timings and row counts of the
+scrapes in the Prometheus text format (see cadmv.metrics). Under cron the
+file only holds the metrics of the latest run. --archive keeps the raw
+responses for bin/replay.py (see cadmv.archive).
 """
+import argparse
+import atexit
+import datetime
 import logging
+import time
 
 from sqlalchemy.orm import sessionmaker
 
+from cadmv.archive import Archive
 import cadmv.dmv as dmv
-import cadmv.queries as queries
+from cadmv.ingest import Ingestor
+from cadmv import metrics
+from cadmv.profiling import Profiler
+import cadmv.schedule as schedule
 import config
 
 
 logger = logging.getLogger("cadmv.scraper")
 
+description = "Scrapes the CA DMV wait times and saves them to the database."
+parser = argparse.ArgumentParser(description=description)
+parser.add_argument("--loop", action="store_true", dest="loop",
+                    help="keep running, scheduling the scrapes itself")
+parser.add_argument("--always", action="store_true", dest="always",
+                    help="scrape and store even when every branch is closed")
+parser.add_argument("--interval", action="store", dest="interval", type=int,
+                    default=schedule.INTERVAL,
+                    help="seconds between scrapes while a branch is open")
+parser.add_argument("--heartbeat", action="store", dest="heartbeat", type=int,
+                    default=schedule.HEARTBEAT,
+                    help="seconds between scrapes while every branch is "
+                         "closed")
+parser.add_argument("--lead", action="store", dest="lead", type=int,
+                    default=schedule.LEAD,
+                    help="seconds before the first opening to resume the "
+                         "full rate")
+parser.add_argument("--metrics-file", action="store", dest="metrics_file",
+                    help="file the metrics are written to after every scrape")
+parser.add_argument("--metrics-port", action="store", dest="metrics_port",
+                    type=int, help="local port serving the metrics on "
+                                   "/metrics, with --loop")
+parser.add_argument("--archive", action="store", dest="archive",
+                    default=config.archive_dir,
+                    help="directory the raw responses are archived to")
+parser.add_argument("--window-days", action="store", dest="window_days",
+                    type=int, default=config.window_days,
+                    help="days of recent wait times kept in memory, 0 for "
+                         "none, default config.window_days")
+parser.add_argument("--profile-sql", action="store", dest="profile_sql",
+                    type=float, metavar="SECONDS",
+                    help="profile the SQL statements, logging those slower "
+                         "than SECONDS with their plan and a summary on exit")
+
+
+def scrape(ingestor, active, archive=None):
+    """Scrapes the wait times once and ingests them. When no branch is
+    active the scrape is only stored if some branch reports a wait. The raw
+    response is archived either way. Failures are counted by the callers.
+    """
+    wait_times = dmv.get_wait_times(archive=archive)
+    if active or schedule.has_waits(wait_times):
+        with metrics.span("cadmv_ingest_seconds"):
+            ingestor.ingest(wait_times)
+        metrics.increment("cadmv_scrapes_total", outcome="stored")
+    else:
+        logger.info("Every branch is closed, not storing %d empty wait times",
+                    len(wait_times))
+        metrics.increment("cadmv_scrapes_total", outcome="empty")
+
+
+def run_once(ingestor, args, archive=None):
+    """A single scrape, as started by cron every args.interval seconds"""
+    now = datetime.datetime.now()
+    active = args.always or \
+        schedule.is_active(ingestor.hours, now, args.lead)
+    if not active and not schedule.heartbeat_due(
+            now, args.interval, args.heartbeat):
+        logger.info("Every branch is closed, skipping the scrape")
+        return
+
+    try:
+        scrape(ingestor, active, archive)
+    except Exception:
+        metrics.increment("cadmv_scrapes_total", outcome="failed")
+        raise
+    finally:
+        if args.metrics_file:
+            metrics.write(args.metrics_file)
+
+
+def run_loop(ingestor, args, archive=None):
+    """Scrapes forever, at the full rate while a branch is open and on the
+    heartbeat otherwise. A failed scrape, whether fetching, parsing or
+    storing, is logged and counted and the loop carries on; when the next
+    run can't be scheduled from the hours it is args.interval away
+    """
+    while True:
+        now = datetime.datetime.now()
+        try:
+            active = args.always or \
+                schedule.is_active(ingestor.hours, now, args.lead)
+            scrape(ingestor, active, archive)
+        except Exception:
+            logger.error("Failed to scrape the wait times", exc_info=True)
+            metrics.increment("cadmv_scrapes_total", outcome="failed")
+        if args.metrics_file:
+            try:
+                metrics.write(args.metrics_file)
+            except OSError:
+                logger.error("Failed to write the metrics", exc_info=True)
+
+        next_run = now + datetime.timedelta(seconds=args.interval)
+        if not args.always:
+            try:
+                next_run = schedule.next_run(ingestor.hours, now,
+                                             args.interval, args.heartbeat,
+                                             args.lead)
+            except Exception:
+                logger.error("Failed to schedule the next scrape",
+                             exc_info=True)
+        delay = (next_run - datetime.datetime.now()).total_seconds()
+        if delay > 0:
+            time.sleep(delay)
+
 
 def main():
-    """Run this with a cron job every 2 minutes or so"""
-    wait_times = dmv.get_wait_times()
+    args = parser.parse_args()
+    if args.metrics_port and not args.loop:
+        parser.error("--metrics-port requires --loop")
+    logging.basicConfig(level=logging.INFO)
+    if args.metrics_file or args.metrics_port:
+        metrics.enable()
+    if args.metrics_port:
+        metrics.serve(port=args.metrics_port)
 
-    Session = sessionmaker(bind=config.engine)
-    session = Session()
-    queries.create_wait_times(session, wait_times)
+    if args.profile_sql is not None:
+        profiler = Profiler(config.engine, threshold=args.profile_sql).attach()
+        atexit.register(
+            lambda: logger.info("SQL profile\n%s", profiler.report()))
 
+    Session = sessionmaker(bind=config.engine)
+    ingestor = Ingestor(Session, config.snapshot_path,
+                        forecast_path=config.forecast_path,
+                        window_days=args.window_days or None)
+    archive = Archive(args.archive) if args.archive else None
+    if args.loop:
+        run_loop(ingestor, args, archive)
+    else:
+        run_once(ingestor, args, archive)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,325 @@
+"""Columnar analytics of the wait times on an in-process DuckDB.
+
+SQLite aggregates wait_times a row at a time, which takes seconds per
+million rows. When duckdb is installed, an Analytics attaches the SQLite
+database (read only), or reads Parquet exports of wait_times, and runs the
+heavy aggregations there. Its functions have the arguments and return
+values of their counterparts in cadmv.queries, with an Analytics in place
+of the session:
+
+    get_open_wait_time_samples(analytics, start, end)
+    get_region_trends(analytics, start, end, region)
+    get_wait_time_percentiles(analytics, branch_num, start, end, percentiles)
+    get_heatmap_cells(analytics, branch_num, region)
+
+The last two are computed from the wait times themselves (exact percentiles
+instead of merged sketches, and heatmap cells of any range) rather than read
+from the derived tables.
+
+backend() picks the backend of a query over a range: DuckDB for ranges of
+LARGE_RANGE or more on a SQLite file, and the database through
+cadmv.queries otherwise. For example,
+
+    module, handle = analytics.backend(session, start, end)
+    trends = module.get_region_trends(handle, start, end, region)
+
+Without duckdb, backend() always picks cadmv.queries.
+
+Attaching the SQLite database needs DuckDB's sqlite extension, which is not
+part of the duckdb wheel: Analytics runs INSTALL sqlite, which downloads it
+once into ~/.duckdb/extensions, and LOAD sqlite. On a machine without
+network access, install the extension beforehand (INSTALL sqlite FROM a
+local repository, or copy the extensions directory). Reading Parquet files
+needs no extension, but the branches, and so the region queries, are only
+in the database.
+"""
+import datetime
+import logging
+import sys
+import threading
+
+import cadmv.queries as queries
+
+
+logger = logging.getLogger('cadmv.analytics')
+
+# Ranges from which backend() picks DuckDB over the database
+LARGE_RANGE = datetime.timedelta(days=31)
+
+# The rows the statistics use, see queries.get_open_wait_time_samples()
+USABLE = 'is_open IS DISTINCT FROM false AND flags = 0'
+
+_analytics = {}
+_lock = threading.Lock()
+
+
+def available():
+    """Determines if duckdb is installed"""
+    try:
+        import duckdb  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _quote(text):
+    return "'" + text.replace("'", "''") + "'"
+
+
+class Analytics:
+    """An in-process DuckDB over the wait times
+
+    :param database:    (str) path of the SQLite database, or None
+    :param parquet:     (str) path or glob of Parquet files of wait_times
+                        (see export_parquet()) read instead of the
+                        database's, or None
+    :raises ImportError: if duckdb isn't installed
+    :raises ValueError: if neither database nor parquet is given
+    :raises duckdb.Error: if the sqlite extension can't be loaded
+    """
+
+    def __init__(self, database=None, parquet=None):
+        import duckdb
+
+        if database is None and parquet is None:
+            raise ValueError('Analytics need a database or Parquet files')
+        self.database = database
+        self.parquet = parquet
+        self.connection = duckdb.connect()
+        if database is not None:
+            self.connection.execute('INSTALL sqlite')
+            self.connection.execute('LOAD sqlite')
+            self.connection.execute(
+                f'ATTACH {_quote(database)} AS cadmv (TYPE sqlite, READ_ONLY)')
+            self.connection.execute(
+                'CREATE VIEW branches AS SELECT * FROM cadmv.branches')
+        source = f'read_parquet({_quote(parquet)}, union_by_name = true)' \
+            if parquet is not None else 'cadmv.wait_times'
+        # SQLite leaves the types of its values to the reader
+        self.connection.execute(f'''
+            CREATE VIEW wait_times AS SELECT
+                CAST(branch_id AS INTEGER) AS branch_id,
+                CAST(appt AS INTEGER) AS appt,
+                CAST(non_appt AS INTEGER) AS non_appt,
+                CAST("timestamp" AS TIMESTAMP) AS "timestamp",
+                CAST(is_open AS BOOLEAN) AS is_open,
+                CAST(COALESCE(flags, 0) AS INTEGER) AS flags
+            FROM {source}''')
+
+    @classmethod
+    def from_engine(cls, engine, parquet=None):
+        """Creates the Analytics of a SQLite engine
+
+        :raises ValueError: if the engine isn't a SQLite file
+        """
+        database = engine.url.database
+        if engine.dialect.name != 'sqlite' or not database \
+                or database == ':memory:':
+            raise ValueError(f'Analytics need a SQLite file, not {engine.url}')
+        return cls(database, parquet)
+
+    @property
+    def has_branches(self):
+        """Whether the branches are available, from the database"""
+        return self.database is not None
+
+    def cursor(self):
+        """Returns a cursor for one thread, see DuckDBPyConnection.cursor()"""
+        return self.connection.cursor()
+
+    def export_parquet(self, path, start=None, end=None):
+        """Writes the wait times of a range to a Parquet file
+
+        :return:    (int) number of wait times written
+        """
+        where, params = _range(start, end)
+        cursor = self.cursor()
+        cursor.execute(
+            f'COPY (SELECT * FROM wait_times WHERE {where} '
+            f'ORDER BY "timestamp") TO {_quote(path)} (FORMAT parquet)',
+            params)
+        return cursor.execute(
+            f'SELECT COUNT(*) FROM read_parquet({_quote(path)})').fetchone()[0]
+
+
+def for_engine(engine):
+    """Returns the shared Analytics of an engine, or None if duckdb isn't
+    installed or the engine isn't a SQLite file
+    """
+    key = str(engine.url)
+    with _lock:
+        if key not in _analytics:
+            try:
+                _analytics[key] = Analytics.from_engine(engine) \
+                    if available() else None
+            except ValueError:
+                _analytics[key] = None
+            except Exception:
+                logger.error('Failed to attach %s to DuckDB', engine.url,
+                             exc_info=True)
+                _analytics[key] = None
+        return _analytics[key]
+
+
+def for_range(engine, start=None, end=None):
+    """Returns the shared Analytics of an engine if a range is large enough
+    for DuckDB, or None if it isn't or there is no Analytics
+
+    :param engine:      SQLAlchemy engine
+    :param start:       (datetime) inclusive lower bound, or None
+    :param end:         (datetime) exclusive upper bound, or None for now
+    """
+    if start is not None and \
+            (end or datetime.datetime.now()) - start < LARGE_RANGE:
+        return None
+    return for_engine(engine)
+
+
+def backend(session, start=None, end=None):
+    """Picks the backend of a query over a range
+
+    :param session:     SQLAlchemy session
+    :param start:       (datetime) inclusive lower bound, or None
+    :param end:         (datetime) exclusive upper bound, or None for now
+    :return:            (tuple) of the module whose functions run the query,
+                        cadmv.analytics or cadmv.queries, and what to pass
+                        them in place of a session
+    """
+    analytics = for_range(session.get_bind(), start, end)
+    if analytics is None:
+        return queries, session
+
+    session.close()
+    return sys.modules[__name__], analytics
+
+
+def _range(start, end, column='"timestamp"'):
+    """Builds the filter of a time range and its parameters"""
+    clauses, params = ['true'], []
+    if start is not None:
+        clauses.append(f'{column} >= ?')
+        params.append(start)
+    if end is not None:
+        clauses.append(f'{column} < ?')
+        params.append(end)
+    return ' AND '.join(clauses), params
+
+
+def _require_branches(analytics):
+    """Refuses the region queries of an Analytics without the branches,
+    rather than answering them with nothing
+    """
+    if not analytics.has_branches:
+        raise ValueError('Region queries need the database, not only '
+                         'Parquet files of the wait times')
+
+
+def get_open_wait_time_samples(analytics, start=None, end=None):
+    """Gets the usable wait times of the open branches. See
+    queries.get_open_wait_time_samples()
+    """
+    samples = []
+    try:
+        where, params = _range(start, end)
+        samples = analytics.cursor().execute(
+            'SELECT branch_id, appt, non_appt, "timestamp" FROM wait_times '
+            f'WHERE {USABLE} AND {where}', params).fetchall()
+    except:
+        logger.error('An error occurred accessing DuckDB', exc_info=True)
+
+    return samples
+
+
+def get_region_trends(analytics, start=None, end=None, region=None):
+    """Averages the wait times of every region by day. See
+    queries.get_region_trends()
+
+    :raises ValueError: if the Analytics only has Parquet files
+    """
+    _require_branches(analytics)
+    trends = []
+    try:
+        where, params = _range(start, end)
+        if region is not None:
+            where += ' AND b.region = ?'
+            params.append(region)
+        rows = analytics.cursor().execute(
+            'SELECT b.region, CAST(w."timestamp" AS DATE) AS day, COUNT(*), '
+            'AVG(w.appt), AVG(w.non_appt) '
+            'FROM wait_times w JOIN branches b ON b.number = w.branch_id '
+            f'WHERE {USABLE} AND {where} '
+            'GROUP BY b.region, day ORDER BY b.region, day', params).fetchall()
+        trends = [(region_, day, count, float(appt), float(non_appt))
+                  for region_, day, count, appt, non_appt in rows]
+    except:
+        logger.error('An error occurred accessing DuckDB', exc_info=True)
+
+    return trends
+
+
+def get_wait_time_percentiles(analytics, branch_num, start=None, end=None,
+                              percentiles=(50, 90)):
+    """Computes the exact percentiles of the usable wait times of a branch.
+    See queries.get_wait_time_percentiles(), which estimates them from the
+    sketches
+    """
+    if start is not None:
+        start = start.replace(minute=0, second=0, microsecond=0)
+    result = None
+    try:
+        where, params = _range(start, end)
+        fractions = [p / 100 for p in percentiles]
+        count, appts, non_appts = analytics.cursor().execute(
+            'SELECT COUNT(*), quantile_cont(appt, ?), '
+            'quantile_cont(non_appt, ?) FROM wait_times '
+            f'WHERE branch_id = ? AND {USABLE} AND {where}',
+            [fractions, fractions, branch_num] + params).fetchone()
+        if count:
+            result = {'count': count}
+            for kind, values in (('appt', appts), ('non_appt', non_appts)):
+                result[kind] = {f'p{p:g}': round(float(value), 1)
+                                for p, value in zip(percentiles, values)}
+    except:
+        logger.error('An error occurred accessing DuckDB', exc_info=True)
+
+    return result
+
+
+def get_heatmap_cells(analytics, branch_num=None, region=None, start=None,
+                      end=None):
+    """Computes the heatmap cells of the usable wait times of a range. See
+    queries.get_heatmap_cells(), which reads the stored ones
+
+    :param start:       (datetime) inclusive lower bound, or None
+    :param end:         (datetime) exclusive upper bound, or None
+    :raises ValueError: if region is given and the Analytics only has
+                        Parquet files
+    """
+    if region is not None:
+        _require_branches(analytics)
+    cells = []
+    try:
+        where, params = _range(start, end, 'w."timestamp"')
+        if branch_num is not None:
+            where += ' AND w.branch_id = ?'
+            params.append(branch_num)
+        join = ''
+        if region is not None:
+            join = 'JOIN branches b ON b.number = w.branch_id'
+            where += ' AND b.region = ?'
+            params.append(region)
+        # isodow() counts from Monday = 1, Python's weekday() from 0
+        rows = analytics.cursor().execute(
+            'SELECT w.branch_id, isodow(w."timestamp") - 1 AS weekday, '
+            'hour(w."timestamp") AS hour, COUNT(*), SUM(w.appt), '
+            f'SUM(w.non_appt) FROM wait_times w {join} '
+            f'WHERE {USABLE} AND {where} '
+            'GROUP BY w.branch_id, weekday, hour', params).fetchall()
+        cells = [(branch_id, weekday, hour, count, float(appt_sum),
+                  float(non_appt_sum))
+                 for branch_id, weekday, hour, count, appt_sum, non_appt_sum
+                 in rows]
+    except:
+        logger.error('An error occurred accessing DuckDB', exc_info=True)
+
+    return cells
@@ -0,0 +1,164 @@
+"""Anomaly and outage detection on the scraped wait times.
+
+The Detector keeps the last WINDOW wait times of every branch, taken while
+it was open, in a ring buffer (a (branches, WINDOW, 2) array) and checks
+every scrape against them before it is stored:
+
+    STUCK       the branch reported the same waits for STUCK_SCRAPES scrapes
+                in a row while open
+    JUMP        a wait is implausibly far from the branch's recent median
+    ALL_ZERO    every open branch reported zero waits
+    STALE       the whole feed was identical for STALE_SCRAPES scrapes in a
+                row while branches were open
+    MISSING     branches of the catalog are missing from the feed
+
+STUCK and JUMP flag single wait times. ALL_ZERO, STALE and MISSING flag the
+snapshot, and ALL_ZERO and STALE are copied to all of its wait times, so
+analytics can keep only the rows with no flags set. The flags are a bitmask
+stored in WaitTime.flags and Snapshot.flags.
+"""
+from collections.abc import Mapping
+
+import numpy as np
+
+import cadmv.queries as queries
+
+
+STUCK = 1
+JUMP = 2
+ALL_ZERO = 4
+STALE = 8
+MISSING = 16
+
+FLAG_NAMES = {
+    STUCK: 'stuck', JUMP: 'jump', ALL_ZERO: 'all_zero', STALE: 'stale',
+    MISSING: 'missing',
+}
+
+# Scrapes kept per branch
+WINDOW = 30
+# Scrapes needed before a branch's median is trusted
+MIN_HISTORY = 5
+# Identical scrapes in a row (at about 2 minutes each) before flagging
+STUCK_SCRAPES = 30
+STALE_SCRAPES = 15
+# A wait further than this from the recent median, and than JUMP_MADS median
+# absolute deviations, is a jump
+JUMP_MINUTES = 60
+JUMP_MADS = 6
+
+
+def describe(flags):
+    """Returns the names of the flags set in a bitmask"""
+    return [name for flag, name in FLAG_NAMES.items() if flags & flag]
+
+
+class Detector:
+    """Checks scrapes against the recent history of every branch
+
+    :param numbers:     (sequence) of the branch numbers expected in the feed
+    """
+
+    def __init__(self, numbers):
+        self.numbers = np.sort(np.asarray(numbers, dtype=np.int64))
+        n = len(self.numbers)
+        self.history = np.zeros((n, WINDOW, 2), dtype=np.int16)
+        self.filled = np.zeros(n, dtype=np.int32)
+        self.last = np.full((n, 2), -1, dtype=np.int16)
+        self.repeats = np.zeros(n, dtype=np.int32)
+        self.feed_repeats = 0
+        self._last_feed = None
+
+    @classmethod
+    def from_session(cls, session, numbers):
+        """Builds a detector primed with the most recent scrapes"""
+        detector = cls(numbers)
+        for wait_times in queries.get_recent_scrapes(session, WINDOW):
+            detector.check(wait_times)
+        return detector
+
+    def check(self, wait_times, is_open=None):
+        """Checks one scrape and adds it to the history
+
+        :param wait_times:  (list) of wait time dicts, records or models of
+                            one scrape
+        :param is_open:     (sequence) of bools, whether the branch of every
+                            wait time is open, or None to take them from
+                            the is_open of the wait times (missing means
+                            open)
+        :return:            (tuple) of the flags of every wait time (a numpy
+                            array), the flags of the snapshot and the sorted
+                            numbers of the missing branches
+        """
+        rows = [wt if isinstance(wt, Mapping) else vars(wt)
+                for wt in wait_times]
+        if is_open is None:
+            is_open = [row.get('is_open') is not False for row in rows]
+        is_open = np.asarray(is_open, dtype=bool)
+        flags = np.zeros(len(rows), dtype=np.int32)
+        if not rows:
+            return flags, MISSING if len(self.numbers) else 0, \
+                self.numbers.tolist()
+
+        branch_ids = np.array([row['branch_id'] for row in rows],
+                              dtype=np.int64)
+        values = np.array([[row['appt'], row['non_appt']] for row in rows],
+                          dtype=np.int64)
+        values = np.clip(values, np.iinfo(np.int16).min,
+                         np.iinfo(np.int16).max).astype(np.int16)
+
+        positions = np.searchsorted(self.numbers, branch_ids)
+        known = positions < len(self.numbers)
+        known[known] = self.numbers[positions[known]] == branch_ids[known]
+        rows_known = np.flatnonzero(known)
+        positions = positions[known]
+        values_known = values[known]
+        open_known = is_open[known]
+
+        # Stuck values, per branch
+        same = np.all(self.last[positions] == values_known, axis=1)
+        self.repeats[positions] = np.where(same, self.repeats[positions] + 1, 0)
+        stuck = (self.repeats[positions] >= STUCK_SCRAPES - 1) & open_known \
+            & np.any(values_known != 0, axis=1)
+        flags[rows_known[stuck]] |= STUCK
+
+        # Jumps, against the median of the branch's history
+        history = self.history[positions].astype(np.float64)
+        window = np.arange(WINDOW)[None, :] < self.filled[positions, None]
+        history[~window] = np.nan
+        trusted = self.filled[positions] >= MIN_HISTORY
+        if trusted.any():
+            with np.errstate(all='ignore'):
+                median = np.nanmedian(history[trusted], axis=1)
+                mad = np.nanmedian(
+                    np.abs(history[trusted] - median[:, None, :]), axis=1)
+            distance = np.abs(values_known[trusted] - median)
+            jump = np.any(
+                (distance > JUMP_MINUTES) & (distance > JUMP_MADS * mad),
+                axis=1) & open_known[trusted]
+            flags[rows_known[np.flatnonzero(trusted)[jump]]] |= JUMP
+
+        # The whole feed
+        snapshot_flags = 0
+        if is_open.any() and not values[is_open].any():
+            snapshot_flags |= ALL_ZERO
+        feed = (branch_ids.tobytes(), values.tobytes())
+        self.feed_repeats = self.feed_repeats + 1 \
+            if feed == self._last_feed else 0
+        self._last_feed = feed
+        if self.feed_repeats >= STALE_SCRAPES - 1 and is_open.any():
+            snapshot_flags |= STALE
+        missing = np.setdiff1d(self.numbers, branch_ids)
+        if len(missing):
+            snapshot_flags |= MISSING
+        flags |= snapshot_flags & (ALL_ZERO | STALE)
+
+        # Add the scrape to the history. Closed hours don't count towards
+        # the medians.
+        self.last[positions] = values_known
+        positions, values_known = positions[open_known], values_known[open_known]
+        self.history[positions, self.filled[positions] % WINDOW] = \
+            values_known
+        self.filled[positions] += 1
+
+        return flags, snapshot_flags, missing.tolist()
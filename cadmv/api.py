@@ -0,0 +1,410 @@
+"""Transport-independent read API for the branches and their wait times.
+
+Api.handle() turns a request path (plus its headers) into a Response. Every
+rendered body is cached in memory under its endpoint, arguments and the
+current snapshot version (the timestamp of the latest scrape), so all of the
+requests made between two scrapes are answered without touching the
+database. The current wait times (and their per-region slices) are served
+straight from the pre-encoded buffers of cadmv.snapshot. Responses carry an
+ETag, conditional requests are answered with 304 Not Modified and clients
+that accept gzip get the pre-compressed body.
+
+Endpoints:
+
+    GET /api/branches
+    GET /api/branches/{number}
+    GET /api/branches/region/{region}?services=<names>
+    GET /api/wait_times
+    GET /api/wait_times/region/{region}
+    GET /api/wait_times/{number}?start=<iso datetime>&end=<iso datetime>
+    GET /api/wait_times/{number}/percentiles?start=<iso datetime>&end=<...>
+    GET /api/wait_times/{number}/series?start=<...>&end=<...>&fill=<fill>
+    GET /api/wait_times/{number}/gaps?start=<iso datetime>&end=<...>
+    GET /api/heatmaps/{number}
+    GET /api/heatmaps/region/{region}
+    GET /api/trends/region/{region}?start=<iso datetime>&end=<iso datetime>
+    GET /api/changes?since=<snapshot id>
+    GET /api/nearest?lat=<deg>&lon=<deg>&k=<count>&max_km=<km>
+                    &services=<names>
+    GET /api/best?lat=<deg>&lon=<deg>&k=<count>&max_km=<km>&kind=<kind>
+                 &services=<names>
+    GET /api/forecast/{number}?at=<iso datetime>
+    GET /api/recent/{number}?start=<iso datetime>&end=<iso datetime>
+    GET /api/recent/region/{region}?start=<iso datetime>&end=<...>
+    GET /api/recent/typical
+
+The nearest and best branch endpoints are answered from an in-memory
+spatial index (see cadmv.geo) and aren't cached, since every client sends
+different coordinates. services restricts the branches to the ones offering
+all of the comma separated services, e.g. services=cdl,vr (see
+cadmv.services). Forecasts are answered from the profiles saved by
+the scraper (see cadmv.forecast). The recent endpoints are answered from a
+RecentWindow of the last window_days (see cadmv.window), synced with the
+database when the snapshot version changes, and answer 404 without one.
+"""
+from collections import namedtuple
+import datetime
+import logging
+import re
+import threading
+from urllib.parse import parse_qs, urlsplit
+
+from cadmv import branches
+from cadmv.cache import TTLCache
+from cadmv.catalog import Catalog
+from cadmv import coverage
+from cadmv import diff
+from cadmv.forecast import Forecaster
+from cadmv.geo import BranchIndex
+import cadmv.queries as queries
+from cadmv import services
+from cadmv.snapshot import SnapshotStore, render
+from cadmv.window import RecentWindow
+
+
+logger = logging.getLogger('cadmv.api')
+
+Response = namedtuple('Response', ['status', 'headers', 'body'])
+
+ROUTES = (
+    (re.compile(r'^/api/branches/?$'), 'branches'),
+    (re.compile(r'^/api/branches/(\d+)/?$'), 'branch'),
+    (re.compile(r'^/api/branches/region/(\d+)/?$'), 'region'),
+    (re.compile(r'^/api/wait_times/?$'), 'wait_times'),
+    (re.compile(r'^/api/wait_times/region/(\d+)/?$'), 'region_wait_times'),
+    (re.compile(r'^/api/wait_times/(\d+)/?$'), 'branch_wait_times'),
+    (re.compile(r'^/api/wait_times/(\d+)/percentiles/?$'),
+     'branch_percentiles'),
+    (re.compile(r'^/api/wait_times/(\d+)/series/?$'), 'branch_series'),
+    (re.compile(r'^/api/wait_times/(\d+)/gaps/?$'), 'branch_gaps'),
+    (re.compile(r'^/api/heatmaps/(\d+)/?$'), 'heatmap'),
+    (re.compile(r'^/api/heatmaps/region/(\d+)/?$'), 'region_heatmaps'),
+    (re.compile(r'^/api/trends/region/(\d+)/?$'), 'region_trends'),
+    (re.compile(r'^/api/changes/?$'), 'changes'),
+    (re.compile(r'^/api/nearest/?$'), 'nearest'),
+    (re.compile(r'^/api/best/?$'), 'best'),
+    (re.compile(r'^/api/forecast/(\d+)/?$'), 'forecast'),
+    (re.compile(r'^/api/recent/(\d+)/?$'), 'recent_series'),
+    (re.compile(r'^/api/recent/region/(\d+)/?$'), 'recent_region'),
+    (re.compile(r'^/api/recent/typical/?$'), 'recent_typical'),
+)
+
+LOADERS = {
+    'branches': branches.read_all,
+    'branch': branches.read_one,
+    'region': branches.read_region,
+    'wait_times': branches.read_current_wait_times,
+    'region_wait_times': branches.read_current_region_wait_times,
+    'branch_wait_times': branches.read_wait_times,
+    'branch_percentiles': branches.read_percentiles,
+    'branch_series': branches.read_series,
+    'branch_gaps': branches.read_gaps,
+    'heatmap': branches.read_heatmap,
+    'region_heatmaps': branches.read_region_heatmaps,
+    'region_trends': branches.read_region_trends,
+    'changes': branches.read_changes,
+}
+
+# Endpoints answered from the spatial index, the current wait times and the
+# forecasts rather than the database, and the arguments they take from a
+# Nearby
+NEARBY_LOADERS = {
+    'nearest': lambda nearby, **params: branches.read_nearest(
+        nearby.index, **params),
+    'best': lambda nearby, **params: branches.read_best(
+        nearby.index, nearby.wait_times, **params),
+    'forecast': lambda nearby, number, **params: branches.read_forecast(
+        nearby.forecaster, number, **params),
+}
+
+# Endpoints answered from the RecentWindow, see Api.recent()
+WINDOW_LOADERS = {
+    'recent_series': branches.read_recent_series,
+    'recent_region': branches.read_recent_region,
+    'recent_typical': branches.read_recent_typical,
+}
+
+POINT_PARAMS = {'lat': float, 'lon': float, 'k': int, 'max_km': float,
+                'services': services.parse}
+
+RANGE_PARAMS = {
+    'start': datetime.datetime.fromisoformat,
+    'end': datetime.datetime.fromisoformat,
+}
+
+# Query string parameters accepted by each endpoint, and their parsers
+PARAMS = {
+    'region': {
+        'services': services.parse,
+    },
+    'branch_wait_times': RANGE_PARAMS,
+    'branch_percentiles': RANGE_PARAMS,
+    'branch_series': dict(RANGE_PARAMS, fill=coverage.parse_fill),
+    'branch_gaps': RANGE_PARAMS,
+    'region_trends': RANGE_PARAMS,
+    'changes': {
+        'since': int,
+    },
+    'nearest': POINT_PARAMS,
+    'best': dict(POINT_PARAMS, kind=str),
+    'forecast': {
+        'at': datetime.datetime.fromisoformat,
+    },
+    'recent_series': RANGE_PARAMS,
+    'recent_region': RANGE_PARAMS,
+}
+
+# The spatial index, the current wait times and the forecasts (or None), see
+# Api.nearby()
+Nearby = namedtuple('Nearby', ['index', 'wait_times', 'forecaster'])
+
+EMPTY_VERSION = 'empty'
+
+
+def route(path):
+    """Matches a request path against ROUTES
+
+    :param path:    (str) request path, with or without a query string
+    :return:        (tuple) of the endpoint name, a tuple of its int
+                    arguments and a dict of its query parameters, or None if
+                    no route matches
+    :raises ValueError: if a query parameter can't be parsed
+    """
+    url = urlsplit(path)
+    for pattern, endpoint in ROUTES:
+        match = pattern.match(url.path)
+        if match:
+            args = tuple(int(arg) for arg in match.groups())
+            return endpoint, args, parse_params(endpoint, url.query)
+
+    return None
+
+
+def parse_params(endpoint, query_string):
+    """Parses the query string parameters accepted by endpoint"""
+    query = parse_qs(query_string)
+    params = {}
+    for name, parse in PARAMS.get(endpoint, {}).items():
+        if name in query:
+            params[name] = parse(query[name][0])
+
+    return params
+
+
+def load_forecaster(path):
+    """Loads the forecasts saved by the scraper, or returns None"""
+    if path is None:
+        return None
+    try:
+        return Forecaster.load(path)
+    except (OSError, ValueError, KeyError):
+        logger.error('Failed to load the forecasts from %s', path,
+                     exc_info=True)
+        return None
+
+
+def error_buffer(status, message):
+    """Builds a cacheable error response"""
+    return render({'error': message}, status)
+
+
+def etag_matches(etag, if_none_match):
+    """Determines if an If-None-Match header value matches etag"""
+    if not etag or not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+
+    candidates = (tag.strip() for tag in if_none_match.split(','))
+    return any(tag.replace('W/', '', 1) == etag for tag in candidates)
+
+
+def accepts_gzip(accept_encoding):
+    """Determines if an Accept-Encoding header value allows gzip"""
+    if not accept_encoding:
+        return False
+
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0')
+
+    return False
+
+
+def build_response(buf, version, headers=None):
+    """Turns a Buffer into a Response, answering 304 Not Modified when the
+    client already holds the current representation and serving the gzipped
+    body to clients that accept it
+    """
+    headers = headers or {}
+    resp_headers = {
+        'Content-Type': 'application/json',
+        'Cache-Control': 'no-cache',
+        'X-Snapshot-Version': version,
+    }
+    body, etag = buf.body, buf.etag
+    if buf.gzipped is not None:
+        resp_headers['Vary'] = 'Accept-Encoding'
+        if accepts_gzip(headers.get('Accept-Encoding')):
+            body, etag = buf.gzipped, buf.etag[:-1] + '-gzip"'
+            resp_headers['Content-Encoding'] = 'gzip'
+
+    if etag:
+        resp_headers['ETag'] = etag
+        if etag_matches(etag, headers.get('If-None-Match')):
+            return Response(304, resp_headers, b'')
+
+    resp_headers['Content-Length'] = str(len(body))
+    return Response(buf.status, resp_headers, body)
+
+
+class Api:
+    """The read API. A single instance is shared by every request thread.
+
+    :param Session:     SQLAlchemy sessionmaker used on cache misses
+    :param ttl:         (int) seconds a rendered response is kept. Entries
+                        are keyed by snapshot version, so this only bounds
+                        memory, it doesn't affect freshness
+    :param version_ttl: (int) seconds between checks for a new snapshot
+                        version. This bounds how stale a response can be
+    :param snapshots:   (SnapshotStore) holding the pre-encoded current
+                        snapshot, or None for one that renders it in-process
+    :param forecast_path:   (str) file the scraper saves the forecasts to, or
+                            None to answer no forecasts
+    :param window_days:     (int) days of wait times kept in memory for the
+                            recent endpoints, or None to keep none
+    """
+
+    def __init__(self, Session, ttl=300, version_ttl=5, snapshots=None,
+                 forecast_path=None, window_days=None):
+        self.Session = Session
+        self.cache = TTLCache(ttl)
+        self.snapshots = snapshots or SnapshotStore()
+        self.forecast_path = forecast_path
+        self.window_days = window_days
+        self._versions = TTLCache(version_ttl, maxsize=1)
+        self._window = None
+        self._window_version = None
+        self._window_lock = threading.Lock()
+
+    def version(self):
+        """Returns the current snapshot version, checking the database at
+        most once every version_ttl seconds
+        """
+        return self._versions.get_or_set('version', self._load_version)
+
+    def invalidate(self):
+        """Forgets the snapshot version so the next request checks for a new
+        one. Call this after ingesting a scrape in the same process.
+        """
+        self._versions.clear()
+
+    def handle(self, path, headers=None):
+        """Answers a GET request
+
+        :param path:    (str) request path including the query string
+        :param headers: (mapping) request headers, or None
+        :return:        (Response)
+        """
+        version = self.version()
+
+        buf = self.snapshots.get(path.rstrip('/'))
+        if buf is not None and self.snapshots.version == version:
+            return build_response(buf, version, headers)
+
+        try:
+            matched = route(path)
+        except ValueError as err:
+            return build_response(error_buffer(400, str(err)), version)
+        if matched is None:
+            return build_response(error_buffer(404, 'Not found'), version)
+
+        endpoint, args, params = matched
+        if endpoint in NEARBY_LOADERS:
+            try:
+                data = NEARBY_LOADERS[endpoint](
+                    self.nearby(version), *args, **params)
+            except ValueError as err:
+                return build_response(error_buffer(400, str(err)), version)
+            if data is None:
+                return build_response(error_buffer(404, 'Not found'), version)
+            return build_response(render(data, compress=False), version)
+
+        key = (endpoint, args, tuple(sorted(params.items())), version)
+        if endpoint in WINDOW_LOADERS:
+            buf = self.cache.get_or_set(
+                key, lambda: self._render_recent(endpoint, args, params,
+                                                 version))
+        else:
+            buf = self.cache.get_or_set(
+                key, lambda: self._render(endpoint, args, params))
+        if buf is None:
+            return build_response(error_buffer(404, 'Not found'), version)
+
+        return build_response(buf, version, headers)
+
+    def nearby(self, version):
+        """Returns the Nearby of a snapshot version, building it once"""
+        return self.cache.get_or_set(('nearby', version), self._load_nearby)
+
+    def _render_recent(self, endpoint, args, params, version):
+        """Reads the RecentWindow synced to a snapshot version and renders
+        the result, or returns None if it found nothing
+        """
+        with self._window_lock:
+            data = WINDOW_LOADERS[endpoint](
+                self.recent(version), *args, **params)
+        if data is None:
+            return None
+
+        return render(data)
+
+    def recent(self, version):
+        """Returns the RecentWindow synced to a snapshot version, building it
+        from the database once, or None if window_days is None. Must be
+        called with self._window_lock held, which also guards its reads
+        """
+        if self.window_days is None:
+            return None
+        if self._window is None:
+            self._window = RecentWindow.from_session(
+                self.Session(), Catalog.from_session(self.Session()),
+                self.window_days)
+        elif self._window_version != version:
+            self._window.sync(self.Session())
+        self._window_version = version
+        return self._window
+
+    def _load_nearby(self):
+        """Builds the spatial index and reads the current wait times and the
+        forecasts
+        """
+        index = BranchIndex(Catalog.from_session(self.Session()))
+        wait_times = queries.get_current_wait_times(self.Session())
+        return Nearby(index, diff.snapshot_state(wait_times),
+                      load_forecaster(self.forecast_path))
+
+    def _load_version(self):
+        """Reads the snapshot version from the database and makes sure the
+        buffers of that snapshot are loaded
+        """
+        timestamp = queries.get_latest_timestamp(self.Session())
+        if timestamp is None:
+            return EMPTY_VERSION
+
+        version = timestamp.isoformat()
+        self.snapshots.sync(version, self.Session)
+        return version
+
+    def _render(self, endpoint, args, params):
+        """Runs the loader for endpoint and renders its result, or returns
+        None if it found nothing. The loaders also answer None when the
+        database fails, so None is never cached
+        """
+        logger.debug('Cache miss for %s%s', endpoint, args)
+        data = LOADERS[endpoint](self.Session(), *args, **params)
+        if data is None:
+            return None
+
+        return render(data)
@@ -0,0 +1,103 @@
+"""Archive of the raw responses of the DMV's wait times feed.
+
+The bodies are stored gzipped and content-addressed, under the SHA-256 of
+the raw body, so a body the feed repeats (as it does all night long) is
+stored once. Every fetch is recorded in a daily index of fetch time and
+hash. The layout of an archive directory is
+
+    objects/3f/3fa2...e1.gz     one gzipped body per distinct hash
+    index/2018-12-06.tsv        lines of "2018-12-06T23:22:13.859932\\t3fa2...e1"
+
+The scraper archives the bodies it fetches with --archive (or
+config.archive_dir), and bin/replay.py ingests an archive again.
+"""
+import datetime
+import gzip
+import hashlib
+import os
+import tempfile
+
+
+class Archive:
+    """Content-addressed store of raw feed bodies
+
+    :param root:    (str) directory of the archive, created if needed
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'index'), exist_ok=True)
+
+    def path(self, digest):
+        """Returns the file of the body with the hash digest"""
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.gz')
+
+    def put(self, body, fetched_at):
+        """Archives a body fetched at a time. The body is only written if it
+        isn't in the archive yet.
+
+        :param body:        (bytes) raw body of the response
+        :param fetched_at:  (datetime) time of the fetch
+        :return:            (str) hex SHA-256 of the body
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(gzip.compress(body))
+                os.replace(tmp_path, path)
+            except:
+                os.remove(tmp_path)
+                raise
+
+        index = os.path.join(self.root, 'index',
+                             fetched_at.date().isoformat() + '.tsv')
+        with open(index, 'a') as f:
+            f.write(f'{fetched_at.isoformat()}\t{digest}\n')
+
+        return digest
+
+    def get(self, digest):
+        """Returns the raw body with the hash digest
+
+        :raises FileNotFoundError: if it isn't in the archive
+        """
+        with open(self.path(digest), 'rb') as f:
+            return gzip.decompress(f.read())
+
+    def days(self):
+        """Returns the dates that have fetches in the archive, oldest first"""
+        return sorted(
+            datetime.date.fromisoformat(name[:-4])
+            for name in os.listdir(os.path.join(self.root, 'index'))
+            if name.endswith('.tsv'))
+
+    def entries(self, start=None, end=None):
+        """Yields the fetches of a range, oldest first
+
+        :param start:   (datetime) inclusive lower bound, or None
+        :param end:     (datetime) exclusive upper bound, or None
+        :return:        (generator) of (fetched_at, hex digest) tuples
+        """
+        for day in self.days():
+            if start is not None and day < start.date() \
+                    or end is not None and day > end.date():
+                continue
+            with open(os.path.join(self.root, 'index',
+                                   day.isoformat() + '.tsv')) as f:
+                entries = []
+                for line in f:
+                    if not line.strip():
+                        continue
+                    timestamp, digest = line.split()
+                    fetched_at = datetime.datetime.fromisoformat(timestamp)
+                    if (start is None or fetched_at >= start) \
+                            and (end is None or fetched_at < end):
+                        entries.append((fetched_at, digest))
+            # Concurrent scrapers may append out of order
+            yield from sorted(entries)
@@ -0,0 +1,438 @@
+"""Asyncio version of the read API in cadmv.api.
+
+AsyncApi serves the same endpoints, caching, ETags and pre-encoded snapshot
+buffers as cadmv.api.Api, but reads the database through cadmv.async_queries
+so that one event loop can serve thousands of concurrent clients without a
+thread per in-flight request.
+
+Because holding a request open costs nothing here, the async API also pushes
+new snapshots to subscribers instead of having them poll:
+
+    GET /api/stream                         server-sent events, one
+                                            "snapshot" event per scrape
+    GET /api/poll?since=<version>&timeout=<seconds>
+                                            long-poll: answers with the
+                                            current snapshot as soon as its
+                                            version differs from since, or
+                                            204 No Content on timeout
+"""
+import asyncio
+import datetime
+import logging
+from urllib.parse import parse_qs, urlsplit
+
+from cadmv import analytics
+from cadmv import branches
+import cadmv.async_queries as async_queries
+from cadmv.api import (
+    EMPTY_VERSION, NEARBY_LOADERS, WINDOW_LOADERS, Nearby, Response,
+    build_response, error_buffer, load_forecaster, route
+)
+from cadmv.cache import TTLCache
+from cadmv.catalog import Catalog
+from cadmv import coverage
+from cadmv import diff
+from cadmv.geo import BranchIndex
+from cadmv import heatmap
+from cadmv.hours import OpeningHours
+from cadmv.push import Broker
+from cadmv.snapshot import (
+    CURRENT_PATH, SnapshotStore, render, render_snapshot
+)
+from cadmv.window import RecentWindow
+
+
+logger = logging.getLogger('cadmv.async_api')
+
+STREAM_PATH = '/api/stream'
+POLL_PATH = '/api/poll'
+
+# Default and largest long-poll timeouts, in seconds
+POLL_TIMEOUT = 30
+MAX_POLL_TIMEOUT = 120
+
+
+async def read_all(session):
+    """Async version of branches.read_all()"""
+    branch_list = await async_queries.get_all_branches(session)
+    return [branches.branch_to_dict(branch) for branch in branch_list]
+
+
+async def read_one(session, number):
+    """Async version of branches.read_one()"""
+    branch = await async_queries.get_branch_by_number(session, number)
+    if branch is None:
+        return None
+
+    return branches.branch_to_dict(branch)
+
+
+async def read_region(session, region, services=0):
+    """Async version of branches.read_region()"""
+    branch_list = await async_queries.get_branches_by_region(
+        session, region, services)
+    if not branch_list:
+        return None
+
+    return [branches.branch_to_dict(branch) for branch in branch_list]
+
+
+async def read_current_wait_times(session):
+    """Async version of branches.read_current_wait_times()"""
+    wait_times = await async_queries.get_current_wait_times(session)
+    return branches.wait_times_to_snapshot(wait_times)
+
+
+async def read_current_region_wait_times(session, region):
+    """Async version of branches.read_current_region_wait_times()"""
+    wait_times = await async_queries.get_current_wait_times(
+        session, region=region)
+    if not wait_times:
+        return None
+
+    return branches.wait_times_to_snapshot(wait_times)
+
+
+async def read_wait_times(session, number, start=None, end=None):
+    """Async version of branches.read_wait_times()"""
+    wait_times = await async_queries.get_wait_times_by_range(
+        session, number, start, end)
+    if not wait_times:
+        return None
+
+    return [branches.wait_time_to_dict(wt) for wt in wait_times]
+
+
+async def read_percentiles(session, number, start=None, end=None):
+    """Async version of branches.read_percentiles(). Like it, large ranges
+    are computed exactly by cadmv.analytics when it is available, in a
+    thread, so that both servers answer the same
+    """
+    duckdb = await asyncio.to_thread(
+        analytics.for_range, session.get_bind(), start, end)
+    if duckdb is not None:
+        await session.close()
+        return await asyncio.to_thread(
+            analytics.get_wait_time_percentiles, duckdb, number, start, end)
+    return await async_queries.get_wait_time_percentiles(
+        session, number, start, end)
+
+
+async def read_series(session, number, start=None, end=None, fill='mark'):
+    """Async version of branches.read_series()"""
+    wait_times = await async_queries.get_wait_times_by_range(
+        session, number, start, end)
+    if not wait_times:
+        return None
+
+    return branches.series_to_dicts(wait_times, start, end, fill)
+
+
+async def read_gaps(session, number, start=None, end=None):
+    """Async version of branches.read_gaps()"""
+    latest = await async_queries.get_latest_timestamp(session)
+    opening_hours = OpeningHours(
+        Catalog(await async_queries.get_all_branches(session)))
+    position = opening_hours.catalog.position(number)
+    if latest is None or position is None:
+        return None
+
+    start, end = branches.gap_range(latest, start, end)
+    days = await async_queries.get_coverage(
+        session, start.date(), end.date(), number)
+    return branches.gaps_to_dicts(coverage.find_gaps(
+        days, [number], start, end,
+        opening_hours.bitmap[position:position + 1]))
+
+
+async def read_heatmap(session, number):
+    """Async version of branches.read_heatmap()"""
+    heatmaps = heatmap.assemble(
+        await async_queries.get_heatmap_cells(session, branch_num=number))
+    return heatmaps[0] if heatmaps else None
+
+
+async def read_region_heatmaps(session, region):
+    """Async version of branches.read_region_heatmaps()"""
+    heatmaps = heatmap.assemble(
+        await async_queries.get_heatmap_cells(session, region=region))
+    return heatmaps or None
+
+
+async def read_region_trends(session, region, start=None, end=None):
+    """Async version of branches.read_region_trends(), always on the
+    database
+    """
+    trends = await async_queries.get_region_trends(session, start, end, region)
+    return branches.trends_to_dicts(region, trends) if trends else None
+
+
+async def read_changes(session, since=None):
+    """Async version of branches.read_changes()"""
+    return await async_queries.get_changes_since(session, since)
+
+
+LOADERS = {
+    'branches': read_all,
+    'branch': read_one,
+    'region': read_region,
+    'wait_times': read_current_wait_times,
+    'region_wait_times': read_current_region_wait_times,
+    'branch_wait_times': read_wait_times,
+    'branch_percentiles': read_percentiles,
+    'branch_series': read_series,
+    'branch_gaps': read_gaps,
+    'heatmap': read_heatmap,
+    'region_heatmaps': read_region_heatmaps,
+    'region_trends': read_region_trends,
+    'changes': read_changes,
+}
+
+
+class AsyncApi:
+    """The read API for an asyncio event loop. See cadmv.api.Api.
+
+    :param Session:     SQLAlchemy sessionmaker creating AsyncSessions
+    :param ttl:         (int) seconds a rendered response is kept
+    :param version_ttl: (int) seconds between checks for a new snapshot
+                        version
+    :param snapshots:   (SnapshotStore) holding the pre-encoded current
+                        snapshot, or None for one that renders it in-process
+    :param broker:      (Broker) new snapshots are published to, or None for
+                        a new one
+    :param forecast_path:   (str) file the scraper saves the forecasts to, or
+                            None to answer no forecasts
+    :param window_days:     (int) days of wait times kept in memory for the
+                            recent endpoints, or None to keep none
+    """
+
+    def __init__(self, Session, ttl=300, version_ttl=5, snapshots=None,
+                 broker=None, forecast_path=None, window_days=None):
+        self.Session = Session
+        self.cache = TTLCache(ttl)
+        self.snapshots = snapshots or SnapshotStore()
+        self.broker = broker or Broker()
+        self.forecast_path = forecast_path
+        self.version_ttl = version_ttl
+        self._versions = TTLCache(version_ttl, maxsize=1)
+        self._inflight = {}
+        self.window_days = window_days
+        self._window = None
+        self._window_version = None
+        self._window_lock = asyncio.Lock()
+
+    async def version(self):
+        """Returns the current snapshot version, checking the database at
+        most once every version_ttl seconds
+        """
+        version = self._versions.get('version')
+        if version is None:
+            version = await self._fill(
+                self._versions, 'version', self._load_version)
+        return version
+
+    def invalidate(self):
+        """Forgets the snapshot version so the next request checks for a new
+        one
+        """
+        self._versions.clear()
+
+    async def handle(self, path, headers=None):
+        """Answers a GET request. See cadmv.api.Api.handle()"""
+        version = await self.version()
+
+        buf = self.snapshots.get(path.rstrip('/'))
+        if buf is not None and self.snapshots.version == version:
+            return build_response(buf, version, headers)
+
+        try:
+            matched = route(path)
+        except ValueError as err:
+            return build_response(error_buffer(400, str(err)), version)
+        if matched is None:
+            return build_response(error_buffer(404, 'Not found'), version)
+
+        endpoint, args, params = matched
+        if endpoint in NEARBY_LOADERS:
+            nearby = await self.nearby(version)
+            try:
+                data = NEARBY_LOADERS[endpoint](nearby, *args, **params)
+            except ValueError as err:
+                return build_response(error_buffer(400, str(err)), version)
+            if data is None:
+                return build_response(error_buffer(404, 'Not found'), version)
+            return build_response(render(data, compress=False), version)
+
+        key = (endpoint, args, tuple(sorted(params.items())), version)
+        buf = self.cache.get(key)
+        if buf is None and endpoint in WINDOW_LOADERS:
+            buf = await self._fill(
+                self.cache, key,
+                lambda: self._render_recent(endpoint, args, params, version))
+        elif buf is None:
+            buf = await self._fill(
+                self.cache, key, lambda: self._render(endpoint, args, params))
+        if buf is None:
+            return build_response(error_buffer(404, 'Not found'), version)
+
+        return build_response(buf, version, headers)
+
+    async def nearby(self, version):
+        """Returns the Nearby of a snapshot version, building it once"""
+        key = ('nearby', version)
+        nearby = self.cache.get(key)
+        if nearby is None:
+            nearby = await self._fill(self.cache, key, self._load_nearby)
+        return nearby
+
+    async def _render_recent(self, endpoint, args, params, version):
+        """Reads the RecentWindow synced to a snapshot version and renders
+        the result, or returns None if it found nothing
+        """
+        async with self._window_lock:
+            window = await self.recent(version)
+            data = WINDOW_LOADERS[endpoint](window, *args, **params)
+        if data is None:
+            return None
+
+        return render(data)
+
+    async def recent(self, version):
+        """Returns the RecentWindow synced to a snapshot version, building it
+        from the database once. See cadmv.api.Api.recent()
+        """
+        if self.window_days is None:
+            return None
+        start = None
+        if self._window is None:
+            branch_list = await async_queries.get_all_branches(self.Session())
+            self._window = RecentWindow(Catalog(branch_list), self.window_days)
+            latest = await async_queries.get_latest_timestamp(self.Session())
+            if latest is None:
+                self._window_version = version
+                return self._window
+            start = latest - datetime.timedelta(days=self.window_days)
+        if self._window_version != version:
+            self._window.add_samples(
+                await async_queries.get_open_wait_time_samples(
+                    self.Session(), self._window.next_start(start)))
+        self._window_version = version
+        return self._window
+
+    async def _load_nearby(self):
+        """Builds the spatial index and reads the current wait times and the
+        forecasts
+        """
+        branch_list = await async_queries.get_all_branches(self.Session())
+        wait_times = await async_queries.get_current_wait_times(self.Session())
+        return Nearby(BranchIndex(Catalog(branch_list)),
+                      diff.snapshot_state(wait_times),
+                      load_forecaster(self.forecast_path))
+
+    async def poll(self, path, headers=None):
+        """Answers a long-poll request for the current snapshot
+
+        :param path:    (str) request path including the query string
+        :param headers: (mapping) request headers, or None
+        :return:        (Response) the current snapshot once its version
+                        differs from the since parameter, or 204 No Content
+                        if that doesn't happen before the timeout
+        """
+        query = parse_qs(urlsplit(path).query)
+        since = query.get('since', [None])[0]
+        version = await self.version()
+        try:
+            timeout = float(query.get('timeout', [POLL_TIMEOUT])[0])
+        except ValueError as err:
+            return build_response(error_buffer(400, str(err)), version)
+
+        message = await self.broker.wait_async(
+            after=since, timeout=max(0, min(timeout, MAX_POLL_TIMEOUT)))
+        if message is None:
+            return Response(204, {'X-Snapshot-Version': version}, b'')
+
+        return build_response(message.buffer, message.version, headers)
+
+    async def watch(self):
+        """Checks for a new snapshot every version_ttl seconds, forever, so
+        that subscribers are pushed new snapshots even when no other requests
+        arrive
+        """
+        while True:
+            try:
+                await self.version()
+            except Exception:
+                logger.error('Could not check for a new snapshot',
+                             exc_info=True)
+            await asyncio.sleep(self.version_ttl)
+
+    async def _fill(self, cache, key, factory):
+        """Awaits factory() and caches its result under key, unless it is
+        None. Concurrent misses on the same key share a single call to
+        factory(), run in a task of its own: a caller that is cancelled, like
+        a client that disconnects, doesn't cancel it for the others.
+        """
+        task = self._inflight.get((id(cache), key))
+        if task is None:
+            task = asyncio.ensure_future(self._store(cache, key, factory))
+            self._inflight[(id(cache), key)] = task
+            task.add_done_callback(
+                lambda done: self._forget(cache, key, done))
+        return await asyncio.shield(task)
+
+    @staticmethod
+    async def _store(cache, key, factory):
+        """Awaits factory() and caches its result under key, unless it is
+        None
+        """
+        value = await factory()
+        if value is not None:
+            cache.set(key, value)
+        return value
+
+    def _forget(self, cache, key, task):
+        """Removes a finished fill of _fill()"""
+        del self._inflight[(id(cache), key)]
+        # Don't warn about an exception nobody else was waiting for
+        if not task.cancelled():
+            task.exception()
+
+    async def _load_version(self):
+        """Reads the snapshot version from the database, makes sure the
+        buffers of that snapshot are loaded and publishes it
+        """
+        timestamp = await async_queries.get_latest_timestamp(self.Session())
+        if timestamp is None:
+            return EMPTY_VERSION
+
+        version = timestamp.isoformat()
+        if self.snapshots.version != version:
+            buffers = await asyncio.to_thread(self.snapshots.load, version)
+            if buffers is None:
+                buffers = await self._render_snapshot()
+            self.snapshots.publish(version, buffers)
+
+        current = self.snapshots.get(CURRENT_PATH)
+        if current is not None:
+            self.broker.publish(version, current)
+
+        return version
+
+    async def _render_snapshot(self):
+        """Renders the buffers of the most recent scrape in the database"""
+        logger.debug('Rendering the current snapshot')
+        branch_list = await async_queries.get_all_branches(self.Session())
+        regions = {branch.number: branch.region for branch in branch_list}
+        wait_times = await async_queries.get_current_wait_times(self.Session())
+        return render_snapshot(wait_times, regions)
+
+    async def _render(self, endpoint, args, params):
+        """Runs the loader for endpoint and renders its result, or returns
+        None if it found nothing. See cadmv.api.Api._render()
+        """
+        logger.debug('Cache miss for %s%s', endpoint, args)
+        data = await LOADERS[endpoint](self.Session(), *args, **params)
+        if data is None:
+            return None
+
+        return render(data)
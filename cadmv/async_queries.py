@@ -0,0 +1,470 @@
+"""Asyncio versions of the database queries in cadmv.queries.
+
+Every function takes a SQLAlchemy AsyncSession (aiosqlite for SQLite,
+asyncpg for PostgreSQL) and otherwise has the same arguments, return values
+and error handling as its counterpart in cadmv.queries.
+"""
+import json
+import logging
+
+from sqlalchemy import func, select
+from sqlalchemy.sql import exists
+
+from cadmv import coverage
+from cadmv import diff
+from cadmv import normalized
+from cadmv.profiling import attributed
+from cadmv.models import (
+    Branch, CoverageDay, HeatmapCell, Snapshot, WaitTime, WaitTimeSketch
+)
+from cadmv.queries import MAX_CHANGES_SPAN, _as_date
+from cadmv import sketch
+from cadmv.session import async_session_scope
+
+
+logger = logging.getLogger('cadmv.async_queries')
+
+
+@attributed
+async def create_new_branch(session, branch_info):
+    """Creates a new DMV branch in the database. See
+    queries.create_new_branch()
+    """
+    branch = Branch(**branch_info)
+    async with async_session_scope(session) as sessn:
+        sessn.add(branch)
+
+
+@attributed
+async def update_branch(session, branch_info):
+    """Updates DMV branch in the database. See queries.update_branch()"""
+    number = branch_info['number']
+    async with async_session_scope(session) as sessn:
+        await sessn.execute(
+            Branch.__table__.update()
+            .where(Branch.number == number)
+            .values(**branch_info)
+        )
+
+
+@attributed
+async def get_branch_by_number(session, number):
+    """Gets a branch by its number
+
+    :param session:     SQLAlchemy AsyncSession
+    :param number:      (int) number of branch
+    :returns branch:    first branch to match the number, or None if none
+                        is found
+    """
+    branch = None
+    try:
+        result = await session.execute(select(Branch).filter_by(number=number))
+        branch = result.scalars().first()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return branch
+
+
+@attributed
+async def get_branches_by_region(session, region, services=0):
+    """Gets branches by region
+
+    :param session:     SQLAlchemy AsyncSession
+    :param region:      (int) region number
+    :param services:    (int) bitmask of the services the branches must all
+                        offer, or 0 for any branch
+    :returns branches:  all branches to match the region
+    """
+    branches = None
+    try:
+        query = select(Branch).filter_by(region=region)
+        if services:
+            query = query.filter(
+                Branch.services.op('&')(services) == services)
+        result = await session.execute(query)
+        branches = result.scalars().all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return branches
+
+
+@attributed
+async def is_branch_in_database(session, branch_num):
+    """Determines if a branch exists in database.
+
+    :param branch_num:  (int) branch number
+    :return:            True if the branch is found in the database.
+                        Otherwise, False.
+    """
+    does_exist = False
+    try:
+        result = await session.execute(
+            select(exists().where(Branch.number == branch_num)))
+        does_exist = result.scalar()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return does_exist
+
+
+@attributed
+async def create_wait_time(session, wait_time):
+    """Creates a new wait time entry in the database. See
+    queries.create_wait_time()
+    """
+    await create_wait_times(session, [wait_time])
+
+
+@attributed
+async def create_wait_times(session, wait_times):
+    """Creates new wait time entries in the database en masse. See
+    queries.create_wait_times()
+    """
+    async with async_session_scope(session) as sessn:
+        if await sessn.run_sync(normalized.is_normalized):
+            await sessn.run_sync(normalized.add_wait_times, wait_times)
+        else:
+            sessn.add_all([WaitTime(**wt) for wt in wait_times])
+
+
+@attributed
+async def get_wait_time_by_number(session, branch_num):
+    """Gets the first wait time for a particular DMV branch, or None"""
+    wait_time = None
+    try:
+        result = await session.execute(
+            select(WaitTime).filter_by(branch_id=branch_num))
+        wait_time = result.scalars().first()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return wait_time
+
+
+@attributed
+async def get_wait_time_by_date(session, date):
+    """Gets the wait times for a particular date. See
+    queries.get_wait_time_by_date()
+    """
+    wait_times = None
+    year, month, day = date.date().year, date.date().month, date.date().day
+    try:
+        result = await session.execute(
+            select(WaitTime)
+            .filter(func.extract('year', WaitTime.timestamp) == year)
+            .filter(func.extract('month', WaitTime.timestamp) == month)
+            .filter(func.extract('day', WaitTime.timestamp) == day)
+        )
+        wait_times = result.scalars().all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return wait_times
+
+
+@attributed
+async def get_wait_times_by_region(session, region):
+    """Gets the (wait time, branch) pairs of a region. See
+    queries.get_wait_times_by_region()
+    """
+    wait_times = None
+    try:
+        result = await session.execute(
+            select(WaitTime, Branch)
+            .filter(Branch.region == region)
+            .filter(Branch.number == WaitTime.branch_id)
+        )
+        wait_times = result.all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return wait_times
+
+
+@attributed
+async def get_all_branches(session):
+    """Gets every branch, sorted by branch number"""
+    branches = []
+    try:
+        result = await session.execute(select(Branch).order_by(Branch.number))
+        branches = result.scalars().all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return branches
+
+
+@attributed
+async def get_latest_timestamp(session):
+    """Gets the timestamp of the most recent scrape, or None"""
+    timestamp = None
+    try:
+        result = await session.execute(select(func.max(WaitTime.timestamp)))
+        timestamp = result.scalar()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return timestamp
+
+
+@attributed
+async def get_current_wait_times(session, region=None):
+    """Gets the wait times of every branch (or of one region) from the most
+    recent scrape. See queries.get_current_wait_times()
+    """
+    wait_times = []
+    try:
+        latest = select(func.max(WaitTime.timestamp)).scalar_subquery()
+        query = select(WaitTime).filter(WaitTime.timestamp == latest)
+        if region is not None:
+            query = query.join(Branch, Branch.number == WaitTime.branch_id)\
+                .filter(Branch.region == region)
+        result = await session.execute(query.order_by(WaitTime.branch_id))
+        wait_times = result.scalars().all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return wait_times
+
+
+@attributed
+async def get_wait_times_by_range(session, branch_num, start=None, end=None):
+    """Gets the wait times for a particular DMV branch between two times. See
+    queries.get_wait_times_by_range()
+    """
+    wait_times = []
+    try:
+        query = select(WaitTime).filter_by(branch_id=branch_num)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        result = await session.execute(query.order_by(WaitTime.timestamp))
+        wait_times = result.scalars().all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return wait_times
+
+
+@attributed
+async def get_open_wait_time_samples(session, start=None, end=None):
+    """Gets the wait times of every branch stored while it was open, as plain
+    rows. See queries.get_open_wait_time_samples()
+    """
+    samples = []
+    try:
+        query = select(WaitTime.branch_id, WaitTime.appt, WaitTime.non_appt,
+                       WaitTime.timestamp)\
+            .filter(WaitTime.is_open.isnot(False))\
+            .filter(func.coalesce(WaitTime.flags, 0) == 0)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        result = await session.execute(query)
+        samples = [tuple(row) for row in result.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return samples
+
+
+@attributed
+async def get_region_trends(session, start=None, end=None, region=None):
+    """Averages the wait times of every region by day. See
+    queries.get_region_trends()
+    """
+    trends = []
+    try:
+        day = func.date(WaitTime.timestamp)
+        query = select(
+            Branch.region, day, func.count(WaitTime.id),
+            func.avg(WaitTime.appt), func.avg(WaitTime.non_appt))\
+            .join(Branch, Branch.number == WaitTime.branch_id)\
+            .filter(WaitTime.is_open.isnot(False))\
+            .filter(func.coalesce(WaitTime.flags, 0) == 0)
+        if region is not None:
+            query = query.filter(Branch.region == region)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        result = await session.execute(
+            query.group_by(Branch.region, day).order_by(Branch.region, day))
+        trends = [(region_, _as_date(date), count, float(appt),
+                   float(non_appt))
+                  for region_, date, count, appt, non_appt in result.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return trends
+
+
+@attributed
+async def get_sketches(session, start=None, end=None, branch_num=None):
+    """Gets the hourly wait time sketches. See queries.get_sketches()"""
+    sketches = []
+    try:
+        query = select(
+            WaitTimeSketch.branch_id, WaitTimeSketch.hour,
+            WaitTimeSketch.count, WaitTimeSketch.appt,
+            WaitTimeSketch.non_appt)
+        if branch_num is not None:
+            query = query.filter(WaitTimeSketch.branch_id == branch_num)
+        if start is not None:
+            query = query.filter(WaitTimeSketch.hour >= start)
+        if end is not None:
+            query = query.filter(WaitTimeSketch.hour < end)
+        result = await session.execute(query)
+        sketches = [tuple(row) for row in result.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return sketches
+
+
+@attributed
+async def get_wait_time_percentiles(session, branch_num, start=None, end=None,
+                                    percentiles=(50, 90)):
+    """Estimates percentiles of the wait times of a branch. See
+    queries.get_wait_time_percentiles()
+    """
+    if start is not None:
+        start = start.replace(minute=0, second=0, microsecond=0)
+    sketches = await get_sketches(session, start, end, branch_num)
+    return sketch.summarize(sketches, percentiles)
+
+
+@attributed
+async def get_heatmap_cells(session, branch_num=None, region=None):
+    """Gets the stored heatmap cells. See queries.get_heatmap_cells()"""
+    cells = []
+    try:
+        query = select(
+            HeatmapCell.branch_id, HeatmapCell.weekday, HeatmapCell.hour,
+            HeatmapCell.count, HeatmapCell.appt_sum, HeatmapCell.non_appt_sum)
+        if branch_num is not None:
+            query = query.filter(HeatmapCell.branch_id == branch_num)
+        if region is not None:
+            query = query.join(Branch, Branch.number == HeatmapCell.branch_id)\
+                .filter(Branch.region == region)
+        result = await session.execute(query)
+        cells = [tuple(row) for row in result.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return cells
+
+
+@attributed
+async def get_coverage(session, start_day, end_day, branch_num=None):
+    """Gets the coverage bitmaps of a range of days. See
+    queries.get_coverage()
+    """
+    days = {}
+    try:
+        query = select(
+            CoverageDay.branch_id, CoverageDay.day, CoverageDay.slots)\
+            .filter(CoverageDay.day >= start_day)\
+            .filter(CoverageDay.day <= end_day)
+        if branch_num is not None:
+            query = query.filter(CoverageDay.branch_id == branch_num)
+        result = await session.execute(query)
+        days = {(branch_id, day): coverage.decode(blob)
+                for branch_id, day, blob in result.all()}
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return days
+
+
+@attributed
+async def get_latest_snapshot_version(session):
+    """Gets the version of the most recent snapshot, or None"""
+    version = None
+    try:
+        result = await session.execute(select(func.max(Snapshot.id)))
+        version = result.scalar()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return version
+
+
+@attributed
+async def get_changes_since(session, version=None, max_span=MAX_CHANGES_SPAN):
+    """Gets what changed since a snapshot version. See
+    queries.get_changes_since()
+    """
+    payload = None
+    try:
+        result = await session.execute(
+            select(Snapshot.id, Snapshot.fetched_at)
+            .order_by(Snapshot.id.desc()).limit(1))
+        row = result.first()
+        if row is None:
+            return None
+        latest, fetched_at = row
+
+        diffs = None
+        if version is not None and 0 <= latest - version <= max_span:
+            result = await session.execute(
+                select(Snapshot.changes)
+                .filter(Snapshot.id > version)
+                .order_by(Snapshot.id)
+            )
+            diffs = result.scalars().all()
+            if None in diffs:
+                diffs = None
+
+        if diffs is not None:
+            changes = diff.merge_diffs(json.loads(d) for d in diffs)
+            payload = dict(version=latest, since=version, full=False,
+                           **changes)
+        else:
+            result = await session.execute(
+                select(WaitTime).filter(WaitTime.timestamp == fetched_at))
+            state = diff.snapshot_state(result.scalars().all())
+            changes = diff.compute_diff({}, state)
+            payload = dict(version=latest, since=None, full=True, **changes)
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        await session.close()
+
+    return payload
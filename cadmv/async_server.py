@@ -0,0 +1,159 @@
+"""A minimal asyncio HTTP/1.1 server for cadmv.async_api. It only speaks what
+the read API needs (GET and HEAD with keep-alive, plus server-sent event
+streams) and is built on the standard library's asyncio streams so that it
+doesn't need a web framework.
+"""
+import asyncio
+from http import HTTPStatus
+import http.client
+import io
+import logging
+from urllib.parse import urlsplit
+
+from cadmv.async_api import POLL_PATH, STREAM_PATH
+
+
+logger = logging.getLogger('cadmv.async_server')
+
+# Largest request head (request line and headers) that is accepted
+MAX_HEAD = 16 * 1024
+
+# Seconds between keep-alive comments on an idle event stream. They also
+# let the server notice clients that went away.
+HEARTBEAT = 20
+
+
+def encode_head(status, headers, keep_alive):
+    """Encodes the status line and headers of a response"""
+    lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}']
+    lines.extend(f'{name}: {value}' for name, value in headers.items())
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def read_request(reader):
+    """Reads the head of one request from reader
+
+    :return:    (tuple) of the method, target, HTTP version and headers, or
+                None if the client closed the connection
+    :raises ValueError: if the request is malformed
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as err:
+        if err.partial.strip():
+            raise ValueError('Incomplete request') from err
+        return None
+    except asyncio.LimitOverrunError as err:
+        raise ValueError('Request head too large') from err
+
+    request_line, _, header_bytes = head.partition(b'\r\n')
+    method, target, version = request_line.decode('latin-1').split()
+    headers = http.client.parse_headers(io.BytesIO(header_bytes))
+
+    # The API doesn't use request bodies, but they must be consumed to keep
+    # the connection usable
+    length = int(headers.get('Content-Length') or 0)
+    if length:
+        await reader.readexactly(length)
+
+    return method, target, version, headers
+
+
+class ConnectionHandler:
+    """Serves the requests of each client connection with api"""
+
+    def __init__(self, api):
+        self.api = api
+
+    async def __call__(self, reader, writer):
+        try:
+            while await self._serve_one(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.error('Error serving a connection', exc_info=True)
+        finally:
+            writer.close()
+
+    async def _serve_one(self, reader, writer):
+        """Serves one request. Returns True if the connection is kept open"""
+        try:
+            request = await read_request(reader)
+        except ValueError:
+            writer.write(encode_head(400, {'Content-Length': '0'}, False))
+            await writer.drain()
+            return False
+        if request is None:
+            return False
+
+        method, target, version, headers = request
+        keep_alive = (version == 'HTTP/1.1'
+                      and headers.get('Connection', '').lower() != 'close')
+
+        if method not in ('GET', 'HEAD'):
+            writer.write(encode_head(
+                405, {'Allow': 'GET, HEAD', 'Content-Length': '0'}, keep_alive))
+            await writer.drain()
+            return keep_alive
+
+        path = urlsplit(target).path.rstrip('/')
+        if path == STREAM_PATH and method == 'GET':
+            await self._stream(writer, headers)
+            return False
+
+        if path == POLL_PATH:
+            resp = await self.api.poll(target, headers)
+        else:
+            resp = await self.api.handle(target, headers)
+        writer.write(encode_head(resp.status, resp.headers, keep_alive))
+        if method == 'GET' and resp.body:
+            writer.write(resp.body)
+        await writer.drain()
+
+        return keep_alive
+
+    async def _stream(self, writer, headers):
+        """Sends each new snapshot as a server-sent event until the client
+        disconnects. A reconnecting client's Last-Event-ID is honoured, so it
+        only gets the current snapshot if it missed it.
+        """
+        await self.api.version()
+        writer.write(encode_head(200, {
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        }, False))
+        last = headers.get('Last-Event-ID')
+        while True:
+            message = await self.api.broker.wait_async(last, HEARTBEAT)
+            if message is None:
+                writer.write(b': keep-alive\n\n')
+            else:
+                writer.write(message.event)
+                last = message.version
+            await writer.drain()
+
+
+async def start_server(api, host='127.0.0.1', port=8000):
+    """Starts serving api and returns the asyncio Server"""
+    return await asyncio.start_server(
+        ConnectionHandler(api), host, port, limit=MAX_HEAD, backlog=1024)
+
+
+def serve(api, host='127.0.0.1', port=8000):
+    """Serves api until interrupted"""
+    async def run():
+        server = await start_server(api, host, port)
+        logger.info('Serving the async API on http://%s:%s', host, port)
+        watcher = asyncio.create_task(api.watch())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
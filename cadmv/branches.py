@@ -1,64 +1,514 @@
 """
-Module that provides the API for the branches
+Module that provides the API for the branches. Each read_* function takes a
+SQLAlchemy session and returns plain, JSON-serializable data (or None when
+nothing matches) so that it can be used by any web front end; see
+cadmv.api for the one shipped with the package.
 """
-# from config import db
-from models import Branch, BranchSchema
+import datetime
 
+import numpy as np
 
-def read_all():
+from cadmv import analytics
+from cadmv.catalog import Catalog
+from cadmv import coverage
+from cadmv import geo
+from cadmv import heatmap
+from cadmv.hours import OpeningHours
+import cadmv.queries as queries
+from cadmv.services import names as service_names
+
+
+BRANCH_FIELDS = (
+    'number', 'name', 'region', 'address', 'hours', 'closures', 'latitude',
+    'longitude', 'nearby1', 'nearby2', 'nearby3', 'nearby4', 'nearby5',
+)
+
+
+def branch_to_dict(branch):
+    """Serializes a Branch model to a dict of its public fields, with the
+    names of the services it offers
+    """
+    data = {field: getattr(branch, field) for field in BRANCH_FIELDS}
+    data['services'] = service_names(branch.services)
+    return data
+
+
+def wait_time_to_dict(wait_time):
+    """Serializes a WaitTime model to a dict with an ISO 8601 timestamp"""
+    return {
+        'branch_id': wait_time.branch_id,
+        'appt': wait_time.appt,
+        'non_appt': wait_time.non_appt,
+        'timestamp': wait_time.timestamp.isoformat(),
+    }
+
+
+def read_all(session):
     """
     Responds to a request for /api/branches with the complete list of
     branches, sorted by branch number
     """
-    # Create the list of branches
-    branches = Branch.query.order_by(Branch.number).all()
-
-    # Serialize the data for the response
-    branch_schema = BranchSchema(many=True)
-    return branch_schema.dump(branches).data
+    branches = queries.get_all_branches(session)
+    return [branch_to_dict(branch) for branch in branches]
 
 
-def read_one(number):
+def read_one(session, number):
     """
     Responds to a request for /api/branches/{number} with one matching branch
     from branches
 
     :param number:   DMV designated number of the branch to find
-    :return:         branch matching number
+    :return:         branch matching number, or None if there isn't one
+    """
+    branch = queries.get_branch_by_number(session, number)
+    if branch is None:
+        return None
+
+    return branch_to_dict(branch)
+
+
+def read_region(session, region, services=0):
+    """
+    Responds to a request for /api/branches/region/{region} with the branches
+    in that region
+
+    :param region:   DMV region number of the branches to find
+    :param services: (int) bitmask of the services the branches must all
+                     offer, see cadmv.services, or 0 for any branch
+    :return:         branches matching region, or None if there aren't any
+    """
+    branches = queries.get_branches_by_region(session, region, services)
+    if not branches:
+        return None
+
+    return [branch_to_dict(branch) for branch in branches]
+
+
+def wait_times_to_snapshot(wait_times):
+    """Serializes the wait times of one scrape, as returned by
+    queries.get_current_wait_times() or dmv.get_wait_times(), to the
+    snapshot format served by /api/wait_times
+    """
+    rows = [
+        wt if isinstance(wt, dict) else {
+            'branch_id': wt.branch_id,
+            'appt': wt.appt,
+            'non_appt': wt.non_appt,
+            'timestamp': wt.timestamp,
+        }
+        for wt in wait_times
+    ]
+    timestamp = rows[0]['timestamp'].isoformat() if rows else None
+
+    return {
+        'timestamp': timestamp,
+        'wait_times': [
+            dict(row, timestamp=row['timestamp'].isoformat()) for row in rows
+        ],
+    }
+
+
+def read_current_wait_times(session):
+    """
+    Responds to a request for /api/wait_times with the wait times of every
+    branch from the most recent scrape
+    """
+    return wait_times_to_snapshot(queries.get_current_wait_times(session))
+
+
+def read_current_region_wait_times(session, region):
+    """
+    Responds to a request for /api/wait_times/region/{region} with the wait
+    times of the branches in that region from the most recent scrape
+
+    :param region:   DMV region number of the branches
+    :return:         the snapshot slice of the region, or None if there
+                     isn't one
+    """
+    wait_times = queries.get_current_wait_times(session, region=region)
+    if not wait_times:
+        return None
+
+    return wait_times_to_snapshot(wait_times)
+
+
+def read_wait_times(session, number, start=None, end=None):
+    """
+    Responds to a request for /api/wait_times/{number} with the historical
+    wait times of one branch
+
+    :param number:   DMV designated number of the branch
+    :param start:    (datetime) inclusive lower bound, or None
+    :param end:      (datetime) exclusive upper bound, or None
+    :return:         wait times of the branch, oldest first, or None if
+                     there are none
+    """
+    wait_times = queries.get_wait_times_by_range(session, number, start, end)
+    if not wait_times:
+        return None
+
+    return [wait_time_to_dict(wt) for wt in wait_times]
+
+
+def series_to_dicts(wait_times, start=None, end=None, fill='mark'):
+    """Aligns the wait times of one branch to two-minute slots, see
+    coverage.series(). The range defaults to the one of the wait times.
+    """
+    if start is None:
+        start = wait_times[0].timestamp
+    if end is None:
+        end = wait_times[-1].timestamp + coverage.SLOT
+    slots = coverage.series(
+        [wt.timestamp for wt in wait_times], [wt.appt for wt in wait_times],
+        [wt.non_appt for wt in wait_times], start, end, fill)
+    for slot in slots:
+        slot['timestamp'] = slot['timestamp'].isoformat()
+    return slots
+
+
+def read_series(session, number, start=None, end=None, fill='mark'):
+    """
+    Responds to a request for /api/wait_times/{number}/series with the wait
+    times of one branch, one per two-minute slot, where the slots the
+    scraper missed are marked or forward-filled
+
+    :param number:   DMV designated number of the branch
+    :param start:    (datetime) inclusive lower bound, or None
+    :param end:      (datetime) exclusive upper bound, or None
+    :param fill:     (str) 'mark' or 'ffill', see coverage.series()
+    :return:         the slots, oldest first, or None if there are no wait
+                     times
+    """
+    wait_times = queries.get_wait_times_by_range(session, number, start, end)
+    if not wait_times:
+        return None
+
+    return series_to_dicts(wait_times, start, end, fill)
+
+
+def gap_range(latest, start=None, end=None):
+    """Fills in the default range of the gaps endpoint: the day up to the
+    latest scrape
+    """
+    if end is None:
+        end = latest + coverage.SLOT
+    if start is None:
+        start = end - datetime.timedelta(days=1)
+    return start, end
+
+
+def gaps_to_dicts(gaps):
+    """Serializes the (branch_id, start, end) tuples of queries.get_gaps()"""
+    return [
+        {'start': gap_start.isoformat(), 'end': gap_end.isoformat(),
+         'minutes': (gap_end - gap_start).total_seconds() / 60}
+        for _, gap_start, gap_end in gaps
+    ]
+
+
+def read_gaps(session, number, start=None, end=None):
+    """
+    Responds to a request for /api/wait_times/{number}/gaps with the times
+    the branch was open but no wait time was scraped, read from the
+    coverage bitmaps (see cadmv.coverage)
+
+    :param number:   DMV designated number of the branch
+    :param start:    (datetime) inclusive lower bound, or None for a day
+                     before end
+    :param end:      (datetime) exclusive upper bound, or None for the
+                     latest scrape
+    :return:         the gaps, oldest first, or None if the branch or the
+                     wait times don't exist
+    """
+    latest = queries.get_latest_timestamp(session)
+    opening_hours = OpeningHours(Catalog.from_session(session))
+    if latest is None or opening_hours.catalog.position(number) is None:
+        return None
+
+    start, end = gap_range(latest, start, end)
+    return gaps_to_dicts(queries.get_gaps(
+        session, start, end, branch_num=number, opening_hours=opening_hours))
+
+
+def read_percentiles(session, number, start=None, end=None):
+    """
+    Responds to a request for /api/wait_times/{number}/percentiles with the
+    median and 90th percentile waits of one branch while it was open. See
+    queries.get_wait_time_percentiles()
+
+    :param number:   DMV designated number of the branch
+    :param start:    (datetime) inclusive lower bound, rounded down to the
+                     hour, or None
+    :param end:      (datetime) exclusive upper bound, or None
+    :return:         the percentiles, or None if there are no wait times.
+                     Over large ranges they are computed exactly by
+                     cadmv.analytics when it is available
+    """
+    module, handle = analytics.backend(session, start, end)
+    return module.get_wait_time_percentiles(handle, number, start, end)
+
+
+def trends_to_dicts(region, trends):
+    """Converts the rows of queries.get_region_trends() for one region
+
+    :return:    (dict) of the form
+                {'region': 7, 'days': [{'date': '2018-12-03', 'count': 3120,
+                                        'appt': 12.4, 'non_appt': 35.1},
+                                       ...]}
+    """
+    return {
+        'region': region,
+        'days': [
+            {'date': day.isoformat(), 'count': count,
+             'appt': round(appt, 1), 'non_appt': round(non_appt, 1)}
+            for _, day, count, appt, non_appt in trends
+        ],
+    }
+
+
+def read_region_trends(session, region, start=None, end=None):
+    """
+    Responds to a request for /api/trends/region/{region} with the daily
+    average waits of the open branches of a region. Large ranges are
+    aggregated by cadmv.analytics when it is available
+
+    :param region:  region number
+    :param start:   (datetime) inclusive lower bound, or None
+    :param end:     (datetime) exclusive upper bound, or None
+    :return:        the trends, see trends_to_dicts(), or None if there are
+                    no wait times
+    """
+    module, handle = analytics.backend(session, start, end)
+    trends = module.get_region_trends(handle, start, end, region)
+    return trends_to_dicts(region, trends) if trends else None
+
+
+def read_heatmap(session, number):
+    """
+    Responds to a request for /api/heatmaps/{number} with the weekday by hour
+    heatmap of one branch. See heatmap.assemble()
+
+    :param number:  DMV designated number of the branch
+    :return:        the heatmap, or None if there is no data for the branch
+    """
+    heatmaps = heatmap.assemble(
+        queries.get_heatmap_cells(session, branch_num=number))
+    return heatmaps[0] if heatmaps else None
+
+
+def read_region_heatmaps(session, region):
     """
-    # Get the requested branch
-    branch = Branch.query.filter(Branch.number == number).one_or_none()
+    Responds to a request for /api/heatmaps/region/{region} with the heatmaps
+    of every branch in a region, sorted by branch number
 
-    # Did we find the branch?
-    if branch is not None:
-        # Serialize the data for the response
-        branch_schema = BranchSchema()
-        return branch_schema.dump(branch).data
-    
-    # Otherwise, nope, didn't find the branch
-    else:
-        # abort(404, f'Branch not found for number: {number}')
-        pass
+    :param region:  region number
+    :return:        the heatmaps, or None if there is no data for the region
+    """
+    heatmaps = heatmap.assemble(
+        queries.get_heatmap_cells(session, region=region))
+    return heatmaps or None
+
+
+def read_changes(session, since=None):
+    """
+    Responds to a request for /api/changes with what changed since the
+    snapshot version the client has. See queries.get_changes_since()
+
+    :param since:   (int) snapshot version the client has, or None
+    :return:        the changes payload, or None if there are no snapshots
+    """
+    return queries.get_changes_since(session, since)
+
+
+# Largest number of branches a nearest or best branch request may ask for
+MAX_NEAREST = 50
 
 
-def read_region(region):
+def _check_point(lat, lon, k):
+    """Validates the arguments of a nearest or best branch request"""
+    if lat is None or lon is None:
+        raise ValueError('lat and lon are required')
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError('lat or lon is out of range')
+    if not 1 <= k <= MAX_NEAREST:
+        raise ValueError(f'k must be between 1 and {MAX_NEAREST}')
+
+
+def _neighbour_to_dict(index, neighbour):
+    catalog = index.catalog
+    return {
+        'number': neighbour.number,
+        'name': catalog.names[neighbour.position],
+        'region': int(catalog.regions[neighbour.position]),
+        'distance_km': round(neighbour.distance_km, 3),
+    }
+
+
+def _services_mask(index, services):
+    """Selects the branches of the catalog offering services, or None to
+    allow every branch
     """
-    Responds to a request for /api/branches/region/{region} with one matching branch from branches
+    return index.catalog.offering(services) if services else None
 
-    :param number:   DMV region number of the branch to find
-    :return:         branch matching region
+
+def read_nearest(index, lat=None, lon=None, k=5, max_km=None, services=0):
+    """
+    Responds to a request for /api/nearest with the branches nearest to a
+    point
+
+    :param index:    (geo.BranchIndex) over the branch catalog
+    :param lat:      (float) latitude in degrees
+    :param lon:      (float) longitude in degrees
+    :param k:        (int) largest number of branches to return
+    :param max_km:   (float) largest distance, or None
+    :param services: (int) bitmask of the services the branches must all
+                     offer, see cadmv.services, or 0 for any branch
+    :return:         nearest branches first
+    :raises ValueError: if the arguments are invalid
     """
-    # Get the requested region
-    branches = Branch.query.filter(Branch.region == region).all()
-    # print(f'There are {branches.count()} branches in region {region}')
+    _check_point(lat, lon, k)
+    return [
+        _neighbour_to_dict(index, neighbour)
+        for neighbour in index.nearest(
+            lat, lon, k, max_km, _services_mask(index, services))
+    ]
+
 
-    # Did we find the regoin?
-    if branches:
-        # Serialize the data for the response
-        branch_schema = BranchSchema(many=True)
-        return branch_schema.dump(branches).data
+def read_best(index, wait_times, lat=None, lon=None, k=5, max_km=50,
+              kind='non_appt', services=0):
+    """
+    Responds to a request for /api/best with the branches near a point that
+    have the shortest current wait
+
+    :param index:       (geo.BranchIndex) over the branch catalog
+    :param wait_times:  (dict) of branch number to (appt, non_appt) of the
+                        current snapshot
+    :param kind:        (str) 'appt' or 'non_appt', the wait to rank by
+    :param services:    (int) bitmask of the services the branches must all
+                        offer, see cadmv.services, or 0 for any branch
+    :return:            shortest wait first
+    :raises ValueError: if the arguments are invalid
+    """
+    _check_point(lat, lon, k)
+    if kind not in ('appt', 'non_appt'):
+        raise ValueError("kind must be 'appt' or 'non_appt'")
+
+    ranked = geo.best_branches_near(
+        index, wait_times, lat, lon, k, max_km, kind,
+        _services_mask(index, services))
+    return [
+        dict(_neighbour_to_dict(index, neighbour), appt=appt,
+             non_appt=non_appt)
+        for neighbour, appt, non_appt in ranked
+    ]
+
+
+def read_forecast(forecaster, number, at=None):
+    """
+    Responds to a request for /api/forecast/{number} with the expected waits
+    at a branch
+
+    :param forecaster:  (forecast.Forecaster), or None if there are no
+                        forecasts
+    :param number:      (int) branch number
+    :param at:          (datetime) local time of arrival, or None for now
+    :return:            the expected waits in minutes, each None if there is
+                        no data for that time. Returns None if the branch
+                        has no forecasts
+    """
+    if forecaster is None or number not in forecaster.positions:
+        return None
+
+    if at is None:
+        at = datetime.datetime.now()
+    waits = {
+        kind: forecaster.forecast(number, at, kind)
+        for kind in ('appt', 'non_appt')
+    }
+    return {
+        'number': number,
+        'at': at.isoformat(),
+        **{kind: None if wait is None else round(wait, 1)
+           for kind, wait in waits.items()},
+    }
+
+
+def _recent_wait(value):
+    """A wait of the recent window, None where there is none"""
+    return None if np.isnan(value) else round(float(value), 1)
+
+
+def _recent_to_dicts(times, appts, non_appts):
+    """Serializes the slots of the recent window, oldest first"""
+    return [
+        {'timestamp': timestamp.isoformat(), 'appt': _recent_wait(appt),
+         'non_appt': _recent_wait(non_appt)}
+        for timestamp, appt, non_appt
+        in zip(times.astype(datetime.datetime).tolist(), appts, non_appts)
+    ]
+
+
+def read_recent_series(window, number, start=None, end=None):
+    """
+    Responds to a request for /api/recent/{number} with the usable waits of
+    one branch per slot of the recent window (see cadmv.window)
+
+    :param window:  (window.RecentWindow), or None if none is kept
+    :param number:  DMV designated number of the branch
+    :param start:   (datetime) inclusive lower bound, or None
+    :param end:     (datetime) exclusive upper bound, or None
+    :return:        the slots, oldest first, or None if the branch isn't in
+                    the window
+    """
+    if window is None:
+        return None
+    appts = window.series(number, start, end, 'appt')
+    if appts is None:
+        return None
+
+    _, non_appts = window.series(number, start, end, 'non_appt')
+    return _recent_to_dicts(appts[0], appts[1], non_appts)
+
+
+def read_recent_region(window, region, start=None, end=None):
+    """
+    Responds to a request for /api/recent/region/{region} with the average
+    usable waits of the branches of a region per slot of the recent window
+
+    :param window:  (window.RecentWindow), or None if none is kept
+    :param region:  (int) region number
+    :param start:   (datetime) inclusive lower bound, or None
+    :param end:     (datetime) exclusive upper bound, or None
+    :return:        the slots, oldest first, or None if the region has no
+                    branches
+    """
+    if window is None or not (window.regions == region).any():
+        return None
+
+    times, appts = window.region_averages(region, start, end, 'appt')
+    _, non_appts = window.region_averages(region, start, end, 'non_appt')
+    return _recent_to_dicts(times, appts, non_appts)
+
+
+def read_recent_typical(window):
+    """
+    Responds to a request for /api/recent/typical with the newest wait of
+    every branch and its typical wait at that time of day, see
+    window.RecentWindow.now_vs_typical()
+
+    :param window:  (window.RecentWindow), or None if none is kept
+    :return:        by branch number, or None if there is no window
+    """
+    if window is None:
+        return None
 
-    # Otherwise, nope, didn't find the branch
-    else:
-        # abort(404, f'Branch not found for region: {region}')
-        pass
+    numbers, appts, typical_appts = window.now_vs_typical('appt')
+    _, non_appts, typical_non_appts = window.now_vs_typical('non_appt')
+    return [
+        {'number': int(number), 'appt': _recent_wait(appt),
+         'typical_appt': _recent_wait(typical_appt),
+         'non_appt': _recent_wait(non_appt),
+         'typical_non_appt': _recent_wait(typical_non_appt)}
+        for number, appt, typical_appt, non_appt, typical_non_appt
+        in zip(numbers, appts, typical_appts, non_appts, typical_non_appts)
+    ]
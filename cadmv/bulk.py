@@ -0,0 +1,253 @@
+"""Bulk inserts of column arrays, bypassing the ORM.
+
+insert_columns() is used to load millions of wait times at once (synthetic
+benchmark data, backfills). PostgreSQL is loaded with COPY, SQLite with one
+executemany on the DB-API cursor, and other databases with a Core
+executemany. Datetime columns are passed as numpy.datetime64 arrays and
+formatted once per column rather than per value.
+
+Dumps of wait times in CSV (with a header line) or JSON lines are split
+into byte ranges with split_file() and parsed into column arrays with
+read_chunk(), so that a process pool can parse them in parallel (see
+bin/bulk_load.py). Their columns are those of WAIT_TIME_COLUMNS, with
+is_open optional and the timestamps in local time, ISO formatted. Empty or
+null is_open values are missing, like the column, and fill_is_open() fills
+them in from the opening hours.
+"""
+import contextlib
+import csv
+import io
+import json
+import logging
+import os
+
+import numpy as np
+from sqlalchemy import Sequence, inspect
+
+
+logger = logging.getLogger('cadmv.bulk')
+
+# Columns of a wait time dump and their dtypes
+WAIT_TIME_COLUMNS = {
+    'branch_id': np.int64,
+    'appt': np.int64,
+    'non_appt': np.int64,
+    'timestamp': 'datetime64[us]',
+    'is_open': bool,
+}
+FORMATS = ('csv', 'jsonl')
+
+
+def _column_values(values, dialect):
+    """Converts one column to a list of values the dialect's driver accepts
+    without per-value adaptation
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        text = np.datetime_as_string(values.astype('datetime64[us]'),
+                                     unit='us')
+        # The format SQLAlchemy stores datetimes in on SQLite
+        return np.char.replace(text, 'T', ' ').tolist() \
+            if dialect == 'sqlite' else text.tolist()
+    if values.dtype == bool and dialect == 'sqlite':
+        return values.astype(np.int8).tolist()
+    return values.tolist()
+
+
+def _reserve_ids(cursor, sequence, count):
+    """Takes count consecutive values from a PostgreSQL sequence
+
+    :return:    (range) of the ids
+    """
+    cursor.execute('SELECT setval(%s, nextval(%s) + %s - 1)',
+                   (sequence, sequence, count))
+    last = cursor.fetchone()[0]
+    return range(last - count + 1, last + 1)
+
+
+def insert_columns(engine, table, columns):
+    """Inserts rows given as column arrays
+
+    :param engine:  SQLAlchemy engine
+    :param table:   SQLAlchemy Table, e.g. WaitTime.__table__
+    :param columns: (dict) of column name to a sequence or numpy array of
+                    its values, all of the same length
+    :return:        (int) number of rows inserted
+    """
+    names = list(columns)
+    count = len(columns[names[0]]) if names else 0
+    if not count:
+        return 0
+
+    dialect = engine.dialect.name
+    values = [_column_values(columns[name], dialect) for name in names]
+    if dialect not in ('postgresql', 'sqlite'):
+        with engine.begin() as conn:
+            conn.execute(table.insert(),
+                         [dict(zip(names, row)) for row in zip(*values)])
+        return count
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        if dialect == 'postgresql':
+            id_column = table.c.get('id')
+            if id_column is not None and 'id' not in columns \
+                    and isinstance(id_column.default, Sequence):
+                names.insert(0, 'id')
+                values.insert(0, _reserve_ids(
+                    cursor, id_column.default.name, count))
+            buf = io.StringIO()
+            csv.writer(buf).writerows(zip(*values))
+            buf.seek(0)
+            cursor.copy_expert(
+                f'COPY {table.name} ({", ".join(names)}) '
+                'FROM STDIN WITH (FORMAT csv)', buf)
+        else:
+            cursor.executemany(
+                f'INSERT INTO {table.name} ({", ".join(names)}) '
+                f'VALUES ({", ".join("?" * len(names))})', zip(*values))
+        raw.commit()
+    except:
+        logger.error('An error occurred bulk inserting into %s', table.name,
+                     exc_info=True)
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    return count
+
+
+def file_format(path):
+    """Guesses the format of a dump from its extension
+
+    :raises ValueError: if it isn't one of FORMATS
+    """
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    if extension in ('json', 'ndjson'):
+        extension = 'jsonl'
+    if extension not in FORMATS:
+        raise ValueError(f'Unknown format of {path}, use one of '
+                         f"{', '.join(FORMATS)}")
+    return extension
+
+
+def split_file(path, chunk_bytes, skip_header=False):
+    """Splits a file into byte ranges of whole lines
+
+    :param path:        (str) the file
+    :param chunk_bytes:  (int) approximate size of a range
+    :param skip_header: (bool) leave the first line out of the ranges
+    :return:            (list) of (start, end) byte offsets
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = len(f.readline()) if skip_header else 0
+        ranges = []
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            # Extend the range to the end of the line it stops in
+            f.readline()
+            end = f.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def read_header(path):
+    """Returns the column names of a CSV dump"""
+    with open(path, newline='') as f:
+        return next(csv.reader(f))
+
+
+def read_chunk(path, start, end, fmt, header=None):
+    """Parses a byte range of a dump into column arrays
+
+    :param path:    (str) the dump
+    :param start:   (int) offset of the first line, see split_file()
+    :param end:     (int) offset after the last line
+    :param fmt:     (str) one of FORMATS
+    :param header:  (list) of the column names of a CSV dump, see
+                    read_header()
+    :return:        (dict) of column name to numpy array, for the columns of
+                    WAIT_TIME_COLUMNS in the dump. is_open is a masked
+                    array, masked where the value is missing
+    :raises ValueError: if a line can't be parsed or a column is missing,
+                        from the dump or from one of its records
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode('utf-8').splitlines()
+    lines = [line for line in lines if line.strip()]
+
+    if fmt == 'csv':
+        rows = list(csv.reader(lines))
+        names = [name for name in header if name in WAIT_TIME_COLUMNS]
+        positions = [header.index(name) for name in names]
+        raw = {name: [row[i] if i < len(row) else '' for row in rows]
+               for name, i in zip(names, positions)}
+    else:
+        records = [json.loads(line) for line in lines]
+        raw = {name: [record.get(name) for record in records]
+               for name in WAIT_TIME_COLUMNS}
+        if all(value is None for value in raw['is_open']):
+            del raw['is_open']
+
+    missing = [name for name in WAIT_TIME_COLUMNS
+               if name != 'is_open'
+               and (name not in raw or None in raw[name])]
+    if missing:
+        raise ValueError(f"{path} lacks the columns {', '.join(missing)}")
+
+    columns = {}
+    for name, values in raw.items():
+        if name == 'is_open':
+            text = ['' if value is None else str(value).strip().lower()
+                    for value in values]
+            columns[name] = np.ma.array(
+                [value in ('1', 'true', 't') for value in text],
+                mask=[value in ('', 'null', 'none') for value in text],
+                dtype=bool)
+        elif name == 'timestamp':
+            columns[name] = np.array(values, dtype='datetime64[us]')
+        else:
+            columns[name] = np.array(values, dtype=np.float64)\
+                .astype(WAIT_TIME_COLUMNS[name])
+    return columns
+
+
+def fill_is_open(columns, hours):
+    """Fills in is_open where the parsed columns of read_chunk() lack it,
+    from the opening hours of the branches
+
+    :param columns: (dict) of column name to numpy array
+    :param hours:   (hours.OpeningHours) of the branches
+    """
+    is_open = columns.get('is_open')
+    if is_open is not None and not np.ma.is_masked(is_open):
+        columns['is_open'] = np.ma.getdata(is_open)
+        return
+
+    opened = hours.open_mask(columns['branch_id'], columns['timestamp'])
+    columns['is_open'] = opened if is_open is None else np.where(
+        np.ma.getmaskarray(is_open), opened, np.ma.getdata(is_open))
+
+
+@contextlib.contextmanager
+def indexes_dropped(engine, table):
+    """Drops the indexes of a table for the duration of a load and creates
+    them again afterwards, even if the load fails. Only the indexes of the
+    model that exist in the database are dropped.
+    """
+    existing = {index['name']
+                for index in inspect(engine).get_indexes(table.name)}
+    dropped = [index for index in table.indexes if index.name in existing]
+    for index in dropped:
+        index.drop(bind=engine)
+    try:
+        yield dropped
+    finally:
+        for index in dropped:
+            logger.info('Creating index %s', index.name)
+            index.create(bind=engine)
@@ -0,0 +1,96 @@
+"""In-process caches used by the read API"""
+import threading
+import time
+
+
+class TTLCache:
+    """A small thread-safe cache whose entries expire after `ttl` seconds.
+
+    The read API keys entries on (endpoint, arguments, snapshot version), so a
+    new scrape naturally misses the cache and the stale entries simply age
+    out. Reads are lock-free; only inserts and evictions take the lock, and
+    fills take a lock of their key.
+    """
+
+    def __init__(self, ttl=120, maxsize=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._clock = clock
+        self._data = {}
+        self._lock = threading.Lock()
+        self._fills = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Returns the value cached under key, or default if it is missing or
+        has expired
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+
+        value, expires = entry
+        if expires < self._clock():
+            with self._lock:
+                self._data.pop(key, None)
+            return default
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Caches value under key for ttl seconds (defaults to self.ttl)"""
+        if ttl is None:
+            ttl = self.ttl
+
+        with self._lock:
+            if key not in self._data and len(self._data) >= self.maxsize:
+                self._evict()
+            self._data[key] = (value, self._clock() + ttl)
+
+    def get_or_set(self, key, factory, ttl=None):
+        """Returns the value cached under key, calling factory() to fill it on
+        a miss. Fills of the same key are serialized so that a burst of
+        requests right after a scrape only runs the (expensive) factory once,
+        while fills of other keys go ahead. A None result, a failed or empty
+        load, is returned but not cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            fill = self._fills.setdefault(key, [threading.Lock(), 0])
+            fill[1] += 1
+        try:
+            with fill[0]:
+                value = self.get(key)
+                if value is None:
+                    value = factory()
+                    if value is not None:
+                        self.set(key, value, ttl)
+        finally:
+            with self._lock:
+                fill[1] -= 1
+                if not fill[1]:
+                    del self._fills[key]
+
+        return value
+
+    def clear(self):
+        """Drops every entry"""
+        with self._lock:
+            self._data.clear()
+
+    def _evict(self):
+        """Drops the expired entries or, if none have expired, the oldest one.
+        Must be called with self._lock held.
+        """
+        now = self._clock()
+        expired = [k for k, (_, expires) in self._data.items() if expires < now]
+        for key in expired:
+            del self._data[key]
+
+        if not expired and self._data:
+            del self._data[next(iter(self._data))]
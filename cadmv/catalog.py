@@ -0,0 +1,83 @@
+"""In-memory catalog of the branches as NumPy column arrays.
+
+The catalog is small (under 200 branches) and changes rarely, so it is read
+once and shared by the vectorized features (nearest branches, neighbour
+graph, opening hours, ...) that address branches by their position in it.
+"""
+import hashlib
+
+import numpy as np
+
+import cadmv.queries as queries
+
+
+FIELDS = ('number', 'name', 'region', 'latitude', 'longitude', 'hours',
+          'closures', 'services')
+
+
+class Catalog:
+    """Column arrays over the branches, sorted by branch number
+
+    :param branches:    (list) of Branch models or dicts with the same keys
+    """
+
+    def __init__(self, branches):
+        rows = sorted(
+            (b if isinstance(b, dict)
+             else {field: getattr(b, field) for field in FIELDS}
+             for b in branches),
+            key=lambda row: row['number'])
+
+        self.numbers = np.array([r['number'] for r in rows], dtype=np.int32)
+        self.names = [r['name'] for r in rows]
+        self.regions = np.array(
+            [r['region'] or 0 for r in rows], dtype=np.int16)
+        self.latitudes = np.array(
+            [np.nan if r['latitude'] is None else r['latitude'] for r in rows],
+            dtype=np.float64)
+        self.longitudes = np.array(
+            [np.nan if r['longitude'] is None else r['longitude']
+             for r in rows],
+            dtype=np.float64)
+        self.hours = [r['hours'] for r in rows]
+        self.closures = [r.get('closures') for r in rows]
+        # Bitmasks of the services, see cadmv.services
+        self.services = np.array(
+            [r.get('services') or 0 for r in rows], dtype=np.uint8)
+        self.positions = {int(n): i for i, n in enumerate(self.numbers)}
+        self.version = self._hash(rows)
+
+    def __len__(self):
+        return len(self.numbers)
+
+    @classmethod
+    def from_session(cls, session):
+        """Reads the catalog from the database"""
+        return cls(queries.get_all_branches(session))
+
+    def position(self, number):
+        """Returns the position of a branch number, or None"""
+        return self.positions.get(number)
+
+    def offering(self, services):
+        """Selects the branches offering services
+
+        :param services:    (int) bitmask of the services, see
+                            cadmv.services
+        :return:            (numpy.ndarray) of bools over the positions,
+                            True for the branches offering all of them
+        """
+        return (self.services & services) == services
+
+    @staticmethod
+    def _hash(rows):
+        """Hashes the fields the catalog is built from. It is used as the
+        catalog version by the caches derived from it.
+        """
+        digest = hashlib.sha1()
+        for r in rows:
+            digest.update(repr((
+                r['number'], r['region'], r['latitude'], r['longitude'],
+                r['hours'], r.get('closures'), r.get('services'),
+            )).encode('utf-8'))
+        return digest.hexdigest()[:16]
@@ -0,0 +1,196 @@
+"""Coverage index of the scraped wait times, and gap-aware series.
+
+The scraper runs every 2 minutes, so a day has SLOTS two-minute slots. The
+coverage_days table holds, per branch and day, a bitmap of the slots a wait
+time was stored in (SLOTS bits packed into SLOT_BYTES bytes). Every scrape
+sets its slot, so the holes left by failed scrapes are found from the
+bitmaps alone, without scanning wait_times.
+
+A slot is expected to be covered while its branch is open (see
+cadmv.hours), or always when the opening hours aren't given.
+"""
+import datetime
+
+import numpy as np
+
+
+SLOT_MINUTES = 2
+SLOTS = 24 * 60 // SLOT_MINUTES
+SLOT_BYTES = SLOTS // 8
+SLOT = datetime.timedelta(minutes=SLOT_MINUTES)
+
+# How series() treats the slots without a wait time
+FILLS = ('ffill', 'mark')
+
+
+def slot_of(timestamp):
+    """Returns the slot of its day a datetime falls in"""
+    return (timestamp.hour * 60 + timestamp.minute) // SLOT_MINUTES
+
+
+def floor_slot(timestamp):
+    """Rounds a datetime down to the start of its slot"""
+    return timestamp.replace(
+        minute=timestamp.minute - timestamp.minute % SLOT_MINUTES,
+        second=0, microsecond=0)
+
+
+def parse_fill(value):
+    """Parses the fill query parameter
+
+    :raises ValueError: if value isn't one of FILLS
+    """
+    if value not in FILLS:
+        raise ValueError(f"fill must be one of {', '.join(FILLS)}")
+    return value
+
+
+def decode(blob):
+    """Unpacks a stored bitmap to a (SLOTS,) array of bools. An empty or
+    missing bitmap has no slot covered.
+    """
+    if not blob:
+        return np.zeros(SLOTS, dtype=bool)
+    return np.unpackbits(np.frombuffer(blob, dtype=np.uint8),
+                         count=SLOTS).astype(bool)
+
+
+def encode(slots):
+    """Packs a (SLOTS,) array of bools for storage"""
+    return np.packbits(np.asarray(slots, dtype=bool)).tobytes()
+
+
+def mark(blob, slots):
+    """Sets slots in a stored bitmap
+
+    :param blob:    (bytes) the bitmap, or None for an empty one
+    :param slots:   (sequence) of the slots to set
+    :return:        (tuple) of the new bitmap and the number of slots it has
+                    set
+    """
+    covered = decode(blob)
+    covered[np.asarray(slots, dtype=np.int64)] = True
+    return encode(covered), int(covered.sum())
+
+
+def build(branch_ids, timestamps):
+    """Computes the bitmaps of many wait times at once
+
+    :param branch_ids:  (sequence) branch number of every wait time
+    :param timestamps:  (sequence) datetime of every wait time
+    :return:            (dict) of (branch number, date) to a (SLOTS,) array
+                        of bools
+    """
+    if not len(branch_ids):
+        return {}
+
+    times = np.array(timestamps, dtype='datetime64[m]')
+    days = times.astype('datetime64[D]')
+    slots = (times - days).astype(np.int64) // SLOT_MINUTES
+    keys, inverse = np.unique(
+        np.stack([np.asarray(branch_ids, dtype=np.int64),
+                  days.astype(np.int64)], axis=1),
+        axis=0, return_inverse=True)
+
+    covered = np.zeros((len(keys), SLOTS), dtype=bool)
+    covered[inverse.ravel(), slots] = True
+    return {
+        (int(number), day.item()): covered[i]
+        for i, (number, day) in enumerate(zip(
+            keys[:, 0], keys[:, 1].astype('datetime64[D]')))
+    }
+
+
+def find_gaps(days, numbers, start, end, bitmap=None):
+    """Finds the expected slots that no wait time was stored in
+
+    :param days:        (dict) of (branch number, date) to a (SLOTS,) array
+                        of bools, see decode(). Missing days have no slot
+                        covered
+    :param numbers:     (sequence) of the branch numbers to check
+    :param start:       (datetime) inclusive lower bound
+    :param end:         (datetime) exclusive upper bound
+    :param bitmap:      (numpy.ndarray) of the weekly opening hours of the
+                        branches, aligned with numbers, see
+                        hours.OpeningHours.bitmap, or None to expect every
+                        slot
+    :return:            (list) of (branch number, gap start, gap end) tuples,
+                        by branch number then time
+    """
+    first = floor_slot(start)
+    count = -(-(end - first) // SLOT)
+    if count <= 0 or not len(numbers):
+        return []
+
+    last = first + (count - 1) * SLOT
+    dates = [first.date() + datetime.timedelta(days=i)
+             for i in range((last.date() - first.date()).days + 1)]
+    covered = np.zeros((len(numbers), len(dates), SLOTS), dtype=bool)
+    for i, number in enumerate(numbers):
+        for j, date in enumerate(dates):
+            day = days.get((number, date))
+            if day is not None:
+                covered[i, j] = day
+
+    if bitmap is None:
+        expected = np.ones_like(covered)
+    else:
+        weekdays = [date.weekday() for date in dates]
+        expected = bitmap[:, weekdays, ::SLOT_MINUTES]
+
+    offset = slot_of(first)
+    missing = (expected & ~covered).reshape(len(numbers), -1)
+    missing = missing[:, offset:offset + count]
+
+    edges = np.diff(np.pad(missing.astype(np.int8), ((0, 0), (1, 1))), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return [
+        (int(numbers[row]), first + int(gap_start) * SLOT,
+         min(first + int(gap_end) * SLOT, end))
+        for row, gap_start, gap_end in zip(rows, starts, ends)
+    ]
+
+
+def series(timestamps, appts, non_appts, start, end, fill='mark'):
+    """Aligns the wait times of one branch to the slots of a range
+
+    :param timestamps:  (sequence) datetime of every wait time, oldest first
+    :param appts:       (sequence) appointment wait of every wait time
+    :param non_appts:   (sequence) non-appointment wait of every wait time
+    :param start:       (datetime) inclusive lower bound
+    :param end:         (datetime) exclusive upper bound
+    :param fill:        (str) 'mark' leaves the waits of the slots without a
+                        wait time None, 'ffill' carries the last wait
+                        forward into them
+    :return:            (list) of one dict per slot, of the form
+                        {'timestamp': datetime, 'appt': 5, 'non_appt': 10,
+                         'gap': False}, where gap is True for the slots
+                        without a wait time
+    """
+    parse_fill(fill)
+    first = floor_slot(start)
+    count = max(-(-(end - first) // SLOT), 0)
+
+    values = np.full((count, 2), -1, dtype=np.int64)
+    if len(timestamps):
+        times = np.array(timestamps, dtype='datetime64[m]')
+        slots = (times - np.datetime64(first, 'm')).astype(np.int64) \
+            // SLOT_MINUTES
+        inside = (slots >= 0) & (slots < count)
+        # The last wait time of a slot wins
+        values[slots[inside]] = np.stack(
+            [np.asarray(appts), np.asarray(non_appts)], axis=1)[inside]
+
+    gap = values[:, 0] < 0
+    if fill == 'ffill' and count:
+        last = np.maximum.accumulate(np.where(gap, -1, np.arange(count)))
+        values = np.where((last >= 0)[:, None], values[last], -1)
+
+    return [
+        {'timestamp': first + i * SLOT,
+         'appt': None if appt < 0 else int(appt),
+         'non_appt': None if non_appt < 0 else int(non_appt),
+         'gap': bool(gap[i])}
+        for i, (appt, non_appt) in enumerate(values.tolist())
+    ]
@@ -0,0 +1,95 @@
+"""Changed-only diffs between snapshots.
+
+A diff is a compact, JSON-serializable dict of the form
+
+    {
+        'added': [[603, 10, 25], ...],      # branch_id, appt, non_appt
+        'changed': [[542, 15, 27], ...],    # branch_id, appt, non_appt
+        'removed': [537, ...]               # branch_id
+    }
+
+Added and changed branches carry their new absolute wait times rather than
+deltas so that applying a diff twice is harmless.
+"""
+
+
+def empty_diff():
+    """Returns a diff with no changes"""
+    return {'added': [], 'changed': [], 'removed': []}
+
+
+def snapshot_state(wait_times):
+    """Maps the wait times of one scrape to a dict of branch_id to a tuple of
+    (appt, non_appt)
+
+    :param wait_times:  (list) of wait time dicts, as returned by
+                        dmv.get_wait_times(), or WaitTime models
+    """
+    state = {}
+    for wt in wait_times:
+        if isinstance(wt, dict):
+            state[wt['branch_id']] = (wt['appt'], wt['non_appt'])
+        else:
+            state[wt.branch_id] = (wt.appt, wt.non_appt)
+
+    return state
+
+
+def compute_diff(previous, current):
+    """Computes the diff between two snapshot states
+
+    :param previous:    (dict) state of the previous snapshot, see
+                        snapshot_state()
+    :param current:     (dict) state of the current snapshot
+    :return:            (dict) diff, see the module docstring
+    """
+    diff = empty_diff()
+    for branch_id, values in sorted(current.items()):
+        old = previous.get(branch_id)
+        if old is None:
+            diff['added'].append([branch_id, *values])
+        elif tuple(old) != tuple(values):
+            diff['changed'].append([branch_id, *values])
+
+    diff['removed'] = sorted(set(previous) - set(current))
+    return diff
+
+
+def merge_diffs(diffs):
+    """Coalesces consecutive diffs, oldest first, into one diff from the
+    state before the first to the state after the last
+    """
+    added, changed, removed = {}, {}, set()
+    for diff in diffs:
+        for branch_id, appt, non_appt in diff['added']:
+            if branch_id in removed:
+                removed.discard(branch_id)
+                changed[branch_id] = (appt, non_appt)
+            else:
+                added[branch_id] = (appt, non_appt)
+        for branch_id, appt, non_appt in diff['changed']:
+            if branch_id in added:
+                added[branch_id] = (appt, non_appt)
+            else:
+                changed[branch_id] = (appt, non_appt)
+        for branch_id in diff['removed']:
+            if added.pop(branch_id, None) is None:
+                changed.pop(branch_id, None)
+                removed.add(branch_id)
+
+    return {
+        'added': [[b, *values] for b, values in sorted(added.items())],
+        'changed': [[b, *values] for b, values in sorted(changed.items())],
+        'removed': sorted(removed),
+    }
+
+
+def apply_diff(state, diff):
+    """Returns a new snapshot state with diff applied to state"""
+    state = dict(state)
+    for branch_id, appt, non_appt in diff['added'] + diff['changed']:
+        state[branch_id] = (appt, non_appt)
+    for branch_id in diff['removed']:
+        state.pop(branch_id, None)
+
+    return state
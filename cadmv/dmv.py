@@ -1,9 +1,13 @@
 """This modules defines the functions necessary to get data from the CA DMV"""
 import datetime
+from email.utils import parsedate_to_datetime
+import hashlib
 
 import requests
 
 from cadmv.helper import data
+from cadmv import metrics
+from cadmv.records import Scrape
 
 
 base_url = 'https://www.dmv.ca.gov/wasapp/webdata'
@@ -31,7 +35,7 @@ def get_offices_json(url=None, timeout=1):
     return resp.json()['foims_offices']['offices']
 
 
-def get_wait_times(url=None, timeout=1):
+def get_wait_times(url=None, timeout=1, archive=None):
     """
     Makes a request to the wait_times_url URL and retrieves the wait times
     for each CA DMV office. timeout is to 1 second because it seems like the
@@ -66,19 +70,45 @@ def get_wait_times(url=None, timeout=1):
 
     :param url:         (str) the url to make the request for the wait times
     :param timeout:     (int) time to wait until the request times out
-    :return wait_times: (list) of dicts of wait times for every branch in the
-                        format given above
+    :param archive:     (archive.Archive) the raw body is archived to, or
+                        None
+    :return wait_times: (records.Scrape) list of wait times for every
+                        branch, as records.WaitTimeRecords that read like
+                        the dicts given above, along with the hash and the
+                        feed time of the response
     """
     if url is None:
         url = wait_times_url
 
     now = datetime.datetime.now()
-    resp = requests.get(url, timeout=timeout)
+    with metrics.span('cadmv_fetch_seconds'):
+        resp = requests.get(url, timeout=timeout)
     if not resp.ok:
         raise requests.exceptions.HTTPError
+    if archive is not None:
+        archive.put(resp.content, now)
+
+    with metrics.span('cadmv_parse_seconds'):
+        _, rows = data.split_response(resp.text)
+        wait_times = Scrape(data.prep_wait_times_data(rows, now),
+                            hashlib.sha256(resp.content).hexdigest(),
+                            feed_time(resp.headers))
+    return wait_times
 
-    text = resp.text.split('\r\n')
-    del text[0] # remove the header
 
-    wait_times = data.prep_wait_times_data(text, now)
-    return wait_times
+def feed_time(headers):
+    """
+    Returns the time a response of the feed reports for itself, its
+    Last-Modified or else its Date header, as a naive local datetime like
+    the timestamps of the wait times. Returns None if neither header can be
+    parsed.
+    """
+    for name in ('Last-Modified', 'Date'):
+        try:
+            reported = parsedate_to_datetime(headers[name])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if reported.tzinfo is not None:
+            reported = reported.astimezone().replace(tzinfo=None)
+        return reported
+    return None
@@ -0,0 +1,240 @@
+"""Wait time forecasts per branch.
+
+Every branch gets a weekly profile: the median wait of each 15 minute bucket
+of each day of the week, for appointments and non-appointments, held in one
+(branches, 672, 2) array so a forecast is a single lookup. The profile is fit
+from the stored wait times in one vectorized pass and then kept up to date
+by every scrape with a streaming median update, which moves each median a
+fixed step towards the new sample.
+
+Within a day the profile is corrected by how far the branch currently is
+from it: the residuals of the day's scrapes are exponentially smoothed and
+added to the forecasts of the same day, fading with every bucket ahead.
+"""
+import os
+
+import numpy as np
+
+from cadmv.hours import weekdays_of
+import cadmv.queries as queries
+
+
+BUCKET_MINUTES = 15
+BUCKETS_PER_DAY = 24 * 60 // BUCKET_MINUTES
+WEEK_BUCKETS = 7 * BUCKETS_PER_DAY
+KINDS = ('appt', 'non_appt')
+
+# Minutes a median moves towards each new sample
+STEP = 1.0
+# Weight of the newest residual in the same-day correction
+ALPHA = 0.3
+# Fraction of the same-day correction kept per bucket ahead
+DAMPING = 0.9
+
+
+def bucket_of(timestamp):
+    """Returns the bucket of the week a datetime falls in"""
+    minute = timestamp.hour * 60 + timestamp.minute
+    return timestamp.weekday() * BUCKETS_PER_DAY + minute // BUCKET_MINUTES
+
+
+def buckets_of(timestamps):
+    """Vectorized bucket_of() over a sequence of datetimes"""
+    times = np.array(timestamps, dtype='datetime64[m]')
+    days = times.astype('datetime64[D]')
+    minutes = (times - days).astype(np.int64)
+    weekdays = weekdays_of(days)
+    return weekdays * BUCKETS_PER_DAY + minutes // BUCKET_MINUTES
+
+
+class Forecaster:
+    """The weekly profiles and same-day corrections of the branches
+
+    :param numbers:     (sequence) of branch numbers
+    :param medians:     (numpy.ndarray) of shape (branches, WEEK_BUCKETS, 2),
+                        NaN where there is no data, or None for none at all
+    :param counts:      (numpy.ndarray) of shape (branches, WEEK_BUCKETS):
+                        the samples behind each median, or None
+    """
+
+    def __init__(self, numbers, medians=None, counts=None):
+        self.numbers = np.asarray(numbers, dtype=np.int32)
+        n = len(self.numbers)
+        self.positions = {int(number): i for i, number in enumerate(self.numbers)}
+        self.medians = np.full((n, WEEK_BUCKETS, len(KINDS)), np.nan,
+                               dtype=np.float32) if medians is None else medians
+        self.counts = np.zeros((n, WEEK_BUCKETS), dtype=np.int32) \
+            if counts is None else counts
+        # Smoothed residual against the profile, per branch and kind, of the
+        # day (as an ordinal) and bucket the branch was last updated in
+        self.levels = np.zeros((n, len(KINDS)), dtype=np.float32)
+        self.level_days = np.full(n, -1, dtype=np.int32)
+        self.level_buckets = np.zeros(n, dtype=np.int32)
+
+    @classmethod
+    def fit(cls, numbers, branch_ids, timestamps, appts, non_appts):
+        """Fits the profiles to samples
+
+        :param numbers:     (sequence) of the branch numbers to forecast
+        :param branch_ids:  (sequence) branch number of every sample
+        :param timestamps:  (sequence) datetime of every sample
+        :param appts:       (sequence) appointment wait of every sample
+        :param non_appts:   (sequence) non-appointment wait of every sample
+        :return:            (Forecaster)
+        """
+        forecaster = cls(numbers)
+        branch_ids = np.asarray(branch_ids, dtype=np.int64)
+        if not len(branch_ids):
+            return forecaster
+
+        positions, known = forecaster._positions(branch_ids)
+        groups = positions * WEEK_BUCKETS + buckets_of(timestamps)
+        groups = groups[known]
+
+        medians = forecaster.medians.reshape(-1, len(KINDS))
+        for k, values in enumerate((appts, non_appts)):
+            values = np.asarray(values, dtype=np.float32)[known]
+            order = np.lexsort((values, groups))
+            sorted_groups, values = groups[order], values[order]
+            starts = np.flatnonzero(
+                np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+            sizes = np.diff(np.r_[starts, len(sorted_groups)])
+            lower = values[starts + (sizes - 1) // 2]
+            upper = values[starts + sizes // 2]
+            medians[sorted_groups[starts], k] = (lower + upper) / 2
+        forecaster.counts.reshape(-1)[:] = np.bincount(
+            groups, minlength=forecaster.counts.size)
+
+        return forecaster
+
+    @classmethod
+    def from_session(cls, session, catalog, start=None, end=None):
+        """Fits the profiles to the wait times stored while the branches were
+        open
+
+        :param session:     SQLAlchemy session
+        :param catalog:     (Catalog) of the branches to forecast
+        :param start:       (datetime) only use wait times at or after start,
+                            or None
+        :param end:         (datetime) only use wait times before end, or None
+        """
+        samples = queries.get_open_wait_time_samples(session, start, end)
+        columns = list(zip(*samples)) or [(), (), (), ()]
+        branch_ids, appts, non_appts, timestamps = columns
+        return cls.fit(catalog.numbers, branch_ids, timestamps, appts,
+                       non_appts)
+
+    def update(self, wait_times):
+        """Updates the profiles and same-day corrections with one scrape
+
+        :param wait_times:  (list) of wait time dicts of one scrape, see
+                            dmv.get_wait_times(). Rows with is_open set to
+                            False are ignored
+        """
+        rows = [wt for wt in wait_times if wt.get('is_open') is not False]
+        if not rows:
+            return
+
+        positions, known = self._positions(
+            np.array([wt['branch_id'] for wt in rows], dtype=np.int64))
+        positions = positions[known]
+        timestamp = rows[0]['timestamp']
+        bucket = bucket_of(timestamp)
+        samples = np.array([[wt['appt'], wt['non_appt']] for wt in rows],
+                           dtype=np.float32)[known]
+
+        medians = self.medians[positions, bucket]
+        missing = np.isnan(medians)
+        residuals = np.where(missing, 0, samples - medians)
+        self.medians[positions, bucket] = np.where(
+            missing, samples, medians + STEP * np.sign(samples - medians))
+        self.counts[positions, bucket] += 1
+
+        day = timestamp.toordinal()
+        same_day = (self.level_days[positions] == day)[:, None]
+        self.levels[positions] = np.where(
+            same_day,
+            ALPHA * residuals + (1 - ALPHA) * self.levels[positions],
+            residuals)
+        self.level_days[positions] = day
+        self.level_buckets[positions] = bucket
+
+    def forecast(self, number, when, kind='non_appt'):
+        """Forecasts the wait at a branch
+
+        :param number:  (int) branch number
+        :param when:    (datetime) local time of arrival
+        :param kind:    (str) 'appt' or 'non_appt'
+        :return:        (float) expected wait in minutes, or None if there is
+                        no data for that branch and time
+        """
+        position = self.positions.get(number)
+        if position is None:
+            return None
+
+        k = KINDS.index(kind)
+        bucket = bucket_of(when)
+        median = self.medians[position, bucket, k]
+        if np.isnan(median):
+            return None
+
+        correction = 0.0
+        if self.level_days[position] == when.toordinal():
+            ahead = max(0, bucket - int(self.level_buckets[position]))
+            correction = self.levels[position, k] * DAMPING ** ahead
+
+        return max(0.0, float(median + correction))
+
+    def forecast_all(self, when, kind='non_appt'):
+        """Vectorized forecast() over every branch
+
+        :return:    (numpy.ndarray) of expected waits in the order of
+                    self.numbers, NaN where there is no data
+        """
+        k = KINDS.index(kind)
+        bucket = bucket_of(when)
+        ahead = np.maximum(0, bucket - self.level_buckets)
+        corrections = np.where(self.level_days == when.toordinal(),
+                               self.levels[:, k] * DAMPING ** ahead, 0)
+
+        return np.maximum(0, self.medians[:, bucket, k] + corrections)
+
+    def save(self, path):
+        """Saves the forecaster to a .npz file, atomically"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(
+            tmp_path, numbers=self.numbers, medians=self.medians,
+            counts=self.counts, levels=self.levels,
+            level_days=self.level_days, level_buckets=self.level_buckets)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a forecaster saved by save()
+
+        :return:    (Forecaster), or None if there is no file at path
+        """
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as arrays:
+            forecaster = cls(arrays['numbers'], arrays['medians'],
+                             arrays['counts'])
+            forecaster.levels = arrays['levels']
+            forecaster.level_days = arrays['level_days']
+            forecaster.level_buckets = arrays['level_buckets']
+
+        return forecaster
+
+    def _positions(self, branch_ids):
+        """Maps branch numbers to positions, with a mask of the known ones"""
+        if not len(self.numbers):
+            return (np.zeros(len(branch_ids), dtype=np.int64),
+                    np.zeros(len(branch_ids), dtype=bool))
+
+        order = np.argsort(self.numbers)
+        found = np.searchsorted(self.numbers, branch_ids, sorter=order)
+        found = np.minimum(found, len(self.numbers) - 1)
+        positions = order[found]
+        return positions, self.numbers[positions] == branch_ids
@@ -0,0 +1,275 @@
+"""Geographic queries over the branch catalog.
+
+BranchIndex buckets the branches into a latitude/longitude grid. A nearest
+branch query only computes (vectorized) haversine distances for the
+branches in the rings of cells around the query point, widening the search
+until the k nearest are known to have been found.
+
+The branch-to-branch neighbour graph is derived from the full distance
+matrix and cached in a small .npz file per catalog version.
+"""
+from collections import namedtuple
+import logging
+import math
+import os
+
+import numpy as np
+
+
+logger = logging.getLogger('cadmv.geo')
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# A branch found near a point: its number, position in the catalog and
+# distance in km
+Neighbour = namedtuple('Neighbour', ['number', 'position', 'distance_km'])
+
+# The k nearest neighbours of every branch: the catalog's branch numbers and
+# (n, k) arrays of the neighbours' branch numbers and distances in km,
+# nearest first
+NeighbourGraph = namedtuple(
+    'NeighbourGraph', ['numbers', 'neighbours', 'distances'])
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km. The arguments are degrees and may be
+    NumPy arrays, which are broadcast against each other.
+    """
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class BranchIndex:
+    """Grid index over the branch locations of a Catalog
+
+    :param catalog:     (Catalog) of the branches
+    :param cell_deg:    (float) size of a grid cell in degrees
+    """
+
+    def __init__(self, catalog, cell_deg=0.5):
+        self.catalog = catalog
+        self.cell_deg = cell_deg
+        lats, lons = catalog.latitudes, catalog.longitudes
+        located = np.flatnonzero(~(np.isnan(lats) | np.isnan(lons)))
+
+        self._cells = {}
+        rows = np.floor(lats[located] / cell_deg).astype(int)
+        cols = np.floor(lons[located] / cell_deg).astype(int)
+        for position, row, col in zip(located, rows, cols):
+            self._cells.setdefault((row, col), []).append(position)
+        self._cells = {
+            cell: np.array(positions) for cell, positions in self._cells.items()
+        }
+
+        if self._cells:
+            cells = np.array(list(self._cells))
+            self._bounds = cells.min(axis=0), cells.max(axis=0)
+            self._max_abs_lat = float(np.max(np.abs(lats[located])))
+        else:
+            self._bounds = None
+
+    def nearest(self, lat, lon, k=5, max_km=None, mask=None):
+        """Finds the branches nearest to a point
+
+        :param lat:     (float) latitude of the point in degrees
+        :param lon:     (float) longitude of the point in degrees
+        :param k:       (int) largest number of branches to return
+        :param max_km:  (float) only return branches within this distance,
+                        or None for no limit
+        :param mask:    (numpy.ndarray) of bools over the catalog positions;
+                        only branches where it is True are returned. None
+                        allows every branch
+        :return:        (list) of up to k Neighbours, nearest first
+        """
+        if self._bounds is None or k <= 0:
+            return []
+
+        row = math.floor(lat / self.cell_deg)
+        col = math.floor(lon / self.cell_deg)
+        (min_row, min_col), (max_row, max_col) = self._bounds
+        max_ring = max(abs(row - min_row), abs(row - max_row),
+                       abs(col - min_col), abs(col - max_col))
+        # A branch outside ring r is at least r cells away. Cells are
+        # narrowest (in km) at the highest latitude involved.
+        max_lat = min(89.0, max(abs(lat), self._max_abs_lat) + self.cell_deg)
+        cell_km = self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(max_lat))
+
+        positions, distances = [], []
+        for ring in range(max_ring + 1):
+            found = [self._cells[cell] for cell in self._ring(row, col, ring)
+                     if cell in self._cells]
+            if found:
+                found = np.concatenate(found)
+                if mask is not None:
+                    found = found[mask[found]]
+                positions.append(found)
+                distances.append(haversine(
+                    lat, lon, self.catalog.latitudes[found],
+                    self.catalog.longitudes[found]))
+
+            reach_km = ring * cell_km
+            if max_km is not None and reach_km >= max_km:
+                break
+            count = sum(len(d) for d in distances)
+            if count >= k and np.partition(
+                    np.concatenate(distances), k - 1)[k - 1] <= reach_km:
+                break
+
+        if not positions:
+            return []
+        positions = np.concatenate(positions)
+        distances = np.concatenate(distances)
+        if max_km is not None:
+            within = distances <= max_km
+            positions, distances = positions[within], distances[within]
+
+        order = np.argsort(distances, kind='stable')[:k]
+        return [
+            Neighbour(int(self.catalog.numbers[p]), int(p), float(d))
+            for p, d in zip(positions[order], distances[order])
+        ]
+
+    def nearest_branches(self, lat, lon, k=5, max_km=None, mask=None):
+        """Same as nearest(), but returns (branch number, distance in km)
+        pairs
+        """
+        return [(n.number, n.distance_km)
+                for n in self.nearest(lat, lon, k, max_km, mask)]
+
+    @staticmethod
+    def _ring(row, col, ring):
+        """Yields the cells at Chebyshev distance ring from (row, col)"""
+        if ring == 0:
+            yield row, col
+            return
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+
+def best_branches_near(index, wait_times, lat, lon, k=5, max_km=50,
+                       kind='non_appt', mask=None):
+    """Ranks the branches near a point by their current wait time
+
+    :param index:       (BranchIndex) over the catalog
+    :param wait_times:  (dict) of branch number to (appt, non_appt), see
+                        diff.snapshot_state()
+    :param lat:         (float) latitude of the point in degrees
+    :param lon:         (float) longitude of the point in degrees
+    :param k:           (int) largest number of branches to return
+    :param max_km:      (float) only consider branches within this distance
+    :param kind:        (str) 'appt' or 'non_appt', the wait time to rank by
+    :param mask:        (numpy.ndarray) of bools restricting the branches
+                        considered, see BranchIndex.nearest()
+    :return:            (list) of (Neighbour, appt, non_appt) tuples, shortest
+                        wait first and nearest first among equal waits.
+                        Branches without a current wait time are left out
+    """
+    column = {'appt': 0, 'non_appt': 1}[kind]
+    candidates = index.nearest(lat, lon, len(index.catalog), max_km, mask)
+    ranked = [
+        (neighbour, *wait_times[neighbour.number])
+        for neighbour in candidates if neighbour.number in wait_times
+    ]
+    ranked.sort(key=lambda item: (item[1 + column], item[0].distance_km))
+
+    return ranked[:k]
+
+
+def distance_matrix(lats, lons):
+    """Computes the (n, n) matrix of great-circle distances in km between n
+    points by broadcasting
+    """
+    lats, lons = np.asarray(lats), np.asarray(lons)
+    return haversine(lats[:, None], lons[:, None], lats[None, :],
+                     lons[None, :])
+
+
+def neighbour_graph(catalog, k=5):
+    """Derives the k-nearest-neighbour graph of the branches
+
+    :param catalog: (Catalog) of the branches
+    :param k:       (int) neighbours per branch
+    :return:        (NeighbourGraph)
+    """
+    n = len(catalog)
+    k = min(k, n - 1)
+    matrix = distance_matrix(catalog.latitudes, catalog.longitudes)
+    # A branch isn't its own neighbour; unknown locations are never near
+    np.fill_diagonal(matrix, np.inf)
+    matrix[np.isnan(matrix)] = np.inf
+
+    if k <= 0:
+        empty = np.empty((n, 0))
+        return NeighbourGraph(catalog.numbers.copy(), empty.astype(np.int32),
+                              empty.astype(np.float32))
+
+    nearest = np.argpartition(matrix, k - 1, axis=1)[:, :k]
+    rows = np.arange(n)[:, None]
+    order = np.argsort(matrix[rows, nearest], axis=1, kind='stable')
+    nearest = nearest[rows, order]
+
+    return NeighbourGraph(
+        catalog.numbers.copy(),
+        catalog.numbers[nearest].astype(np.int32),
+        matrix[rows, nearest].astype(np.float32),
+    )
+
+
+def nearby_lists(graph, count=5):
+    """Lists the nearest neighbours of every branch of a graph, leaving out
+    those at an unknown distance: a branch without a location has no
+    neighbours and is no branch's neighbour
+
+    :param graph:   (NeighbourGraph)
+    :param count:   (int) largest number of neighbours per branch
+    :return:        (dict) of branch number to a list of neighbour numbers,
+                    nearest first, see queries.update_nearby()
+    """
+    return {
+        int(number): [int(n) for n, d in zip(neighbours[:count],
+                                             distances[:count])
+                      if np.isfinite(d)]
+        for number, neighbours, distances in zip(*graph)
+    }
+
+
+def graph_path(cache_dir, catalog, k):
+    """Returns the file the neighbour graph of a catalog version is cached
+    in
+    """
+    return os.path.join(cache_dir, f'neighbours-{catalog.version}-k{k}.npz')
+
+
+def load_neighbour_graph(catalog, k=5, cache_dir=None):
+    """Loads the neighbour graph of the catalog from cache_dir, computing and
+    caching it if it isn't there yet
+
+    :param catalog:     (Catalog) of the branches
+    :param k:           (int) neighbours per branch
+    :param cache_dir:   (str) directory of the cached graphs, or None to
+                        always compute it
+    :return:            (NeighbourGraph)
+    """
+    path = None if cache_dir is None else graph_path(cache_dir, catalog, k)
+    if path is not None and os.path.exists(path):
+        with np.load(path) as arrays:
+            return NeighbourGraph(
+                arrays['numbers'], arrays['neighbours'], arrays['distances'])
+
+    graph = neighbour_graph(catalog, k)
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(tmp_path, **graph._asdict())
+        os.replace(tmp_path, path)
+        logger.info('Cached the neighbour graph in %s', path)
+
+    return graph
@@ -0,0 +1,99 @@
+"""Weekday by hour heatmaps of the average waits of the branches.
+
+The heatmaps are precomputed: the heatmap_cells table holds, per branch,
+weekday and hour of the day, the number of wait times seen while the branch
+was open and their sums. Every scrape adds to the cells of its weekday and
+hour, and a heatmap is read back as 7 x 24 arrays of averages without
+touching wait_times.
+"""
+import numpy as np
+
+from cadmv.hours import weekdays_of
+
+
+DAYS = 7
+HOURS = 24
+
+
+def cell_of(timestamp):
+    """Returns the (weekday, hour) cell a datetime falls in"""
+    return timestamp.weekday(), timestamp.hour
+
+
+def build(branch_ids, timestamps, appts, non_appts):
+    """Computes the cells of many wait times at once
+
+    :param branch_ids:  (sequence) branch number of every wait time
+    :param timestamps:  (sequence) datetime of every wait time
+    :param appts:       (sequence) appointment wait of every wait time
+    :param non_appts:   (sequence) non-appointment wait of every wait time
+    :return:            (dict) of (branch number, weekday, hour) to
+                        [count, appt sum, non_appt sum]
+    """
+    if not len(branch_ids):
+        return {}
+
+    times = np.array(timestamps, dtype='datetime64[h]')
+    days = times.astype('datetime64[D]')
+    hours = (times - days).astype(np.int64)
+    weekdays = weekdays_of(days)
+
+    numbers, branches = np.unique(
+        np.asarray(branch_ids, dtype=np.int64), return_inverse=True)
+    cells = (branches.ravel() * DAYS + weekdays) * HOURS + hours
+    size = len(numbers) * DAYS * HOURS
+    counts = np.bincount(cells, minlength=size)
+    appt_sums = np.bincount(cells, weights=appts, minlength=size)
+    non_appt_sums = np.bincount(cells, weights=non_appts, minlength=size)
+
+    result = {}
+    for cell in np.flatnonzero(counts):
+        branch, rest = divmod(int(cell), DAYS * HOURS)
+        weekday, hour = divmod(rest, HOURS)
+        result[int(numbers[branch]), weekday, hour] = [
+            int(counts[cell]), float(appt_sums[cell]),
+            float(non_appt_sums[cell])]
+
+    return result
+
+
+def assemble(cells):
+    """Turns stored cells into heatmaps
+
+    :param cells:   (list) of (branch_id, weekday, hour, count, appt_sum,
+                    non_appt_sum) tuples, see queries.get_heatmap_cells()
+    :return:        (list) of heatmaps sorted by branch number, of the form
+                    {'number': 542, 'appt': [[...], ...],
+                     'non_appt': [[...], ...]}, where appt and non_appt
+                    hold 7 rows (Monday first) of 24 hourly average waits,
+                    None where there is no data
+    """
+    if not cells:
+        return []
+
+    branch_ids, weekdays, hours, counts, appt_sums, non_appt_sums = \
+        (np.asarray(column) for column in zip(*cells))
+    numbers, branches = np.unique(branch_ids, return_inverse=True)
+    shape = (len(numbers), DAYS, HOURS)
+    index = (branches.ravel(), weekdays, hours)
+
+    totals = np.zeros(shape)
+    np.add.at(totals, index, counts)
+    averages = {}
+    for kind, sums in (('appt', appt_sums), ('non_appt', non_appt_sums)):
+        grid = np.zeros(shape)
+        np.add.at(grid, index, sums)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            averages[kind] = np.round(grid / totals, 1)
+
+    heatmaps = []
+    for i, number in enumerate(numbers.tolist()):
+        heatmap = {'number': number}
+        for kind, grid in averages.items():
+            heatmap[kind] = [
+                [None if np.isnan(value) else float(value) for value in row]
+                for row in grid[i]
+            ]
+        heatmaps.append(heatmap)
+
+    return heatmaps
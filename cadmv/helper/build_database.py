@@ -1,16 +1,23 @@
 """Creates the table(s) in the database.
 
 This module will create the database file that is set in config.py if it 
-doesn't already exist.
+doesn't already exist. Run it again after upgrading: it adds the columns
+that the tables of an existing database lack.
 """
 import logging
 import os
 import pathlib
 
 from sqlalchemy import MetaData
+from sqlalchemy.orm import sessionmaker
 
 import config
+from cadmv.catalog import Catalog
+from cadmv.helper import data
+from cadmv.hours import OpeningHours
 import cadmv.models as models
+from cadmv import normalized
+import cadmv.queries as queries
 
 
 is_db_new = not os.path.exists(config.db_filename)
@@ -24,5 +31,23 @@ else:
                  'and has been created.', config.db_filename)
 
 models.Base.metadata.create_all(bind=config.engine)
+added = normalized.add_missing_columns(config.engine)
+for column in added:
+    logging.info('Added the column %s.', column)
+
+Session = sessionmaker(bind=config.engine)
+# The new branch columns are filled from offices.py, the closures before
+# is_open is worked out from them
+columns = [name for name in ('closures', 'services')
+           if f'branches.{name}' in added]
+if columns:
+    queries.update_branch_columns(
+        Session(), data.prep_branches_data(), columns)
+    logging.info('Filled %s of the branches.', ', '.join(columns))
+if 'wait_times.is_open' in added:
+    updated = queries.update_is_open(
+        Session(), OpeningHours(Catalog.from_session(Session())))
+    logging.info('Set is_open of %d wait times.', updated)
+
 metadata = MetaData(config.engine, reflect=False)
 logging.info('The database "%s" has been created.', config.db_filename)
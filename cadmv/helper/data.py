@@ -5,6 +5,9 @@ from xml.etree.ElementTree import Element
 
 from defusedxml.ElementTree import fromstring
 
+from cadmv.hours import closures_from_disclaimers
+from cadmv.records import BranchRecord, WaitTimeRecord
+from cadmv import services
 import offices
 
 
@@ -18,6 +21,7 @@ def prep_branches_data():
         "number": 538,
         "region": "3",
         "hours": "0800-1700,0800-1700,0900-1700,0800-1700,0800-1700,n,n"
+        "closures": "1200-1315,1200-1315,1200-1315,1200-1315,1200-1315,...",
         "address": "3344 B Lake Tahoe Boulevard, South Lake Tahoe, CA 96150",
         "latitude": 38.945748,
         "longitude": -119.969890,
@@ -25,28 +29,39 @@ def prep_branches_data():
         "nearby2": 0,
         "nearby3": 0,
         "nearby4": 0,
-        "nearby5": 0
+        "nearby5": 0,
+        "services": 45
     }
 
+    closures holds the daily closures (e.g. for lunch) taken from the hours
+    disclaimers in the same format as hours, or None. services is the
+    bitmask of the office's cDLID, cDLPC, ... flags, see cadmv.services.
+
+    The entries are BranchRecords, which read like the dicts above (see
+    cadmv.records).
+
     :return cleaned:    (list) cleaned data with only the attributes that are
                         found in the model
     """
     cleaned = []
 
     for office in offices.original_offices:
-        clean_office = {}
-        clean_office["name"] = office["name"]
-        clean_office["number"] = office["number"]
-        clean_office["region"] = int(office["region"])
-        clean_office["hours"] = office["hours"]
-        clean_office["address"] = office["address"]
-        clean_office["latitude"] = float(office["latitude"])
-        clean_office["longitude"] = float(office["longitude"])
-        clean_office["nearby1"] = office["nearby1"]
-        clean_office["nearby2"] = office["nearby2"]
-        clean_office["nearby3"] = office["nearby3"]
-        clean_office["nearby4"] = office["nearby4"]
-        clean_office["nearby5"] = office["nearby5"]
+        clean_office = BranchRecord(
+            name=office["name"],
+            number=office["number"],
+            region=int(office["region"]),
+            hours=office["hours"],
+            closures=closures_from_disclaimers(office.get("disclaimers", [])),
+            address=office["address"],
+            latitude=float(office["latitude"]),
+            longitude=float(office["longitude"]),
+            nearby1=office["nearby1"],
+            nearby2=office["nearby2"],
+            nearby3=office["nearby3"],
+            nearby4=office["nearby4"],
+            nearby5=office["nearby5"],
+            services=services.from_office(office),
+        )
 
         cleaned.append(clean_office)
 
@@ -84,31 +99,30 @@ def prep_wait_times_data(data, timestamp):
     ]
 
     Note that the timestamps all have the same time because they are all sourced
-    at the same time.
+    at the same time. The entries are WaitTimeRecords, which read like the
+    dicts above and share the one timestamp (see cadmv.records).
     """
     wait_times = [
-        {
-            "branch_id": wt[0],
-            "appt": wt[1],
-            "non_appt": wt[2],
-            "timestamp": timestamp,
-        }
-        for wt in data
+        WaitTimeRecord(branch_id, appt, non_appt, timestamp)
+        for branch_id, appt, non_appt in data
     ]
 
     return wait_times
 
 
-def split_response(response: str) -> tuple:
+def split_response(response: str, xml: bool = True) -> tuple:
     """
     Splits the response from the DMV into its constituent parts of an XML tree
-    and a list of tuples of ints.
+    and a list of tuples of ints. The XML tree is None when xml is False,
+    which saves parsing it when only the wait times are needed.
     """
+    # The wait times follow the XML, so the search starts after its last tag
     pattern = r"\d+,\d+,\d+"
-    index = re.search(pattern, response).start()
+    index = re.compile(pattern).search(response, response.rfind(">") + 1)\
+        .start()
 
     return (
-        text_to_xml(response[:index]),
+        text_to_xml(response[:index]) if xml else None,
         parse_wait_time_list(response[index:].split("\r\n")),
     )
 
@@ -151,5 +165,7 @@ def parse_wait_time_list(wt_string: list) -> list:
         (610, 0, 0),
         (664, 0, 0)
     ]
+
+    Blank lines, such as the one left by a trailing line break, are skipped.
     """
-    return [ast.literal_eval(wt) for wt in wt_string]
+    return [ast.literal_eval(wt) for wt in wt_string if wt.strip()]
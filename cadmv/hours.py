@@ -0,0 +1,249 @@
+"""Opening hours of the branches.
+
+Branch.hours is stored as seven comma-separated entries, Monday first, each
+either "HHMM-HHMM" or "n" for closed, e.g.
+
+    "0800-1700,0800-1700,0900-1700,0800-1700,0800-1700,n,n"
+
+Branch.closures uses the same format for the daily closures (e.g. lunch)
+given in the DMV's disclaimers. OpeningHours compiles both, once, into a
+weekly per-minute bitmap over the branch catalog, so "which branches are
+open at t" is a single array slice. Timestamps are naive local (California)
+time, like the scraped wait times.
+"""
+import datetime
+import re
+
+import numpy as np
+
+from cadmv.models import Branch
+
+
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday',
+        'sunday')
+MINUTES_PER_DAY = 24 * 60
+CLOSED = 'n'
+
+_closure_pattern = re.compile(
+    r'closed\b.*?(\d{1,2}):(\d{2}).*?(?:through|to|-)\s*(\d{1,2}):(\d{2})',
+    re.IGNORECASE)
+_weekday_pattern = re.compile(
+    r'\bon (' + '|'.join(DAYS) + r')s?\b', re.IGNORECASE)
+
+
+def parse_hours(text):
+    """Parses an hours (or closures) string
+
+    :param text:    (str) in the format described in the module docstring,
+                    or None
+    :return:        (list) of seven lists of (start, end) minutes since
+                    midnight, Monday first. Empty lists mean closed all day
+    :raises ValueError: if text is malformed
+    """
+    days = [[] for _ in DAYS]
+    if not text:
+        return days
+
+    entries = text.split(',')
+    if len(entries) != len(DAYS):
+        raise ValueError(f'Expected {len(DAYS)} entries in {text!r}')
+
+    for day, entry in zip(days, entries):
+        entry = entry.strip()
+        if entry in (CLOSED, ''):
+            continue
+        for interval in entry.split(';'):
+            start, end = interval.split('-')
+            day.append((_minutes(start), _minutes(end)))
+
+    return days
+
+
+def format_hours(days):
+    """Formats the output of parse_hours() back into a string"""
+    return ','.join(
+        ';'.join(f'{s // 60:02d}{s % 60:02d}-{e // 60:02d}{e % 60:02d}'
+                 for s, e in day) or CLOSED
+        for day in days)
+
+
+def parse_closure(disclaimer):
+    """Parses a disclaimer such as "This office is closed 12:00 Noon through
+    1:15 PM daily" into a closures string
+
+    :param disclaimer:  (str) English text of an hours disclaimer
+    :return:            (str) closures in the hours format, or None if the
+                        disclaimer isn't about a daily closure
+    """
+    match = _closure_pattern.search(disclaimer)
+    if match is None:
+        return None
+
+    start_hour, start_min, end_hour, end_min = map(int, match.groups())
+    start = start_hour * 60 + start_min
+    end = end_hour * 60 + end_min
+    # "12:00 Noon through 1:15 PM": the end is in the afternoon
+    if end <= start:
+        end += 12 * 60
+
+    interval = f'{start // 60:02d}{start % 60:02d}-{end // 60:02d}{end % 60:02d}'
+    weekday = _weekday_pattern.search(disclaimer)
+    if weekday is None:
+        return ','.join([interval] * len(DAYS))
+
+    day = DAYS.index(weekday.group(1).lower())
+    return ','.join(interval if i == day else CLOSED for i in range(len(DAYS)))
+
+
+def closures_from_disclaimers(disclaimers):
+    """Combines the closures given by the hours disclaimers of an office
+
+    :param disclaimers: (list) of disclaimer dicts as found in offices.py
+    :return:            (str) closures in the hours format, or None
+    """
+    days = [[] for _ in DAYS]
+    for disclaimer in disclaimers:
+        if disclaimer.get('section') != 'hours':
+            continue
+        closure = parse_closure(disclaimer.get('english') or '')
+        if closure is None:
+            continue
+        for day, intervals in zip(days, parse_hours(closure)):
+            day.extend(intervals)
+
+    if not any(days):
+        return None
+    return format_hours([sorted(set(day)) for day in days])
+
+
+def _minutes(hhmm):
+    hhmm = hhmm.strip()
+    if len(hhmm) != 4 or not hhmm.isdigit():
+        raise ValueError(f'Expected HHMM, got {hhmm!r}')
+    return int(hhmm[:2]) * 60 + int(hhmm[2:])
+
+
+def weekdays_of(days):
+    """Vectorized datetime.weekday() of days
+
+    :param days:    (numpy.ndarray) of datetime64[D]
+    :return:        (numpy.ndarray) of ints, 0 for Monday to 6 for Sunday
+    """
+    # 1970-01-01 was a Thursday
+    return (days.astype(np.int64) + 3) % 7
+
+
+def weekly_bitmap(hours, closures=None):
+    """Compiles the hours and closures of one branch
+
+    :return:    (numpy.ndarray) of bools, shape (7, 1440): True where the
+                branch is open on that weekday and minute
+    """
+    bitmap = np.zeros((len(DAYS), MINUTES_PER_DAY), dtype=bool)
+    for day, intervals in enumerate(parse_hours(hours)):
+        for start, end in intervals:
+            bitmap[day, start:end] = True
+    for day, intervals in enumerate(parse_hours(closures)):
+        for start, end in intervals:
+            bitmap[day, start:end] = False
+
+    return bitmap
+
+
+class OpeningHours:
+    """The compiled opening hours of every branch in a Catalog
+
+    :param catalog:     (Catalog) of the branches
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.bitmap = np.stack([
+            weekly_bitmap(hours, closures)
+            for hours, closures in zip(catalog.hours, catalog.closures)
+        ]) if len(catalog) else np.zeros((0, len(DAYS), MINUTES_PER_DAY), bool)
+        # Minutes of the week when at least one branch is open
+        self.any_open = self.bitmap.any(axis=0).ravel()
+
+    def open_at(self, timestamp):
+        """Determines which branches are open at a time
+
+        :param timestamp:   (datetime) local time
+        :return:            (numpy.ndarray) of bools over the catalog
+                            positions
+        """
+        minute = timestamp.hour * 60 + timestamp.minute
+        return self.bitmap[:, timestamp.weekday(), minute]
+
+    def open_mask(self, numbers, timestamps):
+        """Determines if branches were open at times, e.g. for many stored
+        wait times at once
+
+        :param numbers:     (sequence) of branch numbers
+        :param timestamps:  (sequence) of datetimes, local time
+        :return:            (numpy.ndarray) of bools, one per pair. Unknown
+                            branches are considered closed
+        """
+        numbers = np.asarray(numbers, dtype=np.int64)
+        if not len(numbers) or not len(self.catalog):
+            return np.zeros(len(numbers), dtype=bool)
+
+        positions = np.searchsorted(self.catalog.numbers, numbers)
+        positions = np.minimum(positions, len(self.catalog) - 1)
+        known = self.catalog.numbers[positions] == numbers
+
+        times = np.array(timestamps, dtype='datetime64[m]')
+        days = times.astype('datetime64[D]')
+        minutes = (times - days).astype(np.int64)
+        weekdays = weekdays_of(days)
+
+        return known & self.bitmap[positions, weekdays, minutes]
+
+    def next_opening(self, timestamp):
+        """Finds when the first branch opens
+
+        :param timestamp:   (datetime) local time
+        :return:            (datetime) the first minute, starting with the one
+                            timestamp falls in, at which at least one branch
+                            is open, or None if no branch ever opens
+        """
+        open_minutes = np.flatnonzero(self.any_open)
+        if not len(open_minutes):
+            return None
+
+        now = timestamp.weekday() * MINUTES_PER_DAY \
+            + timestamp.hour * 60 + timestamp.minute
+        later = open_minutes[open_minutes >= now]
+        if len(later):
+            wait = int(later[0]) - now
+        else:
+            wait = int(open_minutes[0]) + len(self.any_open) - now
+
+        start = timestamp.replace(second=0, microsecond=0)
+        return start + datetime.timedelta(minutes=wait)
+
+    def open_numbers(self, timestamp):
+        """Returns the numbers of the branches open at a time"""
+        return self.catalog.numbers[self.open_at(timestamp)].tolist()
+
+    def is_open(self, number, timestamp):
+        """Determines if one branch is open at a time. Unknown branches are
+        considered closed.
+        """
+        position = self.catalog.position(number)
+        if position is None:
+            return False
+        minute = timestamp.hour * 60 + timestamp.minute
+        return bool(self.bitmap[position, timestamp.weekday(), minute])
+
+    def is_open_clause(self, timestamp, column=Branch.number):
+        """Builds a SQL filter that keeps the rows of the branches open at a
+        time, e.g.
+
+            session.query(Branch).filter(hours.is_open_clause(now))
+            session.query(WaitTime).filter(
+                hours.is_open_clause(now, WaitTime.branch_id))
+
+        :param column:  the branch number column to filter on
+        """
+        return column.in_(self.open_numbers(timestamp))
@@ -0,0 +1,209 @@
+"""The ingest path: stores the wait times of a scrape and refreshes everything
+that is derived from them
+"""
+import datetime
+import logging
+
+from cadmv import anomaly
+from cadmv.catalog import Catalog
+from cadmv import diff
+from cadmv.forecast import Forecaster
+from cadmv.hours import OpeningHours
+from cadmv import metrics
+import cadmv.queries as queries
+from cadmv.records import WaitTimeRecord
+from cadmv import sketch
+from cadmv import snapshot
+from cadmv.window import RecentWindow
+
+
+logger = logging.getLogger('cadmv.ingest')
+
+
+class Ingestor:
+    """Ingests scrapes. An instance can be reused across scrapes when the
+    scraper runs as a long-lived process.
+
+    :param Session:         SQLAlchemy sessionmaker
+    :param snapshot_path:   (str) file the pre-encoded snapshot buffers are
+                            written to for the API, or None to skip them
+    :param broker:          (push.Broker) new snapshots are published to when
+                            the API runs in the same process, or None
+    :param forecast_path:   (str) file of the forecasts, which are updated
+                            with every scrape, or None to skip them. The
+                            forecasts are fit by bin/forecast.py
+    :param window_days:     (int) days of usable wait times kept in memory
+                            (see window), or None to keep none
+    """
+
+    def __init__(self, Session, snapshot_path=None, broker=None,
+                 forecast_path=None, window_days=None):
+        self.Session = Session
+        self.snapshot_path = snapshot_path
+        self.broker = broker
+        self.forecast_path = forecast_path
+        self._forecaster = None
+        # The sketches of the current hour, see _next_sketches()
+        self._sketch_hour = None
+        self._sketches = None
+        self.version = None
+        self._regions = None
+        self._hours = None
+        self._detector = None
+        self._state = None
+        self.window_days = window_days
+        self._window = None
+
+    @property
+    def regions(self):
+        """The branch number to region number mapping, read once"""
+        if self._regions is None:
+            self._regions = snapshot.load_regions(self.Session())
+        return self._regions
+
+    @property
+    def hours(self):
+        """The compiled opening hours of the branches, read once"""
+        if self._hours is None:
+            self._hours = OpeningHours(Catalog.from_session(self.Session()))
+        return self._hours
+
+    @property
+    def detector(self):
+        """The anomaly detector, primed with the most recent scrapes once"""
+        if self._detector is None:
+            self._detector = anomaly.Detector.from_session(
+                self.Session(), self.hours.catalog.numbers)
+        return self._detector
+
+    @property
+    def window(self):
+        """The RecentWindow of the last window_days, filled from the
+        database once, or None if window_days is None
+        """
+        if self._window is None and self.window_days is not None:
+            self._window = RecentWindow.from_session(
+                self.Session(), self.hours.catalog, self.window_days)
+        return self._window
+
+    def ingest(self, wait_times):
+        """Stores the wait times of one scrape, as returned by
+        dmv.get_wait_times(), along with its diff against the previous
+        scrape, and refreshes the derived data
+
+        :return:    (dict) of request path to the pre-encoded Buffer of the
+                    snapshot
+        """
+        if not wait_times:
+            logger.warning('Scrape returned no wait times, nothing to ingest')
+            return {}
+
+        state = diff.snapshot_state(wait_times)
+        if self._state is None:
+            previous = queries.get_current_wait_times(self.Session())
+            self._state = diff.snapshot_state(previous)
+        changes = diff.compute_diff(self._state, state)
+        is_open = self.hours.open_mask(
+            [wt['branch_id'] for wt in wait_times],
+            [wt['timestamp'] for wt in wait_times])
+        flags, snapshot_flags, missing = self.detector.check(
+            wait_times, is_open)
+        if snapshot_flags:
+            logger.warning('Anomalies in the scrape: %s (missing branches: %s)',
+                           ', '.join(anomaly.describe(snapshot_flags)),
+                           missing)
+        rows = [WaitTimeRecord(wt['branch_id'], wt['appt'], wt['non_appt'],
+                               wt['timestamp'], bool(open_), int(flag))
+                for wt, open_, flag in zip(wait_times, is_open, flags)]
+
+        # Only the usable wait times of open branches feed the statistics
+        usable = [wt for wt in rows if wt['is_open'] and not wt['flags']]
+        sketch_hour, sketches = self._next_sketches(usable)
+        encoded = None
+        if usable:
+            encoded = {
+                (branch_id, sketch_hour): (count, sketch.encode(appt),
+                                           sketch.encode(non_appt))
+                for branch_id, (count, appt, non_appt) in sketches.items()
+            }
+        # The wait times and everything derived from them in the database
+        # are stored in one transaction, and the state kept in memory is
+        # only advanced once it commits, so a failed scrape can be retried
+        self.version = queries.create_snapshot(
+            self.Session(), rows, changes, snapshot_flags,
+            getattr(wait_times, 'source_hash', None),
+            getattr(wait_times, 'feed_time', None),
+            usable=usable, sketches=encoded)
+        self._sketch_hour, self._sketches = sketch_hour, sketches
+
+        closed = sum(not wt['is_open'] for wt in rows)
+        metrics.increment('cadmv_rows_skipped_total', closed, reason='closed')
+        metrics.increment('cadmv_rows_skipped_total',
+                          len(rows) - closed - len(usable), reason='flagged')
+        self._update_forecasts(usable)
+        if self.window is not None:
+            self.window.add(usable)
+        self._state = state
+
+        # The API keys its caches and buffers on the scrape's timestamp
+        timestamp = wait_times[0]['timestamp'].isoformat()
+        buffers = snapshot.render_snapshot(wait_times, self.regions)
+        if self.snapshot_path is not None:
+            snapshot.write_snapshot(self.snapshot_path, timestamp, buffers)
+        if self.broker is not None:
+            self.broker.publish(timestamp, buffers[snapshot.CURRENT_PATH])
+
+        return buffers
+
+    def _next_sketches(self, wait_times):
+        """Adds the wait times to copies of their branches' sketches of the
+        current hour. The sketches of the hour are read once and kept in
+        memory, see ingest()
+
+        :return:    (tuple) of the hour and the dict of branch number to
+                    [count, appt histogram, non_appt histogram]
+        """
+        rows = wait_times
+        if not rows:
+            return self._sketch_hour, self._sketches
+
+        hour = rows[0]['timestamp'].replace(minute=0, second=0, microsecond=0)
+        if hour != self._sketch_hour:
+            stored = queries.get_sketches(
+                self.Session(), hour, hour + datetime.timedelta(hours=1))
+            sketches = {
+                branch_id: [count, sketch.decode(appt),
+                            sketch.decode(non_appt)]
+                for branch_id, _, count, appt, non_appt in stored
+            }
+        else:
+            sketches = {
+                branch_id: [count, appt.copy(), non_appt.copy()]
+                for branch_id, (count, appt, non_appt)
+                in self._sketches.items()
+            }
+
+        for wt in rows:
+            counts = sketches.setdefault(
+                wt['branch_id'],
+                [0, sketch.histogram([]), sketch.histogram([])])
+            counts[0] += 1
+            counts[1][sketch.buckets_of(wt['appt'])] += 1
+            counts[2][sketch.buckets_of(wt['non_appt'])] += 1
+
+        return hour, sketches
+
+    def _update_forecasts(self, wait_times):
+        """Updates the forecasts with a scrape and saves them"""
+        if self.forecast_path is None:
+            return
+        if self._forecaster is None:
+            self._forecaster = Forecaster.load(self.forecast_path)
+            if self._forecaster is None:
+                logger.warning('No forecasts in %s, run bin/forecast.py to '
+                               'fit them', self.forecast_path)
+                self.forecast_path = None
+                return
+
+        self._forecaster.update(wait_times)
+        self._forecaster.save(self.forecast_path)
@@ -0,0 +1,221 @@
+"""Timing spans and counters of the hot paths, exported as Prometheus text.
+
+Metrics are off by default and every call is then a single flag check, so
+the instrumentation can stay in the scraper's hot path. enable() turns them
+on, e.g. from bin/wait_time_scraper.py --metrics-file. For example,
+
+    with metrics.span('cadmv_fetch_seconds'):
+        resp = requests.get(url)
+    metrics.increment('cadmv_rows_written_total', len(rows),
+                      table='wait_times')
+
+Spans are histograms of seconds and counters only go up. Both take labels
+as keyword arguments. render() formats everything in the Prometheus text
+exposition format, which write() saves to a file (for the node exporter's
+textfile collector) and serve() answers on a local HTTP endpoint.
+"""
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger('cadmv.metrics')
+
+# Upper bounds of the span histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0)
+
+# HELP lines of the metrics recorded by the package
+HELP = {
+    'cadmv_fetch_seconds': 'Time spent fetching the wait times from the DMV',
+    'cadmv_parse_seconds': 'Time spent parsing the wait times',
+    'cadmv_db_write_seconds': 'Time spent writing rows, commit included',
+    'cadmv_db_commit_seconds': 'Time spent committing transactions',
+    'cadmv_ingest_seconds': 'Time spent ingesting a scrape',
+    'cadmv_sql_seconds': 'Time spent in SQL statements, see cadmv.profiling',
+    'cadmv_rows_written_total': 'Rows written to the database',
+    'cadmv_rows_skipped_total': 'Wait times left out of the statistics',
+    'cadmv_rows_failed_total': 'Rows whose write failed',
+    'cadmv_scrapes_total': 'Scrapes by outcome',
+}
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_NULL_SPAN = contextlib.nullcontext()
+
+
+def enable():
+    """Starts recording metrics"""
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """Stops recording metrics. What was recorded is kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forgets every recorded metric"""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def increment(name, value=1, **labels):
+    """Adds value to a counter"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Records a duration in a histogram"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        counts = histogram[0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+                break
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+class _Span:
+    """Times the block it wraps, see span()"""
+
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def span(name, **labels):
+    """Returns a context manager recording the time spent in its block in
+    the histogram name. Blocks that raise are timed too.
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, labels)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def render():
+    """Formats the recorded metrics in the Prometheus text format
+
+    :return:    (str)
+    """
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(
+            (key, (list(counts), total, count))
+            for key, (counts, total, count) in _histograms.items())
+
+    lines = []
+    described = set()
+
+    def header(name, kind):
+        if name not in described:
+            described.add(name)
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in counters:
+        header(name, 'counter')
+        lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    for (name, labels), (counts, total, count) in histograms:
+        header(name, 'histogram')
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, counts):
+            cumulative += bucket
+            lines.append(f'{name}_bucket'
+                         f'{_format_labels(labels, [("le", bound)])} '
+                         f'{cumulative}')
+        lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])}'
+                     f' {count}')
+        lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+        lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def write(path):
+    """Writes render() to path, atomically so a collector never reads a
+    partial file
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics with render()"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(host='127.0.0.1', port=9464):
+    """Serves /metrics from a background thread
+
+    :return:    (ThreadingHTTPServer) the server, call shutdown() to stop it
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('Serving metrics on http://%s:%d/metrics',
+                *server.server_address[:2])
+    return server
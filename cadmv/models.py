@@ -1,6 +1,7 @@
 """Models for the app"""
 from sqlalchemy import (
-    Column, DateTime, Float, ForeignKey, Integer, Sequence, String
+    Boolean, Column, Date, DateTime, Float, ForeignKey, Integer, LargeBinary,
+    Sequence, String, Text, UniqueConstraint, inspect, text
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -18,6 +19,8 @@ class Branch(Base):
     address = Column(String(64))
     id = Column(Integer, Sequence('id_seq'), primary_key=True)
     hours = Column(String(64))
+    # Daily closures within the hours, in the same format, see cadmv.hours
+    closures = Column(String(80))
     latitude = Column(Float)
     longitude = Column(Float)
     name = Column(String(64))
@@ -28,6 +31,8 @@ class Branch(Base):
     nearby4 = Column(Integer)
     nearby5 = Column(Integer)
     region = Column(Integer)
+    # Bitmask of the services the branch offers, see cadmv.services
+    services = Column(Integer, default=0)
     timestamp = Column(
         DateTime,
         server_default=func.now(),
@@ -46,15 +51,127 @@ class WaitTime(Base):
     __tablename__ = 'wait_times'
     id = Column(Integer, Sequence('id_seq'), primary_key=True)
     appt = Column(Integer)
-    branch_id = Column(Integer, ForeignKey('branches.number'))
+    branch_id = Column(Integer, ForeignKey('branches.number'), index=True)
     # branch = relationship('Branch', back_populates='wait_times')
     non_appt = Column(Integer)
     # timestamp = Column(DateTime, server_default=func.now()) # only for command line stuff
-    timestamp = Column(DateTime)
+    timestamp = Column(DateTime, index=True)
+    # Whether the branch was open at timestamp according to its hours, so
+    # that statistics can leave out the zeros of closed offices. NULL when
+    # unknown.
+    is_open = Column(Boolean)
+    # Bitmask of the anomalies detected in the wait time or its snapshot,
+    # see cadmv.anomaly. 0 (or NULL for rows stored before the column
+    # existed) when the wait time is usable.
+    flags = Column(Integer, default=0)
 
     def __repr__(self):
         return f'<{self.branch_id}'
 
+
+class Snapshot(Base):
+    """Model for one scrape of the wait times. Its id is the monotonic
+    snapshot version clients sync from; changes holds the JSON diff against
+    the previous snapshot (see cadmv.diff)
+    """
+    __tablename__ = 'snapshots'
+    id = Column(Integer, primary_key=True)
+    fetched_at = Column(DateTime, index=True)
+    changes = Column(Text)
+    # Bitmask of the anomalies detected in the scrape, see cadmv.anomaly
+    flags = Column(Integer, default=0)
+    # Hex SHA-256 of the raw response and the time the feed reported for it
+    # (its Last-Modified or Date header), NULL when unknown
+    source_hash = Column(String(64))
+    feed_time = Column(DateTime)
+
+    def __repr__(self):
+        return f'<Snapshot {self.id}: {self.fetched_at}>'
+
+
+class WaitTimeSketch(Base):
+    """Model for the histogram sketches (see cadmv.sketch) of the wait times
+    of a branch during one hour, while it was open
+    """
+    __tablename__ = 'wait_time_sketches'
+    __table_args__ = (UniqueConstraint('branch_id', 'hour'),)
+    id = Column(Integer, primary_key=True)
+    branch_id = Column(Integer, ForeignKey('branches.number'))
+    hour = Column(DateTime, index=True)
+    count = Column(Integer)
+    appt = Column(LargeBinary)
+    non_appt = Column(LargeBinary)
+
+    def __repr__(self):
+        return f'<WaitTimeSketch {self.branch_id}: {self.hour}>'
+
+
+class HeatmapCell(Base):
+    """Model for one weekday and hour of a branch's heatmap: the number and
+    sums of the wait times seen then while the branch was open (see
+    cadmv.heatmap)
+    """
+    __tablename__ = 'heatmap_cells'
+    __table_args__ = (UniqueConstraint('branch_id', 'weekday', 'hour'),)
+    id = Column(Integer, primary_key=True)
+    branch_id = Column(Integer, ForeignKey('branches.number'), index=True)
+    weekday = Column(Integer)
+    hour = Column(Integer)
+    count = Column(Integer)
+    appt_sum = Column(Float)
+    non_appt_sum = Column(Float)
+
+    def __repr__(self):
+        return f'<HeatmapCell {self.branch_id}: {self.weekday} {self.hour}>'
+
+
+class CoverageDay(Base):
+    """Model for the coverage bitmap of a branch's day: the two-minute slots
+    a wait time was stored in (see cadmv.coverage)
+    """
+    __tablename__ = 'coverage_days'
+    __table_args__ = (UniqueConstraint('branch_id', 'day'),)
+    id = Column(Integer, primary_key=True)
+    branch_id = Column(Integer, ForeignKey('branches.number'))
+    day = Column(Date, index=True)
+    count = Column(Integer)
+    slots = Column(LargeBinary)
+
+    def __repr__(self):
+        return f'<CoverageDay {self.branch_id}: {self.day}>'
+
+
+def add_missing_columns(engine, tables=None):
+    """Adds the columns of the models that the tables of an older database
+    lack, with ALTER TABLE ... ADD COLUMN. Existing rows get NULL. Missing
+    tables are left to create_all().
+
+    :param engine:  SQLAlchemy engine
+    :param tables:  (list) of the Tables to check, or None for those of the
+                    models
+    :return:        (list) of the 'table.column' names of the columns added
+    """
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    with engine.begin() as conn:
+        for table in tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(
+                    f'ALTER TABLE {quote(table.name)} '
+                    f'ADD COLUMN {quote(column.name)} {column_type}'))
+                added.append(f'{table.name}.{column.name}')
+    return added
+
 """
 class Branch(Model):
     __tablename__ = 'branch'
@@ -0,0 +1,196 @@
+"""The normalized layout of the wait times, one row per scrape.
+
+By default every row of wait_times repeats the timestamp of its scrape,
+about 180 times per scrape. In the normalized layout the wait times are
+readings that reference their scrape's row in snapshots by snapshot_id, so
+the big table and its indexes hold no timestamps at all:
+
+    snapshots   id, fetched_at, changes, flags, source_hash, feed_time
+    readings    id, snapshot_id, branch_id, appt, non_appt, is_open, flags
+
+and wait_times becomes a view joining the two, with the columns of the
+table it replaces. The queries in cadmv.queries read the view unchanged; a
+time range is narrowed on the small snapshots table first and then joined
+to the readings of those snapshot ids. The writes of cadmv.queries insert
+readings when is_normalized() says so. The bulk loaders (bin/bulk_load.py,
+bin/replay.py) only write the default layout: load first, then normalize.
+
+create() creates a new database in the normalized layout and normalize()
+moves an existing one over, see bin/normalize.py.
+
+Wait times stored without a snapshot (before snapshots existed, loaded in
+bulk or by queries.create_wait_times()) get one without changes. Those are
+numbered below every existing snapshot, oldest first, so that the latest
+snapshot version, max(id), stays the newest scrape, and
+queries.get_changes_since() answers a span holding one with the full
+snapshot.
+"""
+import weakref
+
+from sqlalchemy import (
+    Boolean, Column, ForeignKey, Index, Integer, MetaData, Table, inspect,
+    literal, select, text
+)
+from sqlalchemy.sql import exists, func
+
+import cadmv.models as models
+from cadmv.models import Base, Branch, Snapshot, WaitTime
+
+
+metadata = MetaData()
+
+readings = Table(
+    'readings', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('snapshot_id', Integer, ForeignKey(Snapshot.__table__.c.id),
+           nullable=False),
+    Column('branch_id', Integer, ForeignKey(Branch.__table__.c.number)),
+    Column('appt', Integer),
+    Column('non_appt', Integer),
+    Column('is_open', Boolean),
+    Column('flags', Integer, default=0),
+    Index('ix_readings_snapshot_id_branch_id', 'snapshot_id', 'branch_id'),
+    Index('ix_readings_branch_id_snapshot_id', 'branch_id', 'snapshot_id'),
+)
+
+VIEW = '''
+    CREATE VIEW wait_times AS
+    SELECT r.id, r.appt, r.branch_id, r.non_appt,
+           s.fetched_at AS "timestamp", r.is_open, r.flags
+    FROM readings r JOIN snapshots s ON s.id = r.snapshot_id
+'''
+
+_layouts = weakref.WeakKeyDictionary()
+
+
+def is_normalized(session):
+    """Determines if the database of a session has the normalized layout.
+    The answer is read once per engine
+    """
+    engine = session.get_bind()
+    if engine not in _layouts:
+        _layouts[engine] = 'wait_times' in \
+            inspect(session.connection()).get_view_names()
+    return _layouts[engine]
+
+
+def add_missing_columns(engine):
+    """Adds the columns of the models, and of readings, that the tables of
+    an older database lack, with ALTER TABLE ... ADD COLUMN. Existing rows
+    get NULL. Missing tables are left to create_all() and the wait_times
+    view of the normalized layout to readings, see
+    models.add_missing_columns()
+
+    :return:    (list) of the 'table.column' names of the columns added
+    """
+    return models.add_missing_columns(
+        engine, Base.metadata.sorted_tables + metadata.sorted_tables)
+
+
+def _first_backfill_id(conn, count):
+    """Returns the first of count snapshot ids below every existing one"""
+    lowest = conn.execute(select(func.min(Snapshot.__table__.c.id))).scalar()
+    return (1 if lowest is None else lowest) - count
+
+
+def create(engine):
+    """Creates the tables of an empty database in the normalized layout"""
+    Base.metadata.create_all(bind=engine, tables=[
+        table for table in Base.metadata.sorted_tables
+        if table is not WaitTime.__table__])
+    metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(text(VIEW))
+    _layouts[engine] = True
+
+
+def normalize(engine):
+    """Moves the wait_times table of a database into readings, in one
+    transaction. Scrapes stored without a snapshot get one without changes,
+    numbered below the existing snapshots. The readings keep the ids of the
+    wait times.
+
+    :return:    (tuple) of the numbers of snapshots created and readings
+    """
+    add_missing_columns(engine)
+    wait_times = WaitTime.__table__
+    snapshots = Snapshot.__table__
+    with engine.begin() as conn:
+        metadata.create_all(bind=conn)
+        missing = select(wait_times.c.timestamp).distinct()\
+            .where(wait_times.c.timestamp.isnot(None))\
+            .where(~exists().where(
+                snapshots.c.fetched_at == wait_times.c.timestamp))\
+            .subquery()
+        created = conn.execute(
+            select(func.count()).select_from(missing)).scalar()
+        if created:
+            first_id = _first_backfill_id(conn, created)
+            numbered = select(
+                first_id - 1 + func.row_number().over(
+                    order_by=missing.c.timestamp),
+                missing.c.timestamp, literal(0))
+            conn.execute(snapshots.insert().from_select(
+                ['id', 'fetched_at', 'flags'], numbered))
+
+        first = select(snapshots.c.fetched_at,
+                       func.min(snapshots.c.id).label('id'))\
+            .group_by(snapshots.c.fetched_at).subquery()
+        rows = select(wait_times.c.id, first.c.id, wait_times.c.branch_id,
+                      wait_times.c.appt, wait_times.c.non_appt,
+                      wait_times.c.is_open,
+                      func.coalesce(wait_times.c.flags, 0))\
+            .join(first, first.c.fetched_at == wait_times.c.timestamp)
+        moved = conn.execute(readings.insert().from_select(
+            ['id', 'snapshot_id', 'branch_id', 'appt', 'non_appt', 'is_open',
+             'flags'], rows)).rowcount
+
+        wait_times.drop(bind=conn)
+        conn.execute(text(VIEW))
+        if engine.dialect.name == 'postgresql':
+            conn.execute(text(
+                "SELECT setval(pg_get_serial_sequence('readings', 'id'), "
+                "COALESCE(MAX(id), 0) + 1, false) FROM readings"))
+    _layouts[engine] = True
+    return created, moved
+
+
+def add_readings(session, snapshot_id, wait_times):
+    """Inserts the wait times of one snapshot as readings, in the session's
+    transaction
+    """
+    if wait_times:
+        session.execute(readings.insert(), [
+            {'snapshot_id': snapshot_id, 'branch_id': wt['branch_id'],
+             'appt': wt['appt'], 'non_appt': wt['non_appt'],
+             'is_open': wt.get('is_open'), 'flags': wt.get('flags') or 0}
+            for wt in wait_times
+        ])
+
+
+def add_wait_times(session, wait_times):
+    """Inserts wait times as readings of the snapshots of their timestamps,
+    creating the snapshots that don't exist yet, without changes and below
+    the existing snapshots, in the session's transaction
+    """
+    by_timestamp = {}
+    for wt in wait_times:
+        by_timestamp.setdefault(wt['timestamp'], []).append(wt)
+    if not by_timestamp:
+        return
+
+    ids = dict(session.query(Snapshot.fetched_at, func.min(Snapshot.id))
+               .filter(Snapshot.fetched_at.in_(list(by_timestamp)))
+               .group_by(Snapshot.fetched_at).all())
+    missing = sorted(timestamp for timestamp in by_timestamp
+                     if timestamp not in ids)
+    if missing:
+        first_id = _first_backfill_id(session, len(missing))
+        created = {timestamp: Snapshot(id=first_id + i, fetched_at=timestamp,
+                                       flags=0)
+                   for i, timestamp in enumerate(missing)}
+        session.add_all(created.values())
+        session.flush()
+        ids.update((timestamp, s.id) for timestamp, s in created.items())
+    for timestamp, rows in by_timestamp.items():
+        add_readings(session, ids[timestamp], rows)
@@ -0,0 +1,328 @@
+"""Opt-in profiling of the SQL statements run on an engine.
+
+A Profiler listens to the before_cursor_execute and after_cursor_execute
+events of an engine and keeps a latency histogram per statement, keyed by
+the statement with its literals and parameter lists normalized away and by
+the function of cadmv.queries (or cadmv.async_queries) that ran it. The
+statements of an async query run in a greenlet whose stack doesn't reach
+the coroutine, so the async queries are decorated with attributed(), which
+names them in a context variable instead.
+Statements slower than the threshold are logged with their query plan.
+report() summarizes the statements by total time. For example,
+
+    profiler = Profiler(config.engine, threshold=0.2).attach()
+    ...
+    print(profiler.report())
+
+bin/api_server.py and bin/wait_time_scraper.py attach one to config.engine
+with --profile-sql. Nothing is hooked into the engine otherwise.
+"""
+import contextvars
+import functools
+import json
+import logging
+import re
+import sys
+import threading
+import time
+
+from sqlalchemy import event
+
+from cadmv import metrics
+
+
+logger = logging.getLogger('cadmv.profiling')
+
+# Modules whose functions statements are attributed to
+QUERY_MODULES = ('cadmv.queries', 'cadmv.async_queries')
+# Seconds above which a statement is logged with its plan
+THRESHOLD = 0.5
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = metrics.BUCKETS
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDER = r'(?:\?|%s|%\(\w+\)s|:\w+|\$\d+)'
+_LIST = re.compile(r'\(\s*' + _PLACEHOLDER + r'(?:\s*,\s*' + _PLACEHOLDER
+                   + r')*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+# The name of the async query function running in the current context, see
+# attributed()
+_current_query = contextvars.ContextVar('cadmv_current_query', default=None)
+
+
+def normalize(statement):
+    """Reduces a statement to its shape: literals become ?, lists of
+    placeholders (expanded IN clauses, multi-row VALUES) become (?...) and
+    whitespace is collapsed
+    """
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _LIST.sub('(?...)', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+def caller(modules=QUERY_MODULES):
+    """Returns the name of the innermost function of modules on the stack,
+    or else of the attributed() async query running, or None when the
+    statement doesn't come from one of them
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        if frame.f_globals.get('__name__') in modules:
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return _current_query.get()
+
+
+def attributed(function):
+    """Decorates an async query function so that the statements it runs are
+    attributed to it, see caller()
+    """
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        token = _current_query.set(function.__name__)
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            _current_query.reset(token)
+
+    return wrapper
+
+
+def _pg_scanned(plan):
+    """Sums the rows read by the scan nodes of a PostgreSQL plan"""
+    rows = 0
+    if 'Scan' in plan.get('Node Type', ''):
+        rows += (plan.get('Actual Rows', 0)
+                 + plan.get('Rows Removed by Filter', 0)) \
+            * plan.get('Actual Loops', 1)
+    for child in plan.get('Plans', ()):
+        rows += _pg_scanned(child)
+    return rows
+
+
+def explain(cursor, dialect, statement, parameters, analyze=False):
+    """Explains one statement with its parameters
+
+    :param cursor:      DB-API cursor to run the EXPLAIN with
+    :param dialect:     (str) name of the database's dialect
+    :param statement:   (str) the statement, as given to the cursor
+    :param parameters:  its parameters, as given to the cursor
+    :param analyze:     (bool) on PostgreSQL, run the statement to get the
+                        actual row counts
+    :return:            (dict) of the plan lines, whether a table is fully
+                        scanned and, with analyze on PostgreSQL, the number
+                        of rows scanned
+    """
+    if dialect == 'postgresql':
+        options = 'ANALYZE, FORMAT JSON' if analyze else 'FORMAT JSON'
+        cursor.execute(f'EXPLAIN ({options}) ' + statement, parameters)
+        plan = cursor.fetchone()[0]
+        plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]
+        lines = []
+
+        def walk(node, depth):
+            lines.append('  ' * depth + node['Node Type']
+                         + (f" on {node['Relation Name']}"
+                            if 'Relation Name' in node else ''))
+            for child in node.get('Plans', ()):
+                walk(child, depth + 1)
+
+        walk(plan['Plan'], 0)
+        return {
+            'plan': lines,
+            'full_scan': any('Seq Scan' in line for line in lines),
+            'rows_scanned': _pg_scanned(plan['Plan']) if analyze else None,
+        }
+
+    if dialect == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        lines = [row[-1] for row in cursor.fetchall()]
+        return {
+            'plan': lines,
+            'full_scan': any(line.startswith('SCAN ') and 'USING' not in line
+                             for line in lines),
+            'rows_scanned': None,
+        }
+
+    cursor.execute('EXPLAIN ' + statement, parameters)
+    return {
+        'plan': [' '.join(str(value) for value in row)
+                 for row in cursor.fetchall()],
+        'full_scan': None,
+        'rows_scanned': None,
+    }
+
+
+class Statistics:
+    """Latency histogram of one statement"""
+
+    __slots__ = ('calls', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.calls += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket the qth percentile falls
+        in, or the slowest call for the last bucket
+        """
+        rank = q / 100 * self.calls
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'total': self.total,
+            'mean': self.total / self.calls if self.calls else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'max': self.max,
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'],
+                                self.buckets)),
+        }
+
+
+class Profiler:
+    """Profiles the statements run on an engine while attached
+
+    :param engine:      SQLAlchemy Engine, or AsyncEngine
+    :param threshold:   (float) seconds above which a statement is logged
+                        with its plan, or None to log none
+    :param explain:     (bool) include the plan of the slow statements
+    """
+
+    def __init__(self, engine, threshold=THRESHOLD, explain=True):
+        self.engine = getattr(engine, 'sync_engine', engine)
+        self.threshold = threshold
+        self.explain = explain
+        self.statistics = {}
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """Starts listening to the engine
+
+        :return:    (Profiler) self
+        """
+        event.listen(self.engine, 'before_cursor_execute', self._before)
+        event.listen(self.engine, 'after_cursor_execute', self._after)
+        return self
+
+    def detach(self):
+        """Stops listening to the engine. The statistics are kept."""
+        event.remove(self.engine, 'before_cursor_execute', self._before)
+        event.remove(self.engine, 'after_cursor_execute', self._after)
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def reset(self):
+        """Forgets the statistics"""
+        with self._lock:
+            self.statistics.clear()
+
+    def _before(self, conn, cursor, statement, parameters, context,
+                executemany):
+        conn.info.setdefault('cadmv_profiling', []).append(
+            time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context,
+               executemany):
+        started = conn.info.get('cadmv_profiling')
+        if not started:
+            # Attached while the statement ran
+            return
+        elapsed = time.perf_counter() - started.pop()
+        function = caller() or '<other>'
+        key = (function, normalize(statement))
+        with self._lock:
+            statistics = self.statistics.get(key)
+            if statistics is None:
+                statistics = self.statistics[key] = Statistics()
+            statistics.add(elapsed)
+        metrics.observe('cadmv_sql_seconds', elapsed, query=function)
+
+        if self.threshold is not None and elapsed >= self.threshold:
+            self._log_slow(conn, function, statement, parameters, executemany,
+                           elapsed)
+
+    def _log_slow(self, conn, function, statement, parameters, executemany,
+                  elapsed):
+        """Logs a slow statement, with its plan when it can be explained"""
+        plan = ''
+        if self.explain and not executemany \
+                and statement.lstrip()[:6].upper() == 'SELECT':
+            try:
+                cursor = conn.connection.cursor()
+                try:
+                    lines = explain(cursor, conn.dialect.name, statement,
+                                    parameters)['plan']
+                finally:
+                    cursor.close()
+                plan = '\n' + '\n'.join('    ' + line for line in lines)
+            except Exception:
+                logger.debug('Could not explain the statement', exc_info=True)
+        logger.warning('Slow statement in %s (%.3f s): %s%s', function,
+                       elapsed, _SPACE.sub(' ', statement).strip(), plan)
+
+    def to_dict(self):
+        """Returns the statistics, by total time
+
+        :return:    (list) of dicts of the function, the normalized
+                    statement and its statistics, see Statistics.to_dict()
+        """
+        with self._lock:
+            items = [(function, statement, statistics.to_dict())
+                     for (function, statement), statistics
+                     in self.statistics.items()]
+        items.sort(key=lambda item: item[2]['total'], reverse=True)
+        return [dict(function=function, statement=statement, **statistics)
+                for function, statement, statistics in items]
+
+    def report(self, limit=20, width=100):
+        """Formats the statements taking the most time
+
+        :param limit:   (int) number of statements, or None for all of them
+        :param width:   (int) characters of each statement shown
+        :return:        (str)
+        """
+        rows = self.to_dict()
+        total = sum(row['total'] for row in rows)
+        lines = [f'{len(rows)} statements, '
+                 f'{sum(row["calls"] for row in rows)} calls, {total:.3f} s',
+                 f"{'function':<32} {'calls':>7} {'total':>9} {'mean':>9} "
+                 f"{'p95':>9} {'max':>9}  statement"]
+        for row in rows[:limit]:
+            lines.append(
+                f"{row['function']:<32} {row['calls']:>7} "
+                f"{row['total']:>9.4f} {row['mean']:>9.4f} "
+                f"{row['p95']:>9.4f} {row['max']:>9.4f}  "
+                f"{row['statement'][:width]}")
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        """Writes the statistics to a JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
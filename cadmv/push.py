@@ -0,0 +1,101 @@
+"""Push channel for new snapshots.
+
+The Broker keeps the latest published snapshot as one pre-encoded Message
+(the snapshot Buffer plus its server-sent event frame) and wakes every
+subscriber when a new one is published, so fanning a scrape out to all
+connected clients costs one encoding and a socket write per client.
+Subscribers can wait from threads or from asyncio event loops.
+"""
+import asyncio
+from collections import namedtuple
+import threading
+
+
+# A published snapshot: its version, its Buffer (see cadmv.snapshot) and
+# the server-sent event frame carrying its JSON body
+Message = namedtuple('Message', ['version', 'buffer', 'event'])
+
+EVENT_NAME = 'snapshot'
+
+
+def encode_event(version, body, event=EVENT_NAME):
+    """Encodes a server-sent event frame. body must not contain newlines,
+    which holds for the compact JSON of cadmv.snapshot.encode().
+    """
+    return (f'id: {version}\nevent: {event}\ndata: '.encode('utf-8')
+            + body + b'\n\n')
+
+
+class Broker:
+    """Publishes snapshots to any number of subscribers"""
+
+    def __init__(self):
+        self._message = None
+        self._condition = threading.Condition()
+        self._waiters = set()
+
+    @property
+    def latest(self):
+        """The latest Message, or None if nothing has been published"""
+        return self._message
+
+    def publish(self, version, buffer):
+        """Publishes the Buffer of a new snapshot to every subscriber. Does
+        nothing if version is already the latest.
+        """
+        with self._condition:
+            if self._message is not None and self._message.version == version:
+                return
+            message = Message(
+                version, buffer, encode_event(version, buffer.body))
+            self._message = message
+            waiters, self._waiters = self._waiters, set()
+            self._condition.notify_all()
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future, message)
+
+    def wait(self, after=None, timeout=None):
+        """Blocks until there is a message whose version isn't after
+
+        :param after:   (str) version the subscriber already has, or None
+        :param timeout: (float) seconds to wait, or None to wait forever
+        :return:        (Message) or None if the timeout expired
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self._is_newer(self._message, after), timeout)
+            message = self._message
+
+        return message if self._is_newer(message, after) else None
+
+    async def wait_async(self, after=None, timeout=None):
+        """Coroutine version of wait()"""
+        message = self._message
+        if self._is_newer(message, after):
+            return message
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (asyncio.get_running_loop(), future)
+        with self._condition:
+            message = self._message
+            if self._is_newer(message, after):
+                return message
+            self._waiters.add(waiter)
+
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._condition:
+                self._waiters.discard(waiter)
+
+    @staticmethod
+    def _is_newer(message, after):
+        return message is not None and message.version != after
+
+
+def _resolve(future, message):
+    if not future.done():
+        future.set_result(message)
@@ -1,18 +1,34 @@
 """Module that holds the database queries"""
 import datetime
+import json
 import logging
 
-from sqlalchemy.sql import exists
+from sqlalchemy.sql import bindparam, exists
 from sqlalchemy.sql.expression import func
 from sqlalchemy import func
 
-from cadmv.models import Branch, WaitTime
+from cadmv import coverage
+from cadmv import diff
+from cadmv import metrics
+from cadmv import normalized
+from cadmv.models import (
+    Branch, CoverageDay, HeatmapCell, Snapshot, WaitTime, WaitTimeSketch
+)
+from cadmv import sketch
 from cadmv.session import session_scope
 
 
 # Session = sessionmaker(bind=config.engine)
 
-logger = logging.getLogger('dictionaryapi.queries')
+logger = logging.getLogger('cadmv.queries')
+
+# get_changes_since() answers with the full current snapshot instead of a
+# merged diff when the client is further behind than this many snapshots
+# (one day of scrapes)
+MAX_CHANGES_SPAN = 720
+
+# update_is_open() reads and updates this many wait times per transaction
+UPDATE_BATCH_SIZE = 10000
 
 
 def create_new_branch(session, branch_info):
@@ -69,6 +85,106 @@ def update_branch(session, branch_info):
             update(branch_info)
 
 
+def update_nearby(session, nearby):
+    """Updates the nearby1..nearby5 columns of many branches in one
+    executemany
+
+    :param session:     SQLAlchemy session
+    :param nearby:      (dict) of branch number to a list of up to five
+                        nearby branch numbers, nearest first. Missing
+                        entries are stored as 0
+    """
+    rows = []
+    for number, neighbours in nearby.items():
+        row = {'b_number': number}
+        for i in range(5):
+            row[f'nearby{i + 1}'] = \
+                int(neighbours[i]) if i < len(neighbours) else 0
+        rows.append(row)
+    if not rows:
+        return
+
+    statement = Branch.__table__.update()\
+        .where(Branch.number == bindparam('b_number'))\
+        .values({f'nearby{i}': bindparam(f'nearby{i}') for i in range(1, 6)})
+    with session_scope(session) as sessn:
+        sessn.execute(statement, rows)
+
+
+def update_branch_columns(session, branches, columns):
+    """Updates some columns of many branches in one executemany, e.g. to
+    fill the columns added to an existing database
+
+    :param session:     SQLAlchemy session
+    :param branches:    (iterable) of branches as prepared by
+                        helper.data.prep_branches_data(). Branches missing
+                        from the database are skipped
+    :param columns:     (sequence) of the names of the columns to update
+    """
+    rows = [dict({name: branch[name] for name in columns},
+                 b_number=branch['number'])
+            for branch in branches]
+    if not rows or not columns:
+        return
+
+    statement = Branch.__table__.update()\
+        .where(Branch.number == bindparam('b_number'))\
+        .values({name: bindparam(name) for name in columns})
+    with session_scope(session) as sessn:
+        sessn.execute(statement, rows)
+
+
+def update_is_open(session, opening_hours, start=None, end=None,
+                   batch_size=UPDATE_BATCH_SIZE):
+    """Sets WaitTime.is_open of the stored wait times from the branches'
+    opening hours, e.g. after the hours changed or for rows stored before the
+    column existed. The wait times are read and updated batch_size at a time
+    in order of id, committing each batch, so the whole table is never held
+    in memory and an interrupted run keeps the batches done
+
+    :param session:         SQLAlchemy session
+    :param opening_hours:   (hours.OpeningHours) compiled hours of the
+                            branches
+    :param start:           (datetime) only update wait times at or after
+                            start, or None
+    :param end:             (datetime) only update wait times before end, or
+                            None
+    :param batch_size:      (int) wait times per transaction
+    :return:                (int) number of wait times updated
+    """
+    updated = 0
+    last_id = None
+    while True:
+        with session_scope(session) as sessn:
+            query = sessn.query(
+                WaitTime.id, WaitTime.branch_id, WaitTime.timestamp)
+            if start is not None:
+                query = query.filter(WaitTime.timestamp >= start)
+            if end is not None:
+                query = query.filter(WaitTime.timestamp < end)
+            if last_id is not None:
+                query = query.filter(WaitTime.id > last_id)
+            rows = query.order_by(WaitTime.id).limit(batch_size).all()
+            if not rows:
+                return updated
+
+            ids, numbers, timestamps = zip(*rows)
+            is_open = opening_hours.open_mask(numbers, timestamps)
+            # The ids of the wait_times view are the ids of the readings
+            table = normalized.readings if normalized.is_normalized(sessn) \
+                else WaitTime.__table__
+            statement = table.update()\
+                .where(table.c.id == bindparam('wt_id'))\
+                .values(is_open=bindparam('open'))
+            sessn.execute(statement, [
+                {'wt_id': wt_id, 'open': bool(flag)}
+                for wt_id, flag in zip(ids, is_open)
+            ])
+
+        updated += len(rows)
+        last_id = ids[-1]
+
+
 def get_branch_by_number(session, number):
     """Gets a branch by its number
 
@@ -88,18 +204,24 @@ def get_branch_by_number(session, number):
     return branch
 
 
-def get_branches_by_region(session, region):
+def get_branches_by_region(session, region, services=0):
     """Gets branches by region
 
     :param session:     SQLAlchemy session
     :param region:      (int) region number
+    :param services:    (int) bitmask of the services the branches must all
+                        offer, see cadmv.services, or 0 for any branch
     :returns branches:  all branches to match the region, or None if none
                         are found. NOTE: it's currently returning [] if
                         none are found...
     """
     branches = None
     try:
-        branches = session.query(Branch).filter_by(region=region).all()
+        query = session.query(Branch).filter_by(region=region)
+        if services:
+            query = query.filter(
+                Branch.services.op('&')(services) == services)
+        branches = query.all()
     except:
         logger.error('An error occurred accessing the database', exc_info=True)
     finally:
@@ -138,9 +260,11 @@ def create_wait_time(session, wait_time):
         'timestamp': datetime.datetime(2018, 12, 6, 23, 22, 13, 859932)
     }
     """
-    wt = WaitTime(**wait_time)
     with session_scope(session) as sessn:
-        sessn.add(wt)
+        if normalized.is_normalized(sessn):
+            normalized.add_wait_times(sessn, [wait_time])
+        else:
+            sessn.add(WaitTime(**wait_time))
 
 
 def create_wait_times(session, wait_times):
@@ -164,10 +288,19 @@ def create_wait_times(session, wait_times):
         }
     ]
     """
-    wts = [WaitTime(**wt) for wt in wait_times]
-
-    with session_scope(session) as sessn:
-        sessn.add_all(wts)
+    try:
+        with metrics.span('cadmv_db_write_seconds', query='create_wait_times'):
+            with session_scope(session) as sessn:
+                if normalized.is_normalized(sessn):
+                    normalized.add_wait_times(sessn, wait_times)
+                else:
+                    sessn.add_all([WaitTime(**wt) for wt in wait_times])
+    except:
+        metrics.increment('cadmv_rows_failed_total', len(wait_times),
+                          table='wait_times')
+        raise
+    metrics.increment('cadmv_rows_written_total', len(wait_times),
+                      table='wait_times')
 
 
 def get_wait_time_by_number(session, branch_num):
@@ -241,3 +374,697 @@ def get_wait_times_by_region(session, region):
         session.close()
 
     return wait_times
+
+
+def get_all_branches(session):
+    """Gets every branch, sorted by branch number
+
+    :param session:     SQLAlchemy session
+    :returns branches:  (list) of all branches. Returns an empty list if there
+                        are none
+    """
+    branches = []
+    try:
+        branches = session.query(Branch).order_by(Branch.number).all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return branches
+
+
+def get_latest_timestamp(session):
+    """Gets the timestamp of the most recent scrape. This is used as the
+    snapshot version by the read API.
+
+    :param session:     SQLAlchemy session
+    :return:            (datetime) of the newest wait time entry, or None if
+                        there are no wait times in the database
+    """
+    timestamp = None
+    try:
+        timestamp = session.query(func.max(WaitTime.timestamp)).scalar()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return timestamp
+
+
+def get_first_timestamp(session):
+    """Gets the timestamp of the oldest scrape
+
+    :param session:     SQLAlchemy session
+    :return:            (datetime) of the oldest wait time entry, or None if
+                        there are no wait times in the database
+    """
+    timestamp = None
+    try:
+        timestamp = session.query(func.min(WaitTime.timestamp)).scalar()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return timestamp
+
+
+def get_current_wait_times(session, region=None):
+    """Gets the wait times of every branch from the most recent scrape
+
+    :param session:     SQLAlchemy session
+    :param region:      (int) only return the branches of this region, or
+                        None for every branch
+    :return:            (list) of the wait times sharing the newest timestamp,
+                        sorted by branch number. Returns an empty list if
+                        there are no wait times in the database
+    """
+    wait_times = []
+    try:
+        latest = session.query(func.max(WaitTime.timestamp)).scalar_subquery()
+        query = session.query(WaitTime).filter(WaitTime.timestamp == latest)
+        if region is not None:
+            query = query.join(Branch, Branch.number == WaitTime.branch_id)\
+                .filter(Branch.region == region)
+        wait_times = query.order_by(WaitTime.branch_id).all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return wait_times
+
+
+def get_recent_scrapes(session, scrapes):
+    """Gets the wait times of the most recent scrapes
+
+    :param session:     SQLAlchemy session
+    :param scrapes:     (int) number of scrapes
+    :return:            (list) of up to scrapes lists of wait times, one per
+                        scrape, oldest first. Returns an empty list if there
+                        are no wait times in the database
+    """
+    grouped = []
+    try:
+        timestamps = session.query(WaitTime.timestamp).distinct()\
+            .order_by(WaitTime.timestamp.desc()).limit(scrapes).subquery()
+        oldest = session.query(func.min(timestamps.c.timestamp))\
+            .scalar_subquery()
+        wait_times = session.query(WaitTime)\
+            .filter(WaitTime.timestamp >= oldest)\
+            .order_by(WaitTime.timestamp, WaitTime.branch_id).all()
+        for wt in wait_times:
+            if not grouped or grouped[-1][0].timestamp != wt.timestamp:
+                grouped.append([])
+            grouped[-1].append(wt)
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return grouped
+
+
+def get_wait_times_by_range(session, branch_num, start=None, end=None):
+    """Gets the wait times for a particular DMV branch between two times
+
+    :param session:     SQLAlchemy session
+    :param branch_num:  (int) branch number
+    :param start:       (datetime) inclusive lower bound, or None for no bound
+    :param end:         (datetime) exclusive upper bound, or None for no bound
+    :return:            (list) of the wait times for the branch in the range,
+                        oldest first. Returns an empty list if there are none
+    """
+    wait_times = []
+    try:
+        query = session.query(WaitTime).filter_by(branch_id=branch_num)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        wait_times = query.order_by(WaitTime.timestamp).all()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return wait_times
+
+
+def get_open_wait_time_samples(session, start=None, end=None):
+    """Gets the wait times of every branch stored while it was open, as plain
+    rows for the vectorized statistics. Rows of unknown opening status are
+    included; rows flagged as anomalies (see cadmv.anomaly) are not.
+
+    :param session:     SQLAlchemy session
+    :param start:       (datetime) inclusive lower bound, or None for no bound
+    :param end:         (datetime) exclusive upper bound, or None for no bound
+    :return:            (list) of (branch_id, appt, non_appt, timestamp)
+                        tuples. Returns an empty list if there are none
+    """
+    samples = []
+    try:
+        query = session.query(WaitTime.branch_id, WaitTime.appt,
+                              WaitTime.non_appt, WaitTime.timestamp)\
+            .filter(WaitTime.is_open.isnot(False))\
+            .filter(func.coalesce(WaitTime.flags, 0) == 0)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        samples = [tuple(row) for row in query.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return samples
+
+
+def get_scrape_times(session, start=None, end=None):
+    """Gets when a wait time of every branch was stored, e.g. to rebuild the
+    coverage bitmaps
+
+    :param session:     SQLAlchemy session
+    :param start:       (datetime) inclusive lower bound, or None for no bound
+    :param end:         (datetime) exclusive upper bound, or None for no bound
+    :return:            (list) of (branch_id, timestamp) tuples. Returns an
+                        empty list if there are none
+    """
+    times = []
+    try:
+        query = session.query(WaitTime.branch_id, WaitTime.timestamp)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        times = [tuple(row) for row in query.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return times
+
+
+def _as_date(value):
+    """Converts a date() column value, a string on SQLite, to a date"""
+    if isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def get_region_trends(session, start=None, end=None, region=None):
+    """Averages the usable wait times of the open branches of every region
+    by day, see get_open_wait_time_samples()
+
+    :param session:     SQLAlchemy session
+    :param start:       (datetime) inclusive lower bound, or None for no bound
+    :param end:         (datetime) exclusive upper bound, or None for no bound
+    :param region:      (int) region number, or None for every region
+    :return:            (list) of (region, date, count, appt average,
+                        non_appt average) tuples, by region then date.
+                        Returns an empty list if there are none
+    """
+    trends = []
+    try:
+        day = func.date(WaitTime.timestamp)
+        query = session.query(
+            Branch.region, day, func.count(WaitTime.id),
+            func.avg(WaitTime.appt), func.avg(WaitTime.non_appt))\
+            .join(Branch, Branch.number == WaitTime.branch_id)\
+            .filter(WaitTime.is_open.isnot(False))\
+            .filter(func.coalesce(WaitTime.flags, 0) == 0)
+        if region is not None:
+            query = query.filter(Branch.region == region)
+        if start is not None:
+            query = query.filter(WaitTime.timestamp >= start)
+        if end is not None:
+            query = query.filter(WaitTime.timestamp < end)
+        query = query.group_by(Branch.region, day)\
+            .order_by(Branch.region, day)
+        trends = [(region_, _as_date(date), count, float(appt),
+                   float(non_appt))
+                  for region_, date, count, appt, non_appt in query.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return trends
+
+
+def create_snapshot(session, wait_times, changes, flags=0, source_hash=None,
+                    feed_time=None, usable=None, sketches=None):
+    """Creates the wait time entries of one scrape together with its snapshot,
+    in one transaction. The ingest path also passes usable and sketches so
+    that the coverage, heatmaps and sketches are updated in that transaction:
+    a scrape that fails to store leaves none of them half applied and can be
+    ingested again
+
+    :param session:     SQLAlchemy session
+    :param wait_times:  (list) of wait times, see create_wait_times()
+    :param changes:     (dict) diff against the previous snapshot, see
+                        cadmv.diff
+    :param flags:       (int) anomalies detected in the scrape, see
+                        cadmv.anomaly
+    :param source_hash: (str) hex SHA-256 of the raw response, or None
+    :param feed_time:   (datetime) time the feed reported, or None
+    :param usable:      (list) of the usable wait times of the scrape, added
+                        to the heatmaps while all of them are added to the
+                        coverage, or None to leave both alone
+    :param sketches:    (dict) of sketches to save, see save_sketches(), or
+                        None
+    :return:            (int) the new snapshot version
+    """
+    snapshot = Snapshot(
+        fetched_at=wait_times[0]['timestamp'],
+        changes=json.dumps(changes, separators=(',', ':')),
+        flags=flags,
+        source_hash=source_hash,
+        feed_time=feed_time,
+    )
+
+    try:
+        with metrics.span('cadmv_db_write_seconds', query='create_snapshot'):
+            with session_scope(session) as sessn:
+                sessn.add(snapshot)
+                if normalized.is_normalized(sessn):
+                    sessn.flush()
+                    normalized.add_readings(sessn, snapshot.id, wait_times)
+                else:
+                    sessn.add_all([WaitTime(**wt) for wt in wait_times])
+                    sessn.flush()
+                version = snapshot.id
+                if usable is not None:
+                    _add_to_coverage(sessn, wait_times)
+                    _add_to_heatmaps(sessn, usable)
+                if sketches:
+                    _save_sketches(sessn, sketches)
+    except:
+        metrics.increment('cadmv_rows_failed_total', len(wait_times),
+                          table='wait_times')
+        raise
+    metrics.increment('cadmv_rows_written_total', len(wait_times),
+                      table='wait_times')
+    metrics.increment('cadmv_rows_written_total', table='snapshots')
+
+    return version
+
+
+def get_latest_snapshot_version(session):
+    """Gets the version of the most recent snapshot
+
+    :param session:     SQLAlchemy session
+    :return:            (int) version, or None if there are no snapshots
+    """
+    version = None
+    try:
+        version = session.query(func.max(Snapshot.id)).scalar()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return version
+
+
+def get_changes_since(session, version=None, max_span=MAX_CHANGES_SPAN):
+    """Gets what changed since a snapshot version so clients can sync
+    incrementally
+
+    :param session:     SQLAlchemy session
+    :param version:     (int) snapshot version the client has, or None if it
+                        has nothing yet
+    :param max_span:    (int) largest number of snapshots whose diffs are
+                        merged. Clients further behind (or unknown versions,
+                        or spans holding a snapshot without a diff) get the
+                        full current snapshot instead
+    :return:            (dict) payload of the form
+    {
+        'version': 1234,        # latest version, pass it as the next since
+        'since': 1230,          # None if this is a full snapshot
+        'full': False,          # True if added holds every branch
+        'added': [[603, 10, 25]],
+        'changed': [[542, 15, 27]],
+        'removed': [537]
+    }
+                        or None if there are no snapshots
+    """
+    payload = None
+    try:
+        row = session.query(Snapshot.id, Snapshot.fetched_at)\
+            .order_by(Snapshot.id.desc()).first()
+        if row is None:
+            return None
+        latest, fetched_at = row
+
+        diffs = None
+        if version is not None and 0 <= latest - version <= max_span:
+            diffs = [changes for changes, in session.query(Snapshot.changes)
+                     .filter(Snapshot.id > version)
+                     .order_by(Snapshot.id)]
+            # Snapshots stored without a diff (see cadmv.normalized) can't
+            # be merged, so a span holding one gets the full snapshot
+            if None in diffs:
+                diffs = None
+
+        if diffs is not None:
+            changes = diff.merge_diffs(json.loads(d) for d in diffs)
+            payload = dict(version=latest, since=version, full=False,
+                           **changes)
+        else:
+            # The wait times of the latest snapshot, not the latest wait
+            # times, which can be newer when loaded without a snapshot
+            wait_times = session.query(WaitTime)\
+                .filter(WaitTime.timestamp == fetched_at).all()
+            changes = diff.compute_diff({}, diff.snapshot_state(wait_times))
+            payload = dict(version=latest, since=None, full=True, **changes)
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return payload
+
+
+def get_sketches(session, start=None, end=None, branch_num=None):
+    """Gets the hourly wait time sketches, see cadmv.sketch
+
+    :param session:     SQLAlchemy session
+    :param start:       (datetime) inclusive lower bound on the hour, or None
+    :param end:         (datetime) exclusive upper bound on the hour, or None
+    :param branch_num:  (int) branch number, or None for every branch
+    :return:            (list) of (branch_id, hour, count, appt, non_appt)
+                        tuples, where appt and non_appt are encoded sketches
+    """
+    sketches = []
+    try:
+        query = session.query(
+            WaitTimeSketch.branch_id, WaitTimeSketch.hour,
+            WaitTimeSketch.count, WaitTimeSketch.appt,
+            WaitTimeSketch.non_appt)
+        if branch_num is not None:
+            query = query.filter(WaitTimeSketch.branch_id == branch_num)
+        if start is not None:
+            query = query.filter(WaitTimeSketch.hour >= start)
+        if end is not None:
+            query = query.filter(WaitTimeSketch.hour < end)
+        sketches = [tuple(row) for row in query.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return sketches
+
+
+def save_sketches(session, sketches):
+    """Creates or replaces hourly wait time sketches
+
+    :param session:     SQLAlchemy session
+    :param sketches:    (dict) of (branch number, hour datetime) to
+                        (count, appt, non_appt), where appt and non_appt are
+                        encoded sketches
+    """
+    if not sketches:
+        return
+
+    with session_scope(session) as sessn:
+        _save_sketches(sessn, sketches)
+
+
+def _save_sketches(sessn, sketches):
+    """save_sketches() in the transaction of sessn"""
+    hours = {hour for _, hour in sketches}
+    existing = {
+        (branch_id, hour): sketch_id
+        for sketch_id, branch_id, hour in sessn.query(
+            WaitTimeSketch.id, WaitTimeSketch.branch_id,
+            WaitTimeSketch.hour).filter(WaitTimeSketch.hour.in_(hours))
+    }
+    updates, inserts = [], []
+    for (branch_id, hour), (count, appt, non_appt) in sketches.items():
+        row = {'count': count, 'appt': appt, 'non_appt': non_appt}
+        if (branch_id, hour) in existing:
+            updates.append(dict(row, s_id=existing[branch_id, hour]))
+        else:
+            inserts.append(dict(row, branch_id=branch_id, hour=hour))
+
+    table = WaitTimeSketch.__table__
+    if updates:
+        sessn.execute(
+            table.update().where(table.c.id == bindparam('s_id')).values(
+                count=bindparam('count'), appt=bindparam('appt'),
+                non_appt=bindparam('non_appt')),
+            updates)
+    if inserts:
+        sessn.execute(table.insert(), inserts)
+
+
+def get_wait_time_percentiles(session, branch_num, start=None, end=None,
+                              percentiles=(50, 90)):
+    """Estimates percentiles of the wait times of a branch while it was open
+    by merging its hourly sketches. Ranges are in whole hours: start is
+    rounded down to the hour.
+
+    :param session:     SQLAlchemy session
+    :param branch_num:  (int) branch number
+    :param start:       (datetime) inclusive lower bound, or None for no bound
+    :param end:         (datetime) exclusive upper bound, or None for no bound
+    :param percentiles: (sequence) of percentiles between 0 and 100
+    :return:            (dict) of the form
+                        {'count': 1230, 'appt': {'p50': 12.0, 'p90': 31.5},
+                         'non_appt': {...}}, or None if there are no wait
+                        times in the range
+    """
+    if start is not None:
+        start = start.replace(minute=0, second=0, microsecond=0)
+    sketches = get_sketches(session, start, end, branch_num)
+    return sketch.summarize(sketches, percentiles)
+
+
+def get_heatmap_cells(session, branch_num=None, region=None):
+    """Gets the stored heatmap cells, see cadmv.heatmap
+
+    :param session:     SQLAlchemy session
+    :param branch_num:  (int) branch number, or None
+    :param region:      (int) region number of the branches, or None
+    :return:            (list) of (branch_id, weekday, hour, count, appt_sum,
+                        non_appt_sum) tuples. Returns an empty list if there
+                        are none
+    """
+    cells = []
+    try:
+        query = session.query(
+            HeatmapCell.branch_id, HeatmapCell.weekday, HeatmapCell.hour,
+            HeatmapCell.count, HeatmapCell.appt_sum, HeatmapCell.non_appt_sum)
+        if branch_num is not None:
+            query = query.filter(HeatmapCell.branch_id == branch_num)
+        if region is not None:
+            query = query.join(Branch, Branch.number == HeatmapCell.branch_id)\
+                .filter(Branch.region == region)
+        cells = [tuple(row) for row in query.all()]
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return cells
+
+
+def add_to_heatmaps(session, wait_times):
+    """Adds the wait times of one scrape to the heatmap cells of their
+    weekday and hour
+
+    :param session:     SQLAlchemy session
+    :param wait_times:  (list) of wait times of one scrape, see
+                        create_wait_times()
+    """
+    if not wait_times:
+        return
+
+    with session_scope(session) as sessn:
+        _add_to_heatmaps(sessn, wait_times)
+
+
+def _add_to_heatmaps(sessn, wait_times):
+    """add_to_heatmaps() in the transaction of sessn"""
+    if not wait_times:
+        return
+
+    timestamp = wait_times[0]['timestamp']
+    weekday, hour = timestamp.weekday(), timestamp.hour
+    table = HeatmapCell.__table__
+    existing = {branch_id for branch_id, in sessn.query(
+        HeatmapCell.branch_id).filter_by(weekday=weekday, hour=hour)}
+    updates = [
+        {'b_id': wt['branch_id'], 'appt': wt['appt'],
+         'non_appt': wt['non_appt']}
+        for wt in wait_times if wt['branch_id'] in existing
+    ]
+    inserts = [
+        {'branch_id': wt['branch_id'], 'weekday': weekday, 'hour': hour,
+         'count': 1, 'appt_sum': wt['appt'],
+         'non_appt_sum': wt['non_appt']}
+        for wt in wait_times if wt['branch_id'] not in existing
+    ]
+    if updates:
+        sessn.execute(
+            table.update().where(
+                (table.c.branch_id == bindparam('b_id'))
+                & (table.c.weekday == weekday) & (table.c.hour == hour)
+            ).values(
+                count=table.c.count + 1,
+                appt_sum=table.c.appt_sum + bindparam('appt'),
+                non_appt_sum=table.c.non_appt_sum + bindparam('non_appt')),
+            updates)
+    if inserts:
+        sessn.execute(table.insert(), inserts)
+
+
+def replace_heatmaps(session, cells):
+    """Replaces every heatmap cell
+
+    :param session:     SQLAlchemy session
+    :param cells:       (dict) of (branch number, weekday, hour) to
+                        [count, appt sum, non_appt sum], see heatmap.build()
+    """
+    rows = [
+        {'branch_id': branch_id, 'weekday': weekday, 'hour': hour,
+         'count': count, 'appt_sum': appt_sum, 'non_appt_sum': non_appt_sum}
+        for (branch_id, weekday, hour), (count, appt_sum, non_appt_sum)
+        in cells.items()
+    ]
+    with session_scope(session) as sessn:
+        sessn.query(HeatmapCell).delete()
+        if rows:
+            sessn.execute(HeatmapCell.__table__.insert(), rows)
+
+
+def add_to_coverage(session, wait_times):
+    """Sets the slots of the wait times of one scrape in the coverage
+    bitmaps of their branches and days
+
+    :param session:     SQLAlchemy session
+    :param wait_times:  (list) of wait times of one scrape, see
+                        create_wait_times()
+    """
+    with session_scope(session) as sessn:
+        _add_to_coverage(sessn, wait_times)
+
+
+def _add_to_coverage(sessn, wait_times):
+    """add_to_coverage() in the transaction of sessn"""
+    slots = {}
+    for wt in wait_times:
+        key = (wt['branch_id'], wt['timestamp'].date())
+        slots.setdefault(key, []).append(coverage.slot_of(wt['timestamp']))
+    if not slots:
+        return
+
+    table = CoverageDay.__table__
+    existing = {
+        (branch_id, day): blob for branch_id, day, blob in sessn.query(
+            CoverageDay.branch_id, CoverageDay.day, CoverageDay.slots)
+        .filter(CoverageDay.day.in_({day for _, day in slots}))
+        .filter(CoverageDay.branch_id.in_(
+            {branch_id for branch_id, _ in slots}))
+    }
+    updates, inserts = [], []
+    for (branch_id, day), day_slots in slots.items():
+        blob, count = coverage.mark(existing.get((branch_id, day)),
+                                    day_slots)
+        if (branch_id, day) in existing:
+            updates.append({'b_id': branch_id, 'b_day': day,
+                            'slots': blob, 'count': count})
+        else:
+            inserts.append({'branch_id': branch_id, 'day': day,
+                            'slots': blob, 'count': count})
+    if updates:
+        sessn.execute(
+            table.update().where(
+                (table.c.branch_id == bindparam('b_id'))
+                & (table.c.day == bindparam('b_day'))
+            ).values(slots=bindparam('slots'), count=bindparam('count')),
+            updates)
+    if inserts:
+        sessn.execute(table.insert(), inserts)
+
+
+def replace_coverage(session, days):
+    """Replaces every coverage bitmap
+
+    :param session:     SQLAlchemy session
+    :param days:        (dict) of (branch number, date) to a (SLOTS,) array
+                        of bools, see coverage.build()
+    """
+    rows = [
+        {'branch_id': branch_id, 'day': day, 'slots': coverage.encode(slots),
+         'count': int(slots.sum())}
+        for (branch_id, day), slots in days.items()
+    ]
+    with session_scope(session) as sessn:
+        sessn.query(CoverageDay).delete()
+        if rows:
+            sessn.execute(CoverageDay.__table__.insert(), rows)
+
+
+def get_coverage(session, start_day, end_day, branch_num=None):
+    """Gets the coverage bitmaps of a range of days
+
+    :param session:     SQLAlchemy session
+    :param start_day:   (date) first day
+    :param end_day:     (date) last day, inclusive
+    :param branch_num:  (int) branch number, or None for every branch
+    :return:            (dict) of (branch number, date) to a (SLOTS,) array
+                        of bools. Returns an empty dict if there are none
+    """
+    days = {}
+    try:
+        query = session.query(
+            CoverageDay.branch_id, CoverageDay.day, CoverageDay.slots)\
+            .filter(CoverageDay.day >= start_day)\
+            .filter(CoverageDay.day <= end_day)
+        if branch_num is not None:
+            query = query.filter(CoverageDay.branch_id == branch_num)
+        days = {(branch_id, day): coverage.decode(blob)
+                for branch_id, day, blob in query.all()}
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+    finally:
+        session.close()
+
+    return days
+
+
+def get_gaps(session, start, end, branch_num=None, opening_hours=None):
+    """Finds the holes the failed scrapes left in the wait times, from the
+    coverage bitmaps
+
+    :param session:         SQLAlchemy session
+    :param start:           (datetime) inclusive lower bound
+    :param end:             (datetime) exclusive upper bound
+    :param branch_num:      (int) branch number, or None for every branch
+    :param opening_hours:   (hours.OpeningHours) the slots of the branches
+                            are expected while they are open, or None to
+                            expect every slot of every branch in the
+                            database
+    :return:                (list) of (branch_id, gap start, gap end) tuples,
+                            by branch number then time
+    """
+    if opening_hours is not None:
+        numbers = opening_hours.catalog.numbers.tolist()
+        bitmap = opening_hours.bitmap
+    else:
+        numbers = [branch.number for branch in get_all_branches(session)]
+        bitmap = None
+    if branch_num is not None:
+        keep = [i for i, number in enumerate(numbers) if number == branch_num]
+        numbers = [numbers[i] for i in keep]
+        bitmap = None if bitmap is None else bitmap[keep]
+
+    days = get_coverage(session, start.date(), end.date(), branch_num)
+    return coverage.find_gaps(days, numbers, start, end, bitmap)
@@ -0,0 +1,101 @@
+"""Compact record types of the scraped data.
+
+A scrape yields about 180 wait times that the ingest path handles one row
+at a time, so they are __slots__ objects rather than dicts: a
+WaitTimeRecord takes less than half of the memory of the equivalent dict.
+
+The records read both like the models, wt.appt, and like the dicts they
+replace, wt['appt'], wt.get('is_open'), dict(wt) or WaitTime(**wt), since
+they are read-only Mappings of their fields. The JSON written by the API is
+built from explicit dicts (see branches.wait_times_to_snapshot()), so
+records never reach json.dumps().
+"""
+from collections.abc import Mapping
+
+
+class Record(Mapping):
+    """Base of the records: a read-only Mapping of the fields in __slots__.
+    Subclasses set __slots__ and may override __init__ for speed
+    """
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError(f'{type(self).__name__} has no fields '
+                            f'{", ".join(sorted(fields))}')
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}'
+                           for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def replace(self, **changes):
+        """Returns a copy with some of the fields changed"""
+        fields = dict(self)
+        fields.update(changes)
+        return type(self)(**fields)
+
+
+class WaitTimeRecord(Record):
+    """The wait times of one branch in one scrape
+
+    :param branch_id:   (int) branch number
+    :param appt:        (int) appointment wait in minutes
+    :param non_appt:    (int) non-appointment wait in minutes
+    :param timestamp:   (datetime) of the scrape
+    :param is_open:     (bool) whether the branch was open, or None when
+                        unknown
+    :param flags:       (int) anomalies detected, see cadmv.anomaly
+    """
+    __slots__ = ('branch_id', 'appt', 'non_appt', 'timestamp', 'is_open',
+                 'flags')
+
+    def __init__(self, branch_id, appt, non_appt, timestamp, is_open=None,
+                 flags=0):
+        self.branch_id = branch_id
+        self.appt = appt
+        self.non_appt = non_appt
+        self.timestamp = timestamp
+        self.is_open = is_open
+        self.flags = flags
+
+
+class BranchRecord(Record):
+    """A branch as prepared for the database, see
+    helper.data.prep_branches_data()
+    """
+    __slots__ = ('name', 'number', 'region', 'hours', 'closures', 'address',
+                 'latitude', 'longitude', 'nearby1', 'nearby2', 'nearby3',
+                 'nearby4', 'nearby5', 'services')
+
+
+class Scrape(list):
+    """The WaitTimeRecords of one fetch of the feed, with what is known
+    about the fetch itself
+
+    :param wait_times:  (iterable) of WaitTimeRecords
+    :param source_hash: (str) hex SHA-256 of the raw response, or None
+    :param feed_time:   (datetime) time the feed reported, or None
+    """
+    __slots__ = ('source_hash', 'feed_time')
+
+    def __init__(self, wait_times=(), source_hash=None, feed_time=None):
+        super().__init__(wait_times)
+        self.source_hash = source_hash
+        self.feed_time = feed_time
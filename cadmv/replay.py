@@ -0,0 +1,159 @@
+"""Replays an archive of raw feed bodies (see cadmv.archive) into the
+database, as fast as the database takes bulk inserts.
+
+The fetches are split into chunks that worker processes read, decompress
+and parse with data.split_response(), skipping the XML, into column arrays.
+Consecutive fetches of the same body are only parsed once. The main process
+adds the opening hours, inserts the wait times and one snapshot per fetch
+with cadmv.bulk, in fetch order, and links the snapshot diffs across chunks.
+
+Fetches at or before the latest stored wait time are skipped, so a replay
+can resume and can fill a database a live scraper has stopped writing to.
+Anomaly flags aren't recomputed. The sketches, heatmaps and coverage are
+rebuilt afterwards with the bin/build_*.py scripts.
+"""
+import json
+import logging
+import multiprocessing
+import time
+
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.archive import Archive
+from cadmv import bulk
+from cadmv.catalog import Catalog
+from cadmv import diff
+from cadmv.helper import data
+from cadmv.hours import OpeningHours
+from cadmv.models import Snapshot, WaitTime
+import cadmv.queries as queries
+
+
+logger = logging.getLogger('cadmv.replay')
+
+# Fetches parsed per task, a day of scrapes
+CHUNK_SIZE = 720
+
+
+def parse_chunk(root, entries):
+    """Parses the bodies of consecutive fetches
+
+    :param root:    (str) directory of the archive
+    :param entries: (list) of (fetched_at, hex digest) tuples, oldest first
+    :return:        (dict) of the wait time column arrays (branch_id, appt,
+                    non_appt, timestamp), the snapshot columns (fetched_at,
+                    changes, where the first diff is None, and
+                    source_hash), the first and last snapshot states and
+                    the number of bodies that couldn't be parsed
+    """
+    archive = Archive(root)
+    rows, counts, fetched_at, hashes, states = [], [], [], [], []
+    last_digest, parsed, failed = None, [], 0
+    for timestamp, digest in entries:
+        if digest != last_digest:
+            last_digest = digest
+            try:
+                _, parsed = data.split_response(
+                    archive.get(digest).decode('utf-8'), xml=False)
+            except Exception:
+                logger.warning('Could not parse %s fetched at %s', digest,
+                               timestamp, exc_info=True)
+                parsed = []
+        if not parsed:
+            failed += 1
+            continue
+        rows.extend(parsed)
+        counts.append(len(parsed))
+        fetched_at.append(timestamp)
+        hashes.append(digest)
+        states.append({number: (appt, non_appt)
+                       for number, appt, non_appt in parsed})
+
+    values = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    times = np.array(fetched_at, dtype='datetime64[us]')
+    changes = [None] + [
+        json.dumps(diff.compute_diff(previous, current),
+                   separators=(',', ':'))
+        for previous, current in zip(states, states[1:])
+    ]
+    return {
+        'wait_times': {
+            'branch_id': values[:, 0],
+            'appt': values[:, 1],
+            'non_appt': values[:, 2],
+            'timestamp': np.repeat(times, counts),
+        },
+        'snapshots': {'fetched_at': times, 'changes': changes,
+                      'source_hash': hashes},
+        'first': states[0] if states else None,
+        'last': states[-1] if states else None,
+        'failed': failed,
+    }
+
+
+def _parse_chunk(args):
+    return parse_chunk(*args)
+
+
+def replay(engine, root, start=None, end=None, workers=None,
+           chunk_size=CHUNK_SIZE, progress=print):
+    """Inserts the archived fetches of a range
+
+    :param engine:      SQLAlchemy engine of the database
+    :param root:        (str) directory of the archive
+    :param start:       (datetime) inclusive lower bound, or None
+    :param end:         (datetime) exclusive upper bound, or None
+    :param workers:     (int) parsing processes, default one per CPU. 1
+                        parses in the calling process
+    :param chunk_size:  (int) fetches parsed per task
+    :param progress:    (callable) taking a progress message
+    :return:            (tuple) of the numbers of fetches and wait times
+                        inserted
+    """
+    Session = sessionmaker(bind=engine)
+    hours = OpeningHours(Catalog.from_session(Session()))
+    latest = queries.get_latest_timestamp(Session())
+    entries = [entry for entry in Archive(root).entries(start, end)
+               if latest is None or entry[0] > latest]
+    chunks = [(root, entries[i:i + chunk_size])
+              for i in range(0, len(entries), chunk_size)]
+    state = diff.snapshot_state(queries.get_current_wait_times(Session()))
+
+    pool = multiprocessing.Pool(workers) if workers != 1 else None
+    results = pool.imap(_parse_chunk, chunks) if pool else \
+        map(_parse_chunk, chunks)
+    fetches = total = failed = 0
+    started = time.monotonic()
+    try:
+        for result in results:
+            failed += result['failed']
+            if result['first'] is None:
+                continue
+            snapshots = result['snapshots']
+            snapshots['changes'][0] = json.dumps(
+                diff.compute_diff(state, result['first']),
+                separators=(',', ':'))
+            snapshots['flags'] = np.zeros(len(snapshots['fetched_at']),
+                                          dtype=np.int64)
+            state = result['last']
+
+            columns = result['wait_times']
+            columns['is_open'] = hours.open_mask(columns['branch_id'],
+                                                 columns['timestamp'])
+            columns['flags'] = np.zeros(len(columns['branch_id']),
+                                        dtype=np.int64)
+            total += bulk.insert_columns(engine, WaitTime.__table__, columns)
+            fetches += bulk.insert_columns(engine, Snapshot.__table__,
+                                           snapshots)
+            rate = total / (time.monotonic() - started)
+            progress(f"{snapshots['fetched_at'][-1]}: {fetches} fetches, "
+                     f'{total} wait times ({rate:,.0f} rows/s)')
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    if failed:
+        logger.warning('Skipped %d fetches that could not be parsed', failed)
+    return fetches, total
@@ -0,0 +1,68 @@
+"""When to scrape, given the opening hours of the branches.
+
+While any branch is open (or about to open) the wait times are scraped every
+interval. Otherwise the scraper backs off to a slow heartbeat, which only
+checks that the feed is still reachable and stores nothing unless some branch
+unexpectedly reports a wait, and it wakes up lead seconds before the first
+branch opens.
+"""
+import datetime
+
+
+INTERVAL = 120
+HEARTBEAT = 30 * 60
+LEAD = 10 * 60
+
+
+def is_active(opening_hours, now, lead=LEAD):
+    """Determines if the wait times should be scraped at the full rate
+
+    :param opening_hours:   (hours.OpeningHours) of the branches
+    :param now:             (datetime) local time
+    :param lead:            (int) seconds before the first opening to start
+                            scraping at the full rate
+    :return:                (bool) True if a branch is open now or opens
+                            within lead seconds
+    """
+    opening = opening_hours.next_opening(now)
+    return opening is not None and \
+        (opening - now).total_seconds() <= lead
+
+
+def next_run(opening_hours, now, interval=INTERVAL, heartbeat=HEARTBEAT,
+             lead=LEAD):
+    """Computes when to scrape next
+
+    :param opening_hours:   (hours.OpeningHours) of the branches
+    :param now:             (datetime) local time of the current scrape
+    :param interval:        (int) seconds between scrapes while active
+    :param heartbeat:       (int) seconds between scrapes while every branch
+                            is closed
+    :param lead:            (int) see is_active()
+    :return:                (datetime) local time of the next scrape
+    """
+    if is_active(opening_hours, now, lead):
+        return now + datetime.timedelta(seconds=interval)
+
+    beat = now + datetime.timedelta(seconds=heartbeat)
+    opening = opening_hours.next_opening(now)
+    if opening is None:
+        return beat
+    wake = opening - datetime.timedelta(seconds=lead)
+    return max(min(wake, beat), now + datetime.timedelta(seconds=interval))
+
+
+def heartbeat_due(now, interval=INTERVAL, heartbeat=HEARTBEAT):
+    """Determines if a scrape started by cron every interval seconds is the
+    one that should also serve as the heartbeat while every branch is
+    closed
+    """
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    return (now - midnight).total_seconds() % heartbeat < interval
+
+
+def has_waits(wait_times):
+    """Determines if any branch reports a wait, i.e. if a scrape taken while
+    every branch is supposedly closed is worth storing
+    """
+    return any(wt['appt'] or wt['non_appt'] for wt in wait_times)
@@ -0,0 +1,55 @@
+"""A lightweight threaded HTTP server for cadmv.api, built on the standard
+library so that it doesn't need a web framework
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+
+
+logger = logging.getLogger('cadmv.server')
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Hands GET and HEAD requests to the server's Api instance"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Answers a GET request"""
+        self._respond(send_body=True)
+
+    def do_HEAD(self):
+        """Answers a HEAD request"""
+        self._respond(send_body=False)
+
+    def log_message(self, format, *args):
+        """Sends the access log to logging instead of stderr"""
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+    def _respond(self, send_body):
+        resp = self.server.api.handle(self.path, self.headers)
+        self.send_response(resp.status)
+        for name, value in resp.headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if send_body and resp.body:
+            self.wfile.write(resp.body)
+
+
+def make_server(api, host='127.0.0.1', port=8000):
+    """Creates (but doesn't start) a threaded HTTP server for api"""
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.daemon_threads = True
+    server.api = api
+    return server
+
+
+def serve(api, host='127.0.0.1', port=8000):
+    """Serves api until interrupted"""
+    server = make_server(api, host, port)
+    logger.info('Serving the API on http://%s:%s', host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
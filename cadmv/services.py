@@ -0,0 +1,47 @@
+"""The services a branch offers, as a bitmask.
+
+offices.py flags every branch's services with the cDLID, cDLPC, ... keys.
+They are stored in Branch.services as one bit per service, loaded into the
+Catalog as an array and matched with bitwise ands, both in NumPy and in SQL.
+The API names the services by the keys of NAMES, e.g.
+/api/best?lat=..&lon=..&services=cdl,vr.
+"""
+
+
+# The office flag of every service, in bit order
+FLAGS = ('cDLID', 'cDLPC', 'cVR', 'cCDL', 'cMDT', 'cQueue', 'cSST')
+
+# API name: (bit, description)
+NAMES = {
+    'dlid': (1 << 0, "driver's licenses and ID cards"),
+    'dlpc': (1 << 1, "driver's license photo capture"),
+    'vr': (1 << 2, 'vehicle registration'),
+    'cdl': (1 << 3, "commercial driver's licenses"),
+    'mdt': (1 << 4, 'motorcycle drive tests'),
+    'queue': (1 << 5, 'virtual queue'),
+    'sst': (1 << 6, 'self-service terminals'),
+}
+
+
+def from_office(office):
+    """Builds the bitmask of an offices.py entry. Missing flags are unset."""
+    return sum(1 << bit for bit, flag in enumerate(FLAGS) if office.get(flag))
+
+
+def parse(text):
+    """Parses a comma separated list of service names to a bitmask
+
+    :raises ValueError: if a name is unknown
+    """
+    mask = 0
+    for name in filter(None, (n.strip().lower() for n in text.split(','))):
+        if name not in NAMES:
+            raise ValueError(
+                f"services must be among {', '.join(NAMES)}")
+        mask |= NAMES[name][0]
+    return mask
+
+
+def names(mask):
+    """Returns the names of the services in a bitmask"""
+    return [name for name, (bit, _) in NAMES.items() if (mask or 0) & bit]
@@ -1,9 +1,11 @@
 """Module to manage database sessions"""
-from contextlib import contextmanager
+from contextlib import asynccontextmanager, contextmanager
 import logging
 
+from cadmv import metrics
 
-logger = logging.getLogger('dictionaryapi.session')
+
+logger = logging.getLogger('cadmv.session')
 
 
 @contextmanager
@@ -16,10 +18,27 @@ def session_scope(session):
     """
     try:
         yield session
-        session.commit()
+        with metrics.span('cadmv_db_commit_seconds'):
+            session.commit()
     except:
         logger.error('An error occurred accessing the database', exc_info=True)
         session.rollback()
         raise
     finally:
         session.close()
+
+
+@asynccontextmanager
+async def async_session_scope(session):
+    """Provide a transactional scope around a series of operations on an
+    AsyncSession. Behaves like session_scope().
+    """
+    try:
+        yield session
+        await session.commit()
+    except:
+        logger.error('An error occurred accessing the database', exc_info=True)
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
@@ -0,0 +1,174 @@
+"""Mergeable histogram sketches of the wait times.
+
+A sketch counts waits in fixed buckets over 0-600 minutes, narrow where waits
+are common and wider further out:
+
+    1 minute buckets up to 30 minutes, 2 minute buckets up to an hour,
+    5 minute buckets up to 3 hours and 10 minute buckets up to 10 hours,
+    plus one bucket for anything longer
+
+Because every sketch uses the same buckets, sketches merge by adding their
+counts, so a percentile over any range of hours is read off the sum of the
+hourly sketches in it instead of sorting the raw wait times. The error is at
+most one bucket width.
+
+Sketches are stored sparsely: one byte per non-empty bucket index followed by
+a two-byte count per non-empty bucket.
+"""
+import numpy as np
+
+
+MAX_MINUTES = 600
+EDGES = np.concatenate([
+    np.arange(0, 30, 1),
+    np.arange(30, 60, 2),
+    np.arange(60, 180, 5),
+    np.arange(180, MAX_MINUTES + 1, 10),
+]).astype(np.float64)
+# Upper edge of every bucket; the last one is open-ended
+UPPER_EDGES = np.append(EDGES[1:], MAX_MINUTES)
+BUCKETS = len(EDGES)
+
+_INDEX = np.dtype(np.uint8)
+_COUNT = np.dtype('<u2')
+
+
+def buckets_of(values):
+    """Returns the bucket of every wait time in values"""
+    values = np.asarray(values, dtype=np.float64)
+    return np.clip(np.searchsorted(EDGES, values, side='right') - 1,
+                   0, BUCKETS - 1)
+
+
+def histogram(values):
+    """Builds the sketch of a sequence of wait times
+
+    :return:    (numpy.ndarray) of BUCKETS counts
+    """
+    return np.bincount(buckets_of(values), minlength=BUCKETS).astype(np.int64)
+
+
+def encode(counts):
+    """Encodes a sketch into its compact stored form
+
+    :raises ValueError: if a count doesn't fit in two bytes
+    """
+    counts = np.asarray(counts)
+    indexes = np.flatnonzero(counts)
+    if len(indexes) and counts[indexes].max() > np.iinfo(_COUNT).max:
+        raise ValueError('Sketch count too large to encode')
+
+    return indexes.astype(_INDEX).tobytes() + \
+        counts[indexes].astype(_COUNT).tobytes()
+
+
+def decode(blob):
+    """Decodes a sketch stored by encode()
+
+    :return:    (numpy.ndarray) of BUCKETS counts
+    """
+    counts = np.zeros(BUCKETS, dtype=np.int64)
+    if not blob:
+        return counts
+
+    n = len(blob) // (_INDEX.itemsize + _COUNT.itemsize)
+    indexes = np.frombuffer(blob, dtype=_INDEX, count=n)
+    counts[indexes] = np.frombuffer(
+        blob, dtype=_COUNT, count=n, offset=n * _INDEX.itemsize)
+    return counts
+
+
+def merge(blobs):
+    """Adds up stored sketches
+
+    :return:    (numpy.ndarray) of BUCKETS counts
+    """
+    total = np.zeros(BUCKETS, dtype=np.int64)
+    for blob in blobs:
+        total += decode(blob)
+    return total
+
+
+def quantiles(counts, qs):
+    """Estimates quantiles from a sketch, interpolating linearly within a
+    bucket. Waits beyond MAX_MINUTES are reported as MAX_MINUTES.
+
+    :param counts:  (numpy.ndarray) of BUCKETS counts
+    :param qs:      (sequence) of quantiles between 0 and 1
+    :return:        (list) of estimated waits in minutes, or None if the
+                    sketch is empty
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return None
+
+    cumulative = np.cumsum(counts)
+    ranks = np.clip(np.asarray(qs, dtype=np.float64), 0, 1) * total
+    # The 0th percentile falls in the first non-empty bucket
+    ranks = np.maximum(ranks, np.finfo(np.float64).tiny)
+    buckets = np.minimum(np.searchsorted(cumulative, ranks, side='left'),
+                         BUCKETS - 1)
+    before = cumulative[buckets] - counts[buckets]
+    within = np.where(counts[buckets] > 0,
+                      (ranks - before) / np.maximum(counts[buckets], 1), 0)
+    lower, upper = EDGES[buckets], UPPER_EDGES[buckets]
+
+    return (lower + within * (upper - lower)).tolist()
+
+
+def build(branch_ids, hours, appts, non_appts):
+    """Builds the sketches of many wait times at once, grouped by branch and
+    hour
+
+    :param branch_ids:  (sequence) branch number of every wait time
+    :param hours:       (sequence) of numpy.datetime64 or datetimes, the hour
+                        every wait time falls in
+    :param appts:       (sequence) appointment wait of every wait time
+    :param non_appts:   (sequence) non-appointment wait of every wait time
+    :return:            (dict) of (branch number, numpy.datetime64 hour) to
+                        (appt counts, non_appt counts)
+    """
+    if not len(branch_ids):
+        return {}
+
+    hours = np.array(hours, dtype='datetime64[h]')
+    keys = np.rec.fromarrays(
+        [np.asarray(branch_ids, dtype=np.int64), hours.astype(np.int64)])
+    groups, inverse = np.unique(keys, return_inverse=True)
+    inverse = inverse.ravel()
+
+    sketches = np.zeros((len(groups), 2, BUCKETS), dtype=np.int64)
+    np.add.at(sketches, (inverse, 0, buckets_of(appts)), 1)
+    np.add.at(sketches, (inverse, 1, buckets_of(non_appts)), 1)
+
+    return {
+        (int(branch), np.datetime64(int(hour), 'h')): (counts[0], counts[1])
+        for (branch, hour), counts in zip(groups.tolist(), sketches)
+    }
+
+
+def summarize(sketches, percentiles=(50, 90)):
+    """Merges stored sketches and estimates percentiles of their wait times
+
+    :param sketches:    (list) of (branch_id, hour, count, appt, non_appt)
+                        tuples, see queries.get_sketches()
+    :param percentiles: (sequence) of percentiles between 0 and 100
+    :return:            (dict) of the form
+                        {'count': 1230, 'appt': {'p50': 12.0, 'p90': 31.5},
+                         'non_appt': {...}}, or None if there are no
+                        sketches
+    """
+    if not sketches:
+        return None
+
+    _, _, counts, appts, non_appts = zip(*sketches)
+    result = {'count': sum(counts)}
+    for kind, blobs in (('appt', appts), ('non_appt', non_appts)):
+        values = quantiles(merge(blobs), [p / 100 for p in percentiles])
+        result[kind] = {
+            f'p{p:g}': round(value, 1)
+            for p, value in zip(percentiles, values)
+        }
+
+    return result
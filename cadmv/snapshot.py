@@ -0,0 +1,186 @@
+"""Pre-encoded response buffers for the current snapshot.
+
+Between two scrapes the "current wait times" responses are identical for
+every client, so the ingest step renders them once per scrape: the whole
+snapshot plus one slice per region, each as compact JSON and gzipped JSON
+with its ETag. The buffers are written to a single file with an atomic
+rename so that an API process can load them and answer requests with a
+dict lookup and a socket write.
+"""
+from collections import namedtuple
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import zipfile
+
+from cadmv import branches
+import cadmv.queries as queries
+
+
+logger = logging.getLogger('cadmv.snapshot')
+
+# A rendered response: its status, body, gzipped body and ETag. The gzipped
+# body and ETag are None for error responses.
+Buffer = namedtuple('Buffer', ['status', 'body', 'gzipped', 'etag'])
+
+CURRENT_PATH = '/api/wait_times'
+REGION_PATH = '/api/wait_times/region/{}'
+
+MANIFEST = 'manifest.json'
+
+
+def encode(data):
+    """Encodes data as compact JSON bytes"""
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def etag_for(body):
+    """Returns a strong ETag for a response body"""
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def render(data, status=200, compress=True):
+    """Renders data to a Buffer. Successful responses are also gzipped
+    unless compress is False, which suits one-off responses.
+    """
+    body = encode(data)
+    if status != 200:
+        return Buffer(status, body, None, None)
+    if not compress:
+        return Buffer(status, body, None, etag_for(body))
+
+    gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+    return Buffer(status, body, gzipped, etag_for(body))
+
+
+def render_snapshot(wait_times, regions):
+    """Renders the buffers of one scrape
+
+    :param wait_times:  (list) of the wait times of one scrape, as returned
+                        by dmv.get_wait_times() or
+                        queries.get_current_wait_times()
+    :param regions:     (dict) of branch number to region number
+    :return:            (dict) of request path to Buffer
+    """
+    snapshot = branches.wait_times_to_snapshot(wait_times)
+    by_region = {}
+    for row in snapshot['wait_times']:
+        region = regions.get(row['branch_id'])
+        if region is not None:
+            by_region.setdefault(region, []).append(row)
+
+    buffers = {CURRENT_PATH: render(snapshot)}
+    for region, rows in by_region.items():
+        buffers[REGION_PATH.format(region)] = render({
+            'timestamp': snapshot['timestamp'],
+            'wait_times': rows,
+        })
+
+    return buffers
+
+
+def load_regions(session):
+    """Gets the branch number to region number mapping"""
+    return {b.number: b.region for b in queries.get_all_branches(session)}
+
+
+def render_current_snapshot(Session):
+    """Renders the buffers of the most recent scrape in the database"""
+    regions = load_regions(Session())
+    return render_snapshot(queries.get_current_wait_times(Session()), regions)
+
+
+def write_snapshot(path, version, buffers):
+    """Writes the buffers of a snapshot to path, replacing it atomically"""
+    manifest = {'version': version, 'buffers': {}}
+    tmp_path = path + '.tmp'
+    with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as archive:
+        for index, (key, buf) in enumerate(buffers.items()):
+            manifest['buffers'][key] = [index, buf.status, buf.etag]
+            archive.writestr(f'{index}.json', buf.body)
+            if buf.gzipped is not None:
+                archive.writestr(f'{index}.json.gz', buf.gzipped)
+        archive.writestr(MANIFEST, encode(manifest))
+
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """Reads the buffers of a snapshot written by write_snapshot()
+
+    :return:    (tuple) of the snapshot version and a dict of request path to
+                Buffer
+    """
+    with zipfile.ZipFile(path) as archive:
+        manifest = json.loads(archive.read(MANIFEST))
+        names = set(archive.namelist())
+        buffers = {}
+        for key, (index, status, etag) in manifest['buffers'].items():
+            gz_name = f'{index}.json.gz'
+            gzipped = archive.read(gz_name) if gz_name in names else None
+            buffers[key] = Buffer(
+                status, archive.read(f'{index}.json'), gzipped, etag)
+
+    return manifest['version'], buffers
+
+
+class SnapshotStore:
+    """Holds the buffers of the current snapshot for the API.
+
+    :param path:    (str) file written by the ingest step, or None to always
+                    render the buffers in this process
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._current = (None, {})
+        self._lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self._current[0]
+
+    def get(self, key):
+        """Returns the Buffer for a request path, or None"""
+        return self._current[1].get(key)
+
+    def publish(self, version, buffers):
+        """Swaps in the buffers of a new snapshot"""
+        self._current = (version, buffers)
+
+    def sync(self, version, Session):
+        """Makes sure the buffers of version are loaded. They are read from
+        self.path when the ingest step has written them, and rendered from
+        the database otherwise.
+        """
+        if self.version == version:
+            return
+
+        with self._lock:
+            if self.version == version:
+                return
+            buffers = self.load(version)
+            if buffers is None:
+                logger.debug('Rendering snapshot %s', version)
+                buffers = render_current_snapshot(Session)
+            self.publish(version, buffers)
+
+    def load(self, version):
+        """Reads the buffers from self.path if they are for version
+
+        :return:    (dict) of request path to Buffer, or None if the file is
+                    missing, unreadable or for another version
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return None
+
+        try:
+            file_version, buffers = read_snapshot(self.path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            logger.error('Could not read snapshot %s', self.path, exc_info=True)
+            return None
+
+        return buffers if file_version == version else None
@@ -0,0 +1,213 @@
+"""Tests for the analytics module and the region trends"""
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import analytics
+from cadmv.api import Api
+from cadmv import async_api
+from cadmv import branches
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.test.test_queries import BRANCHES
+
+
+MONDAY = datetime.datetime(2018, 12, 3, 9)
+DAY = datetime.timedelta(days=1)
+
+
+def wait_times():
+    """Two days of wait times of the test branches, with a closed and a
+    flagged one left out of the statistics
+    """
+    rows = []
+    for day in range(2):
+        for i in range(4):
+            timestamp = MONDAY + day * DAY + datetime.timedelta(hours=i)
+            rows.append({'branch_id': 542, 'appt': 10 * (day + 1) + i,
+                         'non_appt': 20, 'timestamp': timestamp,
+                         'is_open': True, 'flags': 0})
+            rows.append({'branch_id': 537, 'appt': 5, 'non_appt': 8,
+                         'timestamp': timestamp, 'is_open': True, 'flags': 0})
+    rows.append({'branch_id': 542, 'appt': 0, 'non_appt': 0,
+                 'timestamp': MONDAY - datetime.timedelta(hours=3),
+                 'is_open': False, 'flags': 0})
+    rows.append({'branch_id': 542, 'appt': 500, 'non_appt': 500,
+                 'timestamp': MONDAY + datetime.timedelta(minutes=30),
+                 'is_open': True, 'flags': 2})
+    return rows
+
+
+def write_parquet(path, rows):
+    """Writes wait times to a Parquet file with DuckDB alone, which needs no
+    extension
+    """
+    import duckdb
+
+    connection = duckdb.connect()
+    connection.execute(
+        'CREATE TABLE wait_times (branch_id INTEGER, appt INTEGER, '
+        'non_appt INTEGER, "timestamp" TIMESTAMP, is_open BOOLEAN, '
+        'flags INTEGER)')
+    connection.executemany(
+        'INSERT INTO wait_times VALUES (?, ?, ?, ?, ?, ?)',
+        [[r['branch_id'], r['appt'], r['non_appt'], r['timestamp'],
+          r['is_open'], r['flags']] for r in rows])
+    connection.execute(f"COPY wait_times TO '{path}' (FORMAT parquet)")
+    connection.close()
+
+
+class AnalyticsTest(unittest.TestCase):
+    """Tests the region trends and the analytics backend"""
+
+    def setUp(self):
+        """Setup a SQLite database file, which DuckDB can attach"""
+        self.directory = tempfile.TemporaryDirectory()
+        self.engine = create_engine(
+            'sqlite:///' + os.path.join(self.directory.name, 'cadmv.db'))
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.add_all([models.WaitTime(**w) for w in wait_times()])
+        session.commit()
+        session.close()
+
+    def tearDown(self):
+        self.engine.dispose()
+        analytics._analytics.clear()
+        self.directory.cleanup()
+
+    def test_get_region_trends(self):
+        """Test that the usable wait times are averaged by region and day"""
+        trends = queries.get_region_trends(self.Session())
+
+        self.assertEqual(trends[0], (1, MONDAY.date(), 4, 5.0, 8.0))
+        self.assertEqual(trends[2], (7, MONDAY.date(), 4, 11.5, 20.0))
+        self.assertEqual(trends[3], (7, (MONDAY + DAY).date(), 4, 21.5, 20.0))
+        self.assertEqual(
+            queries.get_region_trends(self.Session(), MONDAY + DAY, region=7),
+            trends[3:])
+
+    def test_region_trends_endpoint(self):
+        """Test /api/trends/region/{region}"""
+        resp = Api(self.Session).handle(
+            '/api/trends/region/7?start=2018-12-03T00:00:00'
+            '&end=2018-12-04T00:00:00')
+        self.assertEqual(json.loads(resp.body), {'region': 7, 'days': [
+            {'date': '2018-12-03', 'count': 4, 'appt': 11.5,
+             'non_appt': 20.0}]})
+        resp = Api(self.Session).handle('/api/trends/region/99')
+        self.assertEqual(resp.status, 404)
+
+    def test_backend_short_range(self):
+        """Test that short ranges and in-memory databases stay on the
+        database
+        """
+        session = self.Session()
+        self.assertEqual(analytics.backend(session, MONDAY, MONDAY + DAY),
+                         (queries, session))
+        memory = sessionmaker(bind=create_engine('sqlite://'))()
+        self.assertEqual(analytics.backend(memory), (queries, memory))
+
+    @unittest.skipUnless(analytics.available(), 'duckdb is not installed')
+    def test_duckdb_matches_queries(self):
+        """Test that DuckDB answers like the database over large ranges"""
+        if analytics.for_engine(self.engine) is None:
+            self.skipTest('DuckDB has no sqlite extension here')
+        module, handle = analytics.backend(self.Session())
+        self.assertIs(module, analytics)
+
+        self.assertEqual(module.get_region_trends(handle),
+                         queries.get_region_trends(self.Session()))
+        self.assertEqual(
+            sorted(module.get_open_wait_time_samples(handle)),
+            sorted(queries.get_open_wait_time_samples(self.Session())))
+        self.assertEqual(
+            module.get_wait_time_percentiles(handle, 542, percentiles=(50,)),
+            {'count': 8, 'appt': {'p50': 16.5}, 'non_appt': {'p50': 20.0}})
+        cells = module.get_heatmap_cells(handle, region=7)
+        self.assertEqual(sorted(cells)[0], (542, 0, 9, 1, 10.0, 20.0))
+        self.assertEqual(len(cells), 8)
+
+        path = os.path.join(self.directory.name, 'wait_times.parquet')
+        self.assertEqual(handle.export_parquet(path), 18)
+        parquet = analytics.Analytics(
+            os.path.join(self.directory.name, 'cadmv.db'), parquet=path)
+        self.assertEqual(analytics.get_region_trends(parquet),
+                         module.get_region_trends(handle))
+
+
+
+@unittest.skipUnless(analytics.available(), 'duckdb is not installed')
+class ParquetTest(unittest.TestCase):
+    """Tests an Analytics of Parquet files alone, which runs offline"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'wait_times.parquet')
+        write_parquet(self.path, wait_times())
+        self.analytics = analytics.Analytics(parquet=self.path)
+
+    def tearDown(self):
+        analytics._analytics.clear()
+        self.directory.cleanup()
+
+    def test_parquet_only(self):
+        """Test the queries of the wait times, and that the region queries
+        are refused rather than answered with nothing
+        """
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all([models.WaitTime(**w) for w in wait_times()])
+        session.commit()
+        self.assertEqual(
+            sorted(analytics.get_open_wait_time_samples(self.analytics)),
+            sorted(queries.get_open_wait_time_samples(session)))
+        self.assertEqual(
+            analytics.get_wait_time_percentiles(self.analytics, 542,
+                                                percentiles=(50,)),
+            {'count': 8, 'appt': {'p50': 16.5}, 'non_appt': {'p50': 20.0}})
+        self.assertEqual(
+            len(analytics.get_heatmap_cells(self.analytics, branch_num=542)),
+            8)
+
+        self.assertFalse(self.analytics.has_branches)
+        with self.assertRaises(ValueError):
+            analytics.get_region_trends(self.analytics)
+        with self.assertRaises(ValueError):
+            analytics.get_heatmap_cells(self.analytics, region=7)
+
+    def test_async_percentiles(self):
+        """Test that the async API answers large ranges from the same
+        backend as the sync one
+        """
+        database = os.path.join(self.directory.name, 'cadmv.db')
+        engine = create_engine('sqlite:///' + database)
+        async_engine = create_async_engine('sqlite+aiosqlite:///' + database)
+        for url in (engine.url, async_engine.url):
+            analytics._analytics[str(url)] = self.analytics
+        expected = analytics.get_wait_time_percentiles(self.analytics, 542)
+
+        self.assertEqual(branches.read_percentiles(
+            sessionmaker(bind=engine)(), 542), expected)
+
+        async def read():
+            session = sessionmaker(async_engine, class_=AsyncSession)()
+            percentiles = await async_api.read_percentiles(session, 542)
+            await async_engine.dispose()
+            return percentiles
+        self.assertEqual(asyncio.run(read()), expected)
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
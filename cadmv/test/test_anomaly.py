@@ -0,0 +1,189 @@
+"""Tests for the anomaly module and the flags stored by the ingest path"""
+import datetime
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import anomaly
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.test.test_queries import BRANCHES
+
+
+# A Monday morning, when both test branches are open
+MONDAY = datetime.datetime(2018, 12, 3, 9)
+
+
+def scrape(minutes, waits):
+    """Returns the wait times of one scrape of the test branches"""
+    return [
+        {'branch_id': number, 'appt': wait, 'non_appt': wait,
+         'timestamp': MONDAY + datetime.timedelta(minutes=minutes)}
+        for number, wait in waits.items()
+    ]
+
+
+class DetectorTest(unittest.TestCase):
+    """Tests the checks of the Detector"""
+
+    def setUp(self):
+        self.detector = anomaly.Detector([537, 542])
+
+    def feed(self, count, waits):
+        for i in range(count):
+            result = self.detector.check(scrape(2 * i, waits(i)))
+        return result
+
+    def test_normal(self):
+        """Test that a varying feed is not flagged"""
+        flags, snapshot_flags, missing = self.feed(
+            50, lambda i: {537: 10 + i % 7, 542: 20 + i % 5})
+
+        np.testing.assert_array_equal(flags, 0)
+        self.assertEqual(snapshot_flags, 0)
+        self.assertEqual(missing, [])
+
+    def test_stuck(self):
+        """Test that a branch repeating its waits is flagged as stuck"""
+        flags, _, _ = self.feed(
+            anomaly.STUCK_SCRAPES - 1, lambda i: {537: 15, 542: 20 + i % 5})
+        np.testing.assert_array_equal(flags, 0)
+
+        flags, _, _ = self.feed(1, lambda i: {537: 15, 542: 21})
+        self.assertEqual(flags.tolist(), [anomaly.STUCK, 0])
+
+    def test_jump(self):
+        """Test that a wait far from the recent median is flagged"""
+        self.feed(10, lambda i: {537: 10 + i % 3, 542: 20 + i % 5})
+
+        flags, snapshot_flags, _ = self.detector.check(
+            scrape(30, {537: 250, 542: 22}))
+        self.assertEqual(flags.tolist(), [anomaly.JUMP, 0])
+        self.assertEqual(snapshot_flags, 0)
+
+    def test_all_zero(self):
+        """Test that a feed of only zeros flags the snapshot and its rows"""
+        flags, snapshot_flags, _ = self.detector.check(
+            scrape(0, {537: 0, 542: 0}))
+
+        self.assertEqual(snapshot_flags, anomaly.ALL_ZERO)
+        np.testing.assert_array_equal(flags, anomaly.ALL_ZERO)
+        # Closed branches are expected to report zeros
+        _, snapshot_flags, _ = self.detector.check(
+            scrape(2, {537: 0, 542: 0}), is_open=[False, False])
+        self.assertEqual(snapshot_flags, 0)
+
+    def test_stale(self):
+        """Test that an identical feed is flagged as stale before its
+        branches are flagged as stuck
+        """
+        _, snapshot_flags, _ = self.feed(
+            anomaly.STALE_SCRAPES, lambda i: {537: 12, 542: 34})
+
+        self.assertEqual(anomaly.describe(snapshot_flags), ['stale'])
+
+    def test_missing(self):
+        """Test that branches missing from the feed are reported"""
+        _, snapshot_flags, missing = self.detector.check(
+            scrape(0, {542: 10, 999: 5}))
+
+        self.assertEqual(snapshot_flags, anomaly.MISSING)
+        self.assertEqual(missing, [537])
+        _, snapshot_flags, missing = self.detector.check([])
+        self.assertEqual(missing, [537, 542])
+
+
+class IngestAnomalyTest(unittest.TestCase):
+    """Tests the flags stored by the ingest path"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database"""
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+    def test_flags_stored_and_excluded(self):
+        """Test that the flags are stored with the wait times and the
+        snapshot, that a new ingestor is primed from the database and that
+        flagged wait times are left out of the samples
+        """
+        for i in range(10):
+            Ingestor(self.Session).ingest(
+                scrape(2 * i, {537: 10 + i % 3, 542: 20 + i % 5}))
+        Ingestor(self.Session).ingest(scrape(20, {537: 300, 542: 21}))
+
+        session = self.Session()
+        wait_times = session.query(models.WaitTime)\
+            .filter(models.WaitTime.timestamp ==
+                    MONDAY + datetime.timedelta(minutes=20))\
+            .order_by(models.WaitTime.branch_id).all()
+        self.assertEqual([wt.flags for wt in wait_times], [anomaly.JUMP, 0])
+        self.assertEqual(session.query(models.Snapshot.flags)
+                         .order_by(models.Snapshot.id.desc()).first()[0], 0)
+        session.close()
+
+        samples = queries.get_open_wait_time_samples(self.Session())
+        self.assertEqual(len(samples), 21)
+        self.assertNotIn(300, [appt for _, appt, _, _ in samples])
+
+    def test_all_zero_snapshot(self):
+        """Test that an all-zero scrape flags its snapshot"""
+        Ingestor(self.Session).ingest(scrape(0, {537: 0, 542: 0}))
+
+        session = self.Session()
+        self.assertEqual(session.query(models.Snapshot.flags).scalar(),
+                         anomaly.ALL_ZERO)
+        self.assertEqual(session.query(models.WaitTime)
+                         .filter(models.WaitTime.flags == 0).count(), 0)
+        session.close()
+
+    def test_upgraded_database(self):
+        """Test that the flags columns are added to an older database, whose
+        wait times then count as usable
+        """
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                'CREATE TABLE wait_times (id INTEGER PRIMARY KEY, '
+                'appt INTEGER, branch_id INTEGER, non_appt INTEGER, '
+                '"timestamp" DATETIME)')
+            conn.exec_driver_sql(
+                'CREATE TABLE snapshots (id INTEGER PRIMARY KEY, '
+                'fetched_at DATETIME, changes TEXT)')
+            conn.exec_driver_sql(
+                'INSERT INTO wait_times VALUES (1, 12, 542, 12, '
+                "'2018-12-03 08:58:00.000000')")
+        # As cadmv/helper/build_database.py does
+        models.Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+        self.assertTrue({'wait_times.flags', 'snapshots.flags'}.issubset(
+            models.add_missing_columns(engine)))
+        Ingestor(Session).ingest(scrape(0, {537: 0, 542: 0}))
+
+        session = Session()
+        flags = [flag for flag, in session.query(models.WaitTime.flags)
+                 .order_by(models.WaitTime.id)]
+        self.assertIsNone(flags[0])
+        self.assertTrue(all(flags[1:]))
+        self.assertEqual(session.query(models.Snapshot.flags).scalar(),
+                         anomaly.ALL_ZERO)
+        session.close()
+        self.assertEqual(
+            [appt for _, appt, _, _ in
+             queries.get_open_wait_time_samples(Session())], [12])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+"""Tests for the api, cache and snapshot modules"""
+import gzip
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv.cache import TTLCache
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+from cadmv.snapshot import SnapshotStore, read_snapshot
+from cadmv.test.test_queries import BRANCHES, WAIT_TIMES
+
+
+class TTLCacheTest(unittest.TestCase):
+    """Tests the TTLCache"""
+
+    def setUp(self):
+        """Create a cache with a clock that only moves when told to"""
+        self.now = 0
+        self.cache = TTLCache(ttl=10, maxsize=2, clock=lambda: self.now)
+
+    def test_entry_expires(self):
+        """Test that an entry is dropped once its ttl has passed"""
+        self.cache.set('a', 1)
+        self.now = 5
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 11
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_maxsize(self):
+        """Test that the oldest entry is evicted when the cache is full"""
+        for key in 'abc':
+            self.cache.set(key, key)
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('a'))
+
+    def test_get_or_set_fills_once(self):
+        """Test that the factory is only called on a miss"""
+        calls = []
+        for _ in range(3):
+            self.cache.get_or_set('a', lambda: calls.append(1) or 'value')
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_set_skips_none(self):
+        """Test that a failed load is not cached"""
+        calls = []
+        for _ in range(2):
+            self.assertIsNone(
+                self.cache.get_or_set('a', lambda: calls.append(1)))
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_fills_of_other_keys(self):
+        """Test that a slow fill doesn't hold up the fill of another key"""
+        started, release = threading.Event(), threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+            return 'slow'
+
+        thread = threading.Thread(
+            target=self.cache.get_or_set, args=('a', slow))
+        thread.start()
+        started.wait(5)
+        self.assertEqual(self.cache.get_or_set('b', lambda: 'fast'), 'fast')
+        release.set()
+        thread.join()
+        self.assertEqual(self.cache.get('a'), 'slow')
+
+
+class ApiTest(unittest.TestCase):
+    """Tests the read API"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database"""
+        self.engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.add_all([models.WaitTime(**w) for w in WAIT_TIMES])
+        session.commit()
+        session.close()
+        self.api = Api(self.Session)
+
+    def test_read_all(self):
+        """Test that every branch is returned, sorted by number"""
+        resp = self.api.handle('/api/branches')
+        numbers = [b['number'] for b in json.loads(resp.body)]
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(numbers, sorted(b['number'] for b in BRANCHES))
+
+    def test_read_one_not_found(self):
+        """Test that an unknown branch is a 404"""
+        resp = self.api.handle('/api/branches/9999')
+        self.assertEqual(resp.status, 404)
+
+    def test_read_current_wait_times(self):
+        """Test that the latest snapshot is returned"""
+        resp = self.api.handle('/api/wait_times')
+        data = json.loads(resp.body)
+
+        self.assertEqual(len(data['wait_times']), len(WAIT_TIMES))
+        self.assertEqual(
+            data['timestamp'], WAIT_TIMES[0]['timestamp'].isoformat())
+
+    def test_bad_parameter(self):
+        """Test that an unparsable query parameter is a 400"""
+        resp = self.api.handle('/api/wait_times/542?start=yesterday')
+        self.assertEqual(resp.status, 400)
+
+    def test_best(self):
+        """Test that the branches near a point are ranked by wait time"""
+        resp = self.api.handle(
+            '/api/best?lat=33.7&lon=-117.8&k=2&max_km=1000&kind=appt')
+        data = json.loads(resp.body)
+
+        self.assertEqual([b['number'] for b in data], [542, 537])
+        self.assertEqual(data[0]['appt'], WAIT_TIMES[0]['appt'])
+
+    def test_services_filter(self):
+        """Test that the branches can be restricted to the ones offering
+        services
+        """
+        resp = self.api.handle(
+            '/api/best?lat=33.7&lon=-117.8&max_km=1000&services=sst')
+        self.assertEqual([b['number'] for b in json.loads(resp.body)], [542])
+        resp = self.api.handle(
+            '/api/nearest?lat=33.7&lon=-117.8&services=vr,dlid')
+        self.assertEqual([b['number'] for b in json.loads(resp.body)],
+                         [542, 537])
+
+        branch = json.loads(self.api.handle('/api/branches/537').body)
+        self.assertEqual(branch['services'], ['dlid', 'vr', 'queue'])
+        self.assertEqual(self.api.handle(
+            '/api/branches/region/1?services=sst').status, 404)
+        self.assertEqual(self.api.handle(
+            '/api/branches/region/1?services=queue').status, 200)
+        self.assertEqual(self.api.handle(
+            '/api/nearest?lat=33.7&lon=-117.8&services=x').status, 400)
+
+    def test_nearest_requires_point(self):
+        """Test that a nearest branch request without coordinates is a
+        400
+        """
+        resp = self.api.handle('/api/nearest?lat=33.7')
+        self.assertEqual(resp.status, 400)
+
+    def test_not_modified(self):
+        """Test that a matching If-None-Match is answered with a 304"""
+        etag = self.api.handle('/api/branches/542').headers['ETag']
+        resp = self.api.handle('/api/branches/542', {'If-None-Match': etag})
+
+        self.assertEqual(resp.status, 304)
+        self.assertEqual(resp.body, b'')
+
+    def test_served_from_cache_until_new_version(self):
+        """Test that responses are cached until the snapshot version
+        changes
+        """
+        first = self.api.handle('/api/branches/542').body
+        session = self.Session()
+        session.query(models.Branch).filter_by(number=542)\
+            .update({'name': 'Renamed'})
+        session.commit()
+        session.close()
+
+        self.assertEqual(self.api.handle('/api/branches/542').body, first)
+
+        session = self.Session()
+        new = dict(WAIT_TIMES[0])
+        new['timestamp'] = new['timestamp'].replace(year=2019)
+        session.add(models.WaitTime(**new))
+        session.commit()
+        session.close()
+        self.api.invalidate()
+
+        data = json.loads(self.api.handle('/api/branches/542').body)
+        self.assertEqual(data['name'], 'Renamed')
+
+
+class SnapshotTest(unittest.TestCase):
+    """Tests the pre-encoded snapshot buffers"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database with the branches and a
+        snapshot file written by the ingest step
+        """
+        self.engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'snapshot.zip')
+        Ingestor(self.Session, self.path).ingest(WAIT_TIMES)
+
+    def tearDown(self):
+        """Remove the snapshot file"""
+        self.tmpdir.cleanup()
+
+    def test_region_slices(self):
+        """Test that the ingest step writes one slice per region"""
+        version, buffers = read_snapshot(self.path)
+        region = json.loads(buffers['/api/wait_times/region/7'].body)
+
+        self.assertEqual(version, WAIT_TIMES[0]['timestamp'].isoformat())
+        self.assertEqual(
+            [wt['branch_id'] for wt in region['wait_times']], [542])
+
+    def test_served_from_file(self):
+        """Test that the API serves the buffers written by the ingest step
+        instead of rendering its own
+        """
+        _, buffers = read_snapshot(self.path)
+        api = Api(self.Session, snapshots=SnapshotStore(self.path))
+        resp = api.handle('/api/wait_times/region/1')
+
+        self.assertEqual(resp.body, buffers['/api/wait_times/region/1'].body)
+
+    def test_gzip(self):
+        """Test that clients accepting gzip get the pre-compressed body"""
+        api = Api(self.Session, snapshots=SnapshotStore(self.path))
+        plain = api.handle('/api/wait_times')
+        resp = api.handle('/api/wait_times', {'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.body), plain.body)
+        self.assertNotEqual(resp.headers['ETag'], plain.headers['ETag'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+"""Tests for the archive and replay modules"""
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.archive import Archive
+from cadmv.helper import data
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.replay import replay
+from cadmv.test.test_queries import BRANCHES
+
+
+RESPONSE = os.path.join(os.path.dirname(__file__), 'data', 'response.txt')
+MONDAY = datetime.datetime(2018, 12, 3, 9)
+
+
+def body(waits):
+    """Returns a raw feed body of the test branches"""
+    with open(RESPONSE, 'rb') as f:
+        xml = f.read().split(b'\r\n<branches>')[0]
+    return xml + b'\r\n' + b''.join(
+        f'{number},{appt},{non_appt},\r\n'.encode()
+        for number, (appt, non_appt) in waits.items())
+
+
+class ArchiveTest(unittest.TestCase):
+    """Tests archiving raw bodies"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.archive = Archive(self.directory.name)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_put_dedupes(self):
+        """Test that a repeated body is stored once but every fetch is
+        indexed, in order
+        """
+        with open(RESPONSE, 'rb') as f:
+            raw = f.read()
+        times = [MONDAY + datetime.timedelta(minutes=2 * i) for i in range(3)]
+        digests = [self.archive.put(raw, times[0]),
+                   self.archive.put(raw, times[2]),
+                   self.archive.put(b'other', times[1])]
+
+        self.assertEqual(digests[0], digests[1])
+        self.assertEqual(self.archive.get(digests[0]), raw)
+        self.assertEqual(
+            sum(len(files) for _, _, files in os.walk(
+                os.path.join(self.directory.name, 'objects'))), 2)
+        self.assertEqual(list(self.archive.entries()), [
+            (times[0], digests[0]), (times[1], digests[2]),
+            (times[2], digests[0])])
+        self.assertEqual(list(self.archive.entries(times[1], times[2])),
+                         [(times[1], digests[2])])
+
+    def test_replay(self):
+        """Test that a replay stores the wait times and snapshots of the
+        fetches a live scrape would have, skips unparsable bodies and
+        resumes after the stored wait times
+        """
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+        scrapes = [{537: (1, 2), 542: (3, 4)}, {537: (1, 2), 542: (3, 4)},
+                   {537: (1, 2), 542: (5, 6)}]
+        for i, waits in enumerate(scrapes):
+            self.archive.put(body(waits),
+                             MONDAY + datetime.timedelta(minutes=2 * i))
+        self.archive.put(b'<html>Service unavailable</html>',
+                         MONDAY + datetime.timedelta(minutes=6))
+        _, rows = data.split_response(body(scrapes[0]).decode())
+        self.assertEqual(rows, [(537, 1, 2), (542, 3, 4)])
+
+        result = replay(engine, self.directory.name, workers=1, chunk_size=2,
+                        progress=lambda message: None)
+        self.assertEqual(result, (3, 6))
+        self.assertEqual(replay(engine, self.directory.name, workers=1,
+                                progress=lambda message: None), (0, 0))
+
+        wait_times = queries.get_wait_times_by_range(Session(), 542)
+        self.assertEqual([(wt.appt, wt.non_appt) for wt in wait_times],
+                         [(3, 4), (3, 4), (5, 6)])
+        self.assertTrue(all(wt.is_open for wt in wait_times))
+        session = Session()
+        diffs = [json.loads(s.changes) for s in session.query(models.Snapshot)
+                 .order_by(models.Snapshot.id)]
+        session.close()
+        self.assertEqual(diffs[0]['added'], [[537, 1, 2], [542, 3, 4]])
+        self.assertEqual(diffs[1]['changed'], [])
+        self.assertEqual(diffs[2]['changed'], [[542, 5, 6]])
+
+
+if __name__ == '__main__':
+    unittest.main()
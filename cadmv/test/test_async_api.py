@@ -0,0 +1,208 @@
+"""Tests for the async_queries, async_api, async_server and push modules"""
+import asyncio
+import json
+import unittest
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from cadmv.async_api import AsyncApi
+import cadmv.async_queries as async_queries
+from cadmv import diff
+from cadmv.async_server import start_server
+import cadmv.models as models
+from cadmv.snapshot import render
+from cadmv.test.test_queries import BRANCHES, WAIT_TIMES
+
+
+class AsyncTestCase(unittest.IsolatedAsyncioTestCase):
+    """Sets up an in-memory aiosqlite database with the test data"""
+
+    async def asyncSetUp(self):
+        self.engine = create_async_engine(
+            'sqlite+aiosqlite://', poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        self.Session = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False)
+        async with self.Session() as session:
+            session.add_all([models.Branch(**b) for b in BRANCHES])
+            session.add_all([models.WaitTime(**w) for w in WAIT_TIMES])
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+
+class AsyncQueriesTest(AsyncTestCase):
+    """Tests the async queries"""
+
+    async def test_get_branch_by_number(self):
+        """Test that async_queries.get_branch_by_number() works"""
+        branch = await async_queries.get_branch_by_number(self.Session(), 542)
+        missing = await async_queries.get_branch_by_number(self.Session(), 1)
+
+        self.assertEqual(branch.number, 542)
+        self.assertIsNone(missing)
+
+    async def test_update_branch(self):
+        """Test that async_queries.update_branch() works"""
+        branch = dict(BRANCHES[0], name='Renamed')
+        await async_queries.update_branch(self.Session(), branch)
+        updated = await async_queries.get_branch_by_number(self.Session(), 542)
+
+        self.assertEqual(updated.name, 'Renamed')
+
+    async def test_get_current_wait_times_by_region(self):
+        """Test that the current wait times can be limited to a region"""
+        wait_times = await async_queries.get_current_wait_times(
+            self.Session(), region=BRANCHES[1]['region'])
+
+        self.assertEqual([wt.branch_id for wt in wait_times], [537])
+
+    async def test_changes_without_diff(self):
+        """Test that a span holding a snapshot without a diff is answered
+        with the full snapshot
+        """
+        async with self.Session() as session:
+            session.add_all([
+                models.Snapshot(id=1, fetched_at=WAIT_TIMES[0]['timestamp']),
+                models.Snapshot(id=2, fetched_at=WAIT_TIMES[0]['timestamp'],
+                                changes=json.dumps(diff.empty_diff()))])
+            await session.commit()
+
+        changes = await async_queries.get_changes_since(self.Session(), 0)
+        self.assertEqual((changes['full'], len(changes['added'])), (True, 2))
+        changes = await async_queries.get_changes_since(self.Session(), 1)
+        self.assertFalse(changes['full'])
+
+
+class AsyncCacheTest(AsyncTestCase):
+    """Tests the caching of the async API"""
+
+    async def test_cancelled_fill(self):
+        """Test that a cancelled caller doesn't cancel a shared fill for
+        the other callers
+        """
+        api = AsyncApi(self.Session)
+        loaded = asyncio.Event()
+
+        async def factory():
+            await loaded.wait()
+            return b'buffer'
+
+        first = asyncio.create_task(api._fill(api.cache, 'key', factory))
+        second = asyncio.create_task(api._fill(api.cache, 'key', factory))
+        await asyncio.sleep(0)
+        first.cancel()
+        loaded.set()
+
+        self.assertEqual(await second, b'buffer')
+        with self.assertRaises(asyncio.CancelledError):
+            await first
+        self.assertEqual(api.cache.get('key'), b'buffer')
+        self.assertEqual(api._inflight, {})
+
+
+class AsyncWindowTest(AsyncTestCase):
+    """Tests the recent endpoints of the async API"""
+
+    async def test_recent(self):
+        """Test that the window is built from the database and that unknown
+        branches are 404
+        """
+        api = AsyncApi(self.Session, window_days=1)
+        resp = await api.handle('/api/recent/542')
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(json.loads(resp.body)[-1]['non_appt'],
+                         WAIT_TIMES[0]['non_appt'])
+        self.assertEqual((await api.handle('/api/recent/1')).status, 404)
+
+
+class AsyncServerTest(AsyncTestCase):
+    """Tests the asyncio server end to end"""
+
+    async def test_keep_alive_requests(self):
+        """Test that several requests are served over one connection"""
+        server = await start_server(AsyncApi(self.Session), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            statuses = []
+            for path in ('/api/wait_times', '/api/branches/9999'):
+                writer.write(f'GET {path} HTTP/1.1\r\n\r\n'.encode())
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+                body = await reader.readexactly(length)
+                statuses.append(int(head.split()[1]))
+            writer.close()
+
+        self.assertEqual(statuses, [200, 404])
+        self.assertEqual(len(json.loads(body)), 1)
+
+
+class PushTest(AsyncTestCase):
+    """Tests pushing new snapshots to subscribers"""
+
+    async def asyncSetUp(self):
+        await super().asyncSetUp()
+        self.api = AsyncApi(self.Session)
+        self.version = await self.api.version()
+
+    async def test_poll_returns_current_snapshot(self):
+        """Test that a long-poll from a client without the current snapshot
+        is answered immediately
+        """
+        resp = await self.api.poll('/api/poll?since=old')
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.headers['X-Snapshot-Version'], self.version)
+
+    async def test_poll_times_out(self):
+        """Test that a long-poll from an up to date client times out"""
+        resp = await self.api.poll(
+            f'/api/poll?since={self.version}&timeout=0.01')
+        self.assertEqual(resp.status, 204)
+
+    async def test_poll_woken_by_publish(self):
+        """Test that waiting long-polls are answered when a snapshot is
+        published
+        """
+        polls = [
+            asyncio.create_task(
+                self.api.poll(f'/api/poll?since={self.version}&timeout=5'))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+        self.api.broker.publish('new', render({'wait_times': []}))
+        responses = await asyncio.gather(*polls)
+
+        self.assertEqual(
+            [resp.headers['X-Snapshot-Version'] for resp in responses],
+            ['new'] * 3)
+        self.assertTrue(all(resp.body is responses[0].body
+                            for resp in responses))
+
+    async def test_stream(self):
+        """Test that the event stream sends the current snapshot and then
+        each new one
+        """
+        server = await start_server(self.api, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /api/stream HTTP/1.1\r\n\r\n')
+            await reader.readuntil(b'\r\n\r\n')
+            first = await reader.readuntil(b'\n\n')
+            self.api.broker.publish('new', render({'wait_times': []}))
+            second = await reader.readuntil(b'\n\n')
+            writer.close()
+
+        self.assertTrue(first.startswith(f'id: {self.version}\n'.encode()))
+        self.assertTrue(second.startswith(b'id: new\nevent: snapshot\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+"""Tests for the bulk module"""
+import datetime
+import json
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine, inspect as sa_inspect
+from sqlalchemy.orm import sessionmaker
+
+from cadmv import bulk
+from cadmv.catalog import Catalog
+from cadmv.hours import OpeningHours
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.test.test_queries import BRANCHES
+
+
+class BulkTest(unittest.TestCase):
+    """Tests bulk inserts of column arrays"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database"""
+        self.engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+    def test_insert_columns(self):
+        """Test that inserted columns read back like rows stored through
+        the ORM
+        """
+        start = datetime.datetime(2018, 12, 3, 9, 0, 5, 123456)
+        timestamps = np.datetime64(start) \
+            + np.arange(4).repeat(2) * np.timedelta64(2, 'm')
+        count = bulk.insert_columns(self.engine, models.WaitTime.__table__, {
+            'branch_id': np.tile([537, 542], 4),
+            'appt': np.arange(8),
+            'non_appt': np.arange(8) * 2,
+            'timestamp': timestamps,
+            'is_open': np.array([True, False] * 4),
+        })
+
+        wait_times = queries.get_wait_times_by_range(self.Session(), 542)
+        self.assertEqual(count, 8)
+        self.assertEqual([wt.appt for wt in wait_times], [1, 3, 5, 7])
+        self.assertEqual(wait_times[0].timestamp, start)
+        self.assertEqual(wait_times[1].timestamp,
+                         start + datetime.timedelta(minutes=2))
+        self.assertFalse(wait_times[0].is_open)
+        self.assertEqual(queries.get_latest_timestamp(self.Session()),
+                         start + datetime.timedelta(minutes=6))
+        self.assertEqual(bulk.insert_columns(
+            self.engine, models.WaitTime.__table__, {'appt': []}), 0)
+
+    def test_read_chunks(self):
+        """Test that the chunks of CSV and JSON lines dumps cover every line
+        once and parse to typed columns
+        """
+        rows = [(537 + i % 2 * 5, i, 2 * i,
+                 f'2018-12-03 09:{i:02d}:00', i % 3 == 0) for i in range(50)]
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'dump.csv')
+            with open(csv_path, 'w') as f:
+                f.write('timestamp,branch_id,appt,non_appt,is_open\n')
+                for number, appt, non_appt, timestamp, is_open in rows:
+                    f.write(f'{timestamp},{number},{appt},{non_appt},'
+                            f'{is_open}\n')
+            jsonl_path = os.path.join(directory, 'dump.jsonl')
+            with open(jsonl_path, 'w') as f:
+                for number, appt, non_appt, timestamp, _ in rows:
+                    f.write(json.dumps({
+                        'branch_id': number, 'appt': appt,
+                        'non_appt': non_appt, 'timestamp': timestamp}) + '\n')
+
+            header = bulk.read_header(csv_path)
+            ranges = bulk.split_file(csv_path, 100, skip_header=True)
+            chunks = [bulk.read_chunk(csv_path, start, end, 'csv', header)
+                      for start, end in ranges]
+            jsonl = [bulk.read_chunk(jsonl_path, start, end,
+                                     bulk.file_format(jsonl_path))
+                     for start, end in bulk.split_file(jsonl_path, 1000)]
+
+        self.assertGreater(len(ranges), 10)
+        appts = np.concatenate([chunk['appt'] for chunk in chunks])
+        self.assertEqual(appts.tolist(), list(range(50)))
+        self.assertEqual(chunks[0]['appt'].dtype, np.int64)
+        self.assertEqual(
+            np.concatenate([chunk['is_open'] for chunk in chunks]).tolist(),
+            [row[4] for row in rows])
+        self.assertEqual(chunks[0]['timestamp'][0],
+                         np.datetime64('2018-12-03T09:00'))
+        self.assertNotIn('is_open', jsonl[0])
+        self.assertEqual(
+            np.concatenate([chunk['non_appt'] for chunk in jsonl]).tolist(),
+            [row[2] for row in rows])
+        with self.assertRaises(ValueError):
+            bulk.file_format('dump.xlsx')
+
+    def test_missing_values(self):
+        """Test that empty is_open values are filled in from the opening
+        hours, and that JSON records without a column are refused
+        """
+        hours = OpeningHours(Catalog(BRANCHES))
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'dump.csv')
+            with open(csv_path, 'w') as f:
+                f.write('timestamp,branch_id,appt,non_appt,is_open\n'
+                        '2018-12-03 10:00:00,542,1,2,\n'
+                        '2018-12-03 10:00:00,537,1,2,false\n')
+            csv_columns = bulk.read_chunk(
+                csv_path, *bulk.split_file(csv_path, 1000, True)[0], 'csv',
+                bulk.read_header(csv_path))
+            jsonl_path = os.path.join(directory, 'dump.jsonl')
+            with open(jsonl_path, 'w') as f:
+                f.write('{"branch_id": 542, "appt": 1, "non_appt": 2, '
+                        '"timestamp": "2018-12-03 10:00:00", '
+                        '"is_open": false}\n'
+                        '{"branch_id": 542, "non_appt": 2, '
+                        '"timestamp": "2018-12-03 10:02:00"}\n')
+            with self.assertRaises(ValueError):
+                bulk.read_chunk(jsonl_path, 0, os.path.getsize(jsonl_path),
+                                'jsonl')
+
+        bulk.fill_is_open(csv_columns, hours)
+        self.assertTrue(hours.open_mask([542], ['2018-12-03T10:00'])[0])
+        self.assertEqual(csv_columns['is_open'].tolist(), [True, False])
+        self.assertNotIsInstance(csv_columns['is_open'], np.ma.MaskedArray)
+
+    def test_indexes_dropped(self):
+        """Test that the indexes are dropped during a load and created again
+        after it, even when it fails
+        """
+        table = models.WaitTime.__table__
+
+        def indexes():
+            return {index['name'] for index in
+                    sa_inspect(self.engine).get_indexes(table.name)}
+
+        before = indexes()
+        self.assertTrue(before)
+        with self.assertRaises(RuntimeError):
+            with bulk.indexes_dropped(self.engine, table):
+                self.assertEqual(indexes(), set())
+                raise RuntimeError
+        self.assertEqual(indexes(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
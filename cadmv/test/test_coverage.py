@@ -0,0 +1,159 @@
+"""Tests for the coverage module and the coverage kept by the ingest path"""
+import datetime
+import json
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv.catalog import Catalog
+from cadmv import coverage
+from cadmv.hours import OpeningHours
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.test.test_queries import BRANCHES
+
+
+# A Monday morning, when both test branches are open
+MONDAY = datetime.datetime(2018, 12, 3, 9)
+
+
+def at(minutes):
+    return MONDAY + datetime.timedelta(minutes=minutes)
+
+
+class CoverageTest(unittest.TestCase):
+    """Tests the bitmaps, gaps and series of the coverage module"""
+
+    def test_mark(self):
+        """Test that marking slots survives encoding"""
+        blob, count = coverage.mark(None, [0, 5, coverage.SLOTS - 1])
+        blob, count = coverage.mark(blob, [5, 6])
+
+        self.assertEqual(len(blob), coverage.SLOT_BYTES)
+        self.assertEqual(count, 4)
+        self.assertEqual(np.flatnonzero(coverage.decode(blob)).tolist(),
+                         [0, 5, 6, coverage.SLOTS - 1])
+
+    def test_find_gaps(self):
+        """Test that the missing slots are merged into gaps, across
+        midnight
+        """
+        days = coverage.build(
+            [542] * 4, [at(0), at(2), at(10), at(15 * 60 + 2)])
+
+        self.assertEqual(coverage.find_gaps(days, [542], at(0), at(14)),
+                         [(542, at(4), at(10)), (542, at(12), at(14))])
+        self.assertEqual(
+            coverage.find_gaps(days, [542], at(14 * 60), at(15 * 60 + 4)),
+            [(542, at(14 * 60), at(15 * 60 + 2))])
+        self.assertEqual(coverage.find_gaps(days, [537], at(0), at(1)),
+                         [(537, at(0), at(1))])
+
+    def test_find_gaps_while_open(self):
+        """Test that only the slots of the opening hours are expected"""
+        bitmap = np.zeros((1, 7, 24 * 60), dtype=bool)
+        bitmap[0, 0, 9 * 60:9 * 60 + 6] = True
+        days = coverage.build([542], [at(2)])
+
+        self.assertEqual(
+            coverage.find_gaps(days, [542], at(-60), at(60), bitmap),
+            [(542, at(0), at(2)), (542, at(4), at(6))])
+
+    def test_series(self):
+        """Test that the slots without a wait time are marked or filled"""
+        args = ([at(1), at(4), at(5)], [10, 20, 30], [1, 2, 3], at(0), at(10))
+        marked = coverage.series(*args, fill='mark')
+        filled = coverage.series(*args, fill='ffill')
+
+        self.assertEqual([s['appt'] for s in marked], [10, None, 30, None, None])
+        self.assertEqual([s['gap'] for s in marked],
+                         [False, True, False, True, True])
+        self.assertEqual([s['non_appt'] for s in filled], [1, 1, 3, 3, 3])
+        self.assertEqual(filled[1]['timestamp'], at(2))
+        self.assertEqual(coverage.series([at(4)], [5], [5], at(0), at(6),
+                                         fill='ffill')[0]['appt'], None)
+        with self.assertRaises(ValueError):
+            coverage.series(*args, fill='linear')
+
+
+class IngestCoverageTest(unittest.TestCase):
+    """Tests the coverage kept by the ingest path and its API"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database and ingest scrapes with a hole
+        between 09:06 and 09:10
+        """
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+        ingestor = Ingestor(self.Session)
+        for minutes in (0, 2, 4, 10, 12):
+            ingestor.ingest([
+                {'branch_id': number, 'appt': minutes, 'non_appt': minutes,
+                 'timestamp': at(minutes)}
+                for number in (537, 542)
+            ])
+
+    def test_gaps(self):
+        """Test that the gaps are found from the bitmaps, with and without
+        the opening hours
+        """
+        self.assertEqual(
+            queries.get_gaps(self.Session(), at(0), at(14)),
+            [(537, at(6), at(10)), (542, at(6), at(10))])
+
+        hours = OpeningHours(Catalog.from_session(self.Session()))
+        # 537 opens at 08:00 and 542 at 07:00
+        self.assertEqual(
+            queries.get_gaps(self.Session(), at(-90), at(14), branch_num=537,
+                             opening_hours=hours),
+            [(537, at(-60), at(0)), (537, at(6), at(10))])
+
+    def test_rebuild_matches_incremental(self):
+        """Test that rebuilding the bitmaps from the wait times gives the
+        same coverage
+        """
+        day = MONDAY.date()
+        incremental = queries.get_coverage(self.Session(), day, day)
+        branch_ids, timestamps = zip(
+            *queries.get_scrape_times(self.Session()))
+        queries.replace_coverage(
+            self.Session(), coverage.build(branch_ids, timestamps))
+        rebuilt = queries.get_coverage(self.Session(), day, day)
+
+        self.assertEqual(incremental.keys(), rebuilt.keys())
+        for key in incremental:
+            np.testing.assert_array_equal(incremental[key], rebuilt[key])
+
+    def test_api(self):
+        """Test the series and gaps endpoints"""
+        api = Api(self.Session)
+        resp = api.handle('/api/wait_times/542/series?fill=ffill')
+        series = json.loads(resp.body)
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(len(series), 7)
+        self.assertEqual(series[3], {'timestamp': at(6).isoformat(),
+                                     'appt': 4, 'non_appt': 4, 'gap': True})
+        self.assertEqual(
+            api.handle('/api/wait_times/542/series?fill=linear').status, 400)
+
+        resp = api.handle(
+            '/api/wait_times/542/gaps?start=2018-12-03T09:00')
+        self.assertEqual(json.loads(resp.body), [
+            {'start': at(6).isoformat(), 'end': at(10).isoformat(),
+             'minutes': 4.0}])
+        self.assertEqual(api.handle('/api/wait_times/999/gaps').status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
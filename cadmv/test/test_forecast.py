@@ -0,0 +1,132 @@
+"""Tests for the forecast module"""
+import datetime
+import json
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv import forecast
+from cadmv.forecast import Forecaster
+import cadmv.models as models
+from cadmv.test.test_queries import BRANCHES, WAIT_TIMES
+
+
+# A Tuesday
+TUESDAY = datetime.datetime(2018, 12, 4)
+
+
+class ForecasterTest(unittest.TestCase):
+    """Tests fitting, updating and querying the forecasts"""
+
+    def setUp(self):
+        """Generate samples for two branches over four weeks"""
+        rng = random.Random(0)
+        self.samples = []
+        for day in range(28):
+            for minute in range(7 * 60, 17 * 60, 2):
+                at = TUESDAY + datetime.timedelta(days=day, minutes=minute)
+                for number, base in ((542, 30), (537, 10)):
+                    self.samples.append(
+                        (number, at, rng.randint(0, base), rng.randint(0, base)))
+        branch_ids, timestamps, appts, non_appts = zip(*self.samples)
+        self.forecaster = Forecaster.fit(
+            [537, 542], branch_ids, timestamps, appts, non_appts)
+
+    def test_bucket_of(self):
+        """Test that the vectorized buckets match bucket_of()"""
+        times = [TUESDAY + datetime.timedelta(minutes=m)
+                 for m in range(0, 7 * 24 * 60, 7)]
+        self.assertEqual(forecast.buckets_of(times).tolist(),
+                         [forecast.bucket_of(t) for t in times])
+
+    def test_fit_medians(self):
+        """Test that the fitted profile is the median of each bucket"""
+        at = TUESDAY.replace(hour=10, minute=30)
+        bucket = forecast.bucket_of(at)
+        waits = [na for n, t, _, na in self.samples
+                 if n == 542 and forecast.bucket_of(t) == bucket]
+
+        self.assertEqual(self.forecaster.forecast(542, at), np.median(waits))
+        self.assertIsNone(self.forecaster.forecast(542, TUESDAY.replace(hour=3)))
+        self.assertIsNone(self.forecaster.forecast(999, at))
+
+    def test_update(self):
+        """Test that a scrape moves the medians a step and corrects the rest
+        of the same day
+        """
+        at = TUESDAY + datetime.timedelta(days=28, hours=10)
+        later = at + datetime.timedelta(hours=1)
+        before = self.forecaster.forecast(542, at, 'appt')
+        tomorrow = self.forecaster.forecast(
+            542, later + datetime.timedelta(days=1), 'appt')
+
+        self.forecaster.update([
+            {'branch_id': 542, 'appt': 100, 'non_appt': 100, 'timestamp': at},
+            {'branch_id': 999, 'appt': 100, 'non_appt': 100, 'timestamp': at},
+        ])
+
+        self.assertGreater(self.forecaster.forecast(542, at, 'appt'),
+                           before + forecast.STEP)
+        profile = self.forecaster.medians[
+            self.forecaster.positions[542], forecast.bucket_of(later), 0]
+        self.assertGreater(self.forecaster.forecast(542, later, 'appt'),
+                           profile)
+        self.assertEqual(self.forecaster.forecast(
+            542, later + datetime.timedelta(days=1), 'appt'), tomorrow)
+
+    def test_forecast_all(self):
+        """Test that the vectorized forecasts match forecast()"""
+        at = TUESDAY.replace(hour=11)
+        self.forecaster.update([{'branch_id': 537, 'appt': 50,
+                                 'non_appt': 50, 'timestamp': at}])
+        later = at + datetime.timedelta(minutes=40)
+
+        np.testing.assert_allclose(
+            self.forecaster.forecast_all(later),
+            [self.forecaster.forecast(n, later) for n in (537, 542)],
+            rtol=1e-6)
+
+    def test_save_load(self):
+        """Test that a saved forecaster loads back the same"""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'forecast.npz')
+            self.assertIsNone(Forecaster.load(path))
+            self.forecaster.save(path)
+            loaded = Forecaster.load(path)
+
+        np.testing.assert_array_equal(loaded.medians, self.forecaster.medians)
+        self.assertEqual(loaded.positions, self.forecaster.positions)
+
+    def test_api(self):
+        """Test the forecast endpoint"""
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.add_all([models.WaitTime(**w) for w in WAIT_TIMES])
+        session.commit()
+        session.close()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'forecast.npz')
+            self.forecaster.save(path)
+            api = Api(Session, forecast_path=path)
+            resp = api.handle('/api/forecast/542?at=2018-12-04T10:30')
+            missing = api.handle('/api/forecast/999')
+
+        data = json.loads(resp.body)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(data['non_appt'], round(self.forecaster.forecast(
+            542, TUESDAY.replace(hour=10, minute=30)), 1))
+        self.assertEqual(missing.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+"""Tests for the catalog and geo modules"""
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+from cadmv.catalog import Catalog
+from cadmv import geo
+import cadmv.helper.data
+from cadmv import services
+import offices
+
+
+class BranchIndexTest(unittest.TestCase):
+    """Tests the spatial index against a brute force search over the real
+    branch catalog
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.catalog = Catalog(cadmv.helper.data.prep_branches_data())
+        cls.index = geo.BranchIndex(cls.catalog)
+
+    def brute_force(self, lat, lon, k, max_km=None):
+        distances = geo.haversine(
+            lat, lon, self.catalog.latitudes, self.catalog.longitudes)
+        order = np.argsort(distances, kind='stable')
+        if max_km is not None:
+            order = order[distances[order] <= max_km]
+        return [int(self.catalog.numbers[p]) for p in order[:k]]
+
+    def test_haversine(self):
+        """Test the distance between Los Angeles and San Francisco"""
+        km = geo.haversine(34.0522, -118.2437, 37.7749, -122.4194)
+        self.assertAlmostEqual(float(km), 559, delta=1)
+
+    def test_nearest_matches_brute_force(self):
+        """Test that the index finds the same branches as a brute force
+        search, in the same order
+        """
+        rng = random.Random(0)
+        for _ in range(200):
+            lat, lon = rng.uniform(32, 42.5), rng.uniform(-124.5, -114)
+            k = rng.randint(1, 10)
+            found = [n.number for n in self.index.nearest(lat, lon, k)]
+            self.assertEqual(found, self.brute_force(lat, lon, k))
+
+    def test_nearest_max_km(self):
+        """Test that branches further than max_km are left out"""
+        lat, lon = 33.7454, -117.8506  # Santa Ana
+        found = self.index.nearest_branches(lat, lon, k=50, max_km=15)
+
+        self.assertEqual([n for n, _ in found],
+                         self.brute_force(lat, lon, 50, max_km=15))
+        self.assertTrue(all(km <= 15 for _, km in found))
+
+    def test_nearest_mask(self):
+        """Test that only branches allowed by the mask are returned"""
+        mask = self.catalog.regions == 1
+        found = self.index.nearest(33.7454, -117.8506, k=3, mask=mask)
+
+        self.assertEqual(len(found), 3)
+        self.assertTrue(all(self.catalog.regions[n.position] == 1
+                            for n in found))
+
+    def test_nearest_offering_services(self):
+        """Test that the services of offices.py are loaded into the catalog
+        and select the same branches as their flags
+        """
+        mask = services.parse('cdl,vr')
+        expected = sorted(o['number'] for o in offices.original_offices
+                          if o['cCDL'] and o['cVR'])
+        found = self.index.nearest(33.7454, -117.8506, k=500,
+                                   mask=self.catalog.offering(mask))
+
+        self.assertTrue(expected)
+        self.assertEqual(sorted(n.number for n in found), expected)
+        self.assertEqual(services.names(mask), ['vr', 'cdl'])
+        with self.assertRaises(ValueError):
+            services.parse('cdl,passports')
+
+    def test_best_branches_near(self):
+        """Test that nearby branches are ranked by their wait time"""
+        lat, lon = 33.7454, -117.8506
+        numbers = self.brute_force(lat, lon, 3)
+        wait_times = {n: (0, 30 - 10 * i) for i, n in enumerate(numbers)}
+        ranked = geo.best_branches_near(
+            self.index, wait_times, lat, lon, k=3, max_km=100)
+
+        self.assertEqual([n.number for n, _, _ in ranked], numbers[::-1])
+
+
+class NeighbourGraphTest(unittest.TestCase):
+    """Tests the neighbour graph"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.catalog = Catalog(cadmv.helper.data.prep_branches_data())
+
+    def test_distance_matrix(self):
+        """Test that the matrix is symmetric with a zero diagonal"""
+        matrix = geo.distance_matrix(
+            self.catalog.latitudes, self.catalog.longitudes)
+
+        self.assertEqual(matrix.shape, (len(self.catalog),) * 2)
+        np.testing.assert_allclose(matrix, matrix.T)
+        np.testing.assert_allclose(np.diag(matrix), 0)
+
+    def test_neighbour_graph(self):
+        """Test that every branch gets k distinct neighbours other than
+        itself, nearest first
+        """
+        graph = geo.neighbour_graph(self.catalog, k=5)
+
+        self.assertEqual(graph.neighbours.shape, (len(self.catalog), 5))
+        for number, neighbours, distances in zip(*graph):
+            self.assertNotIn(number, neighbours)
+            self.assertEqual(len(set(neighbours)), 5)
+            self.assertTrue(np.all(np.diff(distances) >= 0))
+
+    def test_nearby_lists(self):
+        """Test that a branch without a location has no neighbours and is no
+        branch's neighbour
+        """
+        rows = [dict(r) for r in cadmv.helper.data.prep_branches_data()]
+        rows[0]['latitude'] = rows[0]['longitude'] = None
+        catalog = Catalog(rows)
+        lost = rows[0]['number']
+
+        nearby = geo.nearby_lists(geo.neighbour_graph(catalog, k=5))
+
+        self.assertEqual(nearby[lost], [])
+        self.assertEqual(len(nearby), len(catalog))
+        self.assertTrue(all(lost not in neighbours and len(neighbours) == 5
+                            for number, neighbours in nearby.items()
+                            if number != lost))
+
+    def test_cached_graph(self):
+        """Test that the graph is cached per catalog version"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            graph = geo.load_neighbour_graph(self.catalog, 3, cache_dir)
+            path = geo.graph_path(cache_dir, self.catalog, 3)
+            cached = geo.load_neighbour_graph(self.catalog, 3, cache_dir)
+
+            self.assertTrue(os.path.exists(path))
+            np.testing.assert_array_equal(graph.neighbours, cached.neighbours)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""Tests for the heatmap module and the heatmaps kept by the ingest path"""
+import datetime
+import json
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv import heatmap
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.test.test_queries import BRANCHES
+
+
+# A Monday morning, when both test branches are open
+MONDAY = datetime.datetime(2018, 12, 3, 9)
+
+
+class HeatmapTest(unittest.TestCase):
+    """Tests the heatmaps kept by the ingest path and their API"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database and ingest two weeks of Monday
+        and Tuesday mornings
+        """
+        self.engine = engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+        self.ingestor = ingestor = Ingestor(self.Session)
+        self.samples = []
+        for day in (0, 1, 7, 8):
+            for minutes in range(0, 120, 30):
+                at = MONDAY + datetime.timedelta(days=day, minutes=minutes)
+                waits = {542: day + minutes, 537: 5}
+                ingestor.ingest([
+                    {'branch_id': number, 'appt': wait, 'non_appt': 2 * wait,
+                     'timestamp': at}
+                    for number, wait in waits.items()
+                ])
+                self.samples.append((at, waits[542]))
+
+    def test_incremental_heatmap(self):
+        """Test that the heatmap holds the average of every weekday and hour
+        """
+        data = heatmap.assemble(
+            queries.get_heatmap_cells(self.Session(), branch_num=542))[0]
+
+        self.assertEqual(len(data['appt']), heatmap.DAYS)
+        self.assertEqual(len(data['appt'][0]), heatmap.HOURS)
+        waits = [w for at, w in self.samples
+                 if at.weekday() == 1 and at.hour == 10]
+        self.assertEqual(data['appt'][1][10], sum(waits) / len(waits))
+        self.assertEqual(data['non_appt'][1][10], 2 * sum(waits) / len(waits))
+        self.assertIsNone(data['appt'][2][10])
+
+    def test_rebuild_matches_incremental(self):
+        """Test that rebuilding the cells from the wait times gives the same
+        heatmaps
+        """
+        incremental = heatmap.assemble(queries.get_heatmap_cells(self.Session()))
+        samples = queries.get_open_wait_time_samples(self.Session())
+        branch_ids, appts, non_appts, timestamps = zip(*samples)
+        queries.replace_heatmaps(self.Session(), heatmap.build(
+            branch_ids, timestamps, appts, non_appts))
+
+        self.assertEqual(
+            heatmap.assemble(queries.get_heatmap_cells(self.Session())),
+            incremental)
+
+    def test_failed_ingest(self):
+        """Test that a scrape that fails to store leaves the heatmaps alone,
+        and is counted once when ingested again
+        """
+        at = MONDAY + datetime.timedelta(days=14)
+        wait_times = [{'branch_id': 542, 'appt': 40, 'non_appt': 80,
+                       'timestamp': at}]
+        cells = queries.get_heatmap_cells(self.Session(), branch_num=542)
+        before = {(weekday, hour): count
+                  for _, weekday, hour, count, _, _ in cells}
+
+        sketches = models.WaitTimeSketch.__table__
+        sketches.drop(bind=self.engine)
+        with self.assertRaises(Exception):
+            self.ingestor.ingest(wait_times)
+        sketches.create(bind=self.engine)
+        cells = queries.get_heatmap_cells(self.Session(), branch_num=542)
+        self.assertEqual({(weekday, hour): count
+                          for _, weekday, hour, count, _, _ in cells}, before)
+        self.assertEqual(queries.get_latest_timestamp(self.Session()),
+                         self.samples[-1][0])
+
+        self.ingestor.ingest(wait_times)
+        cells = queries.get_heatmap_cells(self.Session(), branch_num=542)
+        after = {(weekday, hour): count
+                 for _, weekday, hour, count, _, _ in cells}
+        self.assertEqual(after[0, 9], before[0, 9] + 1)
+        self.assertEqual(queries.get_sketches(self.Session(), at)[0][2], 1)
+
+    def test_region_api(self):
+        """Test that a region's heatmaps come in one response"""
+        api = Api(self.Session)
+        resp = api.handle('/api/heatmaps/region/7')
+        data = json.loads(resp.body)
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual([h['number'] for h in data], [542])
+        self.assertEqual(data[0]['appt'][0][9], (0 + 30 + 7 + 37) / 4)
+        self.assertEqual(api.handle('/api/heatmaps/region/99').status, 404)
+        self.assertEqual(api.handle('/api/heatmaps/537').status, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
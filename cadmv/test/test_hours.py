@@ -0,0 +1,206 @@
+"""Tests for the hours module"""
+import datetime
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.catalog import Catalog
+from cadmv import hours
+from cadmv.models import Base, Branch, WaitTime, add_missing_columns
+import cadmv.queries as queries
+import cadmv.schedule as schedule
+from cadmv.test.test_queries import BRANCHES
+
+
+# A Monday
+MONDAY = datetime.datetime(2018, 12, 3)
+
+
+class ParseHoursTest(unittest.TestCase):
+    """Tests parsing the hours strings and disclaimers"""
+
+    def test_parse_hours(self):
+        """Test that the hours are parsed into minutes, Monday first"""
+        days = hours.parse_hours(
+            '0800-1700,0800-1700,0900-1700,0800-1700,0800-1700,n,n')
+
+        self.assertEqual(days[0], [(480, 1020)])
+        self.assertEqual(days[2], [(540, 1020)])
+        self.assertEqual(days[5], [])
+        self.assertEqual(hours.format_hours(days),
+                         '0800-1700,0800-1700,0900-1700,0800-1700,0800-1700,n,n')
+
+    def test_parse_hours_malformed(self):
+        """Test that malformed hours raise a ValueError"""
+        with self.assertRaises(ValueError):
+            hours.parse_hours('0800-1700,n')
+        with self.assertRaises(ValueError):
+            hours.parse_hours('8-17,n,n,n,n,n,n')
+
+    def test_parse_closure(self):
+        """Test the wordings of the closure disclaimers"""
+        daily = ','.join(['1200-1315'] * 7)
+        self.assertEqual(hours.parse_closure(
+            'This office is closed 12:00 Noon through 1:15 PM daily'), daily)
+        self.assertEqual(hours.parse_closure(
+            'The Weaverville office is closed daily from 12:00-1:15 p.m. for '
+            'lunch.'), daily)
+        self.assertEqual(hours.parse_closure(
+            'This office is closed 12:00 Noon through 1:15 PM on Tuesdays.'),
+            'n,1200-1315,n,n,n,n,n')
+        self.assertIsNone(hours.parse_closure(
+            'Appointments are not available at this office.'))
+
+    def test_closures_from_disclaimers(self):
+        """Test that only closures in the hours section are combined"""
+        disclaimers = [
+            {'section': 'hours', 'english': 'This office is closed 12:00 '
+                                            'Noon through 1:15 PM on Tuesdays.'},
+            {'section': 'services', 'english': 'This office is closed 12:00 '
+                                               'Noon through 1:15 PM daily'},
+        ]
+        self.assertEqual(hours.closures_from_disclaimers(disclaimers),
+                         'n,1200-1315,n,n,n,n,n')
+        self.assertIsNone(hours.closures_from_disclaimers([]))
+
+    def test_weekdays_of(self):
+        """Test that the vectorized weekdays match datetime.weekday()"""
+        days = [datetime.date(1969, 12, 25) + datetime.timedelta(days=i)
+                for i in range(14)]
+        self.assertEqual(
+            hours.weekdays_of(np.array(days, dtype='datetime64[D]')).tolist(),
+            [day.weekday() for day in days])
+
+
+class OpeningHoursTest(unittest.TestCase):
+    """Tests the compiled opening hours"""
+
+    def setUp(self):
+        branches = [dict(b) for b in BRANCHES]
+        branches[0]['closures'] = ','.join(['1200-1315'] * 7)
+        self.catalog = Catalog(branches)
+        self.hours = hours.OpeningHours(self.catalog)
+
+    def test_open_at(self):
+        """Test which branches are open on Monday, when 537 opens at 0800
+        and 542 at 0700 and closes for lunch
+        """
+        at = MONDAY.replace
+        self.assertEqual(self.hours.open_numbers(at(hour=6, minute=59)), [])
+        self.assertEqual(self.hours.open_numbers(at(hour=7, minute=30)), [542])
+        self.assertEqual(self.hours.open_numbers(at(hour=9)), [537, 542])
+        self.assertEqual(self.hours.open_numbers(at(hour=12, minute=30)),
+                         [537])
+        self.assertEqual(self.hours.open_numbers(at(hour=17)), [])
+        saturday = MONDAY + datetime.timedelta(days=5, hours=10)
+        self.assertEqual(self.hours.open_numbers(saturday), [])
+
+    def test_open_mask(self):
+        """Test that the vectorized mask agrees with is_open()"""
+        pairs = [
+            (number, MONDAY + datetime.timedelta(minutes=minutes))
+            for number in (537, 542, 999)
+            for minutes in range(0, 7 * 24 * 60, 37)
+        ]
+        mask = self.hours.open_mask(*zip(*pairs))
+
+        self.assertEqual(mask.tolist(),
+                         [self.hours.is_open(n, t) for n, t in pairs])
+        self.assertTrue(mask.any())
+
+    def test_is_open_clause(self):
+        """Test filtering the stored wait times on the open branches, and
+        backfilling WaitTime.is_open
+        """
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        session.add_all([Branch(**b) for b in BRANCHES])
+        at = MONDAY.replace(hour=7, minute=30)
+        session.add_all([
+            WaitTime(branch_id=537, appt=0, non_appt=0, timestamp=at),
+            WaitTime(branch_id=542, appt=5, non_appt=9, timestamp=at),
+        ])
+        session.commit()
+
+        numbers = [wt.branch_id for wt in session.query(WaitTime).filter(
+            self.hours.is_open_clause(at, WaitTime.branch_id))]
+        self.assertEqual(numbers, [542])
+
+        self.assertEqual(
+            queries.update_is_open(Session(), self.hours, batch_size=1), 2)
+        flags = dict(session.query(WaitTime.branch_id, WaitTime.is_open))
+        self.assertEqual(flags, {537: False, 542: True})
+
+    def test_add_missing_columns(self):
+        """Test that the columns added since a database was created, like
+        closures and is_open, are added to its tables, once
+        """
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                'CREATE TABLE branches (id INTEGER PRIMARY KEY, '
+                'name VARCHAR(64), number INTEGER, hours VARCHAR(64))')
+            conn.exec_driver_sql(
+                'CREATE TABLE wait_times (id INTEGER PRIMARY KEY, '
+                'appt INTEGER, branch_id INTEGER, non_appt INTEGER, '
+                '"timestamp" DATETIME)')
+            conn.exec_driver_sql(
+                'INSERT INTO wait_times VALUES (1, 5, 542, 10, '
+                "'2018-12-06 23:22:13.000000')")
+
+        added = add_missing_columns(engine)
+        self.assertLessEqual({'branches.closures', 'wait_times.is_open'},
+                             set(added))
+        self.assertEqual(add_missing_columns(engine), [])
+        wait_times = queries.get_wait_times_by_range(
+            sessionmaker(bind=engine)(), 542)
+        self.assertEqual([(wt.appt, wt.is_open) for wt in wait_times],
+                         [(5, None)])
+
+
+class ScheduleTest(unittest.TestCase):
+    """Tests scheduling the scrapes around the opening hours"""
+
+    def setUp(self):
+        self.hours = hours.OpeningHours(Catalog(BRANCHES))
+
+    def test_next_opening(self):
+        """Test the next opening from within, before and after the hours,
+        wrapping around the end of the week
+        """
+        at = MONDAY.replace
+        self.assertEqual(self.hours.next_opening(at(hour=9, second=30)),
+                         at(hour=9))
+        self.assertEqual(self.hours.next_opening(at(hour=5)), at(hour=7))
+        friday = MONDAY + datetime.timedelta(days=4, hours=18)
+        self.assertEqual(self.hours.next_opening(friday),
+                         MONDAY + datetime.timedelta(days=7, hours=7))
+
+    def test_next_run(self):
+        """Test the full rate while open, the heartbeat overnight and waking
+        up before the first opening
+        """
+        at = MONDAY.replace
+        self.assertTrue(schedule.is_active(self.hours, at(hour=6, minute=55)))
+        self.assertFalse(schedule.is_active(self.hours, at(hour=6)))
+
+        self.assertEqual(schedule.next_run(self.hours, at(hour=10)),
+                         at(hour=10, minute=2))
+        self.assertEqual(schedule.next_run(self.hours, at(hour=1)),
+                         at(hour=1, minute=30))
+        self.assertEqual(schedule.next_run(self.hours, at(hour=6, minute=40)),
+                         at(hour=6, minute=50))
+
+    def test_heartbeat_due(self):
+        """Test that one cron run per heartbeat is due"""
+        due = [schedule.heartbeat_due(MONDAY + datetime.timedelta(minutes=m))
+               for m in range(0, 60, 2)]
+        self.assertEqual(due.count(True), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
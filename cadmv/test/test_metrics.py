@@ -0,0 +1,107 @@
+"""Tests for the metrics module"""
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.ingest import Ingestor
+from cadmv import metrics
+import cadmv.models as models
+from cadmv.test.test_anomaly import scrape
+from cadmv.test.test_queries import BRANCHES
+
+
+class MetricsTest(unittest.TestCase):
+    """Tests recording and exporting the metrics"""
+
+    def setUp(self):
+        metrics.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_disabled(self):
+        """Test that nothing is recorded while the metrics are disabled"""
+        metrics.disable()
+        with metrics.span('cadmv_fetch_seconds'):
+            pass
+        metrics.increment('cadmv_rows_written_total', 3, table='wait_times')
+        self.assertEqual(metrics.render(), '')
+
+    def test_render(self):
+        """Test the Prometheus text format of counters and histograms"""
+        metrics.increment('cadmv_rows_written_total', 3, table='wait_times')
+        metrics.increment('cadmv_rows_written_total', 2, table='wait_times')
+        metrics.observe('cadmv_fetch_seconds', 0.003)
+        metrics.observe('cadmv_fetch_seconds', 20)
+        text = metrics.render()
+
+        self.assertIn('# TYPE cadmv_rows_written_total counter\n', text)
+        self.assertIn('cadmv_rows_written_total{table="wait_times"} 5\n',
+                      text)
+        self.assertIn('# TYPE cadmv_fetch_seconds histogram\n', text)
+        self.assertIn('cadmv_fetch_seconds_bucket{le="0.0025"} 0\n', text)
+        self.assertIn('cadmv_fetch_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('cadmv_fetch_seconds_bucket{le="10.0"} 1\n', text)
+        self.assertIn('cadmv_fetch_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('cadmv_fetch_seconds_sum 20.003\n', text)
+        self.assertIn('cadmv_fetch_seconds_count 2\n', text)
+
+    def test_span_times_errors(self):
+        """Test that a span records the blocks that raise"""
+        with self.assertRaises(ValueError):
+            with metrics.span('cadmv_parse_seconds'):
+                raise ValueError
+        self.assertIn('cadmv_parse_seconds_count 1\n', metrics.render())
+
+    def test_write_and_serve(self):
+        """Test that the metrics are written to a file and served on
+        /metrics
+        """
+        metrics.increment('cadmv_scrapes_total', outcome='stored')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cadmv.prom')
+            metrics.write(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), metrics.render())
+
+        server = metrics.serve(port=0)
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(
+                    f'http://127.0.0.1:{port}/metrics') as resp:
+                self.assertEqual(resp.read().decode(), metrics.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_ingest(self):
+        """Test the spans and counters of the ingest path"""
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+        # 542 opens at 7 on Mondays and 537 at 8
+        Ingestor(Session).ingest(scrape(-90, {537: 0, 542: 5}))
+        text = metrics.render()
+
+        self.assertIn('cadmv_rows_written_total{table="wait_times"} 2\n', text)
+        self.assertIn('cadmv_rows_written_total{table="snapshots"} 1\n', text)
+        self.assertIn('cadmv_rows_skipped_total{reason="closed"} 1\n', text)
+        self.assertIn('cadmv_rows_skipped_total{reason="flagged"} 0\n', text)
+        self.assertIn(
+            'cadmv_db_write_seconds_count{query="create_snapshot"} 1\n', text)
+        self.assertIn('cadmv_db_commit_seconds_count', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,187 @@
+"""Tests for the normalized layout of the wait times"""
+import datetime
+import unittest
+
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.catalog import Catalog
+from cadmv import dmv
+from cadmv.hours import OpeningHours
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+from cadmv import normalized
+import cadmv.queries as queries
+from cadmv.records import Scrape, WaitTimeRecord
+from cadmv.test.test_anomaly import MONDAY, scrape
+from cadmv.test.test_queries import BRANCHES, WAIT_TIMES
+
+
+def engine_with_branches(normalize=False):
+    """Creates an in-memory database holding the test branches"""
+    engine = create_engine('sqlite://')
+    if normalize:
+        normalized.create(engine)
+    else:
+        models.Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([models.Branch(**b) for b in BRANCHES])
+    session.commit()
+    session.close()
+    return engine
+
+
+class NormalizedTest(unittest.TestCase):
+    """Tests writing and reading the wait times in the normalized layout"""
+
+    def setUp(self):
+        self.engine = engine_with_branches(normalize=True)
+        self.Session = sessionmaker(bind=self.engine)
+
+    def test_ingest(self):
+        """Test that scrapes are stored as one snapshot and its readings, and
+        read back through the wait_times view
+        """
+        ingestor = Ingestor(self.Session)
+        for i in range(3):
+            wait_times = scrape(2 * i, {537: 10 + i, 542: 20 + i})
+            ingestor.ingest(Scrape(
+                [WaitTimeRecord(**wt) for wt in wait_times],
+                source_hash=f'{i:064x}', feed_time=MONDAY))
+
+        self.assertTrue(normalized.is_normalized(self.Session()))
+        self.assertIn('wait_times',
+                      inspect(self.engine).get_view_names())
+        current = queries.get_current_wait_times(self.Session())
+        self.assertEqual([(wt.branch_id, wt.appt) for wt in current],
+                         [(537, 12), (542, 22)])
+        wait_times = queries.get_wait_times_by_range(
+            self.Session(), 542, MONDAY + datetime.timedelta(minutes=1))
+        self.assertEqual([wt.appt for wt in wait_times], [21, 22])
+        self.assertTrue(all(wt.is_open for wt in wait_times))
+
+        session = self.Session()
+        snapshots = session.query(models.Snapshot)\
+            .order_by(models.Snapshot.id).all()
+        self.assertEqual(snapshots[2].source_hash, f'{2:064x}')
+        self.assertEqual(snapshots[2].feed_time, MONDAY)
+        self.assertEqual(session.query(normalized.readings).filter(
+            normalized.readings.c.snapshot_id == snapshots[2].id).count(), 2)
+        session.close()
+
+    def test_create_wait_times(self):
+        """Test that wait times stored without a snapshot get one, and that
+        is_open is updated on the readings
+        """
+        queries.create_wait_times(self.Session(), WAIT_TIMES)
+        queries.create_wait_time(self.Session(), dict(
+            WAIT_TIMES[0], timestamp=MONDAY))
+
+        session = self.Session()
+        self.assertEqual(session.query(models.Snapshot.id,
+                                       models.Snapshot.changes)
+                         .order_by(models.Snapshot.id).all(),
+                         [(-1, None), (0, None)])
+        session.close()
+        self.assertEqual(queries.update_is_open(
+            self.Session(), OpeningHours(Catalog(BRANCHES)), batch_size=2), 3)
+        wait_times = queries.get_wait_times_by_range(self.Session(), 542)
+        self.assertEqual([(wt.timestamp, wt.is_open) for wt in wait_times],
+                         [(MONDAY, True),
+                          (WAIT_TIMES[0]['timestamp'], False)])
+
+
+class NormalizeTest(unittest.TestCase):
+    """Tests moving a database to the normalized layout"""
+
+    def test_normalize(self):
+        """Test that the wait times keep their ids and read back the same,
+        and that scrapes without a snapshot get one
+        """
+        engine = engine_with_branches()
+        Session = sessionmaker(bind=engine)
+        queries.create_wait_times(Session(), WAIT_TIMES)
+        Ingestor(Session).ingest(scrape(0, {537: 1, 542: 2}))
+        before = [(wt.id, wt.branch_id, wt.appt, wt.timestamp, wt.is_open)
+                  for wt in queries.get_wait_times_by_range(Session(), 542)]
+        self.assertFalse(normalized.is_normalized(Session()))
+
+        version = queries.get_latest_snapshot_version(Session())
+        self.assertEqual(normalized.normalize(engine), (1, 4))
+
+        self.assertTrue(normalized.is_normalized(Session()))
+        after = [(wt.id, wt.branch_id, wt.appt, wt.timestamp, wt.is_open)
+                 for wt in queries.get_wait_times_by_range(Session(), 542)]
+        self.assertEqual(after, before)
+        self.assertEqual(queries.get_latest_timestamp(Session()),
+                         WAIT_TIMES[0]['timestamp'])
+        Ingestor(Session).ingest(scrape(4 * 24 * 60, {537: 3, 542: 4}))
+        self.assertEqual(
+            [wt.appt for wt in queries.get_current_wait_times(Session())],
+            [3, 4])
+
+        # The backfilled snapshot is numbered below the scrapes and has no
+        # diff, so only a client from before it gets the full snapshot
+        self.assertEqual(queries.get_latest_snapshot_version(Session()),
+                         version + 1)
+        changes = queries.get_changes_since(Session(), version)
+        self.assertEqual((changes['full'], changes['changed']),
+                         (False, [[537, 3, 3], [542, 4, 4]]))
+        changes = queries.get_changes_since(Session(), version - 2)
+        self.assertEqual((changes['full'], len(changes['added'])), (True, 2))
+
+    def test_add_missing_columns(self):
+        """Test that the columns added since a database was created are
+        added to its tables, once
+        """
+        engine = create_engine('sqlite://')
+        with engine.begin() as conn:
+            conn.exec_driver_sql(
+                'CREATE TABLE branches (id INTEGER PRIMARY KEY, '
+                'name VARCHAR(64), number INTEGER, hours VARCHAR(64))')
+            conn.exec_driver_sql(
+                'CREATE TABLE wait_times (id INTEGER PRIMARY KEY, '
+                'appt INTEGER, branch_id INTEGER, non_appt INTEGER, '
+                '"timestamp" DATETIME)')
+            conn.exec_driver_sql(
+                'CREATE TABLE snapshots (id INTEGER PRIMARY KEY, '
+                'fetched_at DATETIME, changes TEXT)')
+            conn.exec_driver_sql(
+                'INSERT INTO wait_times VALUES (1, 5, 542, 10, '
+                "'2018-12-06 23:22:13.000000')")
+
+        added = normalized.add_missing_columns(engine)
+        self.assertEqual(set(added), {
+            'branches.closures', 'branches.services', 'branches.address',
+            'branches.latitude', 'branches.longitude', 'branches.nearby1',
+            'branches.nearby2', 'branches.nearby3', 'branches.nearby4',
+            'branches.nearby5', 'branches.region', 'branches.timestamp',
+            'wait_times.is_open', 'wait_times.flags', 'snapshots.flags',
+            'snapshots.source_hash', 'snapshots.feed_time'})
+        self.assertEqual(normalized.add_missing_columns(engine), [])
+        wait_times = queries.get_wait_times_by_range(
+            sessionmaker(bind=engine)(), 542)
+        self.assertEqual([(wt.appt, wt.is_open, wt.flags)
+                          for wt in wait_times], [(5, None, None)])
+
+
+class FeedTimeTest(unittest.TestCase):
+    """Tests reading the time the feed reports"""
+
+    def test_feed_time(self):
+        """Test that Last-Modified is preferred to Date, and that a missing
+        or malformed header is None
+        """
+        utc = datetime.datetime(2018, 12, 3, 17, tzinfo=datetime.timezone.utc)
+        local = utc.astimezone().replace(tzinfo=None)
+        self.assertEqual(dmv.feed_time({
+            'Last-Modified': 'Mon, 03 Dec 2018 17:00:00 GMT',
+            'Date': 'Mon, 03 Dec 2018 17:01:00 GMT'}), local)
+        self.assertEqual(dmv.feed_time({
+            'Date': 'Mon, 03 Dec 2018 17:00:00 GMT'}), local)
+        self.assertIsNone(dmv.feed_time({'Date': 'yesterday'}))
+        self.assertIsNone(dmv.feed_time({}))
+
+
+if __name__ == '__main__':
+    unittest.main()
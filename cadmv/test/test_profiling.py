@@ -0,0 +1,113 @@
+"""Tests for the profiling module"""
+import datetime
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import cadmv.async_queries as async_queries
+from cadmv import profiling
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv.test.test_queries import BRANCHES, WAIT_TIMES
+
+
+class ProfilingTest(unittest.TestCase):
+    """Tests profiling the statements of an engine"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database"""
+        self.engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+    def test_normalize(self):
+        """Test that statements differing in literals and list lengths
+        normalize alike
+        """
+        self.assertEqual(
+            profiling.normalize("SELECT *\n  FROM t WHERE a = 'x''y' AND "
+                                "b IN (?, ?, ?) AND c > 12.5 AND d2 = ?"),
+            'SELECT * FROM t WHERE a = ? AND b IN (?...) AND c > ? '
+            'AND d2 = ?')
+        self.assertEqual(
+            profiling.normalize('SELECT 1 FROM t WHERE b IN (%(b_1)s)'),
+            profiling.normalize('SELECT 2 FROM t WHERE b IN '
+                                '(%(b_1)s, %(b_2)s)'))
+
+    def test_attribution(self):
+        """Test that the statements are keyed by the query function that
+        ran them and that detaching stops the profiling
+        """
+        with profiling.Profiler(self.engine, threshold=None) as profiler:
+            queries.create_wait_times(self.Session(), WAIT_TIMES)
+            for _ in range(3):
+                queries.get_branch_by_number(self.Session(), 542)
+            with self.engine.connect() as conn:
+                conn.exec_driver_sql('SELECT 1')
+        queries.get_branch_by_number(self.Session(), 542)
+
+        rows = {(row['function'], row['statement'].split()[0]): row
+                for row in profiler.to_dict()}
+        self.assertEqual(rows[('get_branch_by_number', 'SELECT')]['calls'], 3)
+        self.assertIn(('create_wait_times', 'INSERT'), rows)
+        self.assertIn(('<other>', 'SELECT'), rows)
+        self.assertIn('get_branch_by_number', profiler.report())
+
+    def test_slow_statement_logged_with_plan(self):
+        """Test that statements above the threshold are logged with their
+        plan
+        """
+        with profiling.Profiler(self.engine, threshold=0):
+            with self.assertLogs('cadmv.profiling', 'WARNING') as logs:
+                queries.get_wait_time_by_date(
+                    self.Session(), datetime.datetime(2018, 12, 6))
+        self.assertIn('Slow statement in get_wait_time_by_date',
+                      logs.output[0])
+        self.assertIn('SCAN wait_times', logs.output[0])
+
+
+class AsyncProfilingTest(unittest.IsolatedAsyncioTestCase):
+    """Tests profiling the statements of an async engine"""
+
+    async def asyncSetUp(self):
+        """Setup an in-memory aiosqlite database"""
+        self.engine = create_async_engine(
+            'sqlite+aiosqlite://', poolclass=StaticPool)
+        async with self.engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        self.Session = sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False)
+        async with self.Session() as session:
+            session.add_all([models.Branch(**b) for b in BRANCHES])
+            await session.commit()
+
+    async def asyncTearDown(self):
+        await self.engine.dispose()
+
+    async def test_attribution(self):
+        """Test that the statements of the async queries, which run in
+        greenlets, are keyed by the query function that ran them
+        """
+        with profiling.Profiler(self.engine, threshold=None) as profiler:
+            await async_queries.create_wait_times(self.Session(), WAIT_TIMES)
+            for _ in range(2):
+                await async_queries.get_branch_by_number(self.Session(), 542)
+            async with self.engine.connect() as conn:
+                await conn.exec_driver_sql('SELECT 1')
+
+        rows = {(row['function'], row['statement'].split()[0]): row
+                for row in profiler.to_dict()}
+        self.assertEqual(rows[('get_branch_by_number', 'SELECT')]['calls'], 2)
+        self.assertIn(('create_wait_times', 'INSERT'), rows)
+        self.assertIn(('<other>', 'SELECT'), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ import unittest
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+from cadmv import diff
 import cadmv.models as models
 import cadmv.queries as queries
 
@@ -24,7 +25,8 @@ BRANCHES = [
         'nearby4': 607,
         'nearby5': 607,
         'number': 542,
-        'region': 7
+        'region': 7,
+        'services': 101
     },
     {
         'address': '903 W C St, Alturas, CA 96101',
@@ -38,7 +40,8 @@ BRANCHES = [
         'nearby4': 639,
         'nearby5': 544,
         'number': 537,
-        'region': 1
+        'region': 1,
+        'services': 37
     }
 ]
 
@@ -161,6 +164,47 @@ class UpdateBranchQueriesTest(unittest.TestCase):
         self.assertEqual(branch.address, new_address)
 
 
+class UpdateNearbyQueriesTest(unittest.TestCase):
+    """Tests the bulk update of the nearby columns"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database with the branches"""
+        self.engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=self.engine)
+        Session = sessionmaker(bind=self.engine)
+        self.session = Session()
+        self.session.add_all([models.Branch(**b) for b in BRANCHES])
+        self.session.commit()
+
+    def tearDown(self):
+        """Close the session after each test"""
+        self.session.close()
+
+    def test_update_nearby(self):
+        """Test that the nearby columns of several branches are updated and
+        missing neighbours are stored as 0
+        """
+        queries.update_nearby(self.session, {542: [1, 2, 3, 4, 5], 537: [9]})
+        branches = {b.number: b for b in
+                    self.session.query(models.Branch).all()}
+
+        self.assertEqual(branches[542].nearby5, 5)
+        self.assertEqual(
+            [branches[537].nearby1, branches[537].nearby2], [9, 0])
+
+    def test_update_branch_columns(self):
+        """Test that only the given columns of the branches are updated"""
+        queries.update_branch_columns(self.session, [
+            dict(b, services=0, closures=None, name='x') for b in BRANCHES
+        ], ['services', 'closures'])
+        branches = self.session.query(models.Branch).all()
+
+        self.assertEqual([(b.services, b.closures) for b in branches],
+                         [(0, None)] * len(BRANCHES))
+        self.assertEqual([b.name for b in branches],
+                         [b['name'] for b in BRANCHES])
+
+
 class IsBranchInDatabaseQueriesTest(unittest.TestCase):
     """Tests the is_branch_in_database function"""
 
@@ -347,5 +391,77 @@ class GetWaitTimesByRegionQueriesTest(unittest.TestCase):
         self.assertEqual(len(wt), 0)
 
 
+class GetChangesSinceQueriesTest(unittest.TestCase):
+    """Tests the snapshot diff queries"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database with three snapshots. 542 is
+        changed in the second, 537 is removed in the third and 600 is added
+        in the third
+        """
+        self.engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=self.engine)
+        Session = sessionmaker(bind=self.engine)
+        self.session = Session()
+
+        first = copy.deepcopy(WAIT_TIMES)
+        second = copy.deepcopy(WAIT_TIMES)
+        second[0]['appt'] = 99
+        third = [dict(second[0]), dict(second[0], branch_id=600)]
+        self.states = [{}]
+        for tick, wait_times in enumerate((first, second, third)):
+            for wt in wait_times:
+                wt['timestamp'] += datetime.timedelta(minutes=2 * tick)
+            state = diff.snapshot_state(wait_times)
+            changes = diff.compute_diff(self.states[-1], state)
+            queries.create_snapshot(self.session, wait_times, changes)
+            self.states.append(state)
+
+    def tearDown(self):
+        """Close the session after each test"""
+        self.session.close()
+
+    def test_get_changes_since_merges_diffs(self):
+        """Test that the merged diff takes a client from its version to the
+        latest one
+        """
+        changes = queries.get_changes_since(self.session, 1)
+
+        self.assertEqual(changes['version'], 3)
+        self.assertFalse(changes['full'])
+        self.assertEqual(changes['removed'], [537])
+        self.assertEqual(
+            diff.apply_diff(self.states[1], changes), self.states[3])
+
+    def test_get_changes_since_latest(self):
+        """Test that an up to date client gets an empty diff"""
+        changes = queries.get_changes_since(self.session, 3)
+
+        self.assertEqual(changes['added'] + changes['changed'], [])
+        self.assertEqual(changes['removed'], [])
+
+    def test_get_changes_since_unknown_version(self):
+        """Test that a client without a (valid) version gets the full
+        current snapshot
+        """
+        for version in (None, 99):
+            changes = queries.get_changes_since(self.session, version)
+            self.assertTrue(changes['full'])
+            self.assertEqual(
+                diff.apply_diff({}, changes), self.states[3])
+
+    def test_get_changes_since_without_snapshot(self):
+        """Test that the full snapshot is the latest snapshot's, not newer
+        wait times stored without one
+        """
+        later = dict(WAIT_TIMES[0], appt=1, timestamp=WAIT_TIMES[0][
+            'timestamp'] + datetime.timedelta(hours=1))
+        queries.create_wait_times(self.session, [later])
+        changes = queries.get_changes_since(self.session)
+
+        self.assertEqual(changes['version'], 3)
+        self.assertEqual(diff.apply_diff({}, changes), self.states[3])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,54 @@
+"""Tests for the records module"""
+import datetime
+import unittest
+
+from cadmv.branches import wait_times_to_snapshot
+from cadmv.helper import data
+import cadmv.models as models
+from cadmv.records import BranchRecord, WaitTimeRecord
+
+
+NOW = datetime.datetime(2018, 12, 6, 23, 22, 13)
+
+
+class RecordTest(unittest.TestCase):
+    """Tests that the records read like the dicts they replace"""
+
+    def test_wait_time_record(self):
+        """Test the attribute and the mapping access of a wait time"""
+        wt, = data.prep_wait_times_data([(568, 0, 10)], NOW)
+
+        self.assertIsInstance(wt, WaitTimeRecord)
+        self.assertFalse(hasattr(wt, '__dict__'))
+        self.assertEqual((wt.branch_id, wt['non_appt'], wt.get('is_open')),
+                         (568, 10, None))
+        self.assertEqual(wt, {'branch_id': 568, 'appt': 0, 'non_appt': 10,
+                              'timestamp': NOW, 'is_open': None, 'flags': 0})
+        self.assertEqual(wt.replace(is_open=True).is_open, True)
+        self.assertIsNone(wt.is_open)
+        self.assertEqual(models.WaitTime(**wt).non_appt, 10)
+        with self.assertRaises(KeyError):
+            wt['replace']
+
+    def test_api_edge(self):
+        """Test that the served snapshot is built of plain dicts"""
+        snapshot = wait_times_to_snapshot(
+            data.prep_wait_times_data([(568, 0, 10)], NOW))
+
+        self.assertEqual(snapshot['wait_times'], [
+            {'branch_id': 568, 'appt': 0, 'non_appt': 10,
+             'timestamp': NOW.isoformat()}])
+        self.assertIs(type(snapshot['wait_times'][0]), dict)
+
+    def test_branch_record(self):
+        """Test that unknown fields are refused"""
+        branch = data.prep_branches_data()[0]
+
+        self.assertIsInstance(branch, BranchRecord)
+        self.assertEqual(len(dict(branch)), 14)
+        with self.assertRaises(TypeError):
+            BranchRecord(number=1, phone='555')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Tests for the sketch module and the sketches kept by the ingest path"""
+import datetime
+import json
+import random
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+import cadmv.queries as queries
+from cadmv import sketch
+from cadmv.test.test_queries import BRANCHES
+
+
+# A Monday morning, when both test branches are open
+MONDAY = datetime.datetime(2018, 12, 3, 9)
+
+
+class SketchTest(unittest.TestCase):
+    """Tests building, encoding, merging and reading sketches"""
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.waits = [int(rng.expovariate(1 / 25)) for _ in range(5000)]
+
+    def test_encode_decode(self):
+        """Test that a sketch survives encoding and is stored sparsely"""
+        counts = sketch.histogram([0, 0, 5, 45, 700])
+        blob = sketch.encode(counts)
+
+        self.assertEqual(len(blob), 4 * 3)
+        np.testing.assert_array_equal(sketch.decode(blob), counts)
+        np.testing.assert_array_equal(sketch.decode(b''), 0)
+
+    def test_quantiles(self):
+        """Test that the estimates are within a bucket of the exact
+        percentiles
+        """
+        counts = sketch.histogram(self.waits)
+        for q, estimate in zip((0.1, 0.5, 0.9, 0.99),
+                               sketch.quantiles(counts, (0.1, 0.5, 0.9, 0.99))):
+            exact = np.percentile(self.waits, q * 100)
+            bucket = sketch.buckets_of(exact)
+            width = sketch.UPPER_EDGES[bucket] - sketch.EDGES[bucket]
+            self.assertLessEqual(abs(estimate - exact), width)
+
+        self.assertIsNone(sketch.quantiles(sketch.histogram([]), [0.5]))
+        self.assertEqual(sketch.quantiles(sketch.histogram([900]), [0.5]),
+                         [sketch.MAX_MINUTES])
+
+    def test_merge(self):
+        """Test that merging sketches equals sketching everything at once"""
+        blobs = [sketch.encode(sketch.histogram(self.waits[i:i + 30]))
+                 for i in range(0, len(self.waits), 30)]
+        np.testing.assert_array_equal(sketch.merge(blobs),
+                                      sketch.histogram(self.waits))
+
+    def test_build(self):
+        """Test that the wait times are grouped by branch and hour"""
+        times = [MONDAY + datetime.timedelta(minutes=2 * i) for i in range(60)]
+        built = sketch.build([542] * 60 + [537] * 60, times * 2,
+                             self.waits[:120], self.waits[120:240])
+
+        self.assertEqual(len(built), 4)
+        appt, non_appt = built[542, np.datetime64(MONDAY, 'h')]
+        np.testing.assert_array_equal(appt, sketch.histogram(self.waits[:30]))
+        np.testing.assert_array_equal(
+            non_appt, sketch.histogram(self.waits[120:150]))
+
+
+class IngestSketchTest(unittest.TestCase):
+    """Tests the sketches kept up to date by the ingest path"""
+
+    def setUp(self):
+        """Setup an in-memory SQLite database"""
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+    def ingest(self, ingestor, minutes, waits):
+        ingestor.ingest([
+            {'branch_id': number, 'appt': wait, 'non_appt': wait,
+             'timestamp': MONDAY + datetime.timedelta(minutes=minutes)}
+            for number, wait in waits.items()
+        ])
+
+    def test_ingest_updates_sketches(self):
+        """Test that each scrape is added to the sketch of its hour, also
+        across ingestors, and that closed branches are left out
+        """
+        self.ingest(Ingestor(self.Session), 0, {542: 10, 537: 20})
+        self.ingest(Ingestor(self.Session), 2, {542: 30, 537: 40})
+        self.ingest(Ingestor(self.Session), 60, {542: 50, 537: 60})
+        # Both branches are closed at 23:00
+        self.ingest(Ingestor(self.Session), 14 * 60, {542: 0, 537: 0})
+
+        sketches = queries.get_sketches(self.Session(), branch_num=542)
+        self.assertEqual([(hour.hour, count) for _, hour, count, _, _
+                          in sorted(sketches, key=lambda s: s[1])],
+                         [(9, 2), (10, 1)])
+
+        percentiles = queries.get_wait_time_percentiles(
+            self.Session(), 542, MONDAY, MONDAY + datetime.timedelta(hours=1),
+            percentiles=(0, 100))
+        self.assertEqual(percentiles['count'], 2)
+        self.assertEqual(percentiles['appt'], {'p0': 10, 'p100': 32})
+
+    def test_api(self):
+        """Test the percentiles endpoint"""
+        ingestor = Ingestor(self.Session)
+        for minutes in range(0, 120, 2):
+            self.ingest(ingestor, minutes, {542: minutes // 4, 537: 5})
+
+        resp = Api(self.Session).handle(
+            '/api/wait_times/542/percentiles?start=2018-12-03T10:15')
+        data = json.loads(resp.body)
+
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(data['count'], 30)
+        self.assertAlmostEqual(data['non_appt']['p50'], 22.5, delta=1)
+        self.assertEqual(Api(self.Session).handle(
+            '/api/wait_times/999/percentiles').status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
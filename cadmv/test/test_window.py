@@ -0,0 +1,164 @@
+"""Tests for the window module and its feed from the ingest path"""
+import datetime
+import json
+import unittest
+
+import numpy as np
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from cadmv.api import Api
+from cadmv.catalog import Catalog
+from cadmv.ingest import Ingestor
+import cadmv.models as models
+from cadmv.test.test_anomaly import MONDAY, scrape
+from cadmv.test.test_queries import BRANCHES
+from cadmv.window import RecentWindow
+
+
+DAY = datetime.timedelta(days=1)
+
+
+class RecentWindowTest(unittest.TestCase):
+    """Tests the reads of a RecentWindow"""
+
+    def setUp(self):
+        self.window = RecentWindow(Catalog(BRANCHES), days=2)
+
+    def test_series(self):
+        """Test that a branch's series has its waits by slot and NaN for the
+        slots without one
+        """
+        for minutes in (0, 2, 6):
+            self.window.add(scrape(minutes, {537: minutes, 542: 30}))
+
+        times, values = self.window.series(
+            537, MONDAY, MONDAY + datetime.timedelta(minutes=8))
+        self.assertEqual(times[0], np.datetime64(MONDAY, 'm'))
+        np.testing.assert_array_equal(values, [0, 2, np.nan, 6])
+        self.assertEqual(self.window.latest,
+                         MONDAY + datetime.timedelta(minutes=6))
+        self.assertIsNone(self.window.series(1))
+
+    def test_wraps_around(self):
+        """Test that the slots of the previous lap read as missing once the
+        window moves past them, and that older wait times are dropped
+        """
+        self.window.add(scrape(0, {537: 10}))
+        self.window.add(scrape(2 * 24 * 60 + 2, {537: 20}))
+        self.window.add(scrape(-60, {537: 30}))
+
+        _, values = self.window.matrix()
+        self.assertEqual(np.count_nonzero(~np.isnan(values)), 1)
+        _, values = self.window.series(537, MONDAY + 2 * DAY)
+        self.assertEqual(values[~np.isnan(values)].tolist(), [20])
+
+    def test_region_averages(self):
+        """Test that the averages of a region only take its branches"""
+        self.window.add(scrape(0, {537: 10, 542: 30}))
+
+        _, averages = self.window.region_averages(
+            7, MONDAY - datetime.timedelta(minutes=2))
+        np.testing.assert_array_equal(averages, [np.nan, 30])
+
+    def test_now_vs_typical(self):
+        """Test that the newest waits are compared to the same time of day
+        on the earlier days
+        """
+        self.window.add(scrape(-4, {537: 10, 542: 40}))
+        self.window.add(scrape(4, {537: 20}))
+        self.window.add(scrape(24 * 60, {537: 45, 542: 35}))
+
+        numbers, now, typical = self.window.now_vs_typical()
+        self.assertEqual(numbers.tolist(), [537, 542])
+        np.testing.assert_array_equal(now, [45, 35])
+        np.testing.assert_array_equal(typical, [15, 40])
+
+
+class WindowIngestTest(unittest.TestCase):
+    """Tests that the window is rebuilt from and kept in step with the
+    database
+    """
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+
+    def test_matches_database(self):
+        """Test that a window fed by the ingest path equals one rebuilt from
+        the database, and that sync() catches up with later scrapes
+        """
+        ingestor = Ingestor(self.Session, window_days=1)
+        rebuilt = RecentWindow.from_session(
+            self.Session(), Catalog.from_session(self.Session()), days=1)
+        for i in range(5):
+            ingestor.ingest(scrape(2 * i, {537: 10 + i, 542: 20 + i}))
+            if i == 2:
+                rebuilt.sync(self.Session())
+        ingestor.ingest(scrape(10, {537: 500, 542: 25}))
+        self.assertEqual(rebuilt.sync(self.Session()), 5)
+
+        for kind in ('appt', 'non_appt'):
+            np.testing.assert_array_equal(ingestor.window.values[kind],
+                                          rebuilt.values[kind])
+        np.testing.assert_array_equal(ingestor.window.held, rebuilt.held)
+        self.assertEqual(ingestor.window.latest, rebuilt.latest)
+        # The jump of branch 537 is flagged and left out
+        _, values = rebuilt.series(537, MONDAY)
+        np.testing.assert_array_equal(values[:6],
+                                      [10, 11, 12, 13, 14, np.nan])
+
+
+class WindowApiTest(unittest.TestCase):
+    """Tests the recent endpoints of the read API"""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        models.Base.metadata.create_all(bind=engine)
+        self.Session = sessionmaker(bind=engine)
+        session = self.Session()
+        session.add_all([models.Branch(**b) for b in BRANCHES])
+        session.commit()
+        session.close()
+        self.ingestor = Ingestor(self.Session)
+        for i in range(3):
+            self.ingestor.ingest(scrape(2 * i, {537: 10 + i, 542: 20 + i}))
+
+    def test_recent(self):
+        """Test that the recent reads come from a window that catches up
+        with the scrapes stored after it was built
+        """
+        api = Api(self.Session, window_days=1)
+        since = f'?start={MONDAY.isoformat()}'
+        resp = api.handle('/api/recent/542' + since)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual([slot['appt'] for slot in json.loads(resp.body)],
+                         [20, 21, 22])
+
+        self.ingestor.ingest(scrape(6, {537: 13, 542: 23}))
+        api.invalidate()
+        slots = json.loads(api.handle('/api/recent/542' + since).body)
+        self.assertEqual([slot['appt'] for slot in slots], [20, 21, 22, 23])
+        self.assertEqual(slots[-1]['timestamp'],
+                         (MONDAY + datetime.timedelta(minutes=6)).isoformat())
+        region = json.loads(api.handle('/api/recent/region/7' + since).body)
+        self.assertEqual(region[-1]['non_appt'], 23)
+        typical = json.loads(api.handle('/api/recent/typical').body)
+        self.assertEqual([(b['number'], b['appt'], b['typical_appt'])
+                          for b in typical], [(537, 13, None), (542, 23, None)])
+        self.assertEqual(api.handle('/api/recent/1').status, 404)
+        self.assertEqual(api.handle('/api/recent/region/99').status, 404)
+
+    def test_no_window(self):
+        """Test that the recent endpoints are 404 without a window"""
+        self.assertEqual(Api(self.Session).handle('/api/recent/542').status,
+                         404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+"""In-memory store of the last days of wait times.
+
+Most reads are about the last day or three. A RecentWindow keeps them as one
+ring buffer per kind of wait: a (branches, slots) int16 array with a column
+per SLOT_MINUTES slot of the last few days, so per-branch series, region
+averages and "now vs. typical" comparisons are array slices rather than
+queries. Column c holds the slot whose number (minutes since the epoch //
+slot_minutes) modulo the number of slots is c, and the slot it currently
+holds is tracked, so columns left over from earlier days read as missing.
+
+Like the statistics, the window only holds the usable wait times: the ones
+stored while the branch was open and not flagged as anomalies. It is filled
+from the database once with from_session() and then fed every scrape, by
+the Ingestor in the scraper process or with sync() elsewhere: the read API
+keeps one synced to the latest scrape for its /api/recent endpoints, and
+the async API feeds one with add_samples().
+"""
+from collections.abc import Mapping
+import datetime
+
+import numpy as np
+
+import cadmv.queries as queries
+
+
+KINDS = ('appt', 'non_appt')
+
+# Days kept and the minutes of a slot, about one scrape each
+DAYS = 3
+SLOT_MINUTES = 2
+# Minutes either side of a slot that count towards its typical wait
+TYPICAL_MINUTES = 15
+
+# The int16 of an empty cell
+MISSING = -1
+
+
+def _mean(values, axis):
+    """Averages along an axis, ignoring NaN, with NaN where nothing is left"""
+    present = ~np.isnan(values)
+    counts = present.sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(present, values, 0).sum(axis=axis) / \
+            np.where(counts, counts, np.nan)
+
+
+class RecentWindow:
+    """Ring buffers of the recent wait times of every branch
+
+    :param catalog:         (Catalog) of the branches kept
+    :param days:            (int) days kept
+    :param slot_minutes:    (int) minutes of a slot. A branch keeps one wait
+                            per slot, the last one added
+    """
+
+    def __init__(self, catalog, days=DAYS, slot_minutes=SLOT_MINUTES):
+        self.numbers = catalog.numbers.astype(np.int64)
+        self.regions = catalog.regions
+        self.slot_minutes = slot_minutes
+        self.slots_per_day = 24 * 60 // slot_minutes
+        self.slots = days * self.slots_per_day
+        self.values = {
+            kind: np.full((len(self.numbers), self.slots), MISSING,
+                          dtype=np.int16)
+            for kind in KINDS
+        }
+        # The slot number every column holds, -1 for none
+        self.held = np.full(self.slots, -1, dtype=np.int64)
+        self.newest = -1
+        # The timestamp of the newest wait time added
+        self.latest = None
+
+    @classmethod
+    def from_session(cls, session, catalog, days=DAYS,
+                     slot_minutes=SLOT_MINUTES):
+        """Builds a window holding the last days of stored wait times"""
+        window = cls(catalog, days, slot_minutes)
+        latest = queries.get_latest_timestamp(session)
+        if latest is not None:
+            window.sync(session, latest - datetime.timedelta(days=days))
+        return window
+
+    def sync(self, session, start=None):
+        """Adds the wait times stored after the newest one in the window
+
+        :param session: SQLAlchemy session
+        :param start:   (datetime) inclusive lower bound when the window is
+                        empty, or None for all of them
+        :return:        (int) number of wait times added
+        """
+        samples = queries.get_open_wait_time_samples(
+            session, self.next_start(start))
+        self.add_samples(samples)
+        return len(samples)
+
+    def next_start(self, start=None):
+        """Returns the lower bound of the wait times to sync: just after the
+        newest one in the window, or start when it is empty
+        """
+        if self.latest is not None:
+            return self.latest + datetime.timedelta(microseconds=1)
+        return start
+
+    def add_samples(self, samples):
+        """Adds the (branch_id, appt, non_appt, timestamp) rows of
+        queries.get_open_wait_time_samples()
+        """
+        if samples:
+            branch_ids, appts, non_appts, timestamps = zip(*samples)
+            self.add_columns(branch_ids, timestamps, appts, non_appts)
+
+    def add(self, wait_times):
+        """Adds usable wait times, as dicts, records or models"""
+        rows = [wt if isinstance(wt, Mapping) else vars(wt)
+                for wt in wait_times]
+        if rows:
+            self.add_columns([row['branch_id'] for row in rows],
+                             [row['timestamp'] for row in rows],
+                             [row['appt'] for row in rows],
+                             [row['non_appt'] for row in rows])
+
+    def add_columns(self, branch_ids, timestamps, appts, non_appts):
+        """Adds usable wait times given as columns. Wait times older than
+        the window, or of branches outside the catalog, are dropped
+
+        :param branch_ids:  (sequence) branch number of every wait time
+        :param timestamps:  (sequence) datetime of every wait time
+        :param appts:       (sequence) appointment wait of every wait time
+        :param non_appts:   (sequence) non-appointment wait of every wait time
+        """
+        times = np.array(timestamps, dtype='datetime64[us]')
+        if not len(times):
+            return
+        slots = self.slots_of(times)
+        self.newest = max(self.newest, int(slots.max()))
+        branch_ids = np.asarray(branch_ids, dtype=np.int64)
+        positions = np.searchsorted(self.numbers, branch_ids)
+        keep = (positions < len(self.numbers)) & \
+            (slots > self.newest - self.slots)
+        keep[keep] = self.numbers[positions[keep]] == branch_ids[keep]
+        positions, slots = positions[keep], slots[keep]
+
+        columns = slots % self.slots
+        reused = np.unique(columns[self.held[columns] != slots])
+        for kind, values in zip(KINDS, (appts, non_appts)):
+            values = np.asarray(values, dtype=np.int64)[keep]
+            self.values[kind][:, reused] = MISSING
+            self.values[kind][positions, columns] = np.clip(
+                values, 0, np.iinfo(np.int16).max)
+        self.held[columns] = slots
+
+        latest = times.max().astype(datetime.datetime)
+        if self.latest is None or latest > self.latest:
+            self.latest = latest
+
+    def slots_of(self, timestamps):
+        """Returns the slot numbers of a sequence of datetimes"""
+        minutes = np.array(timestamps, dtype='datetime64[m]').astype(np.int64)
+        return minutes // self.slot_minutes
+
+    def times_of(self, slots):
+        """Returns the starts of slots, as datetime64 minutes"""
+        return (np.asarray(slots) * self.slot_minutes).astype('datetime64[m]')
+
+    def matrix(self, start=None, end=None, kind='non_appt'):
+        """Slices the waits of every branch over a range
+
+        :param start:   (datetime) inclusive lower bound, or None for the
+                        oldest slot of the window
+        :param end:     (datetime) exclusive upper bound, or None for after
+                        the newest slot
+        :param kind:    (str) appt or non_appt
+        :return:        (tuple) of the slot numbers and a (branches, slots)
+                        float array of the waits, NaN where there are none
+        """
+        first = self.newest - self.slots + 1
+        last = self.newest + 1
+        if start is not None:
+            first = max(first, int(self.slots_of([start])[0]))
+        if end is not None:
+            # A slot is in the range if it starts before end
+            micros = int(np.datetime64(end, 'us').astype(np.int64))
+            last = min(last, -(-micros // (self.slot_minutes * 60000000)))
+        slots = np.arange(max(first, 0), max(last, first, 0), dtype=np.int64)
+        columns = slots % self.slots
+        values = self.values[kind][:, columns].astype(np.float64)
+        values[(values == MISSING) | (self.held[columns] != slots)] = np.nan
+        return slots, values
+
+    def series(self, number, start=None, end=None, kind='non_appt'):
+        """Returns the waits of a branch over a range
+
+        :return:    (tuple) of the slot starts (datetime64 minutes) and the
+                    float waits, NaN where there are none, or None if the
+                    branch isn't in the window
+        """
+        position = np.searchsorted(self.numbers, number)
+        if position == len(self.numbers) or self.numbers[position] != number:
+            return None
+        slots, values = self.matrix(start, end, kind)
+        return self.times_of(slots), values[position]
+
+    def region_averages(self, region, start=None, end=None, kind='non_appt'):
+        """Averages the waits of the branches of a region per slot
+
+        :return:    (tuple) of the slot starts (datetime64 minutes) and the
+                    averages, NaN where no branch has a wait
+        """
+        slots, values = self.matrix(start, end, kind)
+        return self.times_of(slots), _mean(values[self.regions == region], 0)
+
+    def now_vs_typical(self, kind='non_appt'):
+        """Compares the newest wait of every branch to its typical wait at
+        that time of day: the average of its waits within TYPICAL_MINUTES of
+        the same time on the earlier days of the window
+
+        :return:    (tuple) of the branch numbers, their waits in the newest
+                    slot and their typical waits, NaN where there are none
+        """
+        slots, values = self.matrix(kind=kind)
+        n = len(self.numbers)
+        if not len(slots):
+            return self.numbers, np.full(n, np.nan), np.full(n, np.nan)
+
+        spread = TYPICAL_MINUTES // self.slot_minutes
+        days = np.arange(1, self.slots // self.slots_per_day + 1)
+        around = (slots[-1] - days[:, None] * self.slots_per_day
+                  + np.arange(-spread, spread + 1)[None, :]).ravel()
+        around = around[around >= slots[0]] - slots[0]
+        return self.numbers, values[:, -1], _mean(values[:, around], 1)
@@ -9,3 +9,25 @@ basedir = os.path.dirname(__file__)
 db_url = "sqlite:////" + os.path.join(basedir, db_filename)
 
 engine = create_engine(db_url, echo=False)  # leave echo=True while developing
+
+# Pre-encoded buffers of the current snapshot, written by the scraper and
+# served by the API. Set to None to have the API render them itself.
+snapshot_path = os.path.join(basedir, "snapshot.zip")
+
+# The same database for the asyncio API server. Use
+# "postgresql+asyncpg://..." (and install asyncpg) for PostgreSQL.
+async_db_url = "sqlite+aiosqlite:////" + os.path.join(basedir, db_filename)
+
+# Directory for caches derived from the database (neighbour graph, ...)
+cache_dir = os.path.join(basedir, "cache")
+
+# Wait time forecasts, fit by bin/forecast.py and updated by the scraper
+forecast_path = os.path.join(cache_dir, "forecast.npz")
+
+# Directory the raw responses of the wait times feed are archived to by the
+# scraper (see cadmv.archive), or None to discard them
+archive_dir = None
+
+# Days of recent wait times kept in memory (see cadmv.window) by the scraper
+# and served by the API's /api/recent endpoints, or None to keep none
+window_days = 3